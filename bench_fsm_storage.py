@@ -0,0 +1,91 @@
+"""
+Замер задержки хранилища FSM на обработку апдейта: MemoryStorage против
+SQLiteStorage (временная БД со схемой create_tables + миграции).
+
+Апдейт имитирует типичный обработчик: get_state, get_data, три update_data
+и set_state. Для SQLiteStorage отдельно показаны сбросы в БД и число
+схлопнутых записей.
+
+    python bench_fsm_storage.py [пользователей] [апдейтов на пользователя]
+"""
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+from aiogram.fsm.storage.base import StorageKey
+from aiogram.fsm.storage.memory import MemoryStorage
+
+from src.database.fsm_storage import SQLiteStorage
+from src.database.models import Database
+from utils.latency_stats import LatencyHistogram
+
+BOT_ID = 1
+
+
+async def simulate_update(storage, key: StorageKey, step: int):
+    await storage.get_state(key)
+    await storage.get_data(key)
+    await storage.update_data(key, {'current_page': step})
+    await storage.update_data(key, {'search_id': f"{step:08x}", 'view': 'list'})
+    await storage.update_data(key, {'last_query': f"запрос {step}"})
+    await storage.set_state(key, 'QuestionStates:waiting_for_search_type')
+
+
+async def run(storage, users: int, updates: int) -> LatencyHistogram:
+    histogram = LatencyHistogram()
+    keys = [StorageKey(bot_id=BOT_ID, chat_id=user_id, user_id=user_id) for user_id in range(1, users + 1)]
+    for step in range(updates):
+        for key in keys:
+            started = time.perf_counter()
+            await simulate_update(storage, key, step)
+            histogram.observe(time.perf_counter() - started)
+        # Пауза между волнами апдейтов: фоновый сброс срабатывает по ходу замера
+        await asyncio.sleep(0.05)
+    return histogram
+
+
+def report(name: str, snapshot: dict):
+    print(
+        f"[BENCH] {name:<14} updates={snapshot['count']:<7} avg={snapshot['avg_ms']:.3f}ms "
+        f"p50={snapshot['p50_ms']:.3f}ms p95={snapshot['p95_ms']:.3f}ms max={snapshot['max_ms']:.3f}ms"
+    )
+
+
+async def main(users: int, updates: int):
+    memory = MemoryStorage()
+    report("MemoryStorage", (await run(memory, users, updates)).snapshot())
+    await memory.close()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        database = Database(os.path.join(tmp_dir, 'fsm.db'))
+        try:
+            await database.create_tables()
+            storage = SQLiteStorage(database.pool)
+            report("SQLiteStorage", (await run(storage, users, updates)).snapshot())
+            await storage.close()
+
+            # Холодный старт: чтение состояний, записанных предыдущим экземпляром
+            cold = SQLiteStorage(database.pool)
+            started = time.perf_counter()
+            for user_id in range(1, users + 1):
+                await cold.get_data(StorageKey(bot_id=BOT_ID, chat_id=user_id, user_id=user_id))
+            print(f"[BENCH] Cold load of {users} records: {(time.perf_counter() - started) * 1000:.1f}ms")
+            await cold.close()
+
+            stats = storage.get_stats()
+            flush = stats['flush_latency']
+            print(
+                f"[BENCH] SQLite writes: changes={stats['changes']} rows_written={stats['rows_written']} "
+                f"coalesced={stats['coalesced']} flushes={stats['flushes']} "
+                f"flush p95={flush['p95_ms']:.1f}ms max={flush['max_ms']:.1f}ms"
+            )
+        finally:
+            await database.close()
+
+
+if __name__ == "__main__":
+    users = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    updates = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    asyncio.run(main(users, updates))
@@ -0,0 +1,346 @@
+"""
+Фоновый движок рассылок.
+
+Рассылка (сообщение или опрос) сохраняется в БД вместе со списком
+получателей и отправляется фоновой задачей: ограниченный пул
+отправителей берет получателей из очереди, общий TokenBucket держит
+темп ниже глобального лимита Telegram, ChatRateLimiter - ниже лимита
+на один чат. TelegramRetryAfter приостанавливает весь bucket на
+retry_after и повторяет того же получателя, а не считается ошибкой.
+
+Результаты пачками пишутся в broadcast_recipients; после перезапуска
+resume_unfinished продолжает рассылку с оставшихся получателей
+(доставка "хотя бы один раз": результаты последней несброшенной
+пачки могут быть отправлены повторно). Прогресс, скорость и ETA
+обновляются в сообщении администратору.
+"""
+import asyncio
+import logging
+import time
+from typing import Dict, List, Optional, Tuple
+
+from aiogram.exceptions import (
+    TelegramBadRequest, TelegramForbiddenError, TelegramNetworkError,
+    TelegramRetryAfter, TelegramServerError
+)
+from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup
+
+from src.database.db_init import db
+from utils.rate_limiter import ChatRateLimiter, TokenBucket
+
+logger = logging.getLogger(__name__)
+
+GLOBAL_RATE_PER_SECOND = 25  # Лимит Telegram ~30 сообщений/с на бота
+PER_CHAT_INTERVAL_SECONDS = 1.0  # Не чаще одного сообщения в секунду в чат
+SENDER_CONCURRENCY = 8
+MAX_NETWORK_RETRIES = 3
+MAX_RETRY_AFTER_PER_RECIPIENT = 5
+RESULTS_FLUSH_INTERVAL_SECONDS = 1.0
+PROGRESS_INTERVAL_SECONDS = 5.0
+
+BROADCAST_HEADER = "📢 <b>Сообщение от группы техподдержки</b>"
+
+
+def get_broadcast_progress_kb(broadcast_id: int) -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="⛔ Остановить рассылку", callback_data=f"broadcast_cancel:{broadcast_id}")]
+    ])
+
+
+async def deliver(bot, chat_id: int, kind: str, payload: dict) -> bool:
+    """Отправляет рассылку одному получателю; False - получатель пропущен"""
+    if kind == 'poll':
+        from bot.handlers.poll_sender import send_poll_to_user
+        return await send_poll_to_user(bot, chat_id, payload['poll_id'])
+
+    reply_markup = None
+    if payload.get('update_button'):
+        from bot.handlers.admin import get_update_bot_kb
+        reply_markup = get_update_bot_kb()
+
+    content_type = payload.get('content_type', 'text')
+    if content_type == 'text':
+        await bot.send_message(chat_id, payload['text'], parse_mode="HTML", reply_markup=reply_markup)
+    elif content_type == 'photo':
+        await bot.send_photo(chat_id, photo=payload['file_id'], caption=payload['caption'],
+                             parse_mode="HTML", reply_markup=reply_markup)
+    elif content_type == 'video':
+        await bot.send_video(chat_id, video=payload['file_id'], caption=payload['caption'],
+                             parse_mode="HTML", reply_markup=reply_markup)
+    elif content_type == 'animation':
+        await bot.send_animation(chat_id, animation=payload['file_id'], caption=payload['caption'],
+                                 parse_mode="HTML", reply_markup=reply_markup)
+    else:
+        raise ValueError(f"Unknown broadcast content type: {content_type}")
+    return True
+
+
+class BroadcastJob:
+    def __init__(self, bot, broadcast: Dict, recipients: List[int], bucket: TokenBucket):
+        self.bot = bot
+        self.broadcast_id = broadcast['id']
+        self.kind = broadcast['kind']
+        self.payload = broadcast['payload']
+        self.admin_chat_id = broadcast['admin_chat_id']
+        self.progress_message_id = broadcast.get('progress_message_id')
+        self.total = broadcast['total']
+        # Уже обработанные до перезапуска
+        self.sent = broadcast.get('sent') or 0
+        self.skipped = broadcast.get('skipped') or 0
+        self.failed = broadcast.get('failed') or 0
+        self.resumed_from = self.sent + self.skipped + self.failed
+
+        self.bucket = bucket
+        self.chat_limiter = ChatRateLimiter(PER_CHAT_INTERVAL_SECONDS)
+        self._queue: asyncio.Queue = asyncio.Queue()
+        for user_id in recipients:
+            self._queue.put_nowait(user_id)
+        self._results: List[Tuple[int, str, Optional[str]]] = []
+        # Остановку могли запросить из другого воркера, пока рассылка не шла
+        self._cancelled = broadcast.get('status') == 'cancel_requested'
+        self.retry_after_events = 0
+        self.started = time.monotonic()
+
+    @property
+    def done(self) -> int:
+        return self.sent + self.skipped + self.failed
+
+    def get_progress(self) -> Dict:
+        elapsed = max(time.monotonic() - self.started, 0.001)
+        rate = (self.done - self.resumed_from) / elapsed
+        remaining = max(self.total - self.done, 0)
+        return {
+            "done": self.done,
+            "total": self.total,
+            "sent": self.sent,
+            "skipped": self.skipped,
+            "failed": self.failed,
+            "rate": rate,
+            "eta_seconds": remaining / rate if rate > 0 else None,
+            "retry_after_events": self.retry_after_events,
+        }
+
+    def cancel(self):
+        self._cancelled = True
+
+    # ============================================================
+    # ОТПРАВКА
+    # ============================================================
+
+    async def _send_one(self, user_id: int) -> Tuple[str, Optional[str]]:
+        network_retries = 0
+        retry_after_count = 0
+        while True:
+            await self.chat_limiter.wait(user_id)
+            await self.bucket.acquire()
+            try:
+                delivered = await deliver(self.bot, user_id, self.kind, self.payload)
+                return ('sent' if delivered else 'skipped'), None
+            except TelegramRetryAfter as e:
+                # Flood control: пауза для всех отправителей, получатель повторяется
+                self.retry_after_events += 1
+                retry_after_count += 1
+                self.bucket.pause(e.retry_after)
+                self.chat_limiter.pause(user_id, e.retry_after)
+                logger.warning(f"[BROADCAST] #{self.broadcast_id} retry after {e.retry_after}s")
+                if retry_after_count >= MAX_RETRY_AFTER_PER_RECIPIENT:
+                    return 'failed', f"retry_after x{retry_after_count}"
+            except TelegramForbiddenError as e:
+                return 'failed', f"blocked: {e.message}"[:200]
+            except TelegramBadRequest as e:
+                return 'failed', e.message[:200]
+            except (TelegramNetworkError, TelegramServerError) as e:
+                network_retries += 1
+                if network_retries >= MAX_NETWORK_RETRIES:
+                    return 'failed', str(e)[:200]
+                await asyncio.sleep(2 ** network_retries)
+            except Exception as e:
+                logger.error(f"[BROADCAST] #{self.broadcast_id} failed to send to {user_id}: {e}")
+                return 'failed', str(e)[:200]
+
+    async def _sender(self):
+        while not self._cancelled:
+            try:
+                user_id = self._queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            status, error = await self._send_one(user_id)
+            if status == 'sent':
+                self.sent += 1
+            elif status == 'skipped':
+                self.skipped += 1
+            else:
+                self.failed += 1
+            self._results.append((user_id, status, error))
+
+    async def _flush_results(self):
+        if not self._results:
+            return
+        batch, self._results = self._results, []
+        try:
+            await db.broadcasts.record_results(self.broadcast_id, batch)
+        except Exception as e:
+            # Вернем в буфер - запишется следующим сбросом
+            self._results = batch + self._results
+            logger.error(f"[BROADCAST] #{self.broadcast_id} failed to save progress: {e}")
+
+    async def _flusher(self):
+        while True:
+            await asyncio.sleep(RESULTS_FLUSH_INTERVAL_SECONDS)
+            await self._flush_results()
+            try:
+                if await db.broadcasts.get_status(self.broadcast_id) == 'cancel_requested':
+                    self.cancel()
+            except Exception as e:
+                logger.warning(f"[BROADCAST] #{self.broadcast_id} status check failed: {e}")
+
+    # ============================================================
+    # ОТЧЕТ АДМИНИСТРАТОРУ
+    # ============================================================
+
+    def _format_progress(self, finished: bool = False) -> str:
+        progress = self.get_progress()
+        percent = progress['done'] / progress['total'] * 100 if progress['total'] else 100
+        title = f"Рассылка{' опроса' if self.kind == 'poll' else ''} #{self.broadcast_id}"
+        if not finished:
+            header = f"📤 {title}"
+        elif self._cancelled:
+            header = f"⛔ {title} остановлена"
+        else:
+            header = f"✅ {title} завершена"
+        text = (
+            f"{header}\n\n"
+            f"Обработано: <b>{progress['done']}/{progress['total']}</b> ({percent:.0f}%)\n"
+            f"📤 Успешно: {progress['sent']}\n"
+        )
+        if progress['skipped']:
+            text += f"⏭ Пропущено: {progress['skipped']}\n"
+        text += f"❌ Не удалось: {progress['failed']}\n"
+        text += f"⚡ Скорость: {progress['rate']:.1f} сообщ./с\n"
+        if not finished and progress['eta_seconds'] is not None:
+            minutes, seconds = divmod(int(progress['eta_seconds']), 60)
+            text += f"⏳ Осталось: ~{minutes} мин {seconds} с\n"
+        if progress['retry_after_events']:
+            text += f"🐢 Пауз по лимиту Telegram: {progress['retry_after_events']}\n"
+        return text
+
+    async def _update_progress(self, finished: bool = False):
+        text = self._format_progress(finished)
+        markup = None if finished else get_broadcast_progress_kb(self.broadcast_id)
+        try:
+            if self.progress_message_id:
+                await self.bot.edit_message_text(
+                    text, chat_id=self.admin_chat_id, message_id=self.progress_message_id,
+                    parse_mode="HTML", reply_markup=markup
+                )
+            else:
+                sent = await self.bot.send_message(self.admin_chat_id, text, parse_mode="HTML", reply_markup=markup)
+                self.progress_message_id = sent.message_id
+        except TelegramBadRequest as e:
+            if "not modified" not in e.message:
+                logger.warning(f"[BROADCAST] #{self.broadcast_id} progress update failed: {e.message}")
+        except Exception as e:
+            logger.warning(f"[BROADCAST] #{self.broadcast_id} progress update failed: {e}")
+
+    async def _reporter(self):
+        while True:
+            await asyncio.sleep(PROGRESS_INTERVAL_SECONDS)
+            await self._update_progress()
+
+    # ============================================================
+    # ЗАПУСК
+    # ============================================================
+
+    async def run(self):
+        await self._update_progress()
+        if not self._cancelled:
+            await db.broadcasts.set_status(self.broadcast_id, 'running', self.progress_message_id)
+        logger.info(f"[BROADCAST] #{self.broadcast_id} started: {self._queue.qsize()} recipients left")
+
+        flusher = asyncio.create_task(self._flusher())
+        reporter = asyncio.create_task(self._reporter())
+        try:
+            senders = [asyncio.create_task(self._sender()) for _ in range(SENDER_CONCURRENCY)]
+            await asyncio.gather(*senders)
+        finally:
+            # При остановке бота (CancelledError) статус остается running - рассылка возобновится
+            flusher.cancel()
+            reporter.cancel()
+            await asyncio.gather(flusher, reporter, return_exceptions=True)
+            await self._flush_results()
+
+        await db.broadcasts.set_status(self.broadcast_id, 'cancelled' if self._cancelled else 'done')
+        await self._update_progress(finished=True)
+        logger.info(
+            f"[BROADCAST] #{self.broadcast_id} finished: sent {self.sent}, "
+            f"skipped {self.skipped}, failed {self.failed}"
+        )
+
+
+class BroadcastEngine:
+    def __init__(self):
+        # Общий bucket: параллельные рассылки делят один лимит бота
+        self.bucket = TokenBucket(GLOBAL_RATE_PER_SECOND, capacity=GLOBAL_RATE_PER_SECOND)
+        self._jobs: Dict[int, BroadcastJob] = {}
+        self._tasks: Dict[int, asyncio.Task] = {}
+        self._starting = set()
+        # Дополнительный воркер многопроцессного режима: рассылки (status pending)
+        # запускает основной, чтобы лимит бота держал один bucket
+        self.delegate_to_primary = False
+
+    async def start(self, bot, broadcast_id: int) -> bool:
+        """Запускает (или продолжает) рассылку фоновой задачей"""
+        if self.delegate_to_primary:
+            logger.info(f"[BROADCAST] #{broadcast_id} queued for the primary worker")
+            return True
+        if broadcast_id in self._tasks or broadcast_id in self._starting:
+            return False
+        self._starting.add(broadcast_id)
+        try:
+            broadcast = await db.broadcasts.get(broadcast_id)
+            if not broadcast:
+                return False
+            recipients = await db.broadcasts.get_pending_recipients(broadcast_id)
+        finally:
+            self._starting.discard(broadcast_id)
+
+        job = BroadcastJob(bot, broadcast, recipients, self.bucket)
+        self._jobs[broadcast_id] = job
+        task = asyncio.create_task(job.run())
+        self._tasks[broadcast_id] = task
+        task.add_done_callback(lambda _: self._forget(broadcast_id))
+        return True
+
+    def _forget(self, broadcast_id: int):
+        self._jobs.pop(broadcast_id, None)
+        task = self._tasks.pop(broadcast_id, None)
+        if task and not task.cancelled() and task.exception():
+            logger.error(f"[BROADCAST] #{broadcast_id} crashed: {task.exception()}")
+
+    def cancel(self, broadcast_id: int) -> bool:
+        job = self._jobs.get(broadcast_id)
+        if not job:
+            return False
+        job.cancel()
+        return True
+
+    async def resume_unfinished(self, bot) -> int:
+        """Продолжает рассылки, прерванные остановкой или падением"""
+        resumed = 0
+        for broadcast_id in await db.broadcasts.get_unfinished_ids():
+            if await self.start(bot, broadcast_id):
+                resumed += 1
+        return resumed
+
+    async def stop(self):
+        """Останавливает задачи при выключении; прогресс сохраняется для возобновления"""
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def get_active(self) -> Dict[int, Dict]:
+        return {broadcast_id: job.get_progress() for broadcast_id, job in self._jobs.items()}
+
+
+broadcast_engine = BroadcastEngine()
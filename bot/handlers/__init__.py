@@ -1,7 +1,6 @@
 from aiogram import Bot, Dispatcher
 from aiogram.enums.parse_mode import ParseMode
 from aiogram.client.default import DefaultBotProperties
-from aiogram.fsm.storage.memory import MemoryStorage
 
 from bot.handlers.poll_sender import poll_callback_router
 from bot.handlers.registration import registration_router
@@ -14,6 +13,9 @@ from bot.handlers.content import content_router
 from bot.handlers.utils import gif_router, file_router
 from bot.handlers.faq_handler import faq_router
 from bot.middleware.metrics_middleware import MetricsMiddleware
+from bot.middleware.outbound_scheduler import outbound_scheduler
+from src.database.db_init import db
+from src.database.fsm_storage import SQLiteStorage
 # from .questions import questions_router, questions_callbacks_router
 from config import BOT_API_KEY
 
@@ -24,7 +26,10 @@ bot = Bot(
     token=BOT_API_KEY,
     default=DefaultBotProperties(parse_mode=ParseMode.HTML)
 )
-dp = Dispatcher(storage=MemoryStorage())
+# Все исходящие вызовы - через планировщик (приоритет результатов над индикаторами загрузки)
+bot.session.middleware(outbound_scheduler)
+# Состояния FSM переживают перезапуск: SQLite с отложенной пакетной записью
+dp = Dispatcher(storage=SQLiteStorage(db.pool))
 
 
 dp.message.middleware(MetricsMiddleware())
@@ -13,7 +13,6 @@ from utils.excel_exporter import ExcelExporter
 from utils.csv_exporter import CSVExporter
 from utils.metrics_exporter import MetricsExporter
 from datetime import datetime
-import asyncio
 
 from src.database.db_init import db
 
@@ -538,33 +537,25 @@ async def send_poll_to_users(message: Message, state: FSMContext):
         await state.clear()
         return
     
-    loading_msg = await message.answer(f"📤 Отправляю опрос {len(recipients)} пользователям...")
-    
     data = await state.get_data()
     poll_id = data['created_poll_id']
-    poll_title = data['created_poll_title']
     
-    # Отправляем опрос пользователям
+    # Отправка - фоновой задачей с сохранением прогресса
     from bot.handlers import bot
-    from bot.handlers.poll_sender import send_poll_to_user
-    
-    success_count = 0
-    failed_count = 0
-    
-    for user_id in recipients:
-        try:
-            await send_poll_to_user(bot, user_id, poll_id)
-            success_count += 1
-            await asyncio.sleep(0.1)
-        except Exception as e:
-            failed_count += 1
-            print(f"Failed to send poll to {user_id}: {e}")
+    from bot.broadcast_engine import broadcast_engine
+    
+    broadcast_id = await db.broadcasts.create(
+        kind='poll',
+        payload={'poll_id': poll_id},
+        recipients=recipients,
+        created_by=message.from_user.id,
+        admin_chat_id=message.chat.id
+    )
+    await broadcast_engine.start(bot, broadcast_id)
     
-    await loading_msg.delete()
     await message.answer(
-        f"✅ Опрос отправлен!\n\n"
-        f"📤 Успешно: {success_count}\n"
-        f"❌ Неудачно: {failed_count}",
+        f"📤 Опрос отправляется {len(recipients)} пользователям в фоне (рассылка #{broadcast_id}).\n"
+        "Прогресс будет обновляться в отдельном сообщении.",
         reply_markup=get_admin_menu_kb()
     )
     await state.clear()
@@ -1306,8 +1297,7 @@ async def send_broadcast(message: Message, state: FSMContext):
     await message.answer(preview_text)
     
     from bot.handlers import bot
-    success_count = 0
-    failed_count = 0
+    from bot.broadcast_engine import broadcast_engine, BROADCAST_HEADER
     
     # Проверяем, содержит ли текст слова об обновлении
     text_content = data.get('text', '') if content_type == "text" else data.get('caption', '')
@@ -1316,57 +1306,30 @@ async def send_broadcast(message: Message, state: FSMContext):
         'перезагруз', 'рестарт', 'restart', 'новая версия'
     ])
     
-    # Создаём клавиатуру только если это сообщение об обновлении
-    reply_markup = get_update_bot_kb() if is_update_message else None
-    
     # Добавляем информацию об обновлении в текст, если это обновление
     update_notice = ""
     if is_update_message:
         update_notice = "\n\n💡 <i>Для обновления бота нажмите на кнопку ниже👇</i>"
     
-    for recipient_id in recipients:
-        try:
-            if content_type == "text":
-                final_text = f"📢 <b>Сообщение от группы техподдержки</b>\n\n{data.get('text')}{update_notice}"
-                await bot.send_message(
-                    recipient_id,
-                    final_text,
-                    parse_mode="HTML",
-                    reply_markup=reply_markup
-                )
-            elif content_type == "photo":
-                caption = f"📢 <b>Сообщение от группы техподдержки</b>\n\n{data.get('caption')}{update_notice}" if data.get('caption') else f"📢 <b>Сообщение от группы техподдержки</b>{update_notice}"
-                await bot.send_photo(
-                    recipient_id,
-                    photo=data.get('file_id'),
-                    caption=caption,
-                    parse_mode="HTML",
-                    reply_markup=reply_markup
-                )
-            elif content_type == "video":
-                caption = f"📢 <b>Сообщение от группы техподдержки</b>\n\n{data.get('caption')}{update_notice}" if data.get('caption') else f"📢 <b>Сообщение от группы техподдержки</b>{update_notice}"
-                await bot.send_video(
-                    recipient_id,
-                    video=data.get('file_id'),
-                    caption=caption,
-                    parse_mode="HTML",
-                    reply_markup=reply_markup
-                )
-            elif content_type == "animation":
-                caption = f"📢 <b>Сообщение от группы техподдержки</b>\n\n{data.get('caption')}{update_notice}" if data.get('caption') else f"📢 <b>Сообщение от группы техподдержки</b>{update_notice}"
-                await bot.send_animation(
-                    recipient_id,
-                    animation=data.get('file_id'),
-                    caption=caption,
-                    parse_mode="HTML",
-                    reply_markup=reply_markup
-                )
-            
-            success_count += 1
-            await asyncio.sleep(0.1)  # Задержка между отправками
-        except Exception as e:
-            failed_count += 1
-            print(f"Failed to send to {recipient_id}: {e}")
+    # Готовое содержимое: фоновая задача (и возобновление после перезапуска) только отправляет
+    payload = {'content_type': content_type, 'update_button': is_update_message}
+    if content_type == "text":
+        payload['text'] = f"{BROADCAST_HEADER}\n\n{data.get('text')}{update_notice}"
+    else:
+        payload['file_id'] = data.get('file_id')
+        payload['caption'] = (
+            f"{BROADCAST_HEADER}\n\n{data.get('caption')}{update_notice}" if data.get('caption')
+            else f"{BROADCAST_HEADER}{update_notice}"
+        )
+    
+    broadcast_id = await db.broadcasts.create(
+        kind='message',
+        payload=payload,
+        recipients=recipients,
+        created_by=message.from_user.id,
+        admin_chat_id=message.chat.id
+    )
+    await broadcast_engine.start(bot, broadcast_id)
     
     # Добавляем информацию о кнопке перезапуска в отчёт
     update_info = ""
@@ -1374,13 +1337,29 @@ async def send_broadcast(message: Message, state: FSMContext):
         update_info = "\n\n💡 К сообщению добавлена кнопка перезапуска бота"
     
     await message.answer(
-        f"✅ Рассылка завершена!{update_info}\n\n"
-        f"📤 Успешно отправлено: {success_count}\n"
-        f"❌ Не удалось отправить: {failed_count}",
+        f"📤 Рассылка #{broadcast_id} запущена в фоне.{update_info}\n\n"
+        "Прогресс, скорость и оставшееся время будут обновляться в отдельном сообщении.",
         reply_markup=get_admin_menu_kb()
     )
     await state.clear()
 
+@admin_router.callback_query(F.data.startswith("broadcast_cancel:"))
+async def cancel_broadcast_handler(callback: CallbackQuery):
+    """Остановка фоновой рассылки"""
+    user = await db.get_user(callback.from_user.id)
+    if not user or user['role'] != 'admin':
+        await callback.answer("У вас нет доступа к этой функции.", show_alert=True)
+        return
+    
+    from bot.broadcast_engine import broadcast_engine
+    
+    broadcast_id = int(callback.data.split(":")[1])
+    # Рассылку может вести другой воркер - тогда остановка через статус в БД
+    if broadcast_engine.cancel(broadcast_id) or await db.broadcasts.request_cancel(broadcast_id):
+        await callback.answer("⛔ Рассылка останавливается...")
+    else:
+        await callback.answer("Рассылка уже завершена.", show_alert=True)
+
 @admin_router.message(F.text == "👥 Пользователи")
 async def show_users(message: Message):
     user_id = message.from_user.id
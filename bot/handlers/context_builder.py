@@ -0,0 +1,129 @@
+"""
+Сборка контекста для LLM по общим вопросам.
+
+Описание каждого теста рендерится один раз на версию каталога и
+кэшируется вместе с оценкой числа токенов. Сборщик добавляет описания
+в порядке релевантности, пока не исчерпан бюджет токенов
+(LLM_CONTEXT_TOKEN_BUDGET; 0 - без ограничения).
+"""
+import logging
+import time
+from typing import Dict, List, Set, Tuple
+
+from config import LLM_CONTEXT_TOKEN_BUDGET
+from bot.handlers.utils import normalize_test_code
+
+logger = logging.getLogger(__name__)
+
+CONTEXT_HEADER = "\n\nРЕЛЕВАНТНАЯ ИНФОРМАЦИЯ ДЛЯ ВАШЕГО ВОПРОСА:\n"
+MAX_FIELD_LENGTH = 100
+CHARS_PER_TOKEN = 3.0  # Грубая оценка для смешанного русского/латинского текста
+
+CONTEXT_FIELDS = [
+    ('type', 'Тип'),
+    ('specialization', 'Специализация'),
+    ('code_letters', 'Аббревиатура в коде теста'),
+    ('department', 'Вид исследования'),
+    ('patient_preparation', 'Подготовка'),
+    ('biomaterial_type', 'Биоматериал'),
+    ('container_type', 'Контейнер'),
+    ('container_number', 'Номер контейнера'),
+    ('storage_temp', 'Хранение'),
+    ('preanalytics', 'Преаналитика'),
+    ('animal_type', 'Виды животных'),
+    ('important_information', 'Важная информация'),
+]
+
+EMPTY_VALUES = ['не указан', 'нет', '-', '']
+
+
+def estimate_tokens(text: str) -> int:
+    """Оценка числа токенов без токенизатора провайдера"""
+    if not text:
+        return 0
+    return int(len(text) / CHARS_PER_TOKEN) + 1
+
+
+def render_test_snippet(test_data: Dict) -> str:
+    """Описание одного теста для контекста LLM"""
+    normalized_code = normalize_test_code(test_data.get('test_code', ''))
+    snippet = f"\n🔬 Тест {normalized_code} - {test_data.get('test_name', '')}:\n"
+
+    for field, label in CONTEXT_FIELDS:
+        value = test_data.get(field)
+        if value and str(value).strip().lower() not in EMPTY_VALUES:
+            value_str = str(value)
+            if len(value_str) > MAX_FIELD_LENGTH:
+                value_str = value_str[:MAX_FIELD_LENGTH - 3] + "..."
+            snippet += f"  {label}: {value_str}\n"
+
+    snippet += "  ─────────────────────────\n"
+    return snippet
+
+
+class ContextBuilder:
+    def __init__(self, token_budget: int = LLM_CONTEXT_TOKEN_BUDGET):
+        self.token_budget = token_budget
+        self._catalog_version = None
+        # test_code -> (snippet, tokens)
+        self._snippets: Dict[str, Tuple[str, int]] = {}
+
+    def _get_snippet(self, test_code: str, test_data: Dict) -> Tuple[str, int]:
+        cached = self._snippets.get(test_code)
+        if cached is None:
+            snippet = render_test_snippet(test_data)
+            cached = (snippet, estimate_tokens(snippet))
+            self._snippets[test_code] = cached
+        return cached
+
+    def build(self, docs: List, catalog_version: str) -> Tuple[str, Set[str], Dict]:
+        """
+        Собирает контекст из документов (уже отсортированных по релевантности).
+
+        Returns:
+            (context_info, коды тестов в контексте, статистика сборки)
+        """
+        started = time.perf_counter()
+
+        if self._catalog_version != catalog_version:
+            self._snippets.clear()
+            self._catalog_version = catalog_version
+
+        context_info = ""
+        test_codes: Set[str] = set()
+        used_tokens = 0
+        included = 0
+
+        if docs:
+            context_info = CONTEXT_HEADER
+            used_tokens = estimate_tokens(CONTEXT_HEADER)
+
+            for doc in docs:
+                test_data = doc.metadata
+                test_code = test_data.get('test_code', '')
+                if not test_code:
+                    continue
+
+                snippet, tokens = self._get_snippet(test_code, test_data)
+                if self.token_budget and used_tokens + tokens > self.token_budget:
+                    # Самые релевантные уже в контексте, остальные не помещаются
+                    break
+
+                context_info += snippet
+                used_tokens += tokens
+                included += 1
+
+                normalized_code = normalize_test_code(test_code)
+                if normalized_code:
+                    test_codes.add(normalized_code.upper())
+
+        stats = {
+            'context_tokens': used_tokens,
+            'tests_included': included,
+            'tests_available': len(docs),
+            'build_ms': (time.perf_counter() - started) * 1000,
+        }
+        return context_info, test_codes, stats
+
+
+context_builder = ContextBuilder()
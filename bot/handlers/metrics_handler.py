@@ -10,6 +10,14 @@ from datetime import datetime, timedelta
 
 from src.database.db_init import db
 from bot.keyboards import get_admin_menu_kb
+from models.llm_gateway import llm_gateway
+from bot.middleware.activity_aggregator import activity_aggregator
+from bot.middleware.outbound_scheduler import outbound_scheduler
+from bot.search_sessions import search_sessions
+from bot.user_scheduler import user_scheduler
+from utils.cpu_offload import cpu_offload
+from utils.loop_monitor import loop_monitor
+from utils.single_flight import single_flight
 
 metrics_router = Router()
 
@@ -174,6 +182,109 @@ async def show_technical_metrics(message: Message, state: FSMContext):
         else:
             response += "• Нет данных\n\n"
         
+        # Пул соединений БД
+        pool_stats = db.pool.get_stats()
+        response += "🗄 <b>Соединения БД (с момента запуска)</b>\n"
+        response += f"• Чтений: <b>{pool_stats['reads']}</b>, записей: <b>{pool_stats['writes']}</b>, откатов: <b>{pool_stats['rollbacks']}</b>\n"
+        response += f"• Свободно читателей: <b>{pool_stats['readers_idle']}/{pool_stats['readers_total']}</b>\n"
+        response += f"• Ожидание чтения p95: <b>{pool_stats['read_wait']['p95_ms']:.1f}</b> мс, записи p95: <b>{pool_stats['write_wait']['p95_ms']:.1f}</b> мс\n\n"
+
+        # Очередь телеметрии
+        telemetry_stats = db.telemetry.get_stats()
+        response += "📝 <b>Запись телеметрии</b>\n"
+        response += f"• В очереди: <b>{telemetry_stats['queue_depth']}</b>, записано: <b>{telemetry_stats['flushed_records']}</b> ({telemetry_stats['flushed_batches']} пакетов)\n"
+        response += f"• Схлопнуто: <b>{telemetry_stats['coalesced']}</b>, потеряно: <b>{telemetry_stats['dropped']}</b>, ожиданий места: <b>{telemetry_stats['backpressure_waits']}</b>\n"
+        response += f"• Сброс p95: <b>{telemetry_stats['flush_latency']['p95_ms']:.1f}</b> мс\n\n"
+
+        # LLM (с момента запуска процесса)
+        llm_stats = llm_gateway.get_stats()
+        response += "🤖 <b>LLM (с момента запуска)</b>\n"
+        response += f"• В работе: <b>{llm_stats['in_flight']}</b>, отклонено: <b>{llm_stats['rejected']}</b>, hedge: <b>{llm_stats['hedges_started']}</b>\n"
+        if llm_stats['models']:
+            for model_name, model_stats in llm_stats['models'].items():
+                latency = model_stats['latency']
+                response += (
+                    f"• {html.escape(model_name)}: {model_stats['calls']} выз., "
+                    f"ошибок {model_stats['errors']} (таймаутов {model_stats['timeouts']}), "
+                    f"p50 {latency['p50_ms'] / 1000:.2f}с / p95 {latency['p95_ms'] / 1000:.2f}с, "
+                    f"breaker: {model_stats['breaker']}\n"
+                )
+        else:
+            response += "• Нет вызовов\n"
+        response += "\n"
+
+        # Кэш пользователей
+        cache_stats = db.user_cache.get_stats()
+        response += "👤 <b>Кэш пользователей</b>\n"
+        response += f"• Записей: <b>{cache_stats['size']}/{cache_stats['max_size']}</b>, попаданий: <b>{cache_stats['hit_rate']:.1%}</b>\n"
+        response += f"• Из кэша: <b>{cache_stats['hits']}</b>, неизвестные: <b>{cache_stats['negative_hits']}</b>, в рамках апдейта: <b>{cache_stats['request_hits']}</b>, промахов: <b>{cache_stats['misses']}</b>\n"
+        response += f"• Вытеснено: <b>{cache_stats['evictions']}</b>, инвалидаций: <b>{cache_stats['invalidations']}</b>\n"
+        search_stats = search_sessions.get_stats()
+        response += f"• Результаты поиска: <b>{search_stats['sessions']}</b> ({search_stats['bytes'] / 1024:.0f} КБ), попаданий: <b>{search_stats['hit_rate']:.1%}</b>, вытеснено: <b>{search_stats['evictions']}</b>\n\n"
+
+        # Middleware и агрегатор активности
+        activity_stats = activity_aggregator.get_stats()
+        response += "⏱ <b>Обработка событий (с момента запуска)</b>\n"
+        response += f"• Middleware до обработчика p50/p95: <b>{activity_stats['middleware_overhead']['p50_ms']:.2f}</b> / <b>{activity_stats['middleware_overhead']['p95_ms']:.2f}</b> мс\n"
+        response += f"• Обработчик p50/p95: <b>{activity_stats['handler_latency']['p50_ms']:.0f}</b> / <b>{activity_stats['handler_latency']['p95_ms']:.0f}</b> мс\n"
+        response += f"• Запись активности (фоном) p95: <b>{activity_stats['db_cost_per_user']['p95_ms']:.1f}</b> мс на пользователя\n"
+        response += f"• Событий: <b>{activity_stats['recorded_events']}</b>, ожидают сброса: <b>{activity_stats['pending_users']}</b>, ошибок: <b>{activity_stats['flush_errors']}</b>\n"
+        scheduler_stats = user_scheduler.get_stats()
+        response += (
+            f"• Запросы пользователей: выполняется <b>{scheduler_stats['running']}</b>, ждут <b>{scheduler_stats['waiting']}</b> "
+            f"(макс. очередь {scheduler_stats['max_waiting']}), ожидание p95: <b>{scheduler_stats['queue_wait']['p95_ms']:.0f}</b> мс\n"
+        )
+        response += f"• Заменены новым запросом: <b>{scheduler_stats['superseded']}</b> отменено, <b>{scheduler_stats['dropped']}</b> не начаты\n"
+        flight_stats = single_flight.get_stats()
+        response += (
+            f"• Одинаковые одновременные поиски: вычислено <b>{flight_stats['total_leaders']}</b>, "
+            f"присоединились <b>{flight_stats['total_coalesced']}</b> ({flight_stats['coalesce_rate'] * 100:.1f}%), "
+            f"сейчас <b>{flight_stats['in_flight']}</b>\n"
+        )
+        for stage, coalesced in sorted(flight_stats['coalesced'].items()):
+            response += f"  - {stage}: присоединились {coalesced} из {coalesced + flight_stats['leaders'].get(stage, 0)}\n"
+        if hasattr(state.storage, 'get_stats'):
+            fsm_stats = state.storage.get_stats()
+            response += (
+                f"• FSM: записей в памяти <b>{fsm_stats['records']}</b>, изменений <b>{fsm_stats['changes']}</b> → "
+                f"записано строк <b>{fsm_stats['rows_written']}</b>, сброс p95: <b>{fsm_stats['flush_latency']['p95_ms']:.1f}</b> мс\n"
+            )
+        response += "\n"
+
+        # Event loop и вынесенная обработка
+        lag_stats = loop_monitor.get_stats()
+        offload_stats = cpu_offload.get_stats()
+        response += "🔄 <b>Event loop</b>\n"
+        response += f"• Задержка loop p50/p95/макс: <b>{lag_stats['lag']['p50_ms']:.1f}</b> / <b>{lag_stats['lag']['p95_ms']:.1f}</b> / <b>{lag_stats['lag']['max_ms']:.0f}</b> мс\n"
+        response += f"• Остановок > 100 мс: <b>{lag_stats['stalls']}</b> (всего {lag_stats['stalled_seconds']:.1f} с)\n"
+        for stage, stage_stats in sorted(offload_stats['stages'].items()):
+            response += (
+                f"  - {stage}: в пуле {stage_stats['offloaded']}, сразу {stage_stats['inline']}, "
+                f"p95 {stage_stats['duration']['p95_ms']:.0f} мс, ожидание p95 {stage_stats['queue_wait']['p95_ms']:.0f} мс\n"
+            )
+        response += "\n"
+
+        # Исходящие вызовы Telegram
+        outbound_stats = outbound_scheduler.get_stats()
+        response += "📨 <b>Исходящие вызовы Telegram</b>\n"
+        response += f"• Вызовов: <b>{outbound_stats['total_calls']}</b>, пропущено правок: <b>{outbound_stats['total_skipped']}</b>\n"
+        response += f"• Ожидание результатов/индикаторов p95: <b>{outbound_stats['queue_latency']['result']['p95_ms']:.0f}</b> / <b>{outbound_stats['queue_latency']['cosmetic']['p95_ms']:.0f}</b> мс\n"
+        response += f"• Ответ Telegram p50/p95: <b>{outbound_stats['api_latency']['p50_ms']:.0f}</b> / <b>{outbound_stats['api_latency']['p95_ms']:.0f}</b> мс\n"
+        top_methods = sorted(outbound_stats['calls'].items(), key=lambda item: item[1], reverse=True)[:5]
+        for method_name, count in top_methods:
+            skipped = outbound_stats['dropped'].get(method_name, 0) + outbound_stats['coalesced'].get(method_name, 0)
+            response += f"  - {method_name}: {count}" + (f" (пропущено {skipped})" if skipped else "") + "\n"
+        response += "\n"
+
+        # Рекомендации "часто смотрят вместе"
+        related_stats = db.related_index.get_stats()
+        response += "🔗 <b>Связанные тесты</b>\n"
+        response += f"• Тестов с рекомендациями: <b>{related_stats['tests']}</b>, пар: <b>{related_stats['pairs']}</b>\n"
+        if related_stats['last_rebuild_at']:
+            response += f"• Пересчет: <b>{related_stats['last_rebuild_at'].strftime('%H:%M')}</b> за <b>{related_stats['last_rebuild_ms']:.0f}</b> мс\n\n"
+        else:
+            response += "• Пересчет еще не выполнялся\n\n"
+
         # Нагрузка vs DAU
         if perf_metrics and perf_metrics.get('overall'):
             overall = perf_metrics['overall']
@@ -15,7 +15,6 @@ from typing import Dict, List, Tuple, Optional, Set
 from datetime import datetime
 import re
 import hashlib
-from collections import defaultdict
 import logging
 
 from bot.handlers.ultimate_classifier import ultimate_classifier
@@ -24,11 +23,15 @@ from bot.handlers.query_processing.query_preprocessing import expand_query_with_
 from bot.handlers.query_processing.animal_filter import animal_filter
 
 from src.database.db_init import db
+from bot.search_sessions import search_sessions, resolve_search_results
 from src.data_vectorization import DataProcessor
-from models.models_init import Google_Gemini_2_5_Flash_Lite as llm
+from src.answer_cache import answer_cache
+from bot.user_scheduler import user_scheduler
+from utils.cpu_offload import cpu_offload
+from utils.single_flight import single_flight, query_key
+from models.llm_gateway import llm_gateway, LLMUnavailableError
 from bot.handlers.utils import (
     fix_bold,
-    safe_delete_message,
     create_test_link,
     is_test_code_pattern,
     normalize_test_code,
@@ -37,7 +40,8 @@ from bot.handlers.utils import (
     is_profile_test
 )
 from bot.handlers.sending_style import (
-    animate_loading,
+    LoadingIndicator,
+    StreamingMessageWriter,
     format_test_data,
     format_test_info,
     get_user_first_name,
@@ -61,6 +65,7 @@ from bot.keyboards import (
 from bot.handlers.utils import normalize_container_name, deduplicate_container_names
 from bot.handlers.feedback import validate_phone_number, get_phone_kb, format_phone_number, send_callback_email
 from bot.handlers.response_ratings import ResponseRatingManager
+from bot.handlers.context_builder import context_builder, estimate_tokens
 
 
 rating_manager = ResponseRatingManager(db)
@@ -78,8 +83,6 @@ TEXT_SEARCH_TOP_K = 80
 
 # Параметры пагинации
 ITEMS_PER_PAGE = 6
-MAX_SEARCH_RESULTS_IN_STATE = 3  # Количество хранимых поисков
-SEARCH_RESULTS_TTL_SECONDS = 1800  # 30 минут
 
 # Параметры LLM
 LLM_TIMEOUT_SECONDS = 30
@@ -97,9 +100,6 @@ logger = logging.getLogger(__name__)
 
 questions_router = Router()
 
-# Lock'и для предотвращения race conditions
-user_processing_locks = defaultdict(asyncio.Lock)
-
 # Кеш для категорий тестов (оптимизация)
 TEST_CATEGORY_KEYWORDS = {
     "биохимия": {"биохим", "алт", "аст", "креатинин", "мочевина", "глюкоза"},
@@ -227,6 +227,18 @@ def _rerank_hits_by_query(hits: List[Tuple[Document, float]], query: str) -> Lis
     return hits
 
 
+async def _embed_and_search_question(processor: DataProcessor, question_text: str):
+    """Вектор вопроса и релевантные тесты (эмбеддинг и Chroma - в пуле cpu_offload)"""
+    question_embedding = await cpu_offload.run(
+        processor.embed_search_query, question_text, stage="embed_query"
+    )
+    relevant_docs = await cpu_offload.run(
+        processor.search_test, query=question_text, top_k=50,
+        query_embedding=question_embedding, stage="vector_search"
+    )
+    return question_embedding, relevant_docs
+
+
 async def apply_animal_filter(
     results: List[Tuple[Document, float]], 
     query: str
@@ -237,7 +249,9 @@ async def apply_animal_filter(
     Returns:
         Tuple[filtered_results, animal_types]
     """
-    animal_types = animal_filter.extract_animals_from_query(query)
+    animal_types = await cpu_offload.run(
+        animal_filter.extract_animals_from_query, query, stage="animal_filter", size=len(query)
+    )
     
     if not animal_types:
         return results, set()
@@ -249,54 +263,6 @@ async def apply_animal_filter(
     return filtered, animal_types
 
 
-async def cleanup_old_search_results(
-    state: FSMContext, 
-    max_age_seconds: int = SEARCH_RESULTS_TTL_SECONDS,
-    keep_last: int = MAX_SEARCH_RESULTS_IN_STATE
-):
-    """
-    Очищает старые результаты поиска из состояния
-    
-    Args:
-        state: FSM контекст
-        max_age_seconds: Максимальный возраст результатов в секундах
-        keep_last: Сколько последних результатов сохранять
-    """
-    data = await state.get_data()
-    now = datetime.now().timestamp()
-    
-    search_results = {}
-    
-    # Собираем все результаты с их временем
-    for key, value in data.items():
-        if key.startswith("search_results_"):
-            if isinstance(value, dict) and 'timestamp' in value:
-                search_results[key] = value
-    
-    # Сортируем по времени
-    sorted_results = sorted(
-        search_results.items(),
-        key=lambda x: x[1].get('timestamp', 0),
-        reverse=True
-    )
-    
-    # Определяем, что удалять
-    to_delete = []
-    
-    for i, (key, value) in enumerate(sorted_results):
-        # Удаляем старые результаты
-        if now - value.get('timestamp', 0) > max_age_seconds:
-            to_delete.append(key)
-        # Удаляем лишние (сверх лимита)
-        elif i >= keep_last:
-            to_delete.append(key)
-    
-    # Удаляем
-    if to_delete:
-        logger.info(f"[CLEANUP] Removing {len(to_delete)} old search results")
-        await state.update_data(**{k: None for k in to_delete})
-
-
 def create_mock_message(original_message, text: str):
     """
     Создает полнофункциональный mock сообщение
@@ -369,62 +335,16 @@ def create_mock_message(original_message, text: str):
     return MockMessage()
 
 
-async def safe_cancel_animation(animation_task: Optional[asyncio.Task]):
-    """Безопасная отмена задачи анимации"""
-    if animation_task and not animation_task.done():
-        animation_task.cancel()
-        try:
-            await animation_task
-        except asyncio.CancelledError:
-            pass  # Ожидаемое исключение
-        except Exception as e:
-            logger.warning(f"[ANIMATION] Error during cancel: {e}")
-
-
 async def find_container_photo_smart(db, container_type: str):
     """
-    Умный поиск фото контейнера с учетом вариантов в БД
+    Умный поиск фото контейнера с учетом вариантов в БД.
+    Варианты написания (количество, регистр "с", пробирка/пробирки, "/" и "+")
+    сворачивает ключ нормализации карты фото - один поиск по словарю.
     """
-    is_test_tube = "пробирк" in container_type.lower()
-    is_container = "контейнер" in container_type.lower()
-    
-    # Сначала точный поиск
     photo = await db.get_container_photo(container_type)
     if photo:
         photo['display_name'] = photo.get('container_type', container_type)
-        return photo
-    
-    # Генерируем варианты для поиска
-    search_variants = []
-    
-    # Варианты с числами
-    if not re.match(r'^\d+\s', container_type):
-        search_variants.extend([
-            f"2 {container_type.replace('Пробирка', 'Пробирки')}",
-            f"3 {container_type.replace('Пробирка', 'Пробирки')}",
-            container_type
-        ])
-    else:
-        search_variants.append(container_type)
-    
-    # Варианты регистра для "с"
-    for variant in search_variants[:]:
-        upper_variant = re.sub(r'\bс\s+', 'С ', variant)
-        if upper_variant != variant:
-            search_variants.append(upper_variant)
-        
-        lower_variant = re.sub(r'\bС\s+', 'с ', variant)
-        if lower_variant != variant:
-            search_variants.append(lower_variant)
-    
-    # Пробуем все варианты
-    for variant in search_variants:
-        photo = await db.get_container_photo(variant)
-        if photo:
-            photo['display_name'] = photo.get('container_type', container_type)
-            return photo
-    
-    return None
+    return photo
 
 # ============================================================================
 # КЛАВИАТУРЫ
@@ -838,7 +758,9 @@ async def handle_universal_search(message: Message, state: FSMContext):
     if is_obvious_question or has_question_keywords:
         logger.info(f"[PRE-CHECK] General question with context detected: {text}")
         
-        expanded_query = expand_query_with_abbreviations(text)
+        expanded_query = await cpu_offload.run(
+            expand_query_with_abbreviations, text, stage="expand_query", size=len(text)
+        )
         await db.add_request_stat(
             user_id=user_id, request_type="question", request_text=text
         )
@@ -851,7 +773,9 @@ async def handle_universal_search(message: Message, state: FSMContext):
     
     if is_test_code_pattern(text):
         logger.info(f"[PRE-CHECK] Pure test code pattern detected: {text}")
-        expanded_query = expand_query_with_abbreviations(text)
+        expanded_query = await cpu_offload.run(
+            expand_query_with_abbreviations, text, stage="expand_query", size=len(text)
+        )
         
         await state.update_data(
             query_classification={
@@ -874,7 +798,9 @@ async def handle_universal_search(message: Message, state: FSMContext):
     # ПРИОРИТЕТ 3: Классификация через ML
     # ============================================================
 
-    expanded_query = expand_query_with_abbreviations(text)
+    expanded_query = await cpu_offload.run(
+        expand_query_with_abbreviations, text, stage="expand_query", size=len(text)
+    )
 
     # Классификация запроса
     query_type, confidence, metadata = await ultimate_classifier.classify_with_certainty(expanded_query)
@@ -1245,15 +1171,14 @@ async def handle_pagination(callback: CallbackQuery, state: FSMContext):
     
     action, page, search_id, current_view = PaginationCallback.unpack(callback.data)
     
-    data = await state.get_data()
-    search_data = data.get(f"search_results_{search_id}")
+    search_hits = search_sessions.get(search_id)
     
-    if not search_data:
+    if search_hits is None:
         await callback.answer("Результаты поиска устарели. Выполните новый поиск.", show_alert=True)
         return
     
-    # Извлекаем результаты
-    all_results = search_data.get('data', [])
+    # Метаданные - из индекса каталога
+    all_results = await resolve_search_results(search_hits)
     
     if not all_results:
         await callback.answer("Результаты не найдены", show_alert=True)
@@ -1356,14 +1281,13 @@ async def handle_switch_view(callback: CallbackQuery, state: FSMContext):
     view_type = parts[1]
     search_id = parts[2] if len(parts) > 2 else ""
     
-    data = await state.get_data()
-    search_data = data.get(f"search_results_{search_id}")
+    search_hits = search_sessions.get(search_id)
     
-    if not search_data:
+    if search_hits is None:
         await callback.answer("Результаты поиска устарели", show_alert=True)
         return
     
-    all_results = search_data.get('data', [])
+    all_results = await resolve_search_results(search_hits)
     
     # Фильтрация
     if view_type == "tests":
@@ -1556,40 +1480,8 @@ async def handle_show_container_photos_callback(callback: CallbackQuery):
         not_found_containers = []
         
         for container in unique_containers:
-            # Варианты для поиска в БД
-            search_variants = [
-                container,  # Оригинал
-                container.replace(" / ", " + "),  # Меняем / на +
-                container.replace(" + ", " / "),  # Меняем + на /
-            ]
-            
-            # Добавляем варианты без чисел
-            container_no_number = re.sub(r'^\d+\s+', '', container)
-            if container_no_number != container:
-                search_variants.extend([
-                    container_no_number,
-                    container_no_number.replace(" / ", " + "),
-                    container_no_number.replace(" + ", " / "),
-                ])
-            
-            # Добавляем варианты с единственным числом
-            if "пробирки" in container.lower():
-                singular = container.replace("пробирки", "пробирка").replace("Пробирки", "Пробирка")
-                search_variants.append(singular)
-                search_variants.append(re.sub(r'^\d+\s+', '', singular))
-            
-            photo_data = None
-            for variant in search_variants:
-                # Сначала точный поиск
-                photo_data = await db.get_container_photo(variant)
-                if photo_data:
-                    break
-                    
-                # Если не нашли - умный поиск
-                if not photo_data:
-                    photo_data = await find_container_photo_smart(db, variant)
-                    if photo_data:
-                        break
+            # Варианты написания сворачиваются ключом карты фото (без запросов к БД)
+            photo_data = await find_container_photo_smart(db, container)
             
             if photo_data:
                 file_id = photo_data.get("file_id")
@@ -1964,13 +1856,22 @@ async def _handle_code_search_internal(
     message: Message,
     state: FSMContext,
     search_text: Optional[str] = None
+):
+    """Поиск по коду через планировщик пользователя: новый запрос отменяет незавершенный"""
+    await user_scheduler.run(message.chat.id, _code_search_pipeline, message, state, search_text)
+
+
+async def _code_search_pipeline(
+    message: Message,
+    state: FSMContext,
+    search_text: Optional[str] = None
 ):
     """
     Внутренняя функция поиска по коду теста
     
     Исправлено:
-    - Добавлен Lock для предотвращения race conditions
-    - Корректная обработка animation_task
+    - Один запрос пользователя за раз (user_scheduler), новый отменяет старый
+    - Индикатор загрузки с быстрым путем (LoadingIndicator)
     - Сохранение минимизированных данных в state
     - Увеличен threshold для fuzzy search
     - Проверка на None после normalize_test_code
@@ -1980,264 +1881,76 @@ async def _handle_code_search_internal(
     # Засекаем время начала для метрик
     import time
     start_time = time.time()
-    
-    # FIX #18: Атомарная блокировка
-    async with user_processing_locks[user_id]:
-        data = await state.get_data()
-        original_input = search_text if search_text else message.text.strip()
-        original_query = data.get("original_query", original_input)
-
-        # НЕ логируем здесь - логирование через log_request_metric происходит после обработки
-        
-        gif_msg = None
-        loading_msg = None
-        animation_task = None
-
-        try:
-            # Загрузка GIF
-            try:
-                if LOADING_GIF_ID:
-                    gif_msg = await message.answer_animation(LOADING_GIF_ID, caption="")
-            except Exception:
-                gif_msg = None
-
-            loading_msg = await message.answer("🔍 Ищу по коду...\n⏳ Анализирую данные...")
-            
-            if loading_msg:
-                animation_task = asyncio.create_task(animate_loading(loading_msg))
-
-            processor = DataProcessor()
-            processor.load_vector_store()
-
-            # FIX #21: Проверка нормализации
-            normalized_input = normalize_test_code(original_input)
-            if not normalized_input:
-                await safe_cancel_animation(animation_task)
-                await safe_delete_message(loading_msg)
-                await safe_delete_message(gif_msg)
-                
-                # Логируем некорректный формат кода (реальная ошибка)
-                response_time = time.time() - start_time
-                try:
-                    await db.log_request_metric(
-                        user_id=user_id,
-                        request_type="code_search",
-                        query_text=original_input[:500],
-                        response_time=response_time,
-                        success=False,
-                        has_answer=False,
-                        error_message="Не удалось распознать код теста"
-                    )
-                except Exception as e:
-                    logger.error(f"[METRICS] Failed to log error metric: {e}")
-                
-                await message.answer(
-                    f"❌ Не удалось распознать код теста: {html.escape(original_input[:50])}",
-                    reply_markup=get_dialog_kb(),
-                    parse_mode="HTML"
-                )
-                return
-
-            # Умный поиск
-            result, found_variant, match_type = await smart_test_search(
-                processor, original_input
-            )
-
-            # Фильтр по животным
-            animal_types = set()
-            if not result:
-                animal_types = animal_filter.extract_animals_from_query(original_query)
 
-            # Если не нашли - fuzzy поиск
-            if not result:
-                # FIX #25: Увеличен threshold
-                similar_tests = await fuzzy_test_search(
-                    processor, normalized_input, threshold=FUZZY_SEARCH_THRESHOLD_MIN
-                )
-
-                # Применяем фильтр по животным
-                if animal_types:
-                    similar_tests, _ = await apply_animal_filter(similar_tests, original_query)
+    data = await state.get_data()
+    original_input = search_text if search_text else message.text.strip()
+    original_query = data.get("original_query", original_input)
 
-                await safe_cancel_animation(animation_task)
-                await safe_delete_message(loading_msg)
-                await safe_delete_message(gif_msg)
+    # НЕ логируем здесь - логирование через log_request_metric происходит после обработки
+    
+    # Индикатор загрузки - только если поиск не уложился в быстрый путь
+    loading = LoadingIndicator(
+        message, "🔍 Ищу по коду...\n⏳ Анализирую данные...", gif_id=LOADING_GIF_ID
+    ).start()
 
-                # Логируем результат поиска
-                response_time = time.time() - start_time
-                try:
-                    await db.log_request_metric(
-                        user_id=user_id,
-                        request_type="code_search",
-                        query_text=original_query[:500],
-                        response_time=response_time,
-                        success=True,
-                        has_answer=True if similar_tests else False
-                    )
-                except Exception as e:
-                    logger.error(f"[METRICS] Failed to log code_search metric: {e}")
+    try:
+        processor = DataProcessor()
+        processor.load_vector_store()
 
-                await db.add_search_history(
+        # FIX #21: Проверка нормализации
+        normalized_input = normalize_test_code(original_input)
+        if not normalized_input:
+            await loading.stop()
+            
+            # Логируем некорректный формат кода (реальная ошибка)
+            response_time = time.time() - start_time
+            try:
+                await db.log_request_metric(
                     user_id=user_id,
-                    search_query=original_query,
-                    search_type="code",
+                    request_type="code_search",
+                    query_text=original_input[:500],
+                    response_time=response_time,
                     success=False,
+                    has_answer=False,
+                    error_message="Не удалось распознать код теста"
                 )
+            except Exception as e:
+                logger.error(f"[METRICS] Failed to log error metric: {e}")
+            
+            await message.answer(
+                f"❌ Не удалось распознать код теста: {html.escape(original_input[:50])}",
+                reply_markup=get_dialog_kb(),
+                parse_mode="HTML"
+            )
+            return
 
-                if similar_tests:
-                    # FIX #17 & #19: Сохраняем минимизированные данные СО score
-                    search_id = hashlib.md5(
-                        f"{user_id}_{datetime.now().timestamp()}_{normalized_input}".encode()
-                    ).hexdigest()[:8]
-                    
-                    simplified_results = [
-                        {
-                            'metadata': {
-                                'test_code': doc.metadata.get('test_code'),
-                                'test_name': doc.metadata.get('test_name'),
-                                'department': doc.metadata.get('department')
-                            },
-                            'score': score
-                        }
-                        for doc, score in similar_tests
-                    ]
-                    
-                    await state.update_data(**{
-                        f"search_results_{search_id}": {
-                            'data': simplified_results,
-                            'timestamp': datetime.now().timestamp(),
-                            'query': normalized_input
-                        }
-                    })
-                    
-                    await cleanup_old_search_results(state)
-                    
-                    # Считаем типы
-                    tests_count = sum(
-                        1 for item in simplified_results 
-                        if not is_profile_test(item['metadata'].get('test_code', ''))
-                    )
-                    profiles_count = sum(
-                        1 for item in simplified_results 
-                        if is_profile_test(item['metadata'].get('test_code', ''))
-                    )
-                    
-                    tests_only_results = [
-                        item for item in simplified_results 
-                        if not is_profile_test(item['metadata'].get('test_code', ''))
-                    ]
-
-                    keyboard, total_pages, items_shown = create_paginated_keyboard(
-                        simplified_results,  # Передаем ВСЕ результаты
-                        current_page=0,
-                        items_per_page=ITEMS_PER_PAGE,
-                        search_id=search_id,
-                        include_filters=True,
-                        tests_count=tests_count,
-                        profiles_count=profiles_count,
-                        total_count=len(simplified_results),
-                        current_view="tests"  # Явно указываем, что показываем только тесты
-                    )
-                    
-                    response = (
-                        f"❌ Точное совпадение для кода '<code>{html.escape(normalized_input)}</code>' не найдено.\n\n"
-                    )
-                    
-                    if animal_types:
-                        animal_display = animal_filter.get_animal_display_names(animal_types)
-                        response += f"🐾 <b>Фильтр по животным:</b> {animal_display}\n\n"
-                    
-                    response += f"🔍 <b>Найдены похожие результаты ({len(similar_tests)} шт.)</b>"
-                    
-                    if total_pages > 1:
-                        response += f" <b>(страница 1 из {total_pages}):</b>\n\n"
-                    else:
-                        response += ":\n\n"
-                    
-
-                    filtered_results = [
-                        item for item in simplified_results 
-                        if not is_profile_test(item['metadata'].get('test_code', ''))
-                    ]
-                    # FIX #17: Правильное использование данных со score
-                    for i, item in enumerate(filtered_results[:items_shown], 1):
-                        metadata = item['metadata']
-                        score = item['score']
-                        
-                        test_code = sanitize_test_code_for_display(metadata['test_code'])
-                        test_name = html.escape(metadata['test_name'])
-                        
-                        type_label = "🔬 Профиль" if is_profile_test(test_code) else "🧪 Тест"
-                        link = create_test_link(test_code)
-                        
-                        response += (
-                            f"<b>{i}.</b> {type_label}: <a href='{link}'>{test_code}</a> - {test_name}\n"
-                            f"   📊 Схожесть: {score:.2f}%\n\n"
-                        )
-                    
-                    response += "\n💡 <i>Нажмите на код теста или используйте кнопки для выбора</i>"
-                    
-                    if total_pages > 1:
-                        response += f"\n📄 <i>Используйте навигацию для просмотра всех результатов</i>"
-                    
-                    await message.answer(
-                        response,
-                        parse_mode="HTML",
-                        disable_web_page_preview=True,
-                        reply_markup=keyboard
-                    )
-                else:
-                    # Ничего не найдено
-                    error_msg = f"❌ Код '<code>{html.escape(normalized_input)}</code>' не найден в базе данных.\n"
-                    
-                    if animal_types:
-                        animal_display = animal_filter.get_animal_display_names(animal_types)
-                        error_msg += f"🐾 <b>Фильтр по животным:</b> {animal_display}\n\n"
-                    
-                    error_msg += "💡 Попробуйте проверить правильность написания кода."
-                    
-                    await message.answer(
-                        error_msg, 
-                        reply_markup=get_dialog_kb(), 
-                        parse_mode="HTML"
-                    )
-
-                await state.set_state(QuestionStates.waiting_for_search_type)
-                return
-
-            # Найден точный результат
-            doc = result[0]
-            test_data = format_test_data(doc.metadata)
-
-            type_info = ""
-            if is_profile_test(test_data["test_code"]):
-                type_info = "🔬 <b>Это профиль тестов</b>\n\n"
-
-            response = type_info + format_test_info(test_data)
+        # Умный поиск
+        result, found_variant, match_type = await smart_test_search(
+            processor, original_input
+        )
 
-            # Статистика
-            await db.add_search_history(
-                user_id=user_id,
-                search_query=original_query,
-                found_test_code=test_data["test_code"],
-                search_type="code",
-                success=True,
+        # Фильтр по животным
+        animal_types = set()
+        if not result:
+            animal_types = await cpu_offload.run(
+                animal_filter.extract_animals_from_query, original_query,
+                stage="animal_filter", size=len(original_query)
             )
 
-            await db.update_user_frequent_test(
-                user_id=user_id,
-                test_code=test_data["test_code"],
-                test_name=test_data["test_name"],
+        # Если не нашли - fuzzy поиск
+        if not result:
+            # FIX #25: Увеличен threshold
+            similar_tests = await fuzzy_test_search(
+                processor, normalized_input, threshold=FUZZY_SEARCH_THRESHOLD_MIN
             )
 
-            await safe_cancel_animation(animation_task)
-            await safe_delete_message(loading_msg)
-            await safe_delete_message(gif_msg)
+            # Применяем фильтр по животным
+            if animal_types:
+                similar_tests, _ = await apply_animal_filter(similar_tests, original_query)
 
-            # Отправляем информацию
-            await send_test_info_with_photo(message, test_data, response)
-            
-            # Логируем метрику запроса
+            await loading.stop()
+
+            # Логируем результат поиска
             response_time = time.time() - start_time
             try:
                 await db.log_request_metric(
@@ -2246,61 +1959,219 @@ async def _handle_code_search_internal(
                     query_text=original_query[:500],
                     response_time=response_time,
                     success=True,
-                    has_answer=True
+                    has_answer=True if similar_tests else False
                 )
-                logger.info(f"[METRICS] Logged code_search metric for user {user_id}")
             except Exception as e:
                 logger.error(f"[METRICS] Failed to log code_search metric: {e}")
-            
-            try:
-                # Формируем текст ответа для логирования в chat_history
-                log_response = f"✅ Найден тест: {test_data['test_code']}\n\n{response}"
+
+            await db.add_search_history(
+                user_id=user_id,
+                search_query=original_query,
+                search_type="code",
+                success=False,
+            )
+
+            if similar_tests:
+                # Для пагинации храним только (код, score) - вне FSM
+                search_id = search_sessions.put(
+                    (doc.metadata.get('test_code'), score) for doc, score in similar_tests
+                )
                 
-                await db.log_chat_interaction(
-                    user_id=user_id,
-                    user_name=message.from_user.full_name or f"ID{user_id}",
-                    question=original_query,
-                    bot_response=log_response,
-                    request_type='code_search',
-                    search_success=True,
-                    found_test_code=test_data['test_code']
+                simplified_results = [
+                    {
+                        'metadata': {
+                            'test_code': doc.metadata.get('test_code'),
+                            'test_name': doc.metadata.get('test_name'),
+                            'department': doc.metadata.get('department')
+                        },
+                        'score': score
+                    }
+                    for doc, score in similar_tests
+                ]
+                
+                # Считаем типы
+                tests_count = sum(
+                    1 for item in simplified_results 
+                    if not is_profile_test(item['metadata'].get('test_code', ''))
                 )
-            except Exception as e:
-                logger.error(f"[LOGGING] Failed to log code search: {e}")
+                profiles_count = sum(
+                    1 for item in simplified_results 
+                    if is_profile_test(item['metadata'].get('test_code', ''))
+                )
+                
+                tests_only_results = [
+                    item for item in simplified_results 
+                    if not is_profile_test(item['metadata'].get('test_code', ''))
+                ]
 
-            # Связанные тесты
-            if "last_viewed_test" in data and data["last_viewed_test"] != test_data["test_code"]:
-                await db.update_related_tests(
-                    user_id=user_id,
-                    test_code_1=data["last_viewed_test"],
-                    test_code_2=test_data["test_code"],
+                keyboard, total_pages, items_shown = create_paginated_keyboard(
+                    simplified_results,  # Передаем ВСЕ результаты
+                    current_page=0,
+                    items_per_page=ITEMS_PER_PAGE,
+                    search_id=search_id,
+                    include_filters=True,
+                    tests_count=tests_count,
+                    profiles_count=profiles_count,
+                    total_count=len(simplified_results),
+                    current_view="tests"  # Явно указываем, что показываем только тесты
+                )
+                
+                response = (
+                    f"❌ Точное совпадение для кода '<code>{html.escape(normalized_input)}</code>' не найдено.\n\n"
+                )
+                
+                if animal_types:
+                    animal_display = animal_filter.get_animal_display_names(animal_types)
+                    response += f"🐾 <b>Фильтр по животным:</b> {animal_display}\n\n"
+                
+                response += f"🔍 <b>Найдены похожие результаты ({len(similar_tests)} шт.)</b>"
+                
+                if total_pages > 1:
+                    response += f" <b>(страница 1 из {total_pages}):</b>\n\n"
+                else:
+                    response += ":\n\n"
+                
+
+                filtered_results = [
+                    item for item in simplified_results 
+                    if not is_profile_test(item['metadata'].get('test_code', ''))
+                ]
+                # FIX #17: Правильное использование данных со score
+                for i, item in enumerate(filtered_results[:items_shown], 1):
+                    metadata = item['metadata']
+                    score = item['score']
+                    
+                    test_code = sanitize_test_code_for_display(metadata['test_code'])
+                    test_name = html.escape(metadata['test_name'])
+                    
+                    type_label = "🔬 Профиль" if is_profile_test(test_code) else "🧪 Тест"
+                    link = create_test_link(test_code)
+                    
+                    response += (
+                        f"<b>{i}.</b> {type_label}: <a href='{link}'>{test_code}</a> - {test_name}\n"
+                        f"   📊 Схожесть: {score:.2f}%\n\n"
+                    )
+                
+                response += "\n💡 <i>Нажмите на код теста или используйте кнопки для выбора</i>"
+                
+                if total_pages > 1:
+                    response += f"\n📄 <i>Используйте навигацию для просмотра всех результатов</i>"
+                
+                await message.answer(
+                    response,
+                    parse_mode="HTML",
+                    disable_web_page_preview=True,
+                    reply_markup=keyboard
+                )
+            else:
+                # Ничего не найдено
+                error_msg = f"❌ Код '<code>{html.escape(normalized_input)}</code>' не найден в базе данных.\n"
+                
+                if animal_types:
+                    animal_display = animal_filter.get_animal_display_names(animal_types)
+                    error_msg += f"🐾 <b>Фильтр по животным:</b> {animal_display}\n\n"
+                
+                error_msg += "💡 Попробуйте проверить правильность написания кода."
+                
+                await message.answer(
+                    error_msg, 
+                    reply_markup=get_dialog_kb(), 
+                    parse_mode="HTML"
                 )
 
-            # Обновляем состояние
             await state.set_state(QuestionStates.waiting_for_search_type)
-            await message.answer(
-                "Готов к новому запросу! Введите код теста или опишите, что ищете:",
-                reply_markup=get_dialog_kb()
-            )
+            return
+
+        # Найден точный результат
+        doc = result[0]
+        test_data = format_test_data(doc.metadata)
 
-        except asyncio.CancelledError:
-            await safe_cancel_animation(animation_task)
-            await safe_delete_message(loading_msg)
-            await safe_delete_message(gif_msg)
-            await message.answer("⏹ Поиск остановлен.", reply_markup=get_dialog_kb())
+        type_info = ""
+        if is_profile_test(test_data["test_code"]):
+            type_info = "🔬 <b>Это профиль тестов</b>\n\n"
 
+        response = type_info + format_test_info(test_data)
+
+        # Статистика
+        await db.add_search_history(
+            user_id=user_id,
+            search_query=original_query,
+            found_test_code=test_data["test_code"],
+            search_type="code",
+            success=True,
+        )
+
+        await db.update_user_frequent_test(
+            user_id=user_id,
+            test_code=test_data["test_code"],
+            test_name=test_data["test_name"],
+        )
+
+        await loading.stop()
+
+        # Отправляем информацию
+        await send_test_info_with_photo(message, test_data, response)
+        
+        # Логируем метрику запроса
+        response_time = time.time() - start_time
+        try:
+            await db.log_request_metric(
+                user_id=user_id,
+                request_type="code_search",
+                query_text=original_query[:500],
+                response_time=response_time,
+                success=True,
+                has_answer=True
+            )
+            logger.info(f"[METRICS] Logged code_search metric for user {user_id}")
         except Exception as e:
-            logger.error(f"[CODE_SEARCH] Failed: {e}", exc_info=True)
+            logger.error(f"[METRICS] Failed to log code_search metric: {e}")
+        
+        try:
+            # Формируем текст ответа для логирования в chat_history
+            log_response = f"✅ Найден тест: {test_data['test_code']}\n\n{response}"
             
-            await safe_cancel_animation(animation_task)
-            await safe_delete_message(loading_msg)
-            await safe_delete_message(gif_msg)
+            await db.log_chat_interaction(
+                user_id=user_id,
+                user_name=message.from_user.full_name or f"ID{user_id}",
+                question=original_query,
+                bot_response=log_response,
+                request_type='code_search',
+                search_success=True,
+                found_test_code=test_data['test_code']
+            )
+        except Exception as e:
+            logger.error(f"[LOGGING] Failed to log code search: {e}")
 
-            await message.answer(
-                "⚠️ Ошибка при поиске. Попробуйте позже",
-                reply_markup=get_dialog_kb()
+        # Связанные тесты
+        if "last_viewed_test" in data and data["last_viewed_test"] != test_data["test_code"]:
+            await db.update_related_tests(
+                user_id=user_id,
+                test_code_1=data["last_viewed_test"],
+                test_code_2=test_data["test_code"],
             )
-            await state.set_state(QuestionStates.waiting_for_search_type)
+
+        # Обновляем состояние
+        await state.set_state(QuestionStates.waiting_for_search_type)
+        await message.answer(
+            "Готов к новому запросу! Введите код теста или опишите, что ищете:",
+            reply_markup=get_dialog_kb()
+        )
+
+    except asyncio.CancelledError:
+        await loading.stop()
+        await message.answer("⏹ Поиск остановлен.", reply_markup=get_dialog_kb())
+
+    except Exception as e:
+        logger.error(f"[CODE_SEARCH] Failed: {e}", exc_info=True)
+        
+        await loading.stop()
+
+        await message.answer(
+            "⚠️ Ошибка при поиске. Попробуйте позже",
+            reply_markup=get_dialog_kb()
+        )
+        await state.set_state(QuestionStates.waiting_for_search_type)
 
 # ============================================================================
 # ПОИСК ПО НАЗВАНИЮ
@@ -2325,15 +2196,24 @@ async def _handle_name_search_internal(
     message: Message,
     state: FSMContext,
     search_text: Optional[str] = None
+):
+    """Поиск по названию через планировщик пользователя: новый запрос отменяет незавершенный"""
+    await user_scheduler.run(message.chat.id, _name_search_pipeline, message, state, search_text)
+
+
+async def _name_search_pipeline(
+    message: Message,
+    state: FSMContext,
+    search_text: Optional[str] = None
 ):
     """
     Внутренняя функция поиска по названию
     
     Исправлено:
-    - Добавлен Lock для предотвращения race conditions
+    - Один запрос пользователя за раз (user_scheduler), новый отменяет старый
     - Минимизированные данные в state
     - Применение фильтра по животным
-    - Корректная обработка animation_task
+    - Индикатор загрузки с быстрым путем (LoadingIndicator)
     """
     user_id = message.from_user.id
     
@@ -2341,278 +2221,260 @@ async def _handle_name_search_internal(
     import time
     start_time = time.time()
 
-    # FIX #18: Атомарная блокировка
-    async with user_processing_locks[user_id]:
-        data = await state.get_data()
-        original_query = data.get("original_query", message.text if not search_text else search_text)
-        text = search_text if search_text else message.text.strip()
-
-        # Записываем статистику поиска по названию
-        await db.add_request_stat(
-            user_id=user_id,
-            request_type="question",  # Считаем name_search как question
-            request_text=original_query
-        )
-
-        gif_msg = None
-        loading_msg = None
-        animation_task = None
+    data = await state.get_data()
+    original_query = data.get("original_query", message.text if not search_text else search_text)
+    text = search_text if search_text else message.text.strip()
+
+    # Записываем статистику поиска по названию
+    await db.add_request_stat(
+        user_id=user_id,
+        request_type="question",  # Считаем name_search как question
+        request_text=original_query
+    )
 
-        try:
-            search_description = "🔍 Ищу тесты по запросу..."
+    search_description = "🔍 Ищу тесты по запросу..."
+    loading = LoadingIndicator(
+        message,
+        f"{search_description}\n⏳ Анализирую данные..." if LOADING_GIF_ID else search_description,
+        gif_id=LOADING_GIF_ID,
+        animated=bool(LOADING_GIF_ID)
+    ).start()
 
-            if LOADING_GIF_ID:
-                try:
-                    gif_msg = await message.answer_animation(LOADING_GIF_ID, caption="")
-                except Exception:
-                    gif_msg = None
-                
-                loading_msg = await message.answer(
-                    f"{search_description}\n⏳ Анализирую данные..."
-                )
-                animation_task = asyncio.create_task(animate_loading(loading_msg))
-            else:
-                loading_msg = await message.answer(search_description)
-
-            processor = DataProcessor()
-            processor.load_vector_store()
+    try:
+        processor = DataProcessor()
+        processor.load_vector_store()
 
-            # Поиск
-            rag_hits = processor.search_test(text, top_k=TEXT_SEARCH_TOP_K)
+        # Поиск (эмбеддинг, Chroma, расширение запроса) - вне event loop,
+        # один на одинаковые одновременные запросы; список копируем - реранжирование сортирует его
+        rag_hits = await single_flight.do(
+            ("vector_search", query_key(text), TEXT_SEARCH_TOP_K, processor.catalog_version),
+            cpu_offload.run, processor.search_test, text, top_k=TEXT_SEARCH_TOP_K, stage="vector_search"
+        )
+        rag_hits = list(rag_hits)
 
-            # Реранжирование
-            rag_hits = _rerank_hits_by_query(rag_hits, original_query)
+        # Реранжирование
+        rag_hits = _rerank_hits_by_query(rag_hits, original_query)
 
-            # Применяем фильтр по животным
-            rag_hits, animal_types = await apply_animal_filter(rag_hits, original_query)
+        # Применяем фильтр по животным
+        rag_hits, animal_types = await apply_animal_filter(rag_hits, original_query)
 
-            if not rag_hits:
-                await db.add_search_history(
+        if not rag_hits:
+            await db.add_search_history(
+                user_id=user_id,
+                search_query=original_query,
+                search_type="text",
+                success=False
+            )
+            
+            # Логируем поиск без результатов (но бот корректно отработал)
+            response_time = time.time() - start_time
+            try:
+                await db.log_request_metric(
                     user_id=user_id,
-                    search_query=original_query,
-                    search_type="text",
-                    success=False
+                    request_type="name_search",
+                    query_text=original_query[:500],
+                    response_time=response_time,
+                    success=True,  # Бот корректно отработал
+                    has_answer=False  # Но результатов не найдено
                 )
-                
-                # Логируем поиск без результатов (но бот корректно отработал)
-                response_time = time.time() - start_time
-                try:
-                    await db.log_request_metric(
-                        user_id=user_id,
-                        request_type="name_search",
-                        query_text=original_query[:500],
-                        response_time=response_time,
-                        success=True,  # Бот корректно отработал
-                        has_answer=False  # Но результатов не найдено
-                    )
-                except Exception as e:
-                    logger.error(f"[METRICS] Failed to log name_search metric: {e}")
+            except Exception as e:
+                logger.error(f"[METRICS] Failed to log name_search metric: {e}")
 
-                await safe_cancel_animation(animation_task)
-                await safe_delete_message(loading_msg)
-                await safe_delete_message(gif_msg)
+            await loading.stop()
 
-                not_found_msg = f"❌ Тесты по запросу '<b>{html.escape(text)}</b>' не найдены.\n\n"
-                
-                if animal_types:
-                    animal_display = animal_filter.get_animal_display_names(animal_types)
-                    not_found_msg += f"🐾 <b>Фильтр по животным:</b> {animal_display}\n\n"
+            not_found_msg = f"❌ Тесты по запросу '<b>{html.escape(text)}</b>' не найдены.\n\n"
+            
+            if animal_types:
+                animal_display = animal_filter.get_animal_display_names(animal_types)
+                not_found_msg += f"🐾 <b>Фильтр по животным:</b> {animal_display}\n\n"
 
-                await message.answer(
-                    not_found_msg,
-                    reply_markup=get_dialog_kb(),
-                    parse_mode="HTML"
-                )
+            await message.answer(
+                not_found_msg,
+                reply_markup=get_dialog_kb(),
+                parse_mode="HTML"
+            )
 
-                await state.set_state(QuestionStates.waiting_for_search_type)
-                return
+            await state.set_state(QuestionStates.waiting_for_search_type)
+            return
 
-            # Выбираем лучшие совпадения
-            selected_docs = await select_best_match(text, rag_hits)
+        # Выбираем лучшие совпадения
+        selected_docs = await select_best_match(
+            text, rag_hits, deadline=start_time + LLM_TIMEOUT_SECONDS
+        )
 
-            # Записываем статистику
-            for doc in selected_docs[:1]:
-                await db.add_search_history(
-                    user_id=user_id,
-                    search_query=original_query,
-                    found_test_code=doc.metadata["test_code"],
-                    search_type="text",
-                    success=True
-                )
+        # Записываем статистику
+        for doc in selected_docs[:1]:
+            await db.add_search_history(
+                user_id=user_id,
+                search_query=original_query,
+                found_test_code=doc.metadata["test_code"],
+                search_type="text",
+                success=True
+            )
 
-                await db.update_user_frequent_test(
-                    user_id=user_id,
-                    test_code=doc.metadata["test_code"],
-                    test_name=doc.metadata["test_name"],
-                )
+            await db.update_user_frequent_test(
+                user_id=user_id,
+                test_code=doc.metadata["test_code"],
+                test_name=doc.metadata["test_name"],
+            )
 
-            await safe_cancel_animation(animation_task)
-            await safe_delete_message(loading_msg)
-            await safe_delete_message(gif_msg)
+        await loading.stop()
 
-            # FIX #17 & #19: Минимизированные данные
-            search_id = hashlib.md5(
-                f"{user_id}_{datetime.now().timestamp()}_{text}".encode()
-            ).hexdigest()[:8]
-            
-            simplified_results = [
-                {
-                    'metadata': {
-                        'test_code': doc.metadata.get('test_code'),
-                        'test_name': doc.metadata.get('test_name'),
-                        'department': doc.metadata.get('department')
-                    },
-                    'score': 0  # Для name search score не так важен
-                }
-                for doc in selected_docs
-            ]
+        # Для пагинации храним только (код, score) - вне FSM
+        search_id = search_sessions.put(
+            (doc.metadata.get('test_code'), 0) for doc in selected_docs
+        )
+        
+        simplified_results = [
+            {
+                'metadata': {
+                    'test_code': doc.metadata.get('test_code'),
+                    'test_name': doc.metadata.get('test_name'),
+                    'department': doc.metadata.get('department')
+                },
+                'score': 0  # Для name search score не так важен
+            }
+            for doc in selected_docs
+        ]
+        
+        # Считаем типы
+        tests_count = sum(
+            1 for item in simplified_results 
+            if not is_profile_test(item['metadata'].get('test_code', ''))
+        )
+        profiles_count = sum(
+            1 for item in simplified_results 
+            if is_profile_test(item['metadata'].get('test_code', ''))
+        )
+        
+        
+        tests_only_results = [
+            item for item in simplified_results 
+            if not is_profile_test(item['metadata'].get('test_code', ''))
+        ]
+        total_count = len(simplified_results)
+
+        keyboard, total_pages, items_shown = create_paginated_keyboard(
+            simplified_results,  # Передаем ВСЕ результаты
+            current_page=0,
+            items_per_page=ITEMS_PER_PAGE,
+            search_id=search_id,
+            include_filters=True,
+            tests_count=tests_count,
+            profiles_count=profiles_count,
+            total_count=total_count,
+            current_view="tests"  # Явно указываем, что показываем только тесты
+        )
+        
+        # Формируем ответ
+        response = f"🔍 <b>Найдено {total_count} результаты</b>"
+        
+        if animal_types:
+            animal_display = animal_filter.get_animal_display_names(animal_types)
+            response += f" <b>(фильтр: {animal_display})</b>"
+        
+        if total_pages > 1:
+            response += f" <b>(страница 1 из {total_pages}):</b>\n\n"
+        else:
+            response += ":\n\n"
+        
+        filtered_results = [
+            item for item in simplified_results 
+            if not is_profile_test(item['metadata'].get('test_code', ''))
+        ]
+
+        for i, item in enumerate(filtered_results[:items_shown], 1):
+
+            metadata = item['metadata']
             
-            await state.update_data(**{
-                f"search_results_{search_id}": {
-                    'data': simplified_results,
-                    'timestamp': datetime.now().timestamp(),
-                    'query': text
-                }
-            })
+            test_code = sanitize_test_code_for_display(metadata['test_code'])
+            test_name = html.escape(metadata['test_name'])
+            department = html.escape(metadata.get('department', 'Не указано'))
             
-            await cleanup_old_search_results(state)
+            type_label = "🔬 Профиль" if is_profile_test(test_code) else "🧪 Тест"
+            link = create_test_link(test_code)
             
-            # Считаем типы
-            tests_count = sum(
-                1 for item in simplified_results 
-                if not is_profile_test(item['metadata'].get('test_code', ''))
+            response += (
+                f"<b>{i}.</b> {type_label}: <a href='{link}'>{test_code}</a>\n"
+                f"📝 {test_name}\n"
+                f"📋 {department}\n\n"
             )
-            profiles_count = sum(
-                1 for item in simplified_results 
-                if is_profile_test(item['metadata'].get('test_code', ''))
-            )
-            
-            
-            tests_only_results = [
-                item for item in simplified_results 
-                if not is_profile_test(item['metadata'].get('test_code', ''))
-            ]
-            total_count = len(simplified_results)
-
-            keyboard, total_pages, items_shown = create_paginated_keyboard(
-                simplified_results,  # Передаем ВСЕ результаты
-                current_page=0,
-                items_per_page=ITEMS_PER_PAGE,
-                search_id=search_id,
-                include_filters=True,
-                tests_count=tests_count,
-                profiles_count=profiles_count,
-                total_count=total_count,
-                current_view="tests"  # Явно указываем, что показываем только тесты
+        
+        response += "\n💡 <i>Нажмите на код теста в сообщении выше или выберите из кнопок</i>"
+        
+        if total_pages > 1:
+            response += f"\n📄 <i>Используйте кнопки навигации для просмотра всех результатов</i>"
+        
+        await message.answer(
+            response,
+            parse_mode="HTML",
+            disable_web_page_preview=True,
+            reply_markup=keyboard
+        )
+        
+        # Логируем успешный поиск по названию
+        response_time = time.time() - start_time
+        try:
+            await db.log_request_metric(
+                user_id=user_id,
+                request_type="name_search",
+                query_text=original_query[:500],
+                response_time=response_time,
+                success=True,
+                has_answer=True
             )
-            
-            # Формируем ответ
-            response = f"🔍 <b>Найдено {total_count} результаты</b>"
-            
-            if animal_types:
-                animal_display = animal_filter.get_animal_display_names(animal_types)
-                response += f" <b>(фильтр: {animal_display})</b>"
-            
-            if total_pages > 1:
-                response += f" <b>(страница 1 из {total_pages}):</b>\n\n"
-            else:
-                response += ":\n\n"
-            
-            filtered_results = [
-                item for item in simplified_results 
-                if not is_profile_test(item['metadata'].get('test_code', ''))
-            ]
-
-            for i, item in enumerate(filtered_results[:items_shown], 1):
+            logger.info(f"[METRICS] Logged name_search metric for user {user_id}")
+        except Exception as e:
+            logger.error(f"[METRICS] Failed to log name_search metric: {e}")
+        
+        should_ask, rating_id = await rating_manager.should_ask_for_rating(
+            user_id=message.from_user.id,
+            response_type="name_search"
+        )
 
-                metadata = item['metadata']
-                
-                test_code = sanitize_test_code_for_display(metadata['test_code'])
-                test_name = html.escape(metadata['test_name'])
-                department = html.escape(metadata.get('department', 'Не указано'))
-                
-                type_label = "🔬 Профиль" if is_profile_test(test_code) else "🧪 Тест"
-                link = create_test_link(test_code)
-                
-                response += (
-                    f"<b>{i}.</b> {type_label}: <a href='{link}'>{test_code}</a>\n"
-                    f"📝 {test_name}\n"
-                    f"📋 {department}\n\n"
-                )
-            
-            response += "\n💡 <i>Нажмите на код теста в сообщении выше или выберите из кнопок</i>"
+        if should_ask:
+            # Сохраняем информацию о запросе и результатах
+            rating_response = response
+        
+            await state.update_data({
+                f"last_question_{rating_id}": text,
+                f"last_response_{rating_id}": rating_response
+            })
             
-            if total_pages > 1:
-                response += f"\n📄 <i>Используйте кнопки навигации для просмотра всех результатов</i>"
+            # Запрашиваем оценку через 1 секунду
+            await asyncio.sleep(1)
+            rating_keyboard = rating_manager.create_rating_keyboard(rating_id)
             
             await message.answer(
-                response,
+                "📊 <b>Оцените, пожалуйста, результаты поиска:</b>",
                 parse_mode="HTML",
-                disable_web_page_preview=True,
-                reply_markup=keyboard
-            )
-            
-            # Логируем успешный поиск по названию
-            response_time = time.time() - start_time
-            try:
-                await db.log_request_metric(
-                    user_id=user_id,
-                    request_type="name_search",
-                    query_text=original_query[:500],
-                    response_time=response_time,
-                    success=True,
-                    has_answer=True
-                )
-                logger.info(f"[METRICS] Logged name_search metric for user {user_id}")
-            except Exception as e:
-                logger.error(f"[METRICS] Failed to log name_search metric: {e}")
-            
-            should_ask, rating_id = await rating_manager.should_ask_for_rating(
-                user_id=message.from_user.id,
-                response_type="name_search"
+                reply_markup=rating_keyboard
             )
 
-            if should_ask:
-                # Сохраняем информацию о запросе и результатах
-                rating_response = response
-            
-                await state.update_data({
-                    f"last_question_{rating_id}": text,
-                    f"last_response_{rating_id}": rating_response
-                })
-                
-                # Запрашиваем оценку через 1 секунду
-                await asyncio.sleep(1)
-                rating_keyboard = rating_manager.create_rating_keyboard(rating_id)
-                
-                await message.answer(
-                    "📊 <b>Оцените, пожалуйста, результаты поиска:</b>",
-                    parse_mode="HTML",
-                    reply_markup=rating_keyboard
-                )
 
+        # Сохраняем последний тест
+        await state.set_state(QuestionStates.waiting_for_search_type)
+        await message.answer(
+            "Готов к новому запросу! Введите код теста или опишите, что ищете:",
+            reply_markup=get_dialog_kb()
+        )
 
-            # Сохраняем последний тест
-            await state.set_state(QuestionStates.waiting_for_search_type)
-            await message.answer(
-                "Готов к новому запросу! Введите код теста или опишите, что ищете:",
-                reply_markup=get_dialog_kb()
-            )
+    except asyncio.CancelledError:
+        await loading.stop()
+        await message.answer("⏹ Поиск остановлен.", reply_markup=get_dialog_kb())
 
-        except Exception as e:
-            logger.error(f"[NAME_SEARCH] Failed: {e}", exc_info=True)
+    except Exception as e:
+        logger.error(f"[NAME_SEARCH] Failed: {e}", exc_info=True)
 
-            await safe_cancel_animation(animation_task)
-            await safe_delete_message(loading_msg)
-            await safe_delete_message(gif_msg)
+        await loading.stop()
 
-            error_msg = (
-                "❌ Тесты не найдены"
-                if str(e) == "Тесты не найдены"
-                else "⚠️ Ошибка поиска. Попробуйте позже."
-            )
-            await message.answer(error_msg, reply_markup=get_dialog_kb())
-            await state.set_state(QuestionStates.waiting_for_search_type)
+        error_msg = (
+            "❌ Тесты не найдены"
+            if str(e) == "Тесты не найдены"
+            else "⚠️ Ошибка поиска. Попробуйте позже."
+        )
+        await message.answer(error_msg, reply_markup=get_dialog_kb())
+        await state.set_state(QuestionStates.waiting_for_search_type)
 
 
 # ============================================================================
@@ -2623,6 +2485,15 @@ async def handle_general_question(
     message: Message,
     state: FSMContext,
     question_text: str
+):
+    """Общий вопрос через планировщик пользователя: новый запрос отменяет незавершенный"""
+    await user_scheduler.run(message.chat.id, _general_question_pipeline, message, state, question_text)
+
+
+async def _general_question_pipeline(
+    message: Message,
+    state: FSMContext,
+    question_text: str
 ):
     """
     Обработка общих вопросов через LLM
@@ -2640,26 +2511,16 @@ async def handle_general_question(
     import time
     start_time = time.time()
 
-    if LOADING_GIF_ID:
-        try:
-            gif_msg = await message.answer_animation(LOADING_GIF_ID, caption="")
-        except Exception:
-            gif_msg = None
-        
-        loading_msg = await message.answer(
-            f"🤔 Анализирую вопрос..."
-        )
-        animation_task = asyncio.create_task(animate_loading(loading_msg))
-    else:
-        loading_msg = await message.answer("🤔 Анализирую вопрос...")
+    loading = LoadingIndicator(
+        message, "🤔 Анализирую вопрос...", gif_id=LOADING_GIF_ID, animated=bool(LOADING_GIF_ID)
+    ).start()
+    writer = None
 
     try:
         # 1. Проверка на нерелевантность
         if await _is_off_topic_question(question_text):
 
-            await safe_cancel_animation(animation_task)
-            await safe_delete_message(loading_msg)
-            await safe_delete_message(gif_msg)
+            await loading.stop()
             
             # Логируем off-topic вопрос (бот корректно отработал)
             response_time = time.time() - start_time
@@ -2693,16 +2554,19 @@ async def handle_general_question(
         processor = DataProcessor()
         processor.load_vector_store()
         
-        # 2. Поиск релевантных тестов
-        relevant_docs = processor.search_test(query=question_text, top_k=50)
+        # 2. Поиск релевантных тестов (вектор вопроса считаем один раз:
+        # он же используется семантическим кэшем ответов)
+        # Одинаковые одновременные вопросы ждут один эмбеддинг и поиск
+        question_embedding, relevant_docs = await single_flight.do(
+            ("question_search", query_key(question_text), processor.catalog_version),
+            _embed_and_search_question, processor, question_text
+        )
         relevant_tests = [doc for doc, score in relevant_docs if score > 0.3]
         
         # 3. Если нет результатов и вопрос сложный
         question_words = len(question_text.split())
         if not relevant_tests and question_words > 3:
-            await safe_cancel_animation(animation_task)
-            await safe_delete_message(loading_msg)
-            await safe_delete_message(gif_msg)
+            await loading.stop()
             
             # Логируем поиск без релевантной информации (бот корректно отработал)
             response_time = time.time() - start_time
@@ -2732,48 +2596,12 @@ async def handle_general_question(
             )
             return
 
-        # 4. Собираем контекст
-        context_info = ""
-        all_test_codes = set()
-        
-        if relevant_tests:
-            context_info = "\n\nРЕЛЕВАНТНАЯ ИНФОРМАЦИЯ ДЛЯ ВАШЕГО ВОПРОСА:\n"
-            
-            for doc in relevant_tests[:50]:
-                test_data = doc.metadata
-                test_code = test_data.get('test_code', '')
-                
-                if test_code:
-                    normalized_code = normalize_test_code(test_code)
-                    if normalized_code:
-                        all_test_codes.add(normalized_code.upper())
-                    
-                    context_info += f"\n🔬 Тест {normalized_code} - {test_data.get('test_name', '')}:\n"
-                    
-                    fields = [
-                        ('type', 'Тип'),
-                        ('specialization', 'Специализация'),
-                        ('code_letters', 'Аббревиатура в коде теста'),
-                        ('department', 'Вид исследования'),
-                        ('patient_preparation', 'Подготовка'),
-                        ('biomaterial_type', 'Биоматериал'),
-                        ('container_type', 'Контейнер'),
-                        ('container_number', 'Номер контейнера'),
-                        ('storage_temp', 'Хранение'),
-                        ('preanalytics', 'Преаналитика'),
-                        ('animal_type', 'Виды животных'),
-                        ('important_information', 'Важная информация'),
-                    ]
-                    
-                    for field, label in fields:
-                        value = test_data.get(field)
-                        if value and str(value).strip().lower() not in ['не указан', 'нет', '-', '']:
-                            value_str = str(value)
-                            if len(value_str) > 100:
-                                value_str = value_str[:97] + "..."
-                            context_info += f"  {label}: {value_str}\n"
-                    
-                    context_info += "  ─────────────────────────\n"
+        # 4. Собираем контекст: готовые описания тестов по релевантности
+        # в пределах бюджета токенов
+        catalog_version = processor.catalog_version
+        context_info, all_test_codes, context_stats = context_builder.build(
+            relevant_tests[:50], catalog_version
+        )
 
         user_name = get_user_first_name(user)
 
@@ -2816,21 +2644,42 @@ async def handle_general_question(
 честно скажи об этом и предложи обратиться к специалисту.
 """
 
-        # 6. Отправляем в LLM с timeout
+        # 6. Отправляем в LLM с timeout (потоково: черновик ответа
+        # появляется в сообщении загрузки по мере генерации)
+        # Черновик пишется в сообщение загрузки (если оно успело появиться);
+        # остальное от индикатора удаляется с первым фрагментом
+        loading_msg = loading.message
+
+        async def _stop_loading_animation():
+            await loading.stop(keep_message=loading_msg)
+
+        writer = StreamingMessageWriter(
+            message,
+            initial_message=loading_msg,
+            on_first_chunk=_stop_loading_animation
+        )
+
+        cache_scope = answer_cache.make_scope(
+            doc.metadata.get('test_code', '') for doc in relevant_tests
+        )
+        cached_answer = answer_cache.lookup(question_embedding, cache_scope, catalog_version)
+
         try:
-            response = await asyncio.wait_for(
-                llm.agenerate([
+            if cached_answer is not None:
+                answer = cached_answer
+            else:
+                # Дедлайн считается от начала обработки вопроса
+                answer = await llm_gateway.stream(
                     [
                         SystemMessage(content=system_prompt),
                         HumanMessage(content=question_text),
-                    ]
-                ]),
-                timeout=LLM_TIMEOUT_SECONDS
-            )
-        except asyncio.TimeoutError:
-            await safe_cancel_animation(animation_task)
-            await safe_delete_message(loading_msg)
-            await safe_delete_message(gif_msg)
+                    ],
+                    writer.push,
+                    deadline=start_time + LLM_TIMEOUT_SECONDS
+                )
+        except (asyncio.TimeoutError, LLMUnavailableError):
+            await writer.discard()
+            await loading.stop()
             
             await message.answer(
                 "⏱ Превышено время ожидания ответа. Попробуйте упростить вопрос или обратитесь к специалисту:",
@@ -2838,13 +2687,22 @@ async def handle_general_question(
             )
             return
 
-        answer = response.generations[0][0].text.strip()
+        answer = answer.strip()
+
+        prompt_tokens = estimate_tokens(system_prompt) + estimate_tokens(question_text)
+        logger.info(
+            f"[CONTEXT] user={user_id} prompt≈{prompt_tokens} tok "
+            f"(context≈{context_stats['context_tokens']} tok, "
+            f"{context_stats['tests_included']}/{context_stats['tests_available']} tests), "
+            f"completion≈{estimate_tokens(answer)} tok, "
+            f"build {context_stats['build_ms']:.1f} ms"
+            f"{', cached answer' if cached_answer is not None else ''}"
+        )
         
         # 7. Проверка качества ответа
         if await _is_unhelpful_answer(answer, question_text):
-            await safe_cancel_animation(animation_task)
-            await safe_delete_message(loading_msg)
-            await safe_delete_message(gif_msg)
+            await writer.discard()
+            await loading.stop()
             
             response_time = time.time() - start_time
             try:
@@ -2873,6 +2731,9 @@ async def handle_general_question(
             )
             return
 
+        if cached_answer is None:
+            answer_cache.store(question_text, question_embedding, cache_scope, catalog_version, answer)
+
         # 8. Обработка успешного ответа
         # Находим коды тестов и создаем ссылки
         code_patterns = [
@@ -2908,11 +2769,10 @@ async def handle_general_question(
             pattern = r'\b' + re.escape(escaped_code) + r'\b'
             processed_text = re.sub(pattern, code_to_link[code], processed_text)
         
-        await safe_cancel_animation(animation_task)
-        await safe_delete_message(loading_msg)
-        await safe_delete_message(gif_msg)
+        await loading.stop(keep_message=loading_msg)
         
-        # 9. Отправка ответа (с разбивкой если длинный)
+        # 9. Отправка ответа (с разбивкой если длинный): черновик
+        # заменяется отформатированным текстом
         if len(processed_text) > 4000:
             parts = []
             current = ""
@@ -2930,26 +2790,10 @@ async def handle_general_question(
             if current:
                 parts.append(current.rstrip())
             
-            for i, part in enumerate(parts):
-                try:
-                    await message.answer(
-                        part,
-                        parse_mode="HTML",
-                        disable_web_page_preview=True
-                    )
-                    if i < len(parts) - 1:
-                        await asyncio.sleep(0.5)
-                except Exception as e:
-                    logger.error(f"[GENERAL_Q] Failed to send part {i+1}: {e}")
-                    clean_part = re.sub(r'<[^>]+>', '', part)
-                    await message.answer(clean_part)
+            await writer.finalize(parts)
         else:
             try:
-                await message.answer(
-                    processed_text,
-                    parse_mode="HTML",
-                    disable_web_page_preview=True
-                )
+                await writer.finalize([processed_text])
                 
                 # Логируем успешный ответ на общий вопрос
                 response_time = time.time() - start_time
@@ -3042,12 +2886,19 @@ async def handle_general_question(
         except Exception as e:
             logger.error(f"[LOGGING] Failed to log general question: {e}")
 
+    except asyncio.CancelledError:
+        # Недописанный черновик ответа (в т.ч. без сообщения загрузки и продолжения) удаляем
+        if writer is not None:
+            await writer.discard()
+        await loading.stop()
+        await message.answer("⏹ Поиск остановлен.", reply_markup=get_dialog_kb())
+
     except Exception as e:
         logger.error(f"[GENERAL_Q] Failed: {e}", exc_info=True)
         
-        await safe_cancel_animation(animation_task)
-        await safe_delete_message(loading_msg)
-        await safe_delete_message(gif_msg)
+        if writer is not None:
+            await writer.discard()
+        await loading.stop()
         
         await message.answer(
             "⚠️ <b>Произошла техническая ошибка при обработке запроса</b>\n\n"
@@ -3078,7 +2929,9 @@ async def _process_confident_query(
     )
 
     user_id = message.from_user.id
-    expanded_query = expand_query_with_abbreviations(text)
+    expanded_query = await cpu_offload.run(
+        expand_query_with_abbreviations, text, stage="expand_query", size=len(text)
+    )
     
     # ============================================================
     # FIX: Улучшенная проверка для общих вопросов с аббревиатурами
@@ -3348,6 +3201,18 @@ async def send_test_info_with_photo(
             )
         ])
 
+    # Часто смотрят вместе - готовые top-N из памяти (пересчет в фоне)
+    for related in await db.get_related_tests(test_data['test_code'], limit=3):
+        related_name = related['test_name']
+        if len(related_name) > 40:
+            related_name = related_name[:37] + "..."
+        keyboard_buttons.append([
+            InlineKeyboardButton(
+                text=f"🔗 {sanitize_test_code_for_display(related['test_code'])} - {related_name}",
+                callback_data=TestCallback.pack("show_test", related['test_code']),
+            )
+        ])
+
     keyboard = InlineKeyboardMarkup(inline_keyboard=keyboard_buttons) if keyboard_buttons else None
     
     # Отправляем основную информацию о тесте
@@ -1,19 +1,26 @@
 from langchain.schema import SystemMessage, Document
 from typing import Optional, List, Tuple
 from fuzzywuzzy import fuzz
-from src.data_vectorization import DataProcessor
-from models.models_init import Google_Gemini_2_5_Flash_Lite as llm
+from src.data_vectorization import DataProcessor, get_catalog_version
+from models.llm_gateway import llm_gateway
 from bot.handlers.utils import normalize_test_code
 import re
+import asyncio
+import time
 from bot.handlers.query_processing.query_preprocessing import expand_query_with_abbreviations
 import pymorphy3
 from fuzzywuzzy import fuzz
 from src.database.db_init import db
+from utils.cpu_offload import cpu_offload
+from utils.single_flight import single_flight, query_key
 
 
 # Инициализируем один раз при загрузке модуля
 morph = pymorphy3.MorphAnalyzer()
 
+# Лимит на выбор лучших тестов через LLM (дальше - первый кандидат)
+LLM_SELECT_TIMEOUT_SECONDS = 10
+
 
 def calculate_fuzzy_score(query: str, test_code: str, test_name: str = "") -> float:
     """Улучшенная функция для точного поиска по коду теста."""
@@ -63,7 +70,19 @@ def calculate_fuzzy_score(query: str, test_code: str, test_name: str = "") -> fl
 async def fuzzy_test_search(
     processor: DataProcessor, query: str, threshold: float = 30
 ) -> List[Tuple[Document, float]]:
-    """Улучшенный fuzzy поиск с фильтрацией по цифрам."""
+    """Улучшенный fuzzy поиск с фильтрацией по цифрам (в пуле cpu_offload)."""
+    # Одинаковые одновременные запросы ждут один проход по каталогу
+    key = ("fuzzy_search", normalize_test_code(query), threshold, processor.catalog_version)
+    results = await single_flight.do(
+        key, cpu_offload.run,
+        _fuzzy_test_search_sync, processor, query, threshold, stage="fuzzy_search"
+    )
+    return list(results)
+
+
+def _fuzzy_test_search_sync(
+    processor: DataProcessor, query: str, threshold: float
+) -> List[Tuple[Document, float]]:
     # Нормализуем запрос
     query = normalize_test_code(query)
 
@@ -375,11 +394,19 @@ async def smart_test_search(processor, original_query: str) -> Optional[tuple]:
     if not normalized_query:
         return None, None, None
 
-    # 1. Точный поиск по нормализованному коду
+    # 1. Точный поиск по нормализованному коду (словарь индекса каталога - сразу)
     results = processor.search_test(filter_dict={"test_code": normalized_query})
     if results:
         return results[0], normalized_query, "exact"
 
+    # Варианты и текстовый поиск - в пуле cpu_offload, один на одинаковые запросы
+    return await single_flight.do(
+        ("code_search", normalized_query, processor.catalog_version),
+        cpu_offload.run, _search_code_variants, processor, normalized_query, stage="code_search"
+    )
+
+
+def _search_code_variants(processor, normalized_query: str) -> tuple:
     # 2. Генерируем варианты и ищем
     variants = generate_test_code_variants(normalized_query)
     for variant in variants[:5]:
@@ -457,9 +484,33 @@ def get_priority_tests_for_query(query: str) -> list[str]:
 
 
 
-async def select_best_match(query: str, docs: list[tuple[Document, float]]) -> list[Document]:
+async def select_best_match(
+    query: str, docs: list[tuple[Document, float]], deadline: Optional[float] = None
+) -> list[Document]:
     """Select best matching tests using LLM with priority table reordering."""
-    
+    # Одинаковые одновременные запросы с теми же кандидатами - один вызов LLM.
+    # Общее вычисление идет без дедлайна (его ограничивает таймаут LLM), а дедлайн
+    # каждого запроса применяется к его ожиданию: чужой таймаут не роняет остальных
+    key = (
+        "select_best_match",
+        query_key(query),
+        tuple(doc.metadata.get("test_code") for doc, _ in docs),
+        get_catalog_version(),
+    )
+    shared = single_flight.do(key, _select_best_match, query, docs)
+    if deadline is None:
+        return list(await shared)
+    try:
+        selected = await asyncio.wait_for(shared, timeout=max(deadline - time.time(), 0))
+    except asyncio.TimeoutError:
+        print(f"[DEBUG] Deadline reached while selecting best match for '{query}', using first candidate")
+        return [docs[0][0]]
+    return list(selected)
+
+
+async def _select_best_match(
+    query: str, docs: list[tuple[Document, float]], deadline: Optional[float] = None
+) -> list[Document]:
     # 1. Проверяем приоритетные тесты из таблицы
     priority_tests, is_preferred = get_priority_tests_for_query(query)
     
@@ -469,7 +520,7 @@ async def select_best_match(query: str, docs: list[tuple[Document, float]]) -> l
         
         preferred_docs = []
         processor = DataProcessor()
-        all_docs = processor.search_test(query, top_k=2000)
+        all_docs = await cpu_offload.run(processor.search_test, query, top_k=2000, stage="vector_search")
         # Ищем тесты ВО ВСЕХ документах в указанном порядке
         for test_code in priority_tests:
             for doc, score in all_docs:
@@ -482,14 +533,14 @@ async def select_best_match(query: str, docs: list[tuple[Document, float]]) -> l
             return preferred_docs
         else:
             print(f"[DEBUG] No docs found for preferred tests, falling back to standard logic")
-            return await original_select_best_match(query, docs)
+            return await original_select_best_match(query, docs, deadline)
     
     # 3. Для обычных приоритетных запросов - сначала LLM, потом переупорядочивание
     elif priority_tests:
         print(f"[DEBUG] Found priority tests for query '{query}': {priority_tests}")
         
         # Сначала получаем результаты от LLM
-        llm_selected_docs = await original_select_best_match(query, docs)
+        llm_selected_docs = await original_select_best_match(query, docs, deadline)
         print(f"[DEBUG] LLM selected docs: {[doc.metadata.get('test_code') for doc in llm_selected_docs]}")
         
         # Переупорядочиваем LLM результаты: приоритетные тесты первыми
@@ -518,11 +569,11 @@ async def select_best_match(query: str, docs: list[tuple[Document, float]]) -> l
     
     # 4. Если приоритетных тестов нет - используем обычную логику
     print(f"[DEBUG] No priority tests found for '{query}', using standard logic")
-    return await original_select_best_match(query, docs)
+    return await original_select_best_match(query, docs, deadline)
 
 
 async def original_select_best_match(
-    query: str, docs: list[tuple[Document, float]]
+    query: str, docs: list[tuple[Document, float]], deadline: Optional[float] = None
 ) -> list[Document]:
     """Select best matching tests using LLM from multiple options."""
     if len(docs) == 1:
@@ -538,7 +589,9 @@ async def original_select_best_match(
     print(f"[DEBUG] Cleaned query: '{cleaned_query}'") 
     print(f"[DEBUG] Detected department: '{query_department}'")
 
-    cleaned_query = expand_query_with_abbreviations(cleaned_query)
+    cleaned_query = await cpu_offload.run(
+        expand_query_with_abbreviations, cleaned_query, stage="expand_query", size=len(cleaned_query)
+    )
 
     for i, (doc, score) in enumerate(docs, 1):
         print(doc.metadata.get('test_code'))
@@ -627,8 +680,14 @@ async def original_select_best_match(
         """
         
     try:
-            response = await llm.agenerate([[SystemMessage(content=prompt)]])
-            selected = response.generations[0][0].text.strip()
+            # При недоступности LLM (breaker, дедлайн) - первый кандидат
+            selected = await llm_gateway.generate(
+                [SystemMessage(content=prompt)],
+                timeout=LLM_SELECT_TIMEOUT_SECONDS,
+                deadline=deadline,
+                hedge=True
+            )
+            selected = selected.strip()
 
             if not selected:
                 return [filtered_docs[0][0]]
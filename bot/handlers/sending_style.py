@@ -7,9 +7,10 @@ import re
 from typing import Dict, List, Tuple
 from datetime import datetime
 from src.database.db_init import db
+from bot.middleware.outbound_scheduler import cosmetic
+from config import LOADING_FAST_PATH_MS
 from bot.handlers.utils import create_test_link, is_profile_test, format_i_pattern_numbered
 import os
-from aiogram.types import FSInputFile
 from typing import List
 import logging
 
@@ -22,59 +23,17 @@ BOT_USERNAME = "AI_VET_Assistant_Bot"
 BLANKS_PATH = "data/documents"
 
 async def send_blank_files_by_names(message, form_names: List[str]) -> Tuple[bool, List[int]]:
-    """Отправляет файлы бланков используя file_id и возвращает message_ids"""
+    """Отправляет файлы бланков альбомами (file_id из кэша) и возвращает message_ids"""
+    from bot.media_delivery import media_delivery
+
     try:
-        sent_files = 0
-        message_ids = []
-        
-        for form_name in form_names:
-            file_name = f"{form_name.strip()}.pdf"
-            
-            # Пытаемся найти file_id в базе данных
-            file_data = await db.get_blank_file_id(file_name)
-            
-            if file_data and file_data.get("file_id"):
-                # Используем существующий file_id для быстрой отправки
-                try:
-                    sent_msg = await message.answer_document(
-                        file_data["file_id"],
-                        caption=f"📄 {form_name}"
-                    )
-                    message_ids.append(sent_msg.message_id)
-                    sent_files += 1
-                    logger.info(f"[BLANKS] Sent blank via file_id: {file_name}")
-                except Exception as e:
-                    logger.warning(f"[BLANKS] File_id expired, sending file directly: {e}")
-                    # Если file_id устарел, отправляем файл напрямую
-                    file_data = None
-            
-            if not file_data or not file_data.get("file_id"):
-                # Загружаем новый файл
-                file_path = os.path.join(BLANKS_PATH, file_name)
-                if os.path.exists(file_path):
-                    try:
-                        sent_msg = await message.answer_document(
-                            FSInputFile(file_path),
-                            caption=f"📄 {form_name}"
-                        )
-                        message_ids.append(sent_msg.message_id)
-                        sent_files += 1
-                        
-                        # Сохраняем file_id для будущего использования
-                        if sent_msg.document:
-                            await db.save_blank_file_id(file_name, sent_msg.document.file_id)
-                            logger.info(f"[BLANKS] Saved new file_id for: {file_name}")
-                    except Exception as e:
-                        logger.error(f"[BLANKS] Failed to send file {file_path}: {e}")
-                        continue
-                else:
-                    logger.warning(f"[BLANKS] File not found: {file_path}")
-                    continue
-            
-            # Небольшая задержка между отправкой файлов
-            await asyncio.sleep(0.3)
-        
-        return sent_files > 0, message_ids
+        documents = [
+            (os.path.join(BLANKS_PATH, f"{form_name.strip()}.pdf"), f"📄 {form_name}")
+            for form_name in form_names
+        ]
+        message_ids = await media_delivery.send_documents(message, documents)
+        logger.info(f"[BLANKS] Sent {len(message_ids)}/{len(form_names)} blanks")
+        return len(message_ids) > 0, message_ids
         
     except Exception as e:
         logger.error(f"[BLANKS] Failed to send blanks: {e}")
@@ -397,6 +356,205 @@ async def animate_loading(loading_msg: Message):
         pass
 
 
+class LoadingIndicator:
+    """
+    Индикатор загрузки (GIF + анимированный текст) с быстрым путем:
+    показывается, только если результат не готов за fast_path_ms.
+    Все его вызовы Bot - косметические (уступают результатам чата),
+    удаление при stop() идет в фоне и не задерживает ответ.
+    """
+
+    _background = set()  # Ссылки на фоновые удаления (не собираются GC)
+
+    def __init__(self, message: Message, text: str, gif_id: str = None,
+                 animated: bool = True, fast_path_ms: int = LOADING_FAST_PATH_MS):
+        self.chat_message = message
+        self.text = text
+        self.gif_id = gif_id
+        self.animated = animated
+        self.fast_path_ms = fast_path_ms
+        self.gif_message = None
+        self.message = None  # Сообщение с текстом загрузки (если успело появиться)
+        self._task = None
+        self._sending = False
+        self._stopped = False
+
+    def start(self) -> "LoadingIndicator":
+        self._task = asyncio.create_task(self._run())
+        return self
+
+    async def _run(self):
+        with cosmetic():
+            if self.fast_path_ms > 0:
+                await asyncio.sleep(self.fast_path_ms / 1000)
+            self._sending = True
+            try:
+                if self.gif_id:
+                    try:
+                        self.gif_message = await self.chat_message.answer_animation(self.gif_id, caption="")
+                    except Exception:
+                        self.gif_message = None
+                if self._stopped:
+                    return
+                self.message = await self.chat_message.answer(self.text)
+            finally:
+                self._sending = False
+            if self.animated and not self._stopped:
+                await animate_loading(self.message)
+
+    async def stop(self, keep_message: Message = None):
+        """Останавливает индикатор и удаляет его сообщения (кроме keep_message)"""
+        self._stopped = True
+        if self._task and not self._task.done():
+            if not self._sending:
+                self._task.cancel()
+            # Отправка уже идет - дожидаемся, чтобы не оставить сообщение без ссылки
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            except Exception as e:
+                logger.warning(f"[LOADING] Indicator failed: {e}")
+
+        to_delete = [
+            msg for msg in (self.gif_message, self.message)
+            if msg is not None and msg is not keep_message
+        ]
+        self.gif_message = None
+        if self.message is not keep_message:
+            self.message = None
+        if to_delete:
+            with cosmetic():
+                task = asyncio.create_task(self._delete(to_delete))
+            self._background.add(task)
+            task.add_done_callback(self._background.discard)
+
+    @staticmethod
+    async def _delete(messages):
+        for msg in messages:
+            try:
+                await msg.delete()
+            except Exception:
+                pass  # Игнорируем ошибки удаления
+
+
+# ============================================================================
+# ПОТОКОВАЯ ОТПРАВКА ОТВЕТОВ LLM
+# ============================================================================
+
+STREAM_EDIT_INTERVAL = 1.0      # Не чаще одной правки сообщения в секунду (лимит Telegram)
+STREAM_MAX_MESSAGE_LENGTH = 4000
+STREAM_CURSOR = " ▌"
+
+
+class StreamingMessageWriter:
+    """
+    Показывает ответ LLM по мере генерации: правит одно сообщение,
+    а при превышении 4000 символов переходит в новое.
+
+    Во время генерации текст идет без разметки (HTML может быть незакрыт),
+    финальный отформатированный вариант подставляется через finalize().
+    """
+
+    def __init__(self, message: Message, initial_message: Message = None, on_first_chunk=None):
+        self.message = message
+        self.messages: List[Message] = [initial_message] if initial_message else []
+        self.on_first_chunk = on_first_chunk
+        self._committed = 0          # Сколько символов уже закреплено в закрытых сообщениях
+        self._last_edit = 0.0
+        self._last_rendered = ""
+        self._started = False
+        self.finalized = False  # Черновик заменен итоговым ответом - discard его не трогает
+
+    async def push(self, text: str):
+        """Принимает весь накопленный текст; правки прореживаются по времени"""
+        if not text.strip():
+            return
+
+        if not self._started:
+            self._started = True
+            if self.on_first_chunk:
+                await self.on_first_chunk()
+
+        tail = text[self._committed:]
+        while len(tail) > STREAM_MAX_MESSAGE_LENGTH:
+            cut = self._find_cut(tail)
+            await self._render(tail[:cut].rstrip(), final=True)
+            self._committed += cut
+            self.messages.append(None)  # Следующий фрагмент уйдет новым сообщением
+            tail = text[self._committed:]
+
+        loop = asyncio.get_running_loop()
+        if loop.time() - self._last_edit >= STREAM_EDIT_INTERVAL:
+            await self._render(tail.lstrip() + STREAM_CURSOR)
+
+    async def finalize(self, parts: List[str], parse_mode: str = "HTML"):
+        """Заменяет черновик итоговыми частями ответа"""
+        for i, part in enumerate(parts):
+            target = self.messages[i] if i < len(self.messages) else None
+            try:
+                await self._edit_or_send(target, part, parse_mode, i)
+            except Exception as e:
+                logger.error(f"[STREAM] Failed to send part {i+1} with {parse_mode}: {e}")
+                clean_part = re.sub(r'<[^>]+>', '', part)
+                await self._edit_or_send(target, clean_part, None, i)
+
+        # Лишние черновые сообщения (если итог короче черновика)
+        for extra in self.messages[len(parts):]:
+            await self._delete(extra)
+        self.messages = self.messages[:len(parts)]
+        self.finalized = True
+
+    async def discard(self):
+        """Удаляет все черновые сообщения"""
+        if self.finalized:
+            return
+        for msg in self.messages:
+            await self._delete(msg)
+        self.messages = []
+
+    @staticmethod
+    def _find_cut(tail: str) -> int:
+        """Позиция разрыва: по абзацу, строке или пробелу перед лимитом"""
+        window = tail[:STREAM_MAX_MESSAGE_LENGTH]
+        for sep in ("\n\n", "\n", " "):
+            pos = window.rfind(sep)
+            if pos > STREAM_MAX_MESSAGE_LENGTH // 2:
+                return pos + len(sep)
+        return STREAM_MAX_MESSAGE_LENGTH
+
+    async def _render(self, text: str, final: bool = False):
+        if not text or (text == self._last_rendered and not final):
+            return
+        index = len(self.messages) - 1 if self.messages else 0
+        target = self.messages[index] if self.messages else None
+        try:
+            await self._edit_or_send(target, text, None, index)
+            self._last_rendered = text
+        except Exception as e:
+            # "message is not modified" и флуд-лимиты не должны ронять ответ
+            logger.debug(f"[STREAM] Draft update skipped: {e}")
+        self._last_edit = asyncio.get_running_loop().time()
+
+    async def _edit_or_send(self, target: Message, text: str, parse_mode, index: int):
+        if target is not None:
+            await target.edit_text(text, parse_mode=parse_mode, disable_web_page_preview=True)
+            return
+        sent = await self.message.answer(text, parse_mode=parse_mode, disable_web_page_preview=True)
+        if index < len(self.messages):
+            self.messages[index] = sent
+        else:
+            self.messages.append(sent)
+
+    @staticmethod
+    async def _delete(msg: Message):
+        try:
+            if msg:
+                await msg.delete()
+        except Exception:
+            pass
+
+
 class CustomEmojiManager:
     def __init__(self):
         self.emoji_ids = {
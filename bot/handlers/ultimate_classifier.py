@@ -3,7 +3,7 @@ import re
 from collections import defaultdict
 from langchain.schema import SystemMessage, HumanMessage
 from bot.handlers.utils import normalize_test_code, is_test_code_pattern
-from models.models_init import Google_Gemini_2_5_Flash_Lite as llm
+from models.llm_gateway import llm_gateway
 import asyncio
 
 class UltimateQuestionClassifier:
@@ -260,11 +260,11 @@ class UltimateQuestionClassifier:
         prompt = self._build_llm_prompt(query)
         
         try:
-            response = await asyncio.wait_for(
-                self.llm.agenerate([[SystemMessage(content=prompt)]]),
+            llm_response = await self.llm.generate(
+                [SystemMessage(content=prompt)],
                 timeout=3.0
             )
-            llm_response = response.generations[0][0].text.strip()
+            llm_response = llm_response.strip()
             
             result_type, confidence, reasoning = self._parse_llm_response(llm_response)
             
@@ -381,4 +381,4 @@ REASONING: <краткое обоснование>
 
 
 # Инициализация
-ultimate_classifier = UltimateQuestionClassifier(llm)
\ No newline at end of file
+ultimate_classifier = UltimateQuestionClassifier(llm_gateway)
\ No newline at end of file
@@ -0,0 +1,193 @@
+"""
+Доставка локальных файлов (бланки из data/documents) через file_id.
+
+Каждый файл загружается в Telegram один раз: file_id кэшируется в
+blank_files по хэшу содержимого (SHA-256), поэтому измененный файл
+загружается заново, а переименованный - нет. Хэш пересчитывается
+только при смене размера или времени изменения файла.
+
+Несколько документов уходят одним send_media_group (до 10 в группе)
+вместо отдельного answer_document и паузы на каждый файл. Если альбом
+отклонен, его документы отправляются по одному: один плохой файл не
+лишает пользователя остальных. Файл, которого нет на диске, все равно
+отправляется, если для его имени сохранен file_id.
+
+Flood control (TelegramRetryAfter) выдерживается: ждем retry_after и
+повторяем тот же альбом. Сетевая или иная ошибка прерывает отправку, но
+message_id уже отправленных сообщений возвращаются - вызывающий код
+может удалить или учесть их.
+"""
+import asyncio
+import hashlib
+import logging
+import os
+from typing import Dict, List, Optional, Tuple
+
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
+from aiogram.types import FSInputFile, InputMediaDocument, Message
+
+from src.database.db_init import db
+
+logger = logging.getLogger(__name__)
+
+MEDIA_GROUP_LIMIT = 10  # Ограничение Telegram на альбом
+MAX_RETRY_AFTER = 3  # Сколько раз выдерживаем flood control на один альбом
+
+
+def file_content_hash(path: str) -> str:
+    sha = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(1024 * 1024), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+class MediaDelivery:
+    def __init__(self):
+        self._file_ids: Dict[str, str] = {}  # хэш содержимого -> file_id
+        self._legacy: Dict[str, str] = {}  # имя файла -> file_id (записи без хэша)
+        self._by_name: Dict[str, str] = {}  # имя файла -> file_id (для файлов, которых нет на диске)
+        self._hashes: Dict[str, Tuple[float, int, str]] = {}  # путь -> (mtime, размер, хэш)
+        self._loaded = False
+        self.uploads = 0
+        self.cached_sends = 0
+        self.api_calls = 0
+        self.retry_after_waits = 0
+
+    async def _ensure_loaded(self):
+        if self._loaded:
+            return
+        for row in await db.get_blank_file_ids():
+            self._by_name[row['file_name']] = row['file_id']
+            if row.get('content_hash'):
+                self._file_ids[row['content_hash']] = row['file_id']
+            else:
+                self._legacy[row['file_name']] = row['file_id']
+        self._loaded = True
+
+    async def _adopt_legacy(self, item: dict):
+        """file_id, сохраненный до появления хэшей, привязывается к хэшу без повторной загрузки"""
+        file_name = os.path.basename(item['path'])
+        file_id = self._legacy.pop(file_name, None)
+        if file_id and item['hash'] not in self._file_ids:
+            self._file_ids[item['hash']] = file_id
+            await db.save_blank_file_id(file_name, file_id, item['hash'])
+
+    async def _content_hash(self, path: str) -> str:
+        stat = os.stat(path)
+        cached = self._hashes.get(path)
+        if cached and cached[0] == stat.st_mtime and cached[1] == stat.st_size:
+            return cached[2]
+        content_hash = await asyncio.to_thread(file_content_hash, path)
+        self._hashes[path] = (stat.st_mtime, stat.st_size, content_hash)
+        return content_hash
+
+    def _cached_file_id(self, item: dict) -> Optional[str]:
+        if item['hash'] is None:
+            return item['file_id']
+        return self._file_ids.get(item['hash'])
+
+    async def _send_chunk(self, message: Message, chunk: List[dict]) -> List[Message]:
+        media = []
+        for item in chunk:
+            file_id = self._cached_file_id(item)
+            media.append(file_id or FSInputFile(item['path']))
+        for attempt in range(MAX_RETRY_AFTER + 1):
+            self.api_calls += 1
+            try:
+                if len(chunk) == 1:
+                    return [await message.answer_document(media[0], caption=chunk[0]['caption'])]
+                return await message.answer_media_group([
+                    InputMediaDocument(media=file, caption=item['caption'])
+                    for file, item in zip(media, chunk)
+                ])
+            except TelegramRetryAfter as e:
+                if attempt == MAX_RETRY_AFTER:
+                    raise
+                self.retry_after_waits += 1
+                logger.warning(f"[MEDIA] Flood control, retrying in {e.retry_after}s")
+                await asyncio.sleep(e.retry_after)
+
+    async def send_documents(self, message: Message, documents: List[Tuple[str, str]]) -> List[int]:
+        """
+        Отправляет документы [(путь, подпись)] альбомами до 10 штук.
+        Возвращает message_id отправленных сообщений.
+        """
+        await self._ensure_loaded()
+
+        items = []
+        for path, caption in documents:
+            if not os.path.exists(path):
+                file_id = self._by_name.get(os.path.basename(path))
+                if file_id is None:
+                    logger.warning(f"[MEDIA] File not found: {path}")
+                    continue
+                # Файла нет на диске, но он уже загружался - отправляем по file_id
+                logger.warning(f"[MEDIA] File not found, sending cached file_id: {path}")
+                items.append({'path': path, 'caption': caption, 'hash': None, 'file_id': file_id})
+                continue
+            item = {'path': path, 'caption': caption, 'hash': await self._content_hash(path)}
+            if self._legacy:
+                await self._adopt_legacy(item)
+            items.append(item)
+
+        message_ids: List[int] = []
+        try:
+            for start in range(0, len(items), MEDIA_GROUP_LIMIT):
+                await self._deliver(message, items[start:start + MEDIA_GROUP_LIMIT], message_ids)
+        except Exception as e:
+            # Сеть, исчерпанный flood control и т.п. - уже отправленное не теряем
+            logger.error(f"[MEDIA] Delivery interrupted after {len(message_ids)} messages: {e}")
+        return message_ids
+
+    async def _deliver(self, message: Message, chunk: List[dict], message_ids: List[int]):
+        """
+        Отправляет альбом (или один документ) и дописывает message_id в
+        message_ids; отклоненные файлы изолируются по одному.
+        """
+        try:
+            sent = await self._send_chunk(message, chunk)
+        except TelegramBadRequest as e:
+            if len(chunk) > 1:
+                # Альбом отклонен целиком - отправляем документы по одному
+                logger.warning(f"[MEDIA] Media group rejected, sending {len(chunk)} files one by one: {e.message}")
+                for item in chunk:
+                    await self._deliver(message, [item], message_ids)
+                return
+
+            item = chunk[0]
+            if item['hash'] is None or item['hash'] not in self._file_ids:
+                logger.error(f"[MEDIA] Failed to send {os.path.basename(item['path'])}: {e.message}")
+                return
+            # Сохраненный file_id стал недействительным - загружаем файл заново
+            logger.warning(f"[MEDIA] Cached file_id rejected, re-uploading: {e.message}")
+            self._file_ids.pop(item['hash'], None)
+            try:
+                sent = await self._send_chunk(message, chunk)
+            except TelegramBadRequest as e:
+                logger.error(f"[MEDIA] Failed to send {os.path.basename(item['path'])}: {e.message}")
+                return
+
+        for item, sent_msg in zip(chunk, sent):
+            message_ids.append(sent_msg.message_id)
+            if self._cached_file_id(item):
+                self.cached_sends += 1
+            elif sent_msg.document:
+                file_name = os.path.basename(item['path'])
+                self.uploads += 1
+                self._file_ids[item['hash']] = sent_msg.document.file_id
+                self._by_name[file_name] = sent_msg.document.file_id
+                await db.save_blank_file_id(file_name, sent_msg.document.file_id, item['hash'])
+                logger.info(f"[MEDIA] Uploaded and cached: {file_name}")
+
+    def get_stats(self) -> Dict:
+        return {
+            "cached_files": len(self._file_ids),
+            "uploads": self.uploads,
+            "cached_sends": self.cached_sends,
+            "api_calls": self.api_calls,
+            "retry_after_waits": self.retry_after_waits,
+        }
+
+
+media_delivery = MediaDelivery()
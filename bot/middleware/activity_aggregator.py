@@ -0,0 +1,97 @@
+"""
+Агрегатор активности пользователей в памяти процесса.
+
+MetricsMiddleware только отмечает событие (без обращения к БД), а
+фоновая задача периодически сбрасывает накопленное в user_activity
+(DAU) и user_sessions. Проверки "зарегистрирован / админ" выполняются
+при сбросе, а не на пути каждого нажатия кнопки.
+"""
+import asyncio
+import logging
+import time
+from datetime import datetime
+from typing import Dict, List, Tuple
+
+from utils.latency_stats import LatencyHistogram
+
+logger = logging.getLogger(__name__)
+
+FLUSH_INTERVAL_SECONDS = 5
+
+
+class ActivityAggregator:
+    def __init__(self):
+        # (user_id, дата) -> [число событий, время последнего события]
+        self._pending: Dict[Tuple[int, object], List] = {}
+        self._flush_lock = asyncio.Lock()
+
+        # Задержки: сколько middleware тратит до обработчика и сам обработчик
+        self.middleware_overhead = LatencyHistogram()
+        self.handler_latency = LatencyHistogram()
+        # Стоимость записи активности одного пользователя в БД - то, что
+        # раньше middleware ждал перед каждым обработчиком
+        self.db_cost_per_user = LatencyHistogram()
+
+        self.recorded_events = 0
+        self.flushed_users = 0
+        self.skipped_users = 0
+        self.flush_errors = 0
+
+    def record(self, user_id: int):
+        """Отмечает событие пользователя (синхронно, без I/O)"""
+        now = datetime.now()
+        key = (user_id, now.date())
+        entry = self._pending.get(key)
+        if entry is None:
+            self._pending[key] = [1, now]
+        else:
+            entry[0] += 1
+            entry[1] = now
+        self.recorded_events += 1
+
+    @property
+    def pending_users(self) -> int:
+        return len(self._pending)
+
+    async def flush(self, db) -> int:
+        """Сбрасывает накопленные счетчики и heartbeat сессий в БД"""
+        async with self._flush_lock:
+            pending, self._pending = self._pending, {}
+            flushed = 0
+
+            for (user_id, _), (count, last_seen) in pending.items():
+                started = time.monotonic()
+                try:
+                    user = await db.get_user(user_id)
+                    if not user or user.get('role') == 'admin':
+                        # Регистрация еще не завершена или админ - не трекаем
+                        self.skipped_users += 1
+                        continue
+
+                    await db.track_user_activity(user_id, count, last_seen)
+                    await db.update_session_activity(user_id, count, last_seen)
+                    flushed += 1
+                except Exception as e:
+                    self.flush_errors += 1
+                    logger.error(f"[ACTIVITY] Failed to flush activity for user {user_id}: {e}")
+                finally:
+                    self.db_cost_per_user.observe(time.monotonic() - started)
+
+            self.flushed_users += flushed
+            return flushed
+
+    def get_stats(self) -> Dict:
+        return {
+            "pending_users": self.pending_users,
+            "recorded_events": self.recorded_events,
+            "flushed_users": self.flushed_users,
+            "skipped_users": self.skipped_users,
+            "flush_errors": self.flush_errors,
+            "middleware_overhead": self.middleware_overhead.snapshot(),
+            "handler_latency": self.handler_latency.snapshot(),
+            "db_cost_per_user": self.db_cost_per_user.snapshot(),
+        }
+
+
+# Глобальный экземпляр (общий для middleware сообщений и callback)
+activity_aggregator = ActivityAggregator()
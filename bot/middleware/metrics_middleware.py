@@ -9,6 +9,8 @@ from aiogram.types import Message, CallbackQuery, TelegramObject
 from datetime import datetime
 
 from src.database.db_init import db
+from src.database.user_cache import request_scope
+from bot.middleware.activity_aggregator import activity_aggregator
 
 logger = logging.getLogger(__name__)
 
@@ -28,6 +30,8 @@ class MetricsMiddleware(BaseMiddleware):
         """
         Обрабатывает событие и отслеживает активность пользователя
         """
+        started = time.monotonic()
+
         # Получаем user_id из события
         user_id = None
         if isinstance(event, Message):
@@ -39,31 +43,18 @@ class MetricsMiddleware(BaseMiddleware):
         if not user_id:
             return await handler(event, data)
         
-        # Проверяем, что пользователь не админ
-        try:
-            user = await db.get_user(user_id)
-            if user and user.get('role') == 'admin':
-                # Админы не участвуют в метриках
-                return await handler(event, data)
-        except Exception as e:
-            logger.error(f"[METRICS] Failed to check user role: {e}")
-        
         # Отслеживаем активность пользователя
         # ВАЖНО:
-        # - track_user_activity: обновляет user_activity (для DAU)
-        # - update_session_activity: создает/обновляет сессии (для метрик времени активности)
+        # - activity_aggregator.record: только отметка в памяти, без БД.
+        #   Фоновый сброс (main.py) пишет user_activity (DAU) и user_sessions
+        #   и там же отсекает админов и незарегистрированных
         # - log_request_metric: логирует запросы (ТОЛЬКО для валидных запросов в обработчиках)
         try:
-            # Отслеживаем активность для DAU (Daily Active Users)
-            await db.track_user_activity(user_id)
-            
-            # Создаем/обновляем сессию при ЛЮБОЙ активности (кнопки, запросы, все)
-            # Закрытие неактивных сессий происходит в фоновой задаче (main.py)
-            await db.update_session_activity(user_id)
+            activity_aggregator.record(user_id)
             
             # Логируем тип события для отладки
             event_type = "message" if isinstance(event, Message) else "callback"
-            logger.debug(f"[METRICS] Tracked {event_type} activity for user {user_id}")
+            logger.debug(f"[METRICS] Recorded {event_type} activity for user {user_id}")
         except Exception as e:
             logger.error(f"[METRICS] Failed to track activity: {e}")
         
@@ -72,7 +63,14 @@ class MetricsMiddleware(BaseMiddleware):
         # Навигационные действия НЕ логируются в request_metrics
         
         # Выполняем обработчик (метрики запросов логируются в самих обработчиках)
-        return await handler(event, data)
+        handler_started = time.monotonic()
+        activity_aggregator.middleware_overhead.observe(handler_started - started)
+        try:
+            # Повторные db.get_user внутри апдейта берутся из мемо запроса
+            with request_scope():
+                return await handler(event, data)
+        finally:
+            activity_aggregator.handler_latency.observe(time.monotonic() - handler_started)
     
     def _determine_request_type(self, text: str) -> str:
         """Определяет тип запроса по тексту"""
@@ -0,0 +1,192 @@
+"""
+Планировщик исходящих запросов к Telegram (middleware сессии Bot).
+
+Каждый вызов Bot проходит через OutboundScheduler. Вызовы делятся на
+результаты (по умолчанию) и косметику - индикаторы загрузки, помеченные
+контекстом cosmetic(). Результаты уходят сразу. Косметика в чате ждет,
+пока там отправляются результаты, и не чаще COSMETIC_MIN_INTERVAL:
+- правка текста, которая совпадает с уже показанным, отбрасывается;
+- правка, которую за время ожидания сменила более новая правка того же
+  сообщения, схлопывается (уходит только последняя);
+- правка во время отправки результата отбрасывается (кадр анимации).
+Отброшенная правка возвращает True, как Telegram для правки без сообщения.
+
+Статистика: вызовы, отброшенные и схлопнутые правки по методам,
+ожидание в планировщике по приоритетам, время ответа Telegram.
+"""
+import asyncio
+import contextvars
+import logging
+import time
+from collections import OrderedDict, defaultdict
+from contextlib import contextmanager
+from typing import Dict, Optional
+
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.methods import EditMessageText
+
+from utils.latency_stats import LatencyHistogram
+
+logger = logging.getLogger(__name__)
+
+COSMETIC_MIN_INTERVAL = 1.0  # Не чаще одного косметического вызова в секунду на чат
+COSMETIC_MAX_WAIT = 5.0  # Дольше результатов не ждем - отправляем как есть
+MAX_TRACKED_EDITS = 5000
+MAX_LANES = 5000
+
+PRIORITY_RESULT = 'result'
+PRIORITY_COSMETIC = 'cosmetic'
+
+_priority: contextvars.ContextVar = contextvars.ContextVar("outbound_priority", default=PRIORITY_RESULT)
+
+
+@contextmanager
+def cosmetic():
+    """Вызовы Bot внутри блока - косметические (индикаторы загрузки)"""
+    token = _priority.set(PRIORITY_COSMETIC)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+class _ChatLane:
+    def __init__(self):
+        self.results_in_flight = 0
+        self.idle = asyncio.Event()
+        self.idle.set()
+        self.last_cosmetic = 0.0
+        self.last_used = time.monotonic()
+        self.edit_seq: Dict[int, int] = {}  # message_id -> номер последней правки
+
+
+class OutboundScheduler(BaseRequestMiddleware):
+    def __init__(self):
+        self._lanes: Dict[int, _ChatLane] = {}
+        self._last_text: OrderedDict = OrderedDict()  # (chat_id, message_id) -> текст
+        self.calls = defaultdict(int)
+        self.dropped = defaultdict(int)
+        self.coalesced = defaultdict(int)
+        self.errors = defaultdict(int)
+        self.queue_latency = {
+            PRIORITY_RESULT: LatencyHistogram(),
+            PRIORITY_COSMETIC: LatencyHistogram(),
+        }
+        self.api_latency = LatencyHistogram()
+
+    def _lane(self, chat_id) -> _ChatLane:
+        lane = self._lanes.get(chat_id)
+        if lane is None:
+            if len(self._lanes) >= MAX_LANES:
+                self._prune_lanes()
+            lane = self._lanes[chat_id] = _ChatLane()
+        lane.last_used = time.monotonic()
+        return lane
+
+    def _prune_lanes(self):
+        threshold = time.monotonic() - 60
+        for chat_id in [
+            chat_id for chat_id, lane in self._lanes.items()
+            if lane.results_in_flight == 0 and lane.last_used < threshold
+        ]:
+            del self._lanes[chat_id]
+
+    def _remember_text(self, key, text: str):
+        self._last_text[key] = text
+        self._last_text.move_to_end(key)
+        while len(self._last_text) > MAX_TRACKED_EDITS:
+            self._last_text.popitem(last=False)
+
+    async def _request(self, make_request, bot, method, name: str, priority: str, queued_at: float):
+        self.queue_latency[priority].observe(time.monotonic() - queued_at)
+        self.calls[name] += 1
+        started = time.monotonic()
+        try:
+            return await make_request(bot, method)
+        except Exception:
+            self.errors[name] += 1
+            raise
+        finally:
+            self.api_latency.observe(time.monotonic() - started)
+
+    async def __call__(self, make_request, bot, method):
+        queued_at = time.monotonic()
+        name = type(method).__name__
+        chat_id = getattr(method, 'chat_id', None)
+        priority = _priority.get()
+
+        if chat_id is None:
+            return await self._request(make_request, bot, method, name, priority, queued_at)
+
+        lane = self._lane(chat_id)
+        if priority == PRIORITY_RESULT:
+            lane.results_in_flight += 1
+            lane.idle.clear()
+            try:
+                result = await self._request(make_request, bot, method, name, priority, queued_at)
+            finally:
+                lane.results_in_flight -= 1
+                if lane.results_in_flight == 0:
+                    lane.idle.set()
+            if isinstance(method, EditMessageText) and method.message_id:
+                # Результат сменил текст - косметика сравнивает с актуальным
+                self._last_text.pop((chat_id, method.message_id), None)
+            return result
+
+        if isinstance(method, EditMessageText) and method.message_id:
+            return await self._cosmetic_edit(make_request, bot, method, name, lane, queued_at)
+
+        # Прочая косметика (GIF, текст загрузки, удаление) - после результатов чата
+        if not lane.idle.is_set():
+            try:
+                await asyncio.wait_for(lane.idle.wait(), timeout=COSMETIC_MAX_WAIT)
+            except asyncio.TimeoutError:
+                pass
+        lane.last_cosmetic = time.monotonic()
+        return await self._request(make_request, bot, method, name, priority, queued_at)
+
+    async def _cosmetic_edit(self, make_request, bot, method, name: str, lane: _ChatLane, queued_at: float):
+        key = (method.chat_id, method.message_id)
+        if self._last_text.get(key) == method.text:
+            self.dropped[name] += 1
+            return True
+
+        seq = lane.edit_seq.get(method.message_id, 0) + 1
+        lane.edit_seq[method.message_id] = seq
+        try:
+            delay = lane.last_cosmetic + COSMETIC_MIN_INTERVAL - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            if lane.edit_seq.get(method.message_id) != seq:
+                # За время ожидания пришла более новая правка этого сообщения
+                self.coalesced[name] += 1
+                return True
+            if lane.results_in_flight:
+                self.dropped[name] += 1
+                return True
+
+            lane.last_cosmetic = time.monotonic()
+            result = await self._request(make_request, bot, method, name, PRIORITY_COSMETIC, queued_at)
+            self._remember_text(key, method.text)
+            return result
+        finally:
+            if lane.edit_seq.get(method.message_id) == seq:
+                del lane.edit_seq[method.message_id]
+
+    def get_stats(self) -> Dict:
+        return {
+            "calls": dict(self.calls),
+            "dropped": dict(self.dropped),
+            "coalesced": dict(self.coalesced),
+            "errors": dict(self.errors),
+            "total_calls": sum(self.calls.values()),
+            "total_skipped": sum(self.dropped.values()) + sum(self.coalesced.values()),
+            "queue_latency": {
+                priority: histogram.snapshot() for priority, histogram in self.queue_latency.items()
+            },
+            "api_latency": self.api_latency.snapshot(),
+            "lanes": len(self._lanes),
+        }
+
+
+outbound_scheduler = OutboundScheduler()
@@ -0,0 +1,137 @@
+"""
+Хранилище результатов поиска для пагинации и переключения вида.
+
+Результаты не кладутся в FSM: по search_id хранятся только коды тестов
+и score (кортеж строк + array('f')). Метаданные для страницы берутся из
+индекса каталога в момент показа. Вытеснение - общее LRU с TTL и
+ограничением по числу поисков и по оценке занимаемой памяти.
+"""
+import secrets
+import sys
+import time
+from array import array
+from collections import OrderedDict
+from typing import Dict, Iterable, List, Optional, Tuple
+
+SEARCH_SESSION_TTL_SECONDS = 1800  # 30 минут
+MAX_SEARCH_SESSIONS = 20000
+MAX_SEARCH_SESSIONS_BYTES = 32 * 1024 * 1024
+
+
+class _SearchSession:
+    __slots__ = ('codes', 'scores', 'created', 'size')
+
+    def __init__(self, codes: Tuple[str, ...], scores: array):
+        self.codes = codes
+        self.scores = scores
+        self.created = time.monotonic()
+        # Оценка: кортеж ссылок + массив float32 + строки кодов (короткие, часто общие)
+        self.size = (
+            sys.getsizeof(codes) + sys.getsizeof(scores)
+            + sum(sys.getsizeof(code) for code in codes) + 64
+        )
+
+
+class SearchSessionStore:
+    def __init__(self, ttl_seconds: int = SEARCH_SESSION_TTL_SECONDS,
+                 max_sessions: int = MAX_SEARCH_SESSIONS,
+                 max_bytes: int = MAX_SEARCH_SESSIONS_BYTES):
+        self.ttl_seconds = ttl_seconds
+        self.max_sessions = max_sessions
+        self.max_bytes = max_bytes
+        self._sessions: "OrderedDict[str, _SearchSession]" = OrderedDict()
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def put(self, hits: Iterable[Tuple[str, float]]) -> str:
+        """Сохраняет [(код, score)] и возвращает новый search_id"""
+        codes = []
+        scores = array('f')
+        for code, score in hits:
+            if not code:
+                continue
+            codes.append(sys.intern(str(code)))
+            scores.append(float(score or 0))
+
+        search_id = secrets.token_hex(4)
+        while search_id in self._sessions:
+            search_id = secrets.token_hex(4)
+
+        session = _SearchSession(tuple(codes), scores)
+        self._sessions[search_id] = session
+        self._bytes += session.size
+        self._evict_over_limit()
+        return search_id
+
+    def get(self, search_id: str) -> Optional[List[Tuple[str, float]]]:
+        """[(код, score)] поиска или None, если устарел или вытеснен"""
+        session = self._sessions.get(search_id)
+        if session is None:
+            self.misses += 1
+            return None
+        if time.monotonic() - session.created > self.ttl_seconds:
+            self._remove(search_id)
+            self.misses += 1
+            return None
+        self._sessions.move_to_end(search_id)
+        self.hits += 1
+        return list(zip(session.codes, session.scores))
+
+    def _remove(self, search_id: str):
+        session = self._sessions.pop(search_id, None)
+        if session is not None:
+            self._bytes -= session.size
+
+    def _evict_over_limit(self):
+        while self._sessions and (
+            len(self._sessions) > self.max_sessions or self._bytes > self.max_bytes
+        ):
+            search_id = next(iter(self._sessions))
+            self._remove(search_id)
+            self.evictions += 1
+
+    def evict_expired(self) -> int:
+        """Удаляет устаревшие поиски (вызывается периодически)"""
+        threshold = time.monotonic() - self.ttl_seconds
+        expired = [
+            search_id for search_id, session in self._sessions.items()
+            if session.created < threshold
+        ]
+        for search_id in expired:
+            self._remove(search_id)
+        return len(expired)
+
+    def get_stats(self) -> Dict:
+        lookups = self.hits + self.misses
+        return {
+            "sessions": len(self._sessions),
+            "bytes": self._bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+        }
+
+
+async def resolve_search_results(hits: List[Tuple[str, float]]) -> List[Dict]:
+    """Результаты в формате клавиатуры и списков: метаданные из индекса каталога"""
+    from src.database.db_init import db
+
+    tests = await db.get_tests_by_codes([code for code, _ in hits])
+    results = []
+    for code, score in hits:
+        test = tests.get(code.upper(), {})
+        results.append({
+            'metadata': {
+                'test_code': test.get('test_code') or code,
+                'test_name': test.get('test_name', ''),
+                'department': test.get('department', ''),
+            },
+            'score': score,
+        })
+    return results
+
+
+search_sessions = SearchSessionStore()
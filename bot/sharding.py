@@ -0,0 +1,276 @@
+"""
+Многопроцессный режим: приемник апдейтов и N воркеров (main_sharded.py).
+
+Приемник - легкий процесс без обработчиков: long polling getUpdates и
+раздача апдейтов воркерам по shard_for(user_id). Все апдейты одного
+пользователя попадают в один воркер и обрабатываются там в порядке
+получения, как при обычном polling, поэтому планировщик запросов
+пользователя, кэш FSM (SQLiteStorage), результаты поиска и кэш
+пользователя остаются корректными в пределах процесса.
+
+Воркер - обычный бот (bot.handlers) с лентой апдейтов из очереди
+вместо polling. Воркер 0 - основной: применяет миграции, строит снимок
+индекса каталога (его открывают через mmap остальные), ведет общие
+периодические задачи и возобновляет рассылки. Остальные стартуют после
+сигнала готовности основного.
+
+Общее состояние: рассылки выполняет только основной воркер (один
+TokenBucket на бота) - остальные сохраняют рассылку в БД, основной
+подхватывает ее за несколько секунд. Фото контейнеров и плохие оценки
+ответов (для семантического кэша) каждый воркер перечитывает из БД раз
+в минуту. Кэш пользователя другого воркера узнает об изменениях,
+сделанных администратором, по истечении TTL.
+
+Остановка: SIGINT (Ctrl+C) и SIGTERM (systemd, docker stop) получает
+приемник и присылает воркерам None - они дообрабатывают очередь и
+сбрасывают FSM и телеметрию. Воркер, у которого пропал родительский
+процесс, завершается тем же путем.
+"""
+import asyncio
+import logging
+import multiprocessing
+import multiprocessing.connection
+import queue
+import signal
+import threading
+from typing import List, Optional
+
+logger = logging.getLogger(__name__)
+
+WORKER_QUEUE_SIZE = 1000  # Апдейтов в очереди воркера; при переполнении приемник ждет
+POLL_TIMEOUT_SECONDS = 30
+POLL_BACKOFF_MAX_SECONDS = 30
+PRIMARY_READY_TIMEOUT_SECONDS = 600  # Сколько воркеры ждут основной при старте
+WORKER_STOP_TIMEOUT_SECONDS = 60
+
+
+def shard_for(user_id: int, workers: int) -> int:
+    """Номер воркера для пользователя (стабилен между процессами, в отличие от hash(str))"""
+    return int(user_id) % workers
+
+
+def update_user_id(update) -> int:
+    """Пользователь, от которого пришел апдейт; 0, если его нет (такие апдейты идут в воркер 0)"""
+    try:
+        event = update.event
+    except Exception:
+        return 0
+    for field in ('from_user', 'user', 'voter_chat', 'chat'):
+        owner = getattr(event, field, None)
+        if owner is not None and getattr(owner, 'id', None) is not None:
+            return owner.id
+    return 0
+
+
+# ============================================================
+# ВОРКЕР
+# ============================================================
+
+def worker_process(index: int, updates, primary_ready):
+    """Точка входа процесса-воркера"""
+    # Ctrl+C (и SIGTERM от systemd) получает вся группа процессов: останавливает
+    # приемник, он присылает воркерам None
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+
+    import main
+
+    asyncio.run(main.run_worker(index, updates, primary_ready))
+
+
+async def wait_primary_ready(primary_ready):
+    ready = await asyncio.to_thread(primary_ready.wait, PRIMARY_READY_TIMEOUT_SECONDS)
+    if not ready:
+        raise RuntimeError("Primary worker did not become ready")
+
+
+async def consume_updates(updates, bot, dp, worker_name: str):
+    """Обрабатывает апдейты из очереди приемника до получения None"""
+    from aiogram.types import Update
+
+    loop = asyncio.get_running_loop()
+    local: asyncio.Queue = asyncio.Queue()
+
+    def reader():
+        # Блокирующее чтение межпроцессной очереди - в отдельном потоке
+        while True:
+            raw = updates.get()
+            loop.call_soon_threadsafe(local.put_nowait, raw)
+            if raw is None:
+                return
+
+    def parent_watch():
+        # Приемник убит (SIGKILL, падение) - None уже не придет, завершаемся сами
+        parent = multiprocessing.parent_process()
+        if parent is None:
+            return
+        multiprocessing.connection.wait([parent.sentinel])
+        logger.warning(f"[{worker_name}] Receiver process is gone, stopping")
+        loop.call_soon_threadsafe(local.put_nowait, None)
+
+    threading.Thread(target=reader, name=f"{worker_name}-reader", daemon=True).start()
+    threading.Thread(target=parent_watch, name=f"{worker_name}-parent-watch", daemon=True).start()
+
+    in_flight = set()
+    processed = 0
+    while True:
+        raw = await local.get()
+        if raw is None:
+            break
+        try:
+            update = Update.model_validate_json(raw, context={"bot": bot})
+        except Exception as e:
+            logger.error(f"[{worker_name}] Malformed update skipped: {e}")
+            continue
+        task = asyncio.create_task(_process_update(dp, bot, update, worker_name))
+        in_flight.add(task)
+        task.add_done_callback(in_flight.discard)
+        processed += 1
+
+    if in_flight:
+        logger.info(f"[{worker_name}] Waiting for {len(in_flight)} updates in progress")
+        await asyncio.gather(*in_flight, return_exceptions=True)
+    logger.info(f"[{worker_name}] Update stream closed after {processed} updates")
+
+
+async def _process_update(dp, bot, update, worker_name: str):
+    try:
+        await dp.feed_update(bot, update)
+    except Exception as e:
+        logger.exception(f"[{worker_name}] Update {update.update_id} failed: {e}")
+
+
+# ============================================================
+# ПРИЕМНИК
+# ============================================================
+
+class UpdateReceiver:
+    def __init__(self, bot, queues: List):
+        self.bot = bot
+        self.queues = queues
+        self.received = 0
+        self.per_worker = [0] * len(queues)
+
+    async def _dispatch(self, update):
+        worker = shard_for(update_user_id(update), len(self.queues))
+        raw = update.model_dump_json(exclude_unset=True)
+        try:
+            self.queues[worker].put_nowait(raw)
+        except queue.Full:
+            # Воркер не успевает - ждем место, не теряя порядок апдейтов пользователя
+            await asyncio.to_thread(self.queues[worker].put, raw)
+        self.received += 1
+        self.per_worker[worker] += 1
+
+    async def run(self):
+        from aiogram.exceptions import TelegramNetworkError, TelegramServerError
+
+        await self.bot.delete_webhook(drop_pending_updates=True)
+        logger.info(f"[RECEIVER] Polling updates for {len(self.queues)} workers")
+
+        offset: Optional[int] = None
+        backoff = 1
+        while True:
+            try:
+                updates = await self.bot.get_updates(
+                    offset=offset, timeout=POLL_TIMEOUT_SECONDS,
+                    request_timeout=POLL_TIMEOUT_SECONDS + 10
+                )
+            except (TelegramNetworkError, TelegramServerError) as e:
+                logger.warning(f"[RECEIVER] getUpdates failed, retry in {backoff}s: {e}")
+                await asyncio.sleep(backoff)
+                backoff = min(backoff * 2, POLL_BACKOFF_MAX_SECONDS)
+                continue
+            backoff = 1
+            for update in updates:
+                await self._dispatch(update)
+                offset = update.update_id + 1
+
+
+def _terminate(signum, frame):
+    raise KeyboardInterrupt
+
+
+def run_receiver(workers: int):
+    """Запускает воркеры и приемник; блокирует до Ctrl+C, SIGTERM или падения воркера"""
+    from aiogram import Bot
+
+    from config import BOT_API_KEY
+
+    if not BOT_API_KEY:
+        raise RuntimeError('BOT_API_KEY not found.')
+
+    # SIGTERM до запуска loop - тем же путем, что Ctrl+C
+    signal.signal(signal.SIGTERM, _terminate)
+
+    context = multiprocessing.get_context('spawn')
+    queues = [context.Queue(maxsize=WORKER_QUEUE_SIZE) for _ in range(workers)]
+    primary_ready = context.Event()
+    processes = [
+        context.Process(
+            target=worker_process, args=(index, queues[index], primary_ready),
+            name=f"bot-worker-{index}"
+        )
+        for index in range(workers)
+    ]
+    for process in processes:
+        process.start()
+    logger.info(f"[RECEIVER] Started {workers} workers")
+
+    def check_workers():
+        if any(not process.is_alive() for process in processes):
+            raise RuntimeError("Worker process exited")
+
+    async def receive():
+        stopping = asyncio.Event()
+        try:
+            asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, stopping.set)
+        except NotImplementedError:
+            pass  # Windows: остается обработчик _terminate
+
+        # Основной воркер применил миграции и построил снимок каталога - начинаем прием
+        while not await asyncio.to_thread(primary_ready.wait, 5):
+            check_workers()
+            if stopping.is_set():
+                return
+
+        bot = Bot(token=BOT_API_KEY)
+        receiver = UpdateReceiver(bot, queues)
+        polling = asyncio.create_task(receiver.run())
+        stop_wait = asyncio.create_task(stopping.wait())
+        try:
+            while not polling.done() and not stopping.is_set():
+                check_workers()
+                await asyncio.wait({polling, stop_wait}, timeout=5)
+            if polling.done():
+                polling.result()
+            else:
+                logger.info("[RECEIVER] SIGTERM received, stopping")
+        finally:
+            polling.cancel()
+            stop_wait.cancel()
+            await asyncio.gather(polling, stop_wait, return_exceptions=True)
+            await bot.session.close()
+            logger.info(
+                f"[RECEIVER] Received {receiver.received} updates, per worker: {receiver.per_worker}"
+            )
+
+    try:
+        asyncio.run(receive())
+    except KeyboardInterrupt:
+        logger.info("[RECEIVER] Stopped by signal")
+    finally:
+        # Повторный сигнал не должен прервать остановку воркеров
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
+        # None - конец ленты: воркер дообрабатывает очередь и завершается штатно
+        for updates in queues:
+            try:
+                updates.put(None, timeout=5)
+            except queue.Full:
+                pass
+        for process in processes:
+            process.join(WORKER_STOP_TIMEOUT_SECONDS)
+            if process.is_alive():
+                logger.warning(f"[RECEIVER] {process.name} did not stop, terminating")
+                process.terminate()
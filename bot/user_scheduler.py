@@ -0,0 +1,120 @@
+"""
+Планировщик запросов пользователя (поиск по коду, по названию, общие вопросы).
+
+Запросы одного пользователя выполняются по одному. Новый запрос
+отменяет выполняющийся (CancelledError внутри конвейера - обработчик
+отвечает "Поиск остановлен") и ожидающие, которые еще не начались:
+пользователь получает ответ на последний запрос, а не на все подряд.
+
+Конвейер запускается отдельной задачей: отмена не задевает задачу
+апдейта (или обработчик очереди webhook), из которой он вызван.
+Повторный вызов изнутри конвейера того же пользователя (например,
+поиск переходит в общий вопрос) выполняется сразу, без отмены себя.
+
+Запись пользователя удаляется, как только у него нет выполняющихся и
+ожидающих запросов - реестр не растет с числом пользователей.
+"""
+import asyncio
+import contextvars
+import logging
+import time
+from typing import Callable, Dict, Optional
+
+from utils.latency_stats import LatencyHistogram
+
+logger = logging.getLogger(__name__)
+
+_active_key: contextvars.ContextVar = contextvars.ContextVar("user_scheduler_key", default=None)
+
+
+class _UserSlot:
+    __slots__ = ('lock', 'generation', 'waiting', 'running')
+
+    def __init__(self):
+        self.lock = asyncio.Lock()
+        self.generation = 0  # Номер последнего поступившего запроса
+        self.waiting = 0
+        self.running: Optional[asyncio.Task] = None
+
+
+class UserRequestScheduler:
+    def __init__(self):
+        self._slots: Dict[int, _UserSlot] = {}
+        self.started = 0
+        self.superseded = 0  # Отменены во время выполнения
+        self.dropped = 0  # Заменены новым запросом до начала
+        self.max_waiting = 0
+        self.queue_wait = LatencyHistogram()
+
+    async def run(self, key: int, func: Callable, *args, **kwargs):
+        """
+        Выполняет конвейер func(*args, **kwargs) для пользователя (чата) key.
+        Возвращает его результат или None, если запрос заменен более новым.
+        """
+        if _active_key.get() == key:
+            return await func(*args, **kwargs)
+
+        slot = self._slots.get(key)
+        if slot is None:
+            slot = self._slots[key] = _UserSlot()
+        slot.generation += 1
+        generation = slot.generation
+        if slot.running is not None and not slot.running.done():
+            slot.running.cancel()
+            self.superseded += 1
+
+        slot.waiting += 1
+        self.max_waiting = max(self.max_waiting, slot.waiting)
+        queued_at = time.monotonic()
+        try:
+            try:
+                await slot.lock.acquire()
+            finally:
+                # Ждущего могли отменить прямо в очереди на блокировку
+                slot.waiting -= 1
+            try:
+                if slot.generation != generation:
+                    self.dropped += 1
+                    return None
+                self.queue_wait.observe(time.monotonic() - queued_at)
+                return await self._execute(key, slot, func, args, kwargs)
+            finally:
+                slot.lock.release()
+        finally:
+            if slot.waiting == 0 and not slot.lock.locked() and self._slots.get(key) is slot:
+                del self._slots[key]
+
+    async def _execute(self, key: int, slot: _UserSlot, func: Callable, args, kwargs):
+        async def pipeline():
+            _active_key.set(key)
+            return await func(*args, **kwargs)
+
+        self.started += 1
+        task = asyncio.create_task(pipeline())
+        slot.running = task
+        try:
+            await asyncio.wait({task})
+        except asyncio.CancelledError:
+            # Отменили вызывающую задачу (остановка бота) - отменяем и конвейер
+            task.cancel()
+            raise
+        finally:
+            slot.running = None
+        if task.cancelled():
+            return None
+        return task.result()
+
+    def get_stats(self) -> Dict:
+        return {
+            "users": len(self._slots),
+            "running": sum(1 for slot in self._slots.values() if slot.running is not None),
+            "waiting": sum(slot.waiting for slot in self._slots.values()),
+            "max_waiting": self.max_waiting,
+            "started": self.started,
+            "superseded": self.superseded,
+            "dropped": self.dropped,
+            "queue_wait": self.queue_wait.snapshot(),
+        }
+
+
+user_scheduler = UserRequestScheduler()
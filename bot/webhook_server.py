@@ -0,0 +1,197 @@
+"""
+Прием апдейтов через webhook (aiohttp, интеграция aiogram).
+
+POST на WEBHOOK_PATH проверяет секрет и кладет апдейт в ограниченную
+очередь; фиксированный пул задач-обработчиков передает апдейты в
+Dispatcher. Telegram получает ответ сразу после постановки в очередь.
+Если очередь заполнена, запрос ждет место не дольше
+WEBHOOK_DEFER_SECONDS, затем получает 503 с Retry-After - Telegram
+повторит доставку позже, апдейт не теряется.
+
+GET /health - процесс жив (и состояние очереди), GET /ready - 200 только
+после прогрева: БД открыта, векторное хранилище и индекс каталога
+загружены, словари аббревиатур прочитаны.
+
+Локальная проверка без Telegram: BOT_MODE=webhook без WEBHOOK_URL и
+replay_updates.py с записанными апдейтами.
+"""
+import asyncio
+import logging
+import sys
+import time
+from typing import Dict, List, Optional
+
+from aiohttp import web
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler
+
+from utils.latency_stats import LatencyHistogram
+
+logger = logging.getLogger(__name__)
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+RETRY_AFTER_SECONDS = 5
+DRAIN_TIMEOUT_SECONDS = 30
+
+
+class QueuedRequestHandler(SimpleRequestHandler):
+    """Обработчик webhook: апдейт ставится в очередь, обработка - в пуле задач"""
+
+    def __init__(self, dispatcher, bot, queue_size: int, consumers: int,
+                 defer_seconds: float, secret_token: Optional[str] = None):
+        super().__init__(dispatcher=dispatcher, bot=bot, secret_token=secret_token)
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=queue_size)
+        self.consumers = consumers
+        self.defer_seconds = defer_seconds
+        self._tasks: List[asyncio.Task] = []
+
+        self.accepted = 0
+        self.deferred = 0
+        self.rejected = 0
+        self.processed = 0
+        self.failed = 0
+        self.queue_wait = LatencyHistogram()
+        self.processing = LatencyHistogram()
+
+    async def handle(self, request: web.Request) -> web.Response:
+        bot = await self.resolve_bot(request)
+        if not self.verify_secret(request.headers.get(SECRET_HEADER, ""), bot):
+            return web.Response(body="Unauthorized", status=401)
+        try:
+            update = await request.json(loads=bot.session.json_loads)
+        except ValueError:
+            return web.Response(body="Bad Request", status=400)
+
+        item = (time.monotonic(), update)
+        try:
+            self.queue.put_nowait(item)
+        except asyncio.QueueFull:
+            # Очередь полна - ненадолго откладываем ответ, затем отказываем
+            self.deferred += 1
+            try:
+                await asyncio.wait_for(self.queue.put(item), timeout=self.defer_seconds)
+            except asyncio.TimeoutError:
+                self.rejected += 1
+                logger.warning(f"[WEBHOOK] Queue full ({self.queue.maxsize}), update rejected")
+                return web.Response(
+                    body="Busy", status=503, headers={"Retry-After": str(RETRY_AFTER_SECONDS)}
+                )
+        self.accepted += 1
+        return web.json_response({})
+
+    async def _consumer(self):
+        while True:
+            queued_at, update = await self.queue.get()
+            started = time.monotonic()
+            self.queue_wait.observe(started - queued_at)
+            try:
+                await self.dispatcher.feed_raw_update(self.bot, update)
+                self.processed += 1
+            except Exception as e:
+                self.failed += 1
+                logger.exception(f"[WEBHOOK] Update {update.get('update_id')} failed: {e}")
+            finally:
+                self.processing.observe(time.monotonic() - started)
+                self.queue.task_done()
+
+    def start(self):
+        for index in range(self.consumers):
+            self._tasks.append(asyncio.create_task(self._consumer(), name=f"webhook-consumer-{index}"))
+
+    async def stop(self):
+        """Дообрабатывает принятые апдейты и останавливает пул"""
+        if self.queue.qsize():
+            try:
+                await asyncio.wait_for(self.queue.join(), timeout=DRAIN_TIMEOUT_SECONDS)
+            except asyncio.TimeoutError:
+                logger.warning(f"[WEBHOOK] {self.queue.qsize()} updates left unprocessed")
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks.clear()
+
+    def get_stats(self) -> Dict:
+        return {
+            "queue": self.queue.qsize(),
+            "queue_size": self.queue.maxsize,
+            "consumers": self.consumers,
+            "accepted": self.accepted,
+            "deferred": self.deferred,
+            "rejected": self.rejected,
+            "processed": self.processed,
+            "failed": self.failed,
+            "queue_wait": self.queue_wait.snapshot(),
+            "processing": self.processing.snapshot(),
+        }
+
+
+# ============================================================
+# ПРОВЕРКИ ГОТОВНОСТИ
+# ============================================================
+
+def readiness_checks() -> Dict[str, bool]:
+    """Прогреты ли компоненты, без которых первые запросы будут медленными"""
+    from src.database.db_init import db
+
+    processor = db.test_processor
+    checks = {
+        "database": db.pool.get_stats()["opened"],
+        "vector_store": processor.vector_store is not None,
+        "catalog_index": processor.catalog_index.get_stats()["version"] is not None,
+    }
+    preprocessing = sys.modules.get("bot.handlers.query_processing.query_preprocessing")
+    expander = getattr(preprocessing, "abbreviation_expander", None)
+    checks["dictionaries"] = expander is not None and bool(
+        expander.vet_dicts or expander.disease_dicts or expander.pcr_dicts
+    )
+    return checks
+
+
+def warm_up():
+    """Прогрев индекса каталога и словарей аббревиатур (блокирующий - вызывать в потоке)"""
+    from bot.handlers.query_processing.query_preprocessing import expand_query_with_abbreviations
+    from src.database.db_init import db
+
+    db.test_processor.catalog_index.codes()
+    expand_query_with_abbreviations("ОАК")
+
+
+class HealthEndpoints:
+    def __init__(self, handler: QueuedRequestHandler):
+        self.handler = handler
+        self.started = time.monotonic()
+        self.warm = False  # Выставляется после прогрева при запуске
+
+    async def health(self, request: web.Request) -> web.Response:
+        from utils.loop_monitor import loop_monitor
+
+        return web.json_response({
+            "status": "ok",
+            "uptime_seconds": round(time.monotonic() - self.started),
+            "webhook": self.handler.get_stats(),
+            "loop_lag": loop_monitor.get_stats(),
+        })
+
+    async def ready(self, request: web.Request) -> web.Response:
+        checks = readiness_checks()
+        checks["warmup"] = self.warm
+        ready = all(checks.values())
+        return web.json_response(
+            {"ready": ready, "checks": checks, "queue": self.handler.queue.qsize()},
+            status=200 if ready else 503
+        )
+
+
+def create_webhook_app(dispatcher, bot, path: str, queue_size: int, consumers: int,
+                       defer_seconds: float, secret_token: Optional[str] = None):
+    """aiohttp-приложение webhook; возвращает (app, обработчик, health)"""
+    handler = QueuedRequestHandler(
+        dispatcher, bot, queue_size=queue_size, consumers=consumers,
+        defer_seconds=defer_seconds, secret_token=secret_token
+    )
+    health = HealthEndpoints(handler)
+
+    app = web.Application()
+    handler.register(app, path=path)
+    app.router.add_get("/health", health.health)
+    app.router.add_get("/ready", health.ready)
+    return app, handler, health
@@ -0,0 +1,57 @@
+"""
+Проверка планов горячих запросов: создает схему во временной БД
+(create_tables + миграции) и прогоняет HOT_QUERIES через EXPLAIN QUERY PLAN.
+Завершается с кодом 1, если какой-то запрос уходит в полный SCAN таблицы.
+
+    python check_query_plans.py
+"""
+import asyncio
+import os
+import sqlite3
+import sys
+import tempfile
+
+from src.database.migrations import HOT_QUERIES
+from src.database.models import Database
+
+
+async def build_schema(db_path: str):
+    database = Database(db_path)
+    try:
+        await database.create_tables()
+    finally:
+        await database.close()
+
+
+def full_scans(conn: sqlite3.Connection, sql: str) -> list:
+    """Шаги плана вида 'SCAN <таблица>' без индекса"""
+    params = (None,) * sql.count('?')
+    plan = conn.execute(f"EXPLAIN QUERY PLAN {sql}", params).fetchall()
+    return [
+        row[3] for row in plan
+        if row[3].startswith('SCAN') and 'USING' not in row[3] and 'SUBQUERY' not in row[3]
+    ]
+
+
+def main() -> int:
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db_path = os.path.join(tmp_dir, 'plans.db')
+        asyncio.run(build_schema(db_path))
+
+        conn = sqlite3.connect(db_path)
+        failed = 0
+        for name, sql in HOT_QUERIES:
+            scans = full_scans(conn, sql)
+            if scans:
+                failed += 1
+                print(f"[FAIL] {name}: {'; '.join(scans)}")
+            else:
+                print(f"[OK] {name}")
+        conn.close()
+
+    print(f"\n{len(HOT_QUERIES) - failed}/{len(HOT_QUERIES)} hot queries use indexes")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -15,3 +15,37 @@ EMAIL_LOGIN = os.getenv('EMAIL_LOGIN')
 EMAIL_PASSWORD = os.getenv('EMAIL_PASSWORD')
 EMAIL_TO = os.getenv('EMAIL_TO')
 
+
+# LLM
+# Бюджет токенов на контекст (описания тестов) в промпте для общих вопросов.
+# 0 - без ограничения: в контекст попадают все найденные тесты (до 50), как раньше;
+# положительное значение сокращает промпт до самых релевантных тестов
+LLM_CONTEXT_TOKEN_BUDGET = int(os.getenv('LLM_CONTEXT_TOKEN_BUDGET', 0))
+
+# Telegram
+# Индикатор загрузки (GIF + текст) не показывается, если ответ готов быстрее
+LOADING_FAST_PATH_MS = int(os.getenv('LOADING_FAST_PATH_MS', 400))
+
+# Синхронные этапы обработки запроса выполняются в пуле потоков (utils/cpu_offload.py)
+CPU_OFFLOAD_WORKERS = int(os.getenv('CPU_OFFLOAD_WORKERS', 4))
+# Запросы не длиннее - обрабатываются сразу в event loop
+CPU_OFFLOAD_INLINE_MAX_CHARS = int(os.getenv('CPU_OFFLOAD_INLINE_MAX_CHARS', 24))
+
+# Развертывание
+# Число процессов-воркеров в режиме main_sharded.py (апдейты распределяются по user_id)
+BOT_WORKERS = int(os.getenv('BOT_WORKERS', 1))
+# Снимок индекса каталога, общий для процессов (mmap); пустое значение - без снимка
+CATALOG_SNAPSHOT_PATH = os.getenv('CATALOG_SNAPSHOT_PATH', 'data/catalog_snapshot.bin')
+
+# Прием апдейтов: polling (по умолчанию) или webhook (bot/webhook_server.py)
+BOT_MODE = os.getenv('BOT_MODE', 'polling')
+# Публичный адрес для setWebhook; без него сервер только принимает POST (локальная проверка)
+WEBHOOK_URL = os.getenv('WEBHOOK_URL', '')
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/webhook')
+WEBHOOK_HOST = os.getenv('WEBHOOK_HOST', '0.0.0.0')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', 8080))
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET') or None
+WEBHOOK_QUEUE_SIZE = int(os.getenv('WEBHOOK_QUEUE_SIZE', 500))
+WEBHOOK_CONSUMERS = int(os.getenv('WEBHOOK_CONSUMERS', 16))
+# Сколько держать запрос Telegram при полной очереди перед ответом 503
+WEBHOOK_DEFER_SECONDS = float(os.getenv('WEBHOOK_DEFER_SECONDS', 2))
@@ -1,8 +1,21 @@
 import asyncio
 import logging
+import time
 from datetime import datetime
+
+_import_started = time.perf_counter()
 from bot.handlers import bot, dp
 from src.database.db_init import db
+IMPORT_SECONDS = time.perf_counter() - _import_started
+
+from bot.broadcast_engine import broadcast_engine
+from bot.search_sessions import search_sessions
+from bot.middleware.activity_aggregator import (
+    activity_aggregator, FLUSH_INTERVAL_SECONDS as ACTIVITY_FLUSH_INTERVAL_SECONDS
+)
+from utils.cpu_offload import cpu_offload
+from utils.loop_monitor import loop_monitor
+from utils.startup_report import build_startup_report
 
 # Настройка логирования
 logging.basicConfig(
@@ -16,11 +29,18 @@ running_tasks = []
 shutdown_event = asyncio.Event()
 
 
-async def periodic_session_cleanup():
-    """Периодически закрывает неактивные сессии (каждые 60 секунд)"""
+async def periodic_session_cleanup(primary: bool = True, sharded: bool = False):
+    """
+    Периодически закрывает неактивные сессии (каждые 60 секунд).
+    В многопроцессном режиме каждый воркер закрывает свои сессии (свежая
+    last_activity есть только у него); основной дополнительно закрывает
+    брошенные сессии упавших воркеров - с тем же запасом, что и при запуске.
+    """
     while not shutdown_event.is_set():
         try:
-            closed = await db.close_inactive_sessions(inactivity_minutes=3)
+            closed = await db.close_inactive_sessions(inactivity_minutes=3, owned_only=sharded)
+            if sharded and primary:
+                closed += await db.close_inactive_sessions(inactivity_minutes=180)
             if closed > 0:
                 logger.info(f"[SESSIONS] Closed {closed} inactive sessions")
         except Exception as e:
@@ -33,6 +53,20 @@ async def periodic_session_cleanup():
             continue
 
 
+async def periodic_activity_flush():
+    """Периодически сбрасывает агрегатор активности в БД (каждые 5 секунд)"""
+    while not shutdown_event.is_set():
+        try:
+            await activity_aggregator.flush(db)
+        except Exception as e:
+            logger.error(f"[ACTIVITY] Flush error: {e}")
+        
+        try:
+            await asyncio.wait_for(shutdown_event.wait(), timeout=ACTIVITY_FLUSH_INTERVAL_SECONDS)
+        except asyncio.TimeoutError:
+            continue
+
+
 async def periodic_metrics_update():
     """Периодически обновляет метрики (каждые 5 минут)"""
     while not shutdown_event.is_set():
@@ -54,13 +88,23 @@ async def periodic_metrics_update():
 
 
 async def periodic_cache_cleanup():
-    """Периодически очищает кэш (каждые 10 минут)"""
+    """Периодически удаляет просроченные записи кэша (каждые 10 минут)"""
     while not shutdown_event.is_set():
         try:
-            # Очищаем кэш пользователей
-            if hasattr(db, 'clear_user_cache'):
-                db.clear_user_cache()
-                logger.info("[CACHE] User cache cleared")
+            # Только просроченные записи: актуальные остаются в LRU
+            evicted = db.user_cache.evict_expired()
+            stats = db.user_cache.get_stats()
+            logger.info(
+                f"[CACHE] User cache: evicted {evicted} expired, size {stats['size']}, "
+                f"hit rate {stats['hit_rate']:.1%}"
+            )
+            
+            # Устаревшие результаты поиска (пагинация)
+            expired = search_sessions.evict_expired()
+            logger.info(
+                f"[CACHE] Search sessions: evicted {expired} expired, "
+                f"{search_sessions.get_stats()['sessions']} left"
+            )
         except Exception as e:
             logger.error(f"[CACHE] Cleanup error: {e}")
         
@@ -71,18 +115,102 @@ async def periodic_cache_cleanup():
             continue
 
 
-async def startup_tasks():
-    """Выполняет задачи при запуске бота"""
+async def periodic_related_tests_rebuild():
+    """Периодически пересчитывает рекомендации "часто смотрят вместе" (каждый час)"""
+    while not shutdown_event.is_set():
+        try:
+            tests = await db.rebuild_related_tests()
+            logger.info(f"[RELATED] Recommendations ready for {tests} tests")
+        except Exception as e:
+            logger.error(f"[RELATED] Rebuild error: {e}")
+        
+        # Ждем час или сигнал остановки
+        try:
+            await asyncio.wait_for(shutdown_event.wait(), timeout=3600)
+        except asyncio.TimeoutError:
+            continue
+
+
+async def periodic_related_tests_reload():
+    """Перечитывает рекомендации, пересобранные основным воркером (каждый час)"""
+    while not shutdown_event.is_set():
+        try:
+            await asyncio.wait_for(shutdown_event.wait(), timeout=3600)
+        except asyncio.TimeoutError:
+            pass
+        else:
+            break
+        try:
+            await db.related_index.load()
+        except Exception as e:
+            logger.error(f"[RELATED] Reload error: {e}")
+
+
+async def periodic_broadcast_pickup():
+    """Запускает рассылки, созданные в других воркерах (каждые 5 секунд)"""
+    while not shutdown_event.is_set():
+        try:
+            started = await broadcast_engine.resume_unfinished(bot)
+            if started:
+                logger.info(f"[BROADCAST] Picked up {started} broadcasts")
+        except Exception as e:
+            logger.error(f"[BROADCAST] Pickup error: {e}")
+
+        try:
+            await asyncio.wait_for(shutdown_event.wait(), timeout=5)
+        except asyncio.TimeoutError:
+            continue
+
+
+async def periodic_shared_state_sync():
+    """Подхватывает изменения других воркеров: фото контейнеров, плохие оценки (каждую минуту)"""
+    while not shutdown_event.is_set():
+        try:
+            await db.reload_container_photos()
+            invalidated = await db.sync_low_ratings()
+            if invalidated:
+                logger.info(f"[SYNC] Applied {invalidated} low ratings from other workers")
+        except Exception as e:
+            logger.error(f"[SYNC] Shared state sync error: {e}")
+
+        try:
+            await asyncio.wait_for(shutdown_event.wait(), timeout=60)
+        except asyncio.TimeoutError:
+            continue
+
+
+async def startup_tasks(primary: bool = True):
+    """
+    Выполняет задачи при запуске бота.
+    primary=False - дополнительный воркер (main_sharded.py): схему БД и общие
+    задачи ведет основной воркер.
+    """
     try:
-        # Создаем таблицы и индексы
-        await db.create_tables()
-        logger.info("[STARTUP] Database tables and indexes created")
+        # Отчет о холодном старте: время импорта, память, загруженные модели
+        for line in build_startup_report(IMPORT_SECONDS):
+            logger.info(f"[STARTUP] {line}")
+
+        # Открываем постоянные соединения с БД и создаем таблицы и индексы
+        await db.connect()
+        if primary:
+            await db.create_tables()
+            logger.info("[STARTUP] Database tables and indexes created")
+
+        # Пакетная запись телеметрии (метрики, история, счетчики активности)
+        await db.telemetry.start()
         
         # Инициализируем векторное хранилище если нужно
         if hasattr(db, 'test_processor'):
             db.test_processor.load_vector_store()
             logger.info("[STARTUP] Vector store loaded")
         
+        # Сохраненные рекомендации - до первой пересборки в фоне
+        loaded = await db.related_index.load()
+        logger.info(f"[STARTUP] Related tests loaded for {loaded} tests")
+        
+        if not primary:
+            return
+        
         # Закрываем старые незавершенные сессии
         closed = await db.close_inactive_sessions(inactivity_minutes=180)
         if closed > 0:
@@ -93,12 +221,17 @@ async def startup_tasks():
         await db.update_quality_metrics()
         logger.info("[STARTUP] Initial metrics updated")
         
+        # Продолжаем рассылки, прерванные остановкой или падением
+        resumed = await broadcast_engine.resume_unfinished(bot)
+        if resumed:
+            logger.info(f"[STARTUP] Resumed {resumed} broadcasts")
+        
     except Exception as e:
         logger.error(f"[STARTUP] Error during startup: {e}")
         raise
 
 
-async def shutdown_tasks():
+async def shutdown_tasks(primary: bool = True, sharded: bool = False):
     """Выполняет задачи при остановке бота"""
     try:
         logger.info("[SHUTDOWN] Starting graceful shutdown...")
@@ -110,27 +243,136 @@ async def shutdown_tasks():
         if running_tasks:
             await asyncio.gather(*running_tasks, return_exceptions=True)
         
-        # Закрываем все активные сессии
-        closed = await db.close_inactive_sessions(inactivity_minutes=0)
-        logger.info(f"[SHUTDOWN] Closed {closed} active sessions")
+        # Останавливаем рассылки: прогресс сохранен, при запуске они продолжатся
+        await broadcast_engine.stop()
+
+        # Сбрасываем агрегатор активности и дописываем телеметрию до финальных метрик
+        await activity_aggregator.flush(db)
+        await db.telemetry.stop()
+
+        # Дописываем отложенные изменения состояний FSM
+        await dp.storage.close()
+        
+        await loop_monitor.stop()
+        cpu_offload.shutdown()
         
-        # Финальное обновление метрик
-        await db.update_daily_metrics()
-        logger.info("[SHUTDOWN] Final metrics saved")
+        if primary or sharded:
+            # Закрываем активные сессии; в многопроцессном режиме каждый воркер - свои
+            closed = await db.close_inactive_sessions(inactivity_minutes=0, owned_only=sharded)
+            logger.info(f"[SHUTDOWN] Closed {closed} active sessions")
+
+        if primary:
+            # Финальное обновление метрик
+            await db.update_daily_metrics()
+            logger.info("[SHUTDOWN] Final metrics saved")
+
+        await db.close()
+        logger.info("[SHUTDOWN] Database connections closed")
         
     except Exception as e:
         logger.error(f"[SHUTDOWN] Error during shutdown: {e}")
 
 
+def start_periodic_tasks(primary: bool = True, sharded: bool = False):
+    """
+    Запускает периодические задачи; общие для всей БД - только в основном процессе.
+    sharded - многопроцессный режим: синхронизация состояния между воркерами.
+    """
+    loop_monitor.start()
+    running_tasks.append(asyncio.create_task(periodic_activity_flush()))
+    running_tasks.append(asyncio.create_task(periodic_cache_cleanup()))
+    running_tasks.append(asyncio.create_task(periodic_session_cleanup(primary, sharded)))
+    if sharded:
+        running_tasks.append(asyncio.create_task(periodic_shared_state_sync()))
+        if primary:
+            running_tasks.append(asyncio.create_task(periodic_broadcast_pickup()))
+    if primary:
+        running_tasks.append(asyncio.create_task(periodic_metrics_update()))
+        running_tasks.append(asyncio.create_task(periodic_related_tests_rebuild()))
+    else:
+        running_tasks.append(asyncio.create_task(periodic_related_tests_reload()))
+
+
+async def run_worker(index: int, updates, primary_ready):
+    """Воркер многопроцессного режима (bot/sharding.py): апдейты из очереди приемника"""
+    from bot.sharding import consume_updates, wait_primary_ready
+
+    primary = index == 0
+    worker_name = f"WORKER-{index}"
+    # Рассылки ведет основной воркер: один лимит отправки на бота
+    broadcast_engine.delegate_to_primary = not primary
+    try:
+        if not primary:
+            await wait_primary_ready(primary_ready)
+        await startup_tasks(primary)
+        if primary:
+            # Снимок индекса каталога строится один раз - остальные открывают его через mmap
+            await asyncio.to_thread(db.test_processor.catalog_index.codes)
+            primary_ready.set()
+        start_periodic_tasks(primary, sharded=True)
+        
+        logger.info(f"[{worker_name}] Ready")
+        await consume_updates(updates, bot, dp, worker_name)
+    finally:
+        await shutdown_tasks(primary, sharded=True)
+        await bot.session.close()
+
+
+async def run_webhook():
+    """Прием апдейтов через webhook: aiohttp-сервер с ограниченной очередью"""
+    from aiohttp import web
+
+    from bot.webhook_server import create_webhook_app, warm_up
+    from config import (
+        WEBHOOK_CONSUMERS, WEBHOOK_DEFER_SECONDS, WEBHOOK_HOST, WEBHOOK_PATH,
+        WEBHOOK_PORT, WEBHOOK_QUEUE_SIZE, WEBHOOK_SECRET, WEBHOOK_URL
+    )
+
+    app, handler, health = create_webhook_app(
+        dp, bot, path=WEBHOOK_PATH, queue_size=WEBHOOK_QUEUE_SIZE,
+        consumers=WEBHOOK_CONSUMERS, defer_seconds=WEBHOOK_DEFER_SECONDS,
+        secret_token=WEBHOOK_SECRET
+    )
+    runner = web.AppRunner(app)
+    await runner.setup()
+    # /health отвечает уже во время прогрева, /ready - после него
+    await web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT).start()
+    logger.info(f"[WEBHOOK] Listening on {WEBHOOK_HOST}:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+    try:
+        await asyncio.to_thread(warm_up)
+        handler.start()
+        health.warm = True
+
+        if WEBHOOK_URL:
+            await bot.set_webhook(
+                WEBHOOK_URL.rstrip('/') + WEBHOOK_PATH,
+                secret_token=WEBHOOK_SECRET,
+                allowed_updates=dp.resolve_used_update_types(),
+                max_connections=min(WEBHOOK_CONSUMERS, 100),
+            )
+            logger.info(f"[WEBHOOK] Webhook set to {WEBHOOK_URL}")
+        else:
+            logger.info("[WEBHOOK] WEBHOOK_URL not set - accepting local POSTs only")
+
+        await asyncio.Event().wait()
+    finally:
+        await handler.stop()
+        await runner.cleanup()
+
+
 async def main():
+    from config import BOT_MODE
+
     try:
         # Выполняем задачи запуска
         await startup_tasks()
         
         # Запускаем периодические задачи
-        running_tasks.append(asyncio.create_task(periodic_session_cleanup()))
-        running_tasks.append(asyncio.create_task(periodic_metrics_update()))
-        running_tasks.append(asyncio.create_task(periodic_cache_cleanup()))
+        start_periodic_tasks()
+        
+        if BOT_MODE == 'webhook':
+            await run_webhook()
+            return
         
         logger.info("[INFO] Starting bot polling...")
         
@@ -0,0 +1,34 @@
+"""
+Многопроцессный запуск бота: приемник апдейтов + BOT_WORKERS воркеров,
+апдейты распределяются по user_id (см. bot/sharding.py).
+
+    BOT_WORKERS=4 python main_sharded.py
+
+При BOT_WORKERS=1 - обычный однопроцессный запуск (main.py).
+"""
+import logging
+from datetime import datetime
+
+from bot.sharding import run_receiver
+from config import BOT_WORKERS
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(processName)s - %(name)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger(__name__)
+
+
+if __name__ == "__main__":
+    if BOT_WORKERS <= 1:
+        import asyncio
+
+        import main
+
+        asyncio.run(main.main())
+    else:
+        logger.info(f"[START] Sharded bot starting at {datetime.now()} with {BOT_WORKERS} workers")
+        try:
+            run_receiver(BOT_WORKERS)
+        finally:
+            logger.info("[END] Sharded bot shutdown complete")
@@ -0,0 +1,320 @@
+# models/llm_gateway.py
+"""
+Единая точка вызова LLM.
+
+- глобальный семафор на число одновременных запросов к провайдеру;
+- дедлайн запроса с учетом оставшегося бюджета времени пользователя;
+- hedging: если основная модель не ответила за p95, параллельно
+  запускается запрос ко второй модели и берется первый ответ;
+- circuit breaker: при деградации провайдера вызовы сразу завершаются
+  LLMUnavailableError, и вызывающий код уходит в не-LLM fallback;
+- гистограммы задержек и счетчики ошибок по моделям.
+"""
+import asyncio
+import logging
+import time
+from typing import Awaitable, Callable, Dict, List, Optional
+
+from models.models_init import get_chat_model
+from utils.latency_stats import LatencyHistogram
+
+logger = logging.getLogger(__name__)
+
+PRIMARY_MODEL = "Google_Gemini_2_5_Flash_Lite"
+HEDGE_MODEL = "gpt_4o"
+
+LLM_MAX_CONCURRENCY = 8
+DEFAULT_TIMEOUT_SECONDS = 30.0
+HEDGE_MIN_SAMPLES = 20          # Сколько замеров нужно, чтобы доверять p95
+HEDGE_DEFAULT_DELAY = 3.0       # Задержка hedging, пока статистики мало
+BREAKER_FAILURE_THRESHOLD = 5   # Ошибок подряд до размыкания
+BREAKER_RESET_SECONDS = 30.0    # Через сколько пробовать снова
+
+
+class LLMUnavailableError(Exception):
+    """LLM недоступна: разомкнут breaker или истек дедлайн"""
+
+
+class CircuitBreaker:
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold: int = BREAKER_FAILURE_THRESHOLD,
+                 reset_timeout: float = BREAKER_RESET_SECONDS):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self._probe_in_flight = False
+
+    def allow(self) -> bool:
+        if self.state == self.CLOSED:
+            return True
+        if self.state == self.OPEN and time.monotonic() - self.opened_at >= self.reset_timeout:
+            self.state = self.HALF_OPEN
+            self._probe_in_flight = False
+        if self.state == self.HALF_OPEN and not self._probe_in_flight:
+            # Пропускаем один пробный запрос
+            self._probe_in_flight = True
+            return True
+        return False
+
+    def record_success(self):
+        self.state = self.CLOSED
+        self.consecutive_failures = 0
+        self._probe_in_flight = False
+
+    def record_failure(self):
+        self.consecutive_failures += 1
+        self._probe_in_flight = False
+        if self.state == self.HALF_OPEN or self.consecutive_failures >= self.failure_threshold:
+            if self.state != self.OPEN:
+                logger.warning(f"[LLM_GATEWAY] Circuit opened after {self.consecutive_failures} failures")
+            self.state = self.OPEN
+            self.opened_at = time.monotonic()
+
+
+class _ModelStats:
+    def __init__(self):
+        self.latency = LatencyHistogram()
+        self.calls = 0
+        self.errors = 0
+        self.timeouts = 0
+        self.hedges_won = 0
+        self.breaker = CircuitBreaker()
+
+
+class LLMGateway:
+    def __init__(
+        self,
+        primary_model: str = PRIMARY_MODEL,
+        hedge_model: Optional[str] = HEDGE_MODEL,
+        max_concurrency: int = LLM_MAX_CONCURRENCY
+    ):
+        self.primary_model = primary_model
+        self.hedge_model = hedge_model
+        self.max_concurrency = max_concurrency
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._stats: Dict[str, _ModelStats] = {}
+        self.rejected = 0
+        self.hedges_started = 0
+
+    def _model_stats(self, alias: str) -> _ModelStats:
+        if alias not in self._stats:
+            self._stats[alias] = _ModelStats()
+        return self._stats[alias]
+
+    @staticmethod
+    def _time_left(timeout: Optional[float], deadline: Optional[float]) -> float:
+        """Оставшееся время: минимум из timeout и дедлайна (time.time())"""
+        left = timeout if timeout is not None else DEFAULT_TIMEOUT_SECONDS
+        if deadline is not None:
+            left = min(left, deadline - time.time())
+        return left
+
+    def _hedge_delay(self) -> float:
+        latency = self._model_stats(self.primary_model).latency
+        if latency.sample_count >= HEDGE_MIN_SAMPLES:
+            return latency.percentile(95) / 1000
+        return HEDGE_DEFAULT_DELAY
+
+    async def _call(self, alias: str, messages: list, time_left: float,
+                    on_text: Optional[Callable[[str], Awaitable]] = None,
+                    admitted: bool = False) -> str:
+        """
+        Один вызов модели под семафором с учетом статистики и breaker.
+        admitted=True - вызывающий код уже получил разрешение breaker.allow()
+        (в том числе пробный запрос half-open), повторно не спрашиваем.
+        """
+        stats = self._model_stats(alias)
+        if not admitted and not stats.breaker.allow():
+            raise LLMUnavailableError(f"Circuit open for {alias}")
+
+        started = time.monotonic()
+        try:
+            await asyncio.wait_for(self._semaphore.acquire(), timeout=max(time_left, 0.01))
+        except asyncio.TimeoutError:
+            # Провайдер не виноват - не считаем это ошибкой модели
+            stats.breaker._probe_in_flight = False
+            raise LLMUnavailableError("LLM concurrency limit: no slot before deadline")
+
+        stats.calls += 1
+        try:
+            remaining = time_left - (time.monotonic() - started)
+            if remaining <= 0:
+                raise asyncio.TimeoutError()
+
+            if on_text is not None:
+                text = await asyncio.wait_for(
+                    self._stream(alias, messages, on_text), timeout=remaining
+                )
+            else:
+                response = await asyncio.wait_for(
+                    get_chat_model(alias).agenerate([messages]), timeout=remaining
+                )
+                text = response.generations[0][0].text
+
+            stats.latency.observe(time.monotonic() - started)
+            stats.breaker.record_success()
+            return text
+        except asyncio.TimeoutError:
+            stats.timeouts += 1
+            stats.errors += 1
+            stats.breaker.record_failure()
+            raise
+        except asyncio.CancelledError:
+            # Проигравший hedged-запрос отменяется - это не ошибка модели
+            stats.breaker._probe_in_flight = False
+            raise
+        except Exception:
+            stats.errors += 1
+            stats.breaker.record_failure()
+            raise
+        finally:
+            self._semaphore.release()
+
+    @staticmethod
+    async def _stream(alias: str, messages: list, on_text: Callable[[str], Awaitable]) -> str:
+        """Потоковая генерация; без токенов - откат на agenerate"""
+        llm = get_chat_model(alias, streaming=True)
+        text = ""
+        try:
+            async for chunk in llm.astream(messages):
+                content = getattr(chunk, "content", "") or ""
+                if not content:
+                    continue
+                text += content
+                await on_text(text)
+        except Exception as e:
+            if text:
+                raise
+            logger.warning(f"[LLM_GATEWAY] Streaming failed for {alias}, falling back to agenerate: {e}")
+            response = await llm.agenerate([messages])
+            text = response.generations[0][0].text
+        return text
+
+    async def generate(
+        self,
+        messages: list,
+        timeout: Optional[float] = None,
+        deadline: Optional[float] = None,
+        hedge: bool = False
+    ) -> str:
+        """
+        Текст ответа LLM.
+
+        Args:
+            timeout: лимит на сам вызов, сек
+            deadline: абсолютный дедлайн (time.time()) - остаток бюджета пользователя
+            hedge: дублировать запрос во вторую модель после p95 задержки
+
+        Raises:
+            LLMUnavailableError: breaker разомкнут или не осталось времени
+            asyncio.TimeoutError: модель не уложилась в дедлайн
+        """
+        time_left = self._time_left(timeout, deadline)
+        if time_left <= 0:
+            self.rejected += 1
+            raise LLMUnavailableError("No latency budget left for LLM call")
+
+        # allow() переводит OPEN в HALF_OPEN по истечении reset_timeout и
+        # пропускает пробный запрос - иначе основная модель не вернется никогда
+        if not self._model_stats(self.primary_model).breaker.allow():
+            if self.hedge_model:
+                # Основная модель деградировала - сразу идем во вторую
+                return await self._guarded(self.hedge_model, messages, time_left)
+            self.rejected += 1
+            raise LLMUnavailableError(f"Circuit open for {self.primary_model}")
+
+        if not hedge or not self.hedge_model:
+            return await self._guarded(self.primary_model, messages, time_left, admitted=True)
+
+        return await self._hedged(messages, time_left)
+
+    async def _guarded(self, alias: str, messages: list, time_left: float,
+                       on_text=None, admitted: bool = False) -> str:
+        try:
+            return await self._call(alias, messages, time_left, on_text, admitted)
+        except LLMUnavailableError:
+            self.rejected += 1
+            raise
+
+    async def _hedged(self, messages: list, time_left: float) -> str:
+        """Hedged-вызов; breaker основной модели уже пропустил запрос (generate)"""
+        started = time.monotonic()
+        primary = asyncio.create_task(
+            self._call(self.primary_model, messages, time_left, admitted=True)
+        )
+        tasks = {primary: self.primary_model}
+
+        try:
+            done, _ = await asyncio.wait({primary}, timeout=min(self._hedge_delay(), time_left))
+            # Hedge и при медленном, и при быстро упавшем основном запросе
+            if not done or primary.exception() is not None:
+                remaining = time_left - (time.monotonic() - started)
+                hedge_stats = self._model_stats(self.hedge_model)
+                if remaining > 0 and hedge_stats.breaker.allow():
+                    self.hedges_started += 1
+                    hedge_task = asyncio.create_task(
+                        self._call(self.hedge_model, messages, remaining, admitted=True)
+                    )
+                    tasks[hedge_task] = self.hedge_model
+
+            pending = set(tasks)
+            last_error: Optional[BaseException] = None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is not primary:
+                            self._model_stats(tasks[task]).hedges_won += 1
+                        return task.result()
+                    last_error = task.exception()
+            raise last_error
+        finally:
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+
+    async def stream(
+        self,
+        messages: list,
+        on_text: Callable[[str], Awaitable],
+        timeout: Optional[float] = None,
+        deadline: Optional[float] = None
+    ) -> str:
+        """Потоковая генерация основной моделью (без hedging - текст уже на экране)"""
+        time_left = self._time_left(timeout, deadline)
+        if time_left <= 0:
+            self.rejected += 1
+            raise LLMUnavailableError("No latency budget left for LLM call")
+
+        if self._model_stats(self.primary_model).breaker.allow():
+            return await self._guarded(self.primary_model, messages, time_left, on_text, admitted=True)
+        if self.hedge_model:
+            return await self._guarded(self.hedge_model, messages, time_left, on_text)
+        self.rejected += 1
+        raise LLMUnavailableError(f"Circuit open for {self.primary_model}")
+
+    def get_stats(self) -> Dict:
+        return {
+            "in_flight": self.max_concurrency - self._semaphore._value,
+            "rejected": self.rejected,
+            "hedges_started": self.hedges_started,
+            "models": {
+                alias: {
+                    "calls": stats.calls,
+                    "errors": stats.errors,
+                    "timeouts": stats.timeouts,
+                    "hedges_won": stats.hedges_won,
+                    "breaker": stats.breaker.state,
+                    "latency": stats.latency.snapshot(),
+                }
+                for alias, stats in self._stats.items()
+            },
+        }
+
+
+llm_gateway = LLMGateway()
@@ -1,7 +1,10 @@
-from langchain_community.chat_models import ChatOpenAI
+from typing import TYPE_CHECKING, Dict, List, Tuple
 
 from config import OPENROUTER_API_KEY
 
+if TYPE_CHECKING:
+    from langchain_community.chat_models import ChatOpenAI
+
 MAX_URLS = 5
 
 SEED = 0
@@ -12,10 +15,13 @@ TOP_P = 1.0
 if not OPENROUTER_API_KEY:
     raise RuntimeError('OPENROUTER_API_KEY not found.')
 
-def make_chat(model_name: str, streaming: bool = True) -> ChatOpenAI:
+def make_chat(model_name: str, streaming: bool = True) -> "ChatOpenAI":
     """
     Helper to instantiate ChatOpenAI with correct kwargs
     """
+    # langchain тяжелый, импортируем только при первом создании клиента
+    from langchain_community.chat_models import ChatOpenAI
+
     return ChatOpenAI(
         model=model_name,
         openai_api_key=OPENROUTER_API_KEY,
@@ -25,25 +31,67 @@ def make_chat(model_name: str, streaming: bool = True) -> ChatOpenAI:
         model_kwargs={"top_p": TOP_P, "seed": SEED},
     )
 
-# FREE models
-qwen_coder_32b_instruct_free = make_chat("qwen/qwen-2.5-coder-32b-instruct:free", streaming=False)
-qwen3_32b_instruct_free = make_chat("qwen/qwen3-32b:free", streaming=False)
-gemma3_27b_instruct_free = make_chat("google/gemma-3-27b-it:free", streaming=False)
-qwq_32b_instruct_free = make_chat("qwen/qwq-32b:free", streaming=False)
-deepseek_r1_instruct_free = make_chat("deepseek/deepseek-r1:free", streaming=False)
-gemini_2_5_pro_exp_free = make_chat("google/gemini-2.5-pro-exp-03-25:free", streaming=False)
-Google_Gemini_2_5_Flash_Lite = make_chat("google/gemini-2.5-flash-lite", streaming=False)
-
-# PAYABLE models
-gpt_4o = make_chat("openai/gpt-4o", streaming=False)
-openai_o1 = make_chat("openai/o1", streaming=False)
-openai_o3_mini_high = make_chat("openai/o3-mini-high", streaming=False)
-openai_o3_mini = make_chat("openai/o3-mini", streaming=False)
-openai_o3 = make_chat("openai/o3", streaming=False)
-openai_o1_pro = make_chat("openai/o1-pro", streaming=False)
-openai_o1_mini = make_chat("openai/o1-mini", streaming=False)
-openai_gpt_4o_search_preview = make_chat("openai/gpt-4o-search-preview", streaming=False)
-qwen3_32b_instruct = make_chat("qwen/qwen3-32b", streaming=False)
+
+# ============================================================================
+# РЕЕСТР МОДЕЛЕЙ
+# ============================================================================
+# Клиенты создаются лениво при первом обращении к атрибуту модуля
+# (from models.models_init import gpt_4o) или через get_chat_model().
+
+CHAT_MODELS: Dict[str, str] = {
+    # FREE models
+    "qwen_coder_32b_instruct_free": "qwen/qwen-2.5-coder-32b-instruct:free",
+    "qwen3_32b_instruct_free": "qwen/qwen3-32b:free",
+    "gemma3_27b_instruct_free": "google/gemma-3-27b-it:free",
+    "qwq_32b_instruct_free": "qwen/qwq-32b:free",
+    "deepseek_r1_instruct_free": "deepseek/deepseek-r1:free",
+    "gemini_2_5_pro_exp_free": "google/gemini-2.5-pro-exp-03-25:free",
+    "Google_Gemini_2_5_Flash_Lite": "google/gemini-2.5-flash-lite",
+
+    # PAYABLE models
+    "gpt_4o": "openai/gpt-4o",
+    "openai_o1": "openai/o1",
+    "openai_o3_mini_high": "openai/o3-mini-high",
+    "openai_o3_mini": "openai/o3-mini",
+    "openai_o3": "openai/o3",
+    "openai_o1_pro": "openai/o1-pro",
+    "openai_o1_mini": "openai/o1-mini",
+    "openai_gpt_4o_search_preview": "openai/gpt-4o-search-preview",
+    "qwen3_32b_instruct": "qwen/qwen3-32b",
+}
+
+_chat_instances: Dict[Tuple[str, bool], "ChatOpenAI"] = {}
+
+
+def get_chat_model(alias: str, streaming: bool = False) -> "ChatOpenAI":
+    """Возвращает клиент модели из реестра, создавая его при первом обращении"""
+    if alias not in CHAT_MODELS:
+        raise KeyError(f"Unknown chat model: {alias}")
+
+    key = (alias, streaming)
+    if key not in _chat_instances:
+        _chat_instances[key] = make_chat(CHAT_MODELS[alias], streaming=streaming)
+    return _chat_instances[key]
+
+
+def loaded_chat_models() -> List[str]:
+    """Список уже созданных клиентов (для отчета о запуске)"""
+    return [
+        f"{alias}{' (streaming)' if streaming else ''}"
+        for alias, streaming in _chat_instances
+    ]
+
+
+def __getattr__(name: str):
+    # PEP 562: старые импорты вида `from models.models_init import gpt_4o`
+    # продолжают работать, но создают только запрошенный клиент
+    if name in CHAT_MODELS:
+        return get_chat_model(name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def __dir__() -> List[str]:
+    return sorted(list(globals().keys()) + list(CHAT_MODELS.keys()))
 
 
 # additional interesting params (for LLMs)
@@ -1,12 +1,7 @@
 # models/vector_models_init.py
 
-import torch
-import torch.nn.functional as F
-from transformers import AutoTokenizer, AutoModel
 from langchain_core.embeddings import Embeddings
-from openai import OpenAI
-from typing import List, Optional
-from torch import Tensor
+from typing import TYPE_CHECKING, List, Optional
 from tqdm import tqdm
 import numpy as np
 import random
@@ -16,18 +11,32 @@ from functools import wraps
 
 from config import DEEPINFRA_API_KEY
 
+if TYPE_CHECKING:
+    from torch import Tensor
+
 # Настройка логирования
 logger = logging.getLogger(__name__)
 
-# Device selection
-if torch.cuda.is_available():
-    device = torch.device('cuda')
-elif torch.backends.mps.is_available():
-    device = torch.device('mps')
-    torch.mps.set_per_process_memory_fraction(0.9)
-    torch.mps.empty_cache()
-else:
-    device = torch.device('cpu')
+# Устройство выбирается только для локальных моделей: при use_remote=True
+# torch и transformers не импортируются вовсе
+_device = None
+
+
+def get_device():
+    """Ленивый выбор устройства (CUDA/MPS/CPU) при первой локальной модели"""
+    global _device
+    if _device is None:
+        import torch
+
+        if torch.cuda.is_available():
+            _device = torch.device('cuda')
+        elif torch.backends.mps.is_available():
+            _device = torch.device('mps')
+            torch.mps.set_per_process_memory_fraction(0.9)
+            torch.mps.empty_cache()
+        else:
+            _device = torch.device('cpu')
+    return _device
 
 
 def retry_with_fallback(max_retries: int = 2, delay: float = 1.0):
@@ -74,6 +83,8 @@ task_prompt = (
 
 def set_global_seed(seed: int = 42):
     """Фиксация сида для всех компонентов."""
+    import torch
+
     random.seed(seed)
     np.random.seed(seed)
     torch.manual_seed(seed)
@@ -117,12 +128,18 @@ class QwenEmbeddings(Embeddings):
             api_key = DEEPINFRA_API_KEY
             if not api_key:
                 raise ValueError('DEEPINFRA_API_KEY not set for remote embeddings')
+            from openai import OpenAI
+
             self.client = OpenAI(
                 api_key=api_key,
                 base_url='https://api.deepinfra.com/v1/openai'
             )
             print(f'[INFO] Using DeepInfra remote embeddings for model: {model_name}')
         else:
+            import torch
+            from transformers import AutoTokenizer, AutoModel
+
+            device = get_device()
             print(f'[INFO] Using local embeddings for model: {model_name} on device: {device}')
             self.device = device
             self.tokenizer = AutoTokenizer.from_pretrained(model_name, padding_side='left')
@@ -138,7 +155,9 @@ class QwenEmbeddings(Embeddings):
                 self.model.to(self.device)
             self.model.eval()
 
-    def last_token_pool(self, last_hidden_states: Tensor, attention_mask: Tensor) -> Tensor:
+    def last_token_pool(self, last_hidden_states: "Tensor", attention_mask: "Tensor") -> "Tensor":
+        import torch
+
         left_padding = (attention_mask[:, -1].sum() == attention_mask.shape[0])
         if left_padding:
             return last_hidden_states[:, -1]
@@ -205,6 +224,9 @@ class QwenEmbeddings(Embeddings):
                 results.extend(arr.tolist())
             return results
         else:
+            import torch
+            import torch.nn.functional as F
+
             batch_size = model.batch_size
             for i in tqdm(range(0, len(texts), batch_size), desc=f'Local embedding ({model.model_name})'):
                 batch_texts = texts[i:i + batch_size]
@@ -235,22 +257,43 @@ class QwenEmbeddings(Embeddings):
         return self.current_model.model_name
 
 
-# Создаем основную модель (4B) с fallback на 8B
-primary_model = QwenEmbeddings(
-    model_name='Qwen/Qwen3-Embedding-4B', 
-    task_prompt=task_prompt, 
-    use_remote=True
-)
+# ============================================================================
+# ЛЕНИВАЯ ИНИЦИАЛИЗАЦИЯ МОДЕЛЕЙ
+# ============================================================================
+# Клиенты эмбеддингов создаются при первом обращении к атрибуту модуля
+# (from models.vector_models_init import embedding_model), а не при импорте.
 
-# Создаем fallback модель (8B)
-fallback_model = QwenEmbeddings(
-    model_name='Qwen/Qwen3-Embedding-8B',
-    task_prompt=task_prompt, 
-    use_remote=True
-)
+_models = {}
+
+
+def _build_models():
+    """Создает основную модель (4B) с fallback на 8B"""
+    if not _models:
+        primary = QwenEmbeddings(
+            model_name='Qwen/Qwen3-Embedding-4B',
+            task_prompt=task_prompt,
+            use_remote=True
+        )
+
+        fallback = QwenEmbeddings(
+            model_name='Qwen/Qwen3-Embedding-8B',
+            task_prompt=task_prompt,
+            use_remote=True
+        )
+
+        # Связываем основную модель с fallback
+        primary.fallback_model = fallback
+
+        _models['primary_model'] = primary
+        _models['fallback_model'] = fallback
+        # Для обратной совместимости используем основную модель
+        _models['embedding_model'] = primary
+    return _models
 
-# Связываем основную модель с fallback
-primary_model.fallback_model = fallback_model
 
-# Для обратной совместимости используем основную модель
-embedding_model = primary_model
\ No newline at end of file
+def __getattr__(name: str):
+    if name in ('primary_model', 'fallback_model', 'embedding_model'):
+        return _build_models()[name]
+    if name == 'device':
+        return get_device()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
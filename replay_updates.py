@@ -0,0 +1,87 @@
+"""
+Отправка записанных апдейтов на локальный webhook (BOT_MODE=webhook).
+
+Файл - JSON Lines (апдейт на строку) или JSON-массив, например
+result из ответа getUpdates. Апдейты отправляются параллельно; в конце -
+коды ответов (503 - очередь переполнена) и задержка приема.
+
+    BOT_MODE=webhook python main.py
+    python replay_updates.py updates.jsonl --concurrency 20 --repeat 10
+"""
+import argparse
+import asyncio
+import json
+import time
+from collections import Counter
+
+import aiohttp
+
+from config import WEBHOOK_PATH, WEBHOOK_PORT, WEBHOOK_SECRET
+from utils.latency_stats import LatencyHistogram
+
+
+def load_updates(path: str) -> list:
+    with open(path, encoding='utf-8') as file:
+        content = file.read().strip()
+    if content.startswith('['):
+        return json.loads(content)
+    try:
+        data = json.loads(content)
+    except ValueError:
+        # JSON Lines
+        return [json.loads(line) for line in content.splitlines() if line.strip()]
+    # Ответ getUpdates целиком или один апдейт
+    return data.get('result', [data])
+
+
+async def replay(url: str, updates: list, concurrency: int, secret: str = None):
+    statuses = Counter()
+    latency = LatencyHistogram()
+    semaphore = asyncio.Semaphore(concurrency)
+    headers = {"X-Telegram-Bot-Api-Secret-Token": secret} if secret else {}
+
+    async with aiohttp.ClientSession(headers=headers) as session:
+        async def post(update: dict):
+            async with semaphore:
+                started = time.perf_counter()
+                try:
+                    async with session.post(url, json=update) as response:
+                        statuses[response.status] += 1
+                except aiohttp.ClientError as e:
+                    statuses[type(e).__name__] += 1
+                latency.observe(time.perf_counter() - started)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(post(update) for update in updates))
+        elapsed = time.perf_counter() - started
+
+    snapshot = latency.snapshot()
+    print(f"[REPLAY] {len(updates)} updates in {elapsed:.2f}s ({len(updates) / elapsed:.0f}/s)")
+    print(f"[REPLAY] Status codes: {dict(statuses)}")
+    print(f"[REPLAY] Latency p50={snapshot['p50_ms']:.1f}ms p95={snapshot['p95_ms']:.1f}ms max={snapshot['max_ms']:.1f}ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay recorded Telegram updates to the local webhook")
+    parser.add_argument("file", help="JSON Lines or JSON array of updates")
+    parser.add_argument("--url", default=f"http://127.0.0.1:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--repeat", type=int, default=1, help="Send the recorded set N times")
+    args = parser.parse_args()
+
+    recorded = load_updates(args.file)
+    updates = []
+    next_id = max((update.get('update_id', 0) for update in recorded), default=0) + 1
+    for round_index in range(args.repeat):
+        for update in recorded:
+            if round_index:
+                # Повторы - с новыми update_id, как у настоящих апдейтов
+                update = dict(update, update_id=next_id)
+                next_id += 1
+            updates.append(update)
+
+    asyncio.run(replay(args.url, updates, args.concurrency, WEBHOOK_SECRET))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,161 @@
+# answer_cache.py
+"""
+Семантический кэш ответов на общие вопросы.
+
+Вопрос ищется среди ранее отвеченных по косинусной близости эмбеддингов,
+но только внутри той же "области": одинаковый набор найденных тестов и
+та же версия каталога. Кэш сбрасывается при смене версии каталога и
+при низкой оценке ответа.
+"""
+import time
+import logging
+from collections import OrderedDict
+from typing import Dict, FrozenSet, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+ANSWER_CACHE_SIMILARITY_THRESHOLD = 0.93
+ANSWER_CACHE_MAX_ENTRIES = 1000
+ANSWER_CACHE_TTL_SECONDS = 24 * 3600
+ANSWER_CACHE_SCOPE_TOP_N = 10   # Сколько лучших тестов определяют область кэша
+LOW_RATING_THRESHOLD = 3        # Оценки <= 3 считаются негативными
+
+
+class _CacheEntry:
+    __slots__ = ("question", "embedding", "answer", "created_at")
+
+    def __init__(self, question: str, embedding: np.ndarray, answer: str):
+        self.question = question
+        self.embedding = embedding
+        self.answer = answer
+        self.created_at = time.time()
+
+
+class SemanticAnswerCache:
+    def __init__(
+        self,
+        threshold: float = ANSWER_CACHE_SIMILARITY_THRESHOLD,
+        max_entries: int = ANSWER_CACHE_MAX_ENTRIES,
+        ttl: int = ANSWER_CACHE_TTL_SECONDS
+    ):
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._catalog_version: Optional[str] = None
+        # scope -> записи; порядок scope'ов = LRU
+        self._scopes: "OrderedDict[FrozenSet[str], List[_CacheEntry]]" = OrderedDict()
+        self._size = 0
+        self.stats = {"hits": 0, "misses": 0, "stores": 0, "invalidations": 0}
+
+    @staticmethod
+    def make_scope(test_codes: Iterable[str]) -> FrozenSet[str]:
+        """Область кэша - набор лучших найденных тестов (порядок не важен)"""
+        codes = []
+        for code in test_codes:
+            code = (code or "").upper()
+            if code and code not in codes:
+                codes.append(code)
+            if len(codes) >= ANSWER_CACHE_SCOPE_TOP_N:
+                break
+        return frozenset(codes)
+
+    def _check_catalog_version(self, catalog_version: str):
+        if self._catalog_version != catalog_version:
+            if self._size:
+                logger.info(f"[ANSWER_CACHE] Catalog version changed, dropping {self._size} entries")
+                self.stats["invalidations"] += self._size
+            self._scopes.clear()
+            self._size = 0
+            self._catalog_version = catalog_version
+
+    @staticmethod
+    def _normalize(embedding) -> np.ndarray:
+        vector = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def lookup(self, embedding, scope: FrozenSet[str], catalog_version: str) -> Optional[str]:
+        """Возвращает сохраненный ответ на близкий вопрос или None"""
+        self._check_catalog_version(catalog_version)
+
+        entries = self._scopes.get(scope)
+        if not entries:
+            self.stats["misses"] += 1
+            return None
+
+        now = time.time()
+        fresh = [e for e in entries if now - e.created_at < self.ttl]
+        self._size -= len(entries) - len(fresh)
+        entries[:] = fresh
+
+        query = self._normalize(embedding)
+        best_entry, best_similarity = None, -1.0
+        for entry in entries:
+            similarity = float(np.dot(query, entry.embedding))
+            if similarity > best_similarity:
+                best_entry, best_similarity = entry, similarity
+
+        if best_entry is None or best_similarity < self.threshold:
+            self.stats["misses"] += 1
+            return None
+
+        self._scopes.move_to_end(scope)
+        self.stats["hits"] += 1
+        logger.info(
+            f"[ANSWER_CACHE] Hit ({best_similarity:.3f}) for question: {best_entry.question[:80]}"
+        )
+        return best_entry.answer
+
+    def store(self, question: str, embedding, scope: FrozenSet[str], catalog_version: str, answer: str):
+        self._check_catalog_version(catalog_version)
+
+        self._scopes.setdefault(scope, []).append(
+            _CacheEntry(question, self._normalize(embedding), answer)
+        )
+        self._scopes.move_to_end(scope)
+        self._size += 1
+        self.stats["stores"] += 1
+
+        # Вытесняем самые давние области
+        while self._size > self.max_entries and self._scopes:
+            _, evicted = self._scopes.popitem(last=False)
+            self._size -= len(evicted)
+
+    def invalidate_rated(self, question: str, response: str) -> int:
+        """Удаляет ответы, получившие низкую оценку (сравнение по сохраненным префиксам)"""
+        question_key = (question or "")[:500]
+        response_key = (response or "")[:1000]
+        removed = 0
+
+        for scope in list(self._scopes.keys()):
+            entries = self._scopes[scope]
+            kept = [
+                e for e in entries
+                if not (
+                    (question_key and e.question[:500] == question_key)
+                    or (response_key and e.answer[:1000] == response_key)
+                )
+            ]
+            removed += len(entries) - len(kept)
+            if kept:
+                self._scopes[scope] = kept
+            else:
+                del self._scopes[scope]
+
+        if removed:
+            self._size -= removed
+            self.stats["invalidations"] += removed
+            logger.info(f"[ANSWER_CACHE] Invalidated {removed} entries after low rating")
+        return removed
+
+    def clear(self):
+        self._scopes.clear()
+        self._size = 0
+
+    def get_stats(self) -> Dict[str, int]:
+        return {**self.stats, "entries": self._size, "scopes": len(self._scopes)}
+
+
+answer_cache = SemanticAnswerCache()
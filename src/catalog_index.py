@@ -0,0 +1,202 @@
+# catalog_index.py
+"""
+Индекс каталога тестов в памяти процесса.
+
+Строится одним проходом по коллекции Chroma и перестраивается только
+при смене версии каталога (get_catalog_version). Точный поиск по коду
+и пакетная выборка по списку кодов - словарные обращения вместо
+загрузки всей коллекции на каждый вызов search_test(filter_dict=...).
+
+Построенный индекс сохраняется снимком (CATALOG_SNAPSHOT_PATH): другие
+процессы (воркеры) и следующий запуск открывают его через mmap вместо
+чтения всей коллекции Chroma, документы разбираются при обращении.
+"""
+import threading
+import time
+from collections.abc import Sequence
+from typing import Dict, Iterable, List, Optional, Set
+
+from config import CATALOG_SNAPSHOT_PATH
+from src.catalog_snapshot import CatalogSnapshot, write_snapshot
+from src.container_index import container_key, display_container_name, split_container_field
+
+
+def test_info_from_metadata(metadata: dict) -> dict:
+    """Карточка теста в формате Database.get_test_by_code"""
+    return {
+        'test_code': metadata.get('test_code', ''),
+        'test_name': metadata.get('test_name', ''),
+        'container_type': metadata.get('container_type', ''),
+        'primary_container_type': metadata.get('primary_container_type', ''),
+        'preanalytics': metadata.get('preanalytics', ''),
+        'storage_temp': metadata.get('storage_temp', ''),
+        'department': metadata.get('department', '')
+    }
+
+
+class _SnapshotDocuments(Sequence):
+    """Документы каталога из снимка: Document создается при обращении"""
+
+    def __init__(self, snapshot: CatalogSnapshot):
+        self.snapshot = snapshot
+
+    def __len__(self) -> int:
+        return len(self.snapshot)
+
+    def __getitem__(self, position):
+        if isinstance(position, slice):
+            return [self[i] for i in range(*position.indices(len(self)))]
+        if position < 0:
+            position += len(self)
+        if not 0 <= position < len(self):
+            raise IndexError(position)
+
+        from langchain.schema import Document
+
+        content, metadata = self.snapshot.record(position)
+        return Document(page_content=content, metadata=metadata)
+
+
+class CatalogIndex:
+    def __init__(self, processor, snapshot_path: Optional[str] = CATALOG_SNAPSHOT_PATH):
+        self.processor = processor
+        self.snapshot_path = snapshot_path
+        self._version: Optional[str] = None
+        self._documents: List = []
+        self._by_code: Dict[str, int] = {}  # КОД -> позиция в _documents
+        self._containers: Dict[str, str] = {}  # ключ контейнера -> отображаемое имя
+        self._test_containers: Dict[str, List[str]] = {}  # КОД -> ключи контейнеров
+        self._lock = threading.Lock()
+        self.build_ms = 0.0
+        self.builds = 0
+        self.source: Optional[str] = None  # 'snapshot' или 'chroma'
+
+    def _ensure(self):
+        version = self.processor.catalog_version
+        if version == self._version and self._documents:
+            return
+        with self._lock:
+            if version == self._version and self._documents:
+                return
+            self._build(version)
+
+    def _build(self, version: str):
+        started = time.monotonic()
+        snapshot = CatalogSnapshot.open(self.snapshot_path, version) if self.snapshot_path else None
+        if snapshot is not None:
+            self._documents = _SnapshotDocuments(snapshot)
+            self._by_code = snapshot.by_code
+            self._containers = snapshot.containers
+            self._test_containers = snapshot.test_containers
+            self._finish_build(version, 'snapshot', started)
+            return
+
+        from langchain.schema import Document
+
+        store = self.processor.get_vector_store()
+        data = store.get(include=["metadatas", "documents"])
+
+        documents = []
+        by_code = {}
+        containers = {}
+        test_containers = {}
+        for content, metadata in zip(data.get('documents') or [], data.get('metadatas') or []):
+            metadata = metadata or {}
+            position = len(documents)
+            documents.append(Document(page_content=content or "", metadata=metadata))
+            code = str(metadata.get('test_code', '')).upper()
+            if code and code not in by_code:
+                by_code[code] = position
+
+            # Контейнеры из обоих полей (primary_container_type - приоритет)
+            keys = []
+            for field in ('primary_container_type', 'container_type'):
+                for name in split_container_field(metadata.get(field, '')):
+                    key = container_key(name)
+                    containers.setdefault(key, display_container_name(name))
+                    if key not in keys:
+                        keys.append(key)
+            if code and keys:
+                test_containers.setdefault(code, keys)
+
+        self._documents = documents
+        self._by_code = by_code
+        self._containers = containers
+        self._test_containers = test_containers
+        if self.snapshot_path:
+            try:
+                write_snapshot(
+                    self.snapshot_path, version,
+                    [(doc.page_content, doc.metadata) for doc in documents],
+                    by_code, containers, test_containers
+                )
+            except (OSError, TypeError, ValueError) as e:
+                print(f"[WARNING] Catalog snapshot not saved: {e}")
+        self._finish_build(version, 'chroma', started)
+
+    def _finish_build(self, version: str, source: str, started: float):
+        self._version = version
+        self.source = source
+        self.builds += 1
+        self.build_ms = (time.monotonic() - started) * 1000
+        print(f"[CATALOG] Index built from {source}: {len(self._by_code)} tests in {self.build_ms:.0f} ms")
+
+    # ============================================================
+    # ДОСТУП
+    # ============================================================
+
+    @property
+    def documents(self) -> Sequence:
+        self._ensure()
+        return self._documents
+
+    def get_document(self, code: str):
+        """Document теста по точному коду (без учета регистра) или None"""
+        self._ensure()
+        position = self._by_code.get(str(code).upper())
+        return self._documents[position] if position is not None else None
+
+    def get_documents_by_codes(self, codes: Iterable[str]) -> Dict[str, object]:
+        """{КОД: Document} для найденных кодов"""
+        self._ensure()
+        result = {}
+        for code in codes:
+            if not code:
+                continue
+            key = str(code).upper()
+            position = self._by_code.get(key)
+            if position is not None:
+                result[key] = self._documents[position]
+        return result
+
+    def get_tests_by_codes(self, codes: Iterable[str]) -> Dict[str, dict]:
+        """{КОД: карточка теста} для найденных кодов"""
+        return {
+            code: test_info_from_metadata(doc.metadata)
+            for code, doc in self.get_documents_by_codes(codes).items()
+        }
+
+    def codes(self) -> Set[str]:
+        """Коды всех тестов каталога (в верхнем регистре)"""
+        self._ensure()
+        return set(self._by_code)
+
+    def container_types(self) -> List[str]:
+        """Уникальные типы контейнеров каталога (отображаемые имена)"""
+        self._ensure()
+        return sorted(set(self._containers.values()))
+
+    def get_test_containers(self, code: str) -> List[str]:
+        """Отображаемые имена контейнеров теста"""
+        self._ensure()
+        return [self._containers[key] for key in self._test_containers.get(str(code).upper(), [])]
+
+    def get_stats(self) -> Dict:
+        return {
+            "version": self._version,
+            "tests": len(self._by_code),
+            "containers": len(self._containers),
+            "builds": self.builds,
+            "build_ms": self.build_ms,
+            "source": self.source,
+        }
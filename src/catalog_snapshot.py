@@ -0,0 +1,101 @@
+# catalog_snapshot.py
+"""
+Снимок индекса каталога в файле для общего использования процессами.
+
+Файл: сигнатура и длина заголовка, JSON-заголовок (версия каталога,
+смещения записей, коды, контейнеры) и записи [page_content, metadata]
+компактным JSON. Процессы открывают снимок через mmap: страницы файла
+общие в page cache ОС, в памяти процесса - только заголовок, запись
+разбирается при обращении.
+
+Снимок пишется во временный файл и подменяется через os.replace:
+процессы, открывшие прежний снимок, продолжают читать его до закрытия.
+"""
+import json
+import mmap
+import os
+import struct
+from typing import Dict, List, Optional, Tuple
+
+SNAPSHOT_MAGIC = b'VETCAT01'
+_PREFIX = struct.Struct('<8sQ')  # сигнатура, длина заголовка
+
+
+def write_snapshot(path: str, version: str, records: List[Tuple[str, dict]],
+                   by_code: Dict[str, int], containers: Dict[str, str],
+                   test_containers: Dict[str, List[str]]):
+    """Атомарно записывает снимок каталога"""
+    blobs = [
+        json.dumps([content, metadata], ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+        for content, metadata in records
+    ]
+    offsets = [0]
+    for blob in blobs:
+        offsets.append(offsets[-1] + len(blob))
+    header = json.dumps({
+        'version': version,
+        'offsets': offsets,
+        'by_code': by_code,
+        'containers': containers,
+        'test_containers': test_containers,
+    }, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'wb') as file:
+        file.write(_PREFIX.pack(SNAPSHOT_MAGIC, len(header)))
+        file.write(header)
+        for blob in blobs:
+            file.write(blob)
+    os.replace(tmp_path, path)
+
+
+class CatalogSnapshot:
+    def __init__(self, path: str):
+        with open(path, 'rb') as file:
+            self._mm = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, header_len = _PREFIX.unpack_from(self._mm, 0)
+        if magic != SNAPSHOT_MAGIC:
+            self._mm.close()
+            raise ValueError(f"Not a catalog snapshot: {path}")
+        header = json.loads(self._mm[_PREFIX.size:_PREFIX.size + header_len].decode('utf-8'))
+        self._base = _PREFIX.size + header_len
+        self._offsets: List[int] = header['offsets']
+        self.version: str = header['version']
+        self.by_code: Dict[str, int] = header['by_code']
+        self.containers: Dict[str, str] = header['containers']
+        self.test_containers: Dict[str, List[str]] = header['test_containers']
+
+    @classmethod
+    def open(cls, path: str, version: str) -> Optional["CatalogSnapshot"]:
+        """Снимок нужной версии каталога или None (нет файла, устарел, поврежден)"""
+        if not os.path.exists(path):
+            return None
+        try:
+            snapshot = cls(path)
+        except (OSError, ValueError, KeyError, struct.error) as e:
+            print(f"[WARNING] Catalog snapshot {path} unreadable: {e}")
+            return None
+        if snapshot.version != version:
+            snapshot.close()
+            return None
+        return snapshot
+
+    def __len__(self) -> int:
+        return len(self._offsets) - 1
+
+    def record(self, position: int) -> Tuple[str, dict]:
+        """(page_content, metadata) записи по позиции"""
+        start = self._base + self._offsets[position]
+        end = self._base + self._offsets[position + 1]
+        content, metadata = json.loads(self._mm[start:end].decode('utf-8'))
+        return content, metadata
+
+    @property
+    def size(self) -> int:
+        return len(self._mm)
+
+    def close(self):
+        self._mm.close()
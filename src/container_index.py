@@ -0,0 +1,94 @@
+# container_index.py
+"""
+Нормализация типов контейнеров и карта фото контейнеров в памяти.
+
+Один ключ нормализации используется и для индекса каталога (тест ->
+контейнеры), и для фото из container_photos. Ключ сворачивает варианты,
+которые раньше перебирались запросами к БД: регистр ("с"/"С"), кавычки,
+пробелы, "/" и "+", количество в начале ("2 Пробирки") и число
+("пробирки" -> "пробирка").
+"""
+import re
+from typing import Dict, List, Optional
+
+EMPTY_CONTAINER_VALUES = {'не указан', 'нет', '-', '', 'none', 'null'}
+
+
+def split_container_field(raw) -> List[str]:
+    """Типы контейнеров из поля каталога (несколько - через *I*)"""
+    raw = str(raw or '').strip()
+    if not raw or raw.lower() in EMPTY_CONTAINER_VALUES:
+        return []
+    raw = ' '.join(raw.replace('"', '').replace('\n', ' ').split())
+    return [part.strip() for part in raw.split('*I*') if part.strip()]
+
+
+def display_container_name(name: str) -> str:
+    """Отображаемое имя: каждое слово с заглавной буквы"""
+    return ' '.join(word.capitalize() for word in str(name).split())
+
+
+def exact_container_key(name: str) -> str:
+    """Ключ без учета регистра, кавычек и лишних пробелов"""
+    name = str(name or '').replace('"', '').replace("'", '').replace('\n', ' ')
+    return ' '.join(name.lower().replace('ё', 'е').split())
+
+
+def container_key(name: str) -> str:
+    """Свернутый ключ: без количества, с единым разделителем и числом"""
+    key = exact_container_key(name)
+    key = re.sub(r'^\d+\s+', '', key)
+    key = re.sub(r'\s*[+/]\s*', ' / ', key)
+    key = re.sub(r'\bпробирк[аеи]\b', 'пробирка', key)
+    return ' '.join(key.split())
+
+
+class ContainerPhotoMap:
+    """Фото контейнеров (container_photos) в памяти: разрешение - обращение к словарю"""
+
+    def __init__(self):
+        self._rows: Dict[str, dict] = {}     # container_type из БД -> фото
+        self._exact: Dict[str, str] = {}     # точный ключ -> container_type
+        self._folded: Dict[str, str] = {}    # свернутый ключ -> container_type
+        self.loaded = False
+
+    def load(self, rows: List[dict]):
+        self._rows = {}
+        for row in rows:
+            self._rows[row['container_type']] = {
+                'container_type': row['container_type'],
+                'file_id': row['file_id'],
+                'description': row.get('description'),
+            }
+        self._reindex()
+        self.loaded = True
+
+    def _reindex(self):
+        self._exact = {}
+        self._folded = {}
+        # Сортировка: при совпадении свернутых ключей побеждает имя без количества
+        for container_type in sorted(self._rows, key=lambda name: (bool(re.match(r'^\d', name)), name)):
+            self._exact.setdefault(exact_container_key(container_type), container_type)
+            self._folded.setdefault(container_key(container_type), container_type)
+
+    def set(self, container_type: str, file_id: str, description: Optional[str] = None):
+        self._rows[container_type] = {
+            'container_type': container_type,
+            'file_id': file_id,
+            'description': description,
+        }
+        self._reindex()
+
+    def remove(self, container_type: str):
+        if self._rows.pop(container_type, None) is not None:
+            self._reindex()
+
+    def resolve(self, name: str) -> Optional[dict]:
+        """Фото по имени контейнера: точное совпадение, затем свернутый ключ"""
+        container_type = self._exact.get(exact_container_key(name)) or self._folded.get(container_key(name))
+        if container_type is None:
+            return None
+        return dict(self._rows[container_type])
+
+    def __len__(self):
+        return len(self._rows)
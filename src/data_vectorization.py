@@ -17,6 +17,23 @@ if str(project_root) not in sys.path:
 import re
 import json
 
+
+def get_catalog_version(persist_path: str = "data/chroma_db") -> str:
+    """
+    Версия каталога тестов: меняется при каждом пересоздании/обновлении
+    хранилища (по времени изменения файлов Chroma). Используется кэшами,
+    которые зависят от содержимого каталога.
+    """
+    parts = []
+    for name in ("chroma.sqlite3", "embedding_info.json"):
+        file_path = Path(persist_path) / name
+        try:
+            parts.append(str(file_path.stat().st_mtime_ns))
+        except OSError:
+            parts.append("0")
+    return "-".join(parts)
+
+
 class DataProcessor:
     def __init__(self, file_path: str = 'data/processed/joined_data.xlsx'):
         self.file_path = Path(file_path)
@@ -24,6 +41,7 @@ class DataProcessor:
         self.vector_store = None
         self.embeddings = None
         self._current_store_path = "data/chroma_db"  # Всегда один путь
+        self._catalog_index = None
 
     def _get_embeddings(self):
         """Ленивая загрузка модели эмбеддингов"""
@@ -246,6 +264,32 @@ class DataProcessor:
         print(f'[INFO] Vector store loaded successfully from {path}')
         return self.vector_store
 
+    @property
+    def catalog_version(self) -> str:
+        return get_catalog_version(self._current_store_path)
+
+    def get_vector_store(self):
+        if self.vector_store is None:
+            self.load_vector_store()  # Автоматически пересоздаст если нужно
+        return self.vector_store
+
+    @property
+    def catalog_index(self):
+        """Индекс каталога в памяти (перестраивается при смене версии каталога)"""
+        if self._catalog_index is None:
+            from src.catalog_index import CatalogIndex
+            self._catalog_index = CatalogIndex(self)
+        return self._catalog_index
+
+    def embed_search_query(self, query: str) -> list:
+        """
+        Эмбеддинг запроса в том же виде, в каком его ищет search_test.
+        Позволяет посчитать вектор один раз и переиспользовать его
+        (поиск + семантический кэш ответов).
+        """
+        expanded = self._expand_query(query)
+        return self._get_embeddings().embed_query(expanded.lower())
+
     def get_metadata_columns(self) -> list:
         if self.vector_store is None:
             self.load_vector_store()
@@ -257,7 +301,8 @@ class DataProcessor:
         self, 
         query: str = "", 
         filter_dict: Optional[dict] = None,
-        top_k: int = 3
+        top_k: int = 3,
+        query_embedding: Optional[list] = None
     ):
         query = self._expand_query(query)
         if self.vector_store is None:
@@ -268,25 +313,33 @@ class DataProcessor:
         print(f'[INFO] Cleaned query: "{cleaned_query}"')
 
         if filter_dict:
-            all_tests = self.vector_store.get()
-            
+            # Точный поиск по коду - словарь индекса каталога
+            if set(filter_dict) == {"test_code"}:
+                doc = self.catalog_index.get_document(filter_dict["test_code"])
+                return [(doc, 1.0)] if doc is not None and top_k > 0 else []
+
             matches = []
-            for i, metadata in enumerate(all_tests['metadatas']):
+            for doc in self.catalog_index.documents:
                 if all(
-                    str(metadata.get(k, "")).upper() == str(v).upper()
+                    str(doc.metadata.get(k, "")).upper() == str(v).upper()
                     for k, v in filter_dict.items()
                 ):
-                    doc = Document(
-                        page_content=all_tests['documents'][i],
-                        metadata=metadata
-                    )
                     matches.append((doc, 1.0))
+                    if len(matches) >= top_k:
+                        break
             
-            return matches[:top_k]
+            return matches
         
-        for doc, score in self.vector_store.similarity_search_with_score(query.lower(), k=top_k):
+        if query_embedding is None:
+            query_embedding = self._get_embeddings().embed_query(query.lower())
+
+        # Один запрос к хранилищу по готовому вектору (раньше поиск выполнялся дважды)
+        results = self.vector_store.similarity_search_by_vector_with_relevance_scores(
+            query_embedding, k=top_k
+        )
+        for doc, score in results:
             print(doc.metadata['test_code'])
-        return self.vector_store.similarity_search_with_score(query.lower(), k=top_k)
+        return results
     
     def check_test_codes(self):
         if self.vector_store is None:
@@ -0,0 +1,128 @@
+"""
+Хранение рассылок и прогресса по получателям.
+
+broadcasts - задание рассылки (тип, содержимое в JSON, счетчики, статус),
+broadcast_recipients - строка на получателя со статусом доставки.
+Движок рассылки (bot/broadcast_engine.py) пакетно отмечает результаты;
+после падения или перезапуска незавершенная рассылка продолжается с
+получателей в статусе pending.
+
+Статусы получателя: pending, sent, skipped (например, опрос уже пройден),
+failed (в т.ч. бот заблокирован пользователем).
+
+Статус рассылки cancel_requested - остановка запрошена из другого
+процесса (воркера), чем тот, что ведет рассылку; движок замечает его
+при очередном сбросе результатов.
+"""
+import json
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+
+import aiosqlite
+
+from src.database import queries
+
+UNFINISHED_STATUSES = ('pending', 'running', 'cancel_requested')
+
+
+class BroadcastStore:
+    def __init__(self, pool):
+        self.pool = pool
+
+    async def create(self, kind: str, payload: dict, recipients: List[int],
+                     created_by: int, admin_chat_id: int) -> int:
+        """Создает рассылку со списком получателей; возвращает id"""
+        recipients = list(dict.fromkeys(recipients))  # без дублей, порядок сохраняется
+        async with self.pool.write() as db:
+            cursor = await db.execute('''
+                INSERT INTO broadcasts
+                (kind, payload, status, total, created_by, admin_chat_id, created_at)
+                VALUES (?, ?, 'pending', ?, ?, ?, ?)
+            ''', (kind, json.dumps(payload, ensure_ascii=False), len(recipients),
+                  created_by, admin_chat_id, datetime.now()))
+            broadcast_id = cursor.lastrowid
+            await db.executemany('''
+                INSERT INTO broadcast_recipients (broadcast_id, user_id, status)
+                VALUES (?, ?, 'pending')
+            ''', [(broadcast_id, user_id) for user_id in recipients])
+            await db.commit()
+        return broadcast_id
+
+    async def get(self, broadcast_id: int) -> Optional[Dict]:
+        async with self.pool.read() as db:
+            db.row_factory = aiosqlite.Row
+            cursor = await db.execute('SELECT * FROM broadcasts WHERE id = ?', (broadcast_id,))
+            row = await cursor.fetchone()
+        if not row:
+            return None
+        broadcast = dict(row)
+        broadcast['payload'] = json.loads(broadcast['payload'] or '{}')
+        return broadcast
+
+    async def get_unfinished_ids(self) -> List[int]:
+        """Рассылки, прерванные остановкой или падением бота"""
+        async with self.pool.read() as db:
+            cursor = await db.execute(f'''
+                SELECT id FROM broadcasts
+                WHERE status IN ({",".join("?" * len(UNFINISHED_STATUSES))})
+                ORDER BY id
+            ''', UNFINISHED_STATUSES)
+            return [row[0] for row in await cursor.fetchall()]
+
+    async def get_pending_recipients(self, broadcast_id: int) -> List[int]:
+        async with self.pool.read() as db:
+            cursor = await db.execute(queries.GET_BROADCAST_PENDING_RECIPIENTS, (broadcast_id,))
+            return [row[0] for row in await cursor.fetchall()]
+
+    async def get_status(self, broadcast_id: int) -> Optional[str]:
+        async with self.pool.read() as db:
+            cursor = await db.execute('SELECT status FROM broadcasts WHERE id = ?', (broadcast_id,))
+            row = await cursor.fetchone()
+        return row[0] if row else None
+
+    async def request_cancel(self, broadcast_id: int) -> bool:
+        """Запрашивает остановку рассылки, которую ведет другой процесс"""
+        async with self.pool.write() as db:
+            cursor = await db.execute('''
+                UPDATE broadcasts SET status = 'cancel_requested'
+                WHERE id = ? AND status IN ('pending', 'running')
+            ''', (broadcast_id,))
+            await db.commit()
+            return cursor.rowcount > 0
+
+    async def set_status(self, broadcast_id: int, status: str, progress_message_id: int = None):
+        now = datetime.now()
+        async with self.pool.write() as db:
+            await db.execute('''
+                UPDATE broadcasts SET
+                    status = ?,
+                    progress_message_id = COALESCE(?, progress_message_id),
+                    started_at = CASE WHEN ? = 'running' THEN COALESCE(started_at, ?) ELSE started_at END,
+                    finished_at = CASE WHEN ? IN ('done', 'cancelled') THEN ? ELSE finished_at END
+                WHERE id = ?
+            ''', (status, progress_message_id, status, now, status, now, broadcast_id))
+            await db.commit()
+
+    async def record_results(self, broadcast_id: int, results: List[Tuple[int, str, Optional[str]]]):
+        """Отмечает пачку результатов [(user_id, status, error)] одной транзакцией"""
+        if not results:
+            return
+        now = datetime.now()
+        counts = {'sent': 0, 'skipped': 0, 'failed': 0}
+        for _, status, _ in results:
+            counts[status] = counts.get(status, 0) + 1
+
+        async with self.pool.write() as db:
+            await db.executemany('''
+                UPDATE broadcast_recipients
+                SET status = ?, error = ?, updated_at = ?
+                WHERE broadcast_id = ? AND user_id = ?
+            ''', [(status, error, now, broadcast_id, user_id) for user_id, status, error in results])
+            await db.execute('''
+                UPDATE broadcasts SET
+                    sent = sent + ?,
+                    skipped = skipped + ?,
+                    failed = failed + ?
+                WHERE id = ?
+            ''', (counts['sent'], counts['skipped'], counts['failed'], broadcast_id))
+            await db.commit()
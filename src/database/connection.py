@@ -0,0 +1,162 @@
+"""
+Пул постоянных соединений SQLite для Database.
+
+Одно выделенное соединение на запись (сериализуется asyncio.Lock) и
+небольшой пул соединений на чтение. Соединения открываются один раз,
+PRAGMA применяются при открытии. В режиме WAL читатели не блокируются
+писателем.
+"""
+import asyncio
+import contextvars
+import logging
+import time
+from contextlib import asynccontextmanager
+from typing import List, Optional
+
+import aiosqlite
+
+from utils.latency_stats import LatencyHistogram
+
+logger = logging.getLogger(__name__)
+
+READ_POOL_SIZE = 4
+BUSY_TIMEOUT_MS = 10000
+
+CONNECTION_PRAGMAS = [
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA cache_size=-16000",      # ~16 МБ страничного кэша на соединение
+    "PRAGMA mmap_size=134217728",    # 128 МБ memory-mapped I/O
+    f"PRAGMA busy_timeout={BUSY_TIMEOUT_MS}",
+    "PRAGMA temp_store=MEMORY",
+]
+
+# Соединение, уже захваченное текущей задачей: вложенные вызовы
+# методов Database переиспользуют его, а не ждут второе (и не
+# блокируют сами себя на writer lock)
+_held_connection: contextvars.ContextVar = contextvars.ContextVar("held_db_connection", default=None)
+
+
+class ConnectionManager:
+    def __init__(self, db_path: str, read_pool_size: int = READ_POOL_SIZE):
+        self.db_path = db_path
+        self.read_pool_size = read_pool_size
+
+        self._writer: Optional[aiosqlite.Connection] = None
+        self._writer_lock = asyncio.Lock()
+        self._readers: List[aiosqlite.Connection] = []
+        self._read_pool: Optional[asyncio.Queue] = None
+        self._open_lock = asyncio.Lock()
+        self._opened = False
+
+        self.read_wait = LatencyHistogram()
+        self.write_wait = LatencyHistogram()
+        self.reads = 0
+        self.writes = 0
+        self.rollbacks = 0
+
+    async def _connect(self) -> aiosqlite.Connection:
+        conn = await aiosqlite.connect(self.db_path, timeout=BUSY_TIMEOUT_MS / 1000)
+        for pragma in CONNECTION_PRAGMAS:
+            await conn.execute(pragma)
+        return conn
+
+    async def open(self):
+        """Открывает соединения (идемпотентно; вызывается на старте или лениво)"""
+        if self._opened:
+            return
+        async with self._open_lock:
+            if self._opened:
+                return
+            # Писатель открывается первым: он переводит файл в WAL
+            self._writer = await self._connect()
+            self._read_pool = asyncio.Queue()
+            for _ in range(self.read_pool_size):
+                conn = await self._connect()
+                self._readers.append(conn)
+                self._read_pool.put_nowait(conn)
+            self._opened = True
+            logger.info(f"[DB_POOL] Opened 1 writer + {self.read_pool_size} reader connections to {self.db_path}")
+
+    async def close(self):
+        if not self._opened:
+            return
+        async with self._writer_lock:
+            for conn in [self._writer] + self._readers:
+                try:
+                    await conn.close()
+                except Exception as e:
+                    logger.warning(f"[DB_POOL] Error closing connection: {e}")
+            self._writer = None
+            self._readers = []
+            self._read_pool = None
+            self._opened = False
+            logger.info("[DB_POOL] Connections closed")
+
+    @staticmethod
+    async def _release(conn: aiosqlite.Connection) -> bool:
+        """Возвращает соединение в исходное состояние; True если был откат"""
+        conn.row_factory = None
+        if conn.in_transaction:
+            # Метод не сделал commit (ошибка или только чтение) - как и при
+            # закрытии отдельного соединения, незафиксированное отбрасываем
+            await conn.rollback()
+            return True
+        return False
+
+    @asynccontextmanager
+    async def write(self):
+        """Соединение для записи (эксклюзивно на время блока)"""
+        held = _held_connection.get()
+        if held is not None and held is self._writer:
+            yield held
+            return
+
+        await self.open()
+        started = time.monotonic()
+        async with self._writer_lock:
+            self.write_wait.observe(time.monotonic() - started)
+            self.writes += 1
+            token = _held_connection.set(self._writer)
+            try:
+                yield self._writer
+            finally:
+                _held_connection.reset(token)
+                if await self._release(self._writer):
+                    self.rollbacks += 1
+
+    @asynccontextmanager
+    async def read(self):
+        """Соединение из пула чтения"""
+        held = _held_connection.get()
+        if held is not None:
+            yield held
+            return
+
+        await self.open()
+        started = time.monotonic()
+        conn = await self._read_pool.get()
+        self.read_wait.observe(time.monotonic() - started)
+        self.reads += 1
+        token = _held_connection.set(conn)
+        try:
+            yield conn
+        finally:
+            _held_connection.reset(token)
+            try:
+                await self._release(conn)
+            finally:
+                self._read_pool.put_nowait(conn)
+
+    def get_stats(self) -> dict:
+        return {
+            "opened": self._opened,
+            "readers_idle": self._read_pool.qsize() if self._read_pool else 0,
+            "readers_total": len(self._readers),
+            "writer_busy": self._writer_lock.locked(),
+            "reads": self.reads,
+            "writes": self.writes,
+            "rollbacks": self.rollbacks,
+            "read_wait": self.read_wait.snapshot(),
+            "write_wait": self.write_wait.snapshot(),
+        }
@@ -0,0 +1,251 @@
+"""
+Хранилище FSM aiogram на SQLite (таблица fsm_storage).
+
+Состояния и данные диалогов переживают перезапуск бота. Чтение идет из
+памяти (запись загружается из БД при первом обращении), изменения
+помечают ключ "грязным" и сбрасываются фоновой задачей раз в
+FLUSH_INTERVAL_SECONDS одной транзакцией на writer-соединении пула:
+несколько update_data за обработку апдейта дают одну запись в БД.
+Пустая запись (нет состояния и данных) удаляется.
+
+Сериализация: компактный JSON, сжатый zlib при размере больше
+COMPRESS_THRESHOLD; данные, которые не сериализуются в JSON, - pickle.
+
+Фоновый sweeper выгружает из памяти давно не используемые записи и
+удаляет из БД записи, не менявшиеся дольше FSM_TTL_DAYS.
+
+Кэш в памяти - на процесс: несколько воркеров должны получать апдейты
+одного пользователя в одном и том же процессе.
+"""
+import asyncio
+import json
+import logging
+import pickle
+import time
+import zlib
+from typing import Any, Dict, Optional, Set
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, StorageKey
+
+from src.database import queries
+from utils.latency_stats import LatencyHistogram
+
+logger = logging.getLogger(__name__)
+
+FLUSH_INTERVAL_SECONDS = 0.5
+SWEEP_INTERVAL_SECONDS = 300
+MEMORY_IDLE_SECONDS = 1800  # Чистые записи без обращений выгружаются из памяти
+FSM_TTL_DAYS = 14
+COMPRESS_THRESHOLD = 512
+
+_JSON = b'j'
+_JSON_ZLIB = b'z'
+_PICKLE = b'p'
+
+
+def dump_data(data: Dict[str, Any]) -> bytes:
+    try:
+        raw = json.dumps(data, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+        if len(raw) > COMPRESS_THRESHOLD:
+            return _JSON_ZLIB + zlib.compress(raw)
+        return _JSON + raw
+    except (TypeError, ValueError):
+        return _PICKLE + pickle.dumps(data, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def load_data(blob: Optional[bytes]) -> Dict[str, Any]:
+    if not blob:
+        return {}
+    kind, payload = blob[:1], blob[1:]
+    if kind == _JSON:
+        return json.loads(payload.decode('utf-8'))
+    if kind == _JSON_ZLIB:
+        return json.loads(zlib.decompress(payload).decode('utf-8'))
+    if kind == _PICKLE:
+        return pickle.loads(payload)
+    raise ValueError(f"Unknown FSM data format: {kind!r}")
+
+
+class _Record:
+    __slots__ = ('state', 'data', 'touched')
+
+    def __init__(self, state: Optional[str] = None, data: Optional[Dict[str, Any]] = None):
+        self.state = state
+        self.data = data or {}
+        self.touched = time.monotonic()
+
+
+class SQLiteStorage(BaseStorage):
+    def __init__(self, pool, flush_interval: float = FLUSH_INTERVAL_SECONDS):
+        self.pool = pool
+        self.flush_interval = flush_interval
+        self._records: Dict[str, _Record] = {}
+        self._dirty: Set[str] = set()
+        self._task: Optional[asyncio.Task] = None
+        self._closed = False
+        self._last_sweep = time.monotonic()
+
+        self.loads = 0
+        self.changes = 0
+        self.rows_written = 0
+        self.flushes = 0
+        self.flush_latency = LatencyHistogram()
+
+    @staticmethod
+    def _key(key: StorageKey) -> str:
+        return ':'.join(str(part) for part in (
+            key.bot_id, key.chat_id, key.user_id,
+            getattr(key, 'thread_id', None) or '',
+            getattr(key, 'business_connection_id', None) or '',
+            key.destiny,
+        ))
+
+    async def _get(self, key: StorageKey) -> _Record:
+        storage_key = self._key(key)
+        record = self._records.get(storage_key)
+        if record is None:
+            async with self.pool.read() as db:
+                cursor = await db.execute(
+                    'SELECT state, data FROM fsm_storage WHERE key = ?', (storage_key,)
+                )
+                row = await cursor.fetchone()
+            self.loads += 1
+            # Пока шло чтение, запись могла появиться в памяти - она новее
+            record = self._records.setdefault(
+                storage_key, _Record(row[0], load_data(row[1])) if row else _Record()
+            )
+        record.touched = time.monotonic()
+        return record
+
+    def _changed(self, key: StorageKey):
+        self._dirty.add(self._key(key))
+        self.changes += 1
+        if self._task is None and not self._closed:
+            self._task = asyncio.create_task(self._run())
+
+    # ============================================================
+    # ИНТЕРФЕЙС BaseStorage
+    # ============================================================
+
+    async def set_state(self, key: StorageKey, state=None) -> None:
+        record = await self._get(key)
+        record.state = state.state if isinstance(state, State) else state
+        self._changed(key)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        return (await self._get(key)).state
+
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        record = await self._get(key)
+        record.data = dict(data)
+        self._changed(key)
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        return (await self._get(key)).data.copy()
+
+    async def update_data(self, key: StorageKey, data: Dict[str, Any]) -> Dict[str, Any]:
+        record = await self._get(key)
+        record.data.update(data)
+        self._changed(key)
+        return record.data.copy()
+
+    async def close(self) -> None:
+        """Останавливает фоновый сброс и дописывает изменения"""
+        self._closed = True
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        await self.flush()
+
+    # ============================================================
+    # ЗАПИСЬ И ОЧИСТКА
+    # ============================================================
+
+    async def flush(self) -> int:
+        """Пишет накопленные изменения одной транзакцией"""
+        if not self._dirty:
+            return 0
+        keys, self._dirty = self._dirty, set()
+        now = time.time()
+        upserts = []
+        deletes = []
+        for storage_key in keys:
+            record = self._records.get(storage_key)
+            if record is None:
+                continue
+            if record.state is None and not record.data:
+                deletes.append((storage_key,))
+            else:
+                upserts.append((storage_key, record.state, dump_data(record.data), now))
+
+        started = time.monotonic()
+        try:
+            async with self.pool.write() as db:
+                if upserts:
+                    await db.executemany('''
+                        INSERT INTO fsm_storage (key, state, data, updated_at)
+                        VALUES (?, ?, ?, ?)
+                        ON CONFLICT(key) DO UPDATE SET
+                            state = excluded.state,
+                            data = excluded.data,
+                            updated_at = excluded.updated_at
+                    ''', upserts)
+                if deletes:
+                    await db.executemany('DELETE FROM fsm_storage WHERE key = ?', deletes)
+                await db.commit()
+        except Exception:
+            # Повторим со следующим сбросом
+            self._dirty |= keys
+            raise
+        finally:
+            self.flush_latency.observe(time.monotonic() - started)
+
+        self.flushes += 1
+        self.rows_written += len(upserts) + len(deletes)
+        return len(upserts) + len(deletes)
+
+    async def sweep(self) -> int:
+        """Выгружает из памяти простаивающие записи и удаляет устаревшие из БД"""
+        threshold = time.monotonic() - MEMORY_IDLE_SECONDS
+        idle = [
+            storage_key for storage_key, record in self._records.items()
+            if record.touched < threshold and storage_key not in self._dirty
+        ]
+        for storage_key in idle:
+            del self._records[storage_key]
+
+        async with self.pool.write() as db:
+            cursor = await db.execute(
+                queries.DELETE_EXPIRED_FSM_STATES,
+                (time.time() - FSM_TTL_DAYS * 86400,)
+            )
+            await db.commit()
+            expired = cursor.rowcount
+        if idle or expired:
+            logger.info(f"[FSM] Unloaded {len(idle)} idle records, deleted {expired} expired")
+        return expired
+
+    async def _run(self):
+        while not self._closed:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+                if time.monotonic() - self._last_sweep > SWEEP_INTERVAL_SECONDS:
+                    self._last_sweep = time.monotonic()
+                    await self.sweep()
+            except Exception as e:
+                logger.error(f"[FSM] Storage flush error: {e}")
+
+    def get_stats(self) -> Dict:
+        return {
+            "records": len(self._records),
+            "dirty": len(self._dirty),
+            "loads": self.loads,
+            "changes": self.changes,
+            "rows_written": self.rows_written,
+            "coalesced": max(self.changes - self.rows_written, 0),
+            "flushes": self.flushes,
+            "flush_latency": self.flush_latency.snapshot(),
+        }
@@ -0,0 +1,317 @@
+"""
+Версионированные миграции схемы БД.
+
+Database.create_tables создает базовую схему (CREATE TABLE IF NOT EXISTS),
+после чего apply_migrations применяет недостающие миграции по порядку.
+Примененные версии хранятся в таблице schema_version; каждая миграция
+выполняется в своей транзакции (явный BEGIN: модуль sqlite3 сам не
+открывает транзакцию перед DDL, и без него ALTER TABLE фиксировался бы
+сразу, а откат после ошибки не отменял бы уже выполненные операторы).
+
+Новые изменения схемы - только новой миграцией в конец MIGRATIONS
+(уже примененные миграции не редактируются). Добавление столбца -
+шагом AddColumn: он проверяет PRAGMA table_info и не падает на БД,
+где столбец уже есть (например, добавлен вручную или старой версией).
+
+HOT_QUERIES - горячие запросы, для которых индекс обязателен. Это те же
+константы из queries.py, что выполняет код; check_query_plans.py
+прогоняет их через EXPLAIN QUERY PLAN и падает, если какой-то из них
+уходит в полный SCAN таблицы.
+"""
+import logging
+from dataclasses import dataclass
+from typing import List, Tuple, Union
+
+from src.database import queries
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class AddColumn:
+    """ALTER TABLE ... ADD COLUMN; пропускается, если столбец уже есть"""
+    table: str
+    column: str
+    definition: str
+
+    async def apply(self, db):
+        cursor = await db.execute(f'PRAGMA table_info({self.table})')
+        if any(row[1] == self.column for row in await cursor.fetchall()):
+            logger.info(f"[MIGRATIONS] Column {self.table}.{self.column} already exists, skipped")
+            return
+        await db.execute(f'ALTER TABLE {self.table} ADD COLUMN {self.column} {self.definition}')
+
+
+@dataclass(frozen=True)
+class Migration:
+    version: int
+    description: str
+    statements: Tuple[Union[str, AddColumn], ...]
+
+
+MIGRATIONS: List[Migration] = [
+    Migration(
+        1,
+        "Tables previously created lazily (polls, user_frequent_tests)",
+        (
+            '''
+            CREATE TABLE IF NOT EXISTS polls (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                title TEXT NOT NULL,
+                description TEXT,
+                created_by INTEGER,
+                is_active BOOLEAN DEFAULT 1,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+            ''',
+            '''
+            CREATE TABLE IF NOT EXISTS poll_questions (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                poll_id INTEGER,
+                question_text TEXT NOT NULL,
+                question_type TEXT NOT NULL,
+                options TEXT,
+                question_order INTEGER,
+                FOREIGN KEY (poll_id) REFERENCES polls (id)
+            )
+            ''',
+            '''
+            CREATE TABLE IF NOT EXISTS poll_responses (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                poll_id INTEGER,
+                question_id INTEGER,
+                user_id INTEGER,
+                answer TEXT,
+                answered_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                FOREIGN KEY (poll_id) REFERENCES polls (id),
+                FOREIGN KEY (question_id) REFERENCES poll_questions (id)
+            )
+            ''',
+            '''
+            CREATE TABLE IF NOT EXISTS user_frequent_tests (
+                user_id INTEGER NOT NULL,
+                test_code TEXT NOT NULL,
+                test_name TEXT,
+                frequency INTEGER DEFAULT 1,
+                last_accessed TIMESTAMP,
+                PRIMARY KEY (user_id, test_code)
+            )
+            ''',
+        ),
+    ),
+    Migration(
+        2,
+        "Workload indexes from EXPLAIN QUERY PLAN of models.py queries",
+        (
+            # get_recent_searches, get_user_search_stats
+            '''
+            CREATE INDEX IF NOT EXISTS idx_search_history_user_created
+            ON search_history(user_id, created_at DESC)
+            ''',
+            # cleanup_old_search_history
+            '''
+            CREATE INDEX IF NOT EXISTS idx_search_history_created
+            ON search_history(created_at)
+            ''',
+            # get_user_frequent_tests, get_user_search_stats (без сортировки во временном B-tree)
+            '''
+            CREATE INDEX IF NOT EXISTS idx_frequent_tests_user_rank
+            ON user_frequent_tests(user_id, frequency DESC, last_accessed DESC)
+            ''',
+            # get_user_related_tests: test_code_1 покрыт первичным ключом, test_code_2 - нет
+            '''
+            CREATE INDEX IF NOT EXISTS idx_related_tests_user_code2
+            ON related_tests(user_id, test_code_2)
+            ''',
+            # Аналитика по найденным тестам в chat_history
+            '''
+            CREATE INDEX IF NOT EXISTS idx_chat_history_found_code
+            ON chat_history(found_test_code, timestamp)
+            WHERE found_test_code IS NOT NULL
+            ''',
+            # check_user_poll_participation, результаты опросов
+            '''
+            CREATE INDEX IF NOT EXISTS idx_poll_responses_poll_user
+            ON poll_responses(poll_id, user_id)
+            ''',
+            '''
+            CREATE INDEX IF NOT EXISTS idx_poll_responses_question
+            ON poll_responses(question_id, answer)
+            ''',
+            '''
+            CREATE INDEX IF NOT EXISTS idx_poll_questions_poll
+            ON poll_questions(poll_id, question_order)
+            ''',
+            # get_buffer, get_latest_summary, clear_buffer
+            '''
+            CREATE INDEX IF NOT EXISTS idx_conversation_memory_user_type
+            ON conversation_memory(user_id, type, timestamp)
+            ''',
+            # clear_old_logs
+            '''
+            CREATE INDEX IF NOT EXISTS idx_conversation_memory_timestamp
+            ON conversation_memory(timestamp)
+            ''',
+            # get_rating_stats, get_average_user_rating
+            '''
+            CREATE INDEX IF NOT EXISTS idx_response_ratings_timestamp
+            ON response_ratings(timestamp)
+            ''',
+        ),
+    ),
+    Migration(
+        3,
+        "Global top-N related tests (co-occurrence recommendations)",
+        (
+            '''
+            CREATE TABLE IF NOT EXISTS test_recommendations (
+                test_code TEXT NOT NULL,
+                rank INTEGER NOT NULL,
+                related_code TEXT NOT NULL,
+                score REAL NOT NULL,
+                updated_at TIMESTAMP,
+                PRIMARY KEY (test_code, rank)
+            ) WITHOUT ROWID
+            ''',
+        ),
+    ),
+    Migration(
+        4,
+        "Background broadcasts with per-recipient progress",
+        (
+            '''
+            CREATE TABLE IF NOT EXISTS broadcasts (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                kind TEXT NOT NULL,
+                payload TEXT,
+                status TEXT NOT NULL DEFAULT 'pending',
+                total INTEGER DEFAULT 0,
+                sent INTEGER DEFAULT 0,
+                skipped INTEGER DEFAULT 0,
+                failed INTEGER DEFAULT 0,
+                created_by INTEGER,
+                admin_chat_id INTEGER,
+                progress_message_id INTEGER,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                started_at TIMESTAMP,
+                finished_at TIMESTAMP
+            )
+            ''',
+            '''
+            CREATE TABLE IF NOT EXISTS broadcast_recipients (
+                broadcast_id INTEGER NOT NULL,
+                user_id INTEGER NOT NULL,
+                status TEXT NOT NULL DEFAULT 'pending',
+                error TEXT,
+                updated_at TIMESTAMP,
+                PRIMARY KEY (broadcast_id, user_id)
+            ) WITHOUT ROWID
+            ''',
+            # Возобновление: только оставшиеся получатели
+            '''
+            CREATE INDEX IF NOT EXISTS idx_broadcast_recipients_status
+            ON broadcast_recipients(broadcast_id, status)
+            ''',
+        ),
+    ),
+    Migration(
+        5,
+        "Content hash for cached Telegram file_id of local blank files",
+        (
+            AddColumn('blank_files', 'content_hash', 'TEXT'),
+        ),
+    ),
+    Migration(
+        6,
+        "Persistent FSM storage (states and data of dialogs)",
+        (
+            '''
+            CREATE TABLE IF NOT EXISTS fsm_storage (
+                key TEXT PRIMARY KEY,
+                state TEXT,
+                data BLOB,
+                updated_at REAL NOT NULL
+            ) WITHOUT ROWID
+            ''',
+            '''
+            CREATE INDEX IF NOT EXISTS idx_fsm_storage_updated
+            ON fsm_storage(updated_at)
+            ''',
+        ),
+    ),
+]
+
+
+# ============================================================
+# ГОРЯЧИЕ ЗАПРОСЫ ДЛЯ ПРОВЕРКИ ПЛАНОВ (check_query_plans.py)
+# ============================================================
+
+HOT_QUERIES: List[Tuple[str, str]] = [
+    ("get_user", queries.GET_USER),
+    ("get_recent_searches", queries.GET_RECENT_SEARCHES),
+    ("get_user_search_stats", queries.GET_USER_SEARCH_TOTALS),
+    ("get_user_search_stats_most_frequent", queries.GET_USER_MOST_FREQUENT_TEST),
+    ("cleanup_old_search_history", queries.CLEANUP_OLD_SEARCH_HISTORY),
+    ("get_user_frequent_tests", queries.GET_USER_FREQUENT_TESTS),
+    ("get_user_related_tests", queries.GET_USER_RELATED_TESTS),
+    ("check_user_poll_participation", queries.CHECK_USER_POLL_PARTICIPATION),
+    ("get_poll_questions", queries.GET_POLL_QUESTIONS),
+    ("poll_top_answer", queries.GET_POLL_TOP_ANSWER),
+    ("get_buffer", queries.GET_BUFFER),
+    ("get_latest_summary", queries.GET_LATEST_SUMMARY),
+    ("get_active_session", queries.GET_ACTIVE_SESSION),
+    ("close_inactive_sessions", queries.CLOSE_INACTIVE_SESSIONS),
+    ("close_inactive_session_by_id", queries.CLOSE_INACTIVE_SESSION_BY_ID),
+    ("get_user_metrics", queries.GET_USER_REQUEST_STATS),
+    ("get_rating_stats", queries.GET_RATING_STATS),
+    ("rollup_request_metrics_batch", queries.ROLLUP_REQUEST_METRICS_BATCH),
+    ("rollup_user_activity_batch", queries.ROLLUP_USER_ACTIVITY_BATCH),
+    ("broadcast_pending_recipients", queries.GET_BROADCAST_PENDING_RECIPIENTS),
+    ("fsm_storage_expired", queries.DELETE_EXPIRED_FSM_STATES),
+]
+
+
+# ============================================================
+# ПРИМЕНЕНИЕ
+# ============================================================
+
+async def get_schema_version(db) -> int:
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS schema_version (
+            version INTEGER PRIMARY KEY,
+            description TEXT,
+            applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    cursor = await db.execute('SELECT COALESCE(MAX(version), 0) FROM schema_version')
+    return (await cursor.fetchone())[0]
+
+
+async def apply_migrations(db) -> int:
+    """Применяет недостающие миграции; возвращает итоговую версию схемы"""
+    current = await get_schema_version(db)
+    await db.commit()
+
+    for migration in sorted(MIGRATIONS, key=lambda m: m.version):
+        if migration.version <= current:
+            continue
+        try:
+            await db.execute('BEGIN')
+            for statement in migration.statements:
+                if isinstance(statement, AddColumn):
+                    await statement.apply(db)
+                else:
+                    await db.execute(statement)
+            await db.execute(
+                'INSERT INTO schema_version (version, description) VALUES (?, ?)',
+                (migration.version, migration.description)
+            )
+            await db.commit()
+        except Exception as e:
+            await db.rollback()
+            logger.error(f"[MIGRATIONS] Migration {migration.version} failed: {e}")
+            raise
+        current = migration.version
+        logger.info(f"[MIGRATIONS] Applied {migration.version}: {migration.description}")
+
+    return current
@@ -7,55 +7,83 @@ from datetime import datetime, timedelta
 import re
 
 from src.data_vectorization import DataProcessor
+from src.answer_cache import answer_cache, LOW_RATING_THRESHOLD
+from src.database import queries
+from src.database.connection import ConnectionManager
+from src.database.telemetry_writer import TelemetryWriter
+from src.database.user_cache import UserCache, MISSING
+from src.database.rollups import MetricsRollups
+from src.database.related_tests import RelatedTestsIndex
+from src.database.broadcasts import BroadcastStore
+from src.database.migrations import apply_migrations
+from src.container_index import ContainerPhotoMap, display_container_name
+
+SESSION_TIMEOUT_MINUTES = 3  # Пауза, после которой начинается новая сессия
 
 class Database:
     def __init__(self, db_path: str):
         self.db_path = db_path
+        self.pool = ConnectionManager(db_path)  # Постоянные соединения (1 writer + пул чтения)
+        self.telemetry = TelemetryWriter(self.pool)  # Пакетная запись метрик и истории
+        self._active_sessions = {}  # user_id -> [session_id, last_activity]
+        self.rollups = MetricsRollups(self.pool)  # Инкрементальные агрегаты метрик
+        self._register_telemetry_counters()
         self.test_processor = DataProcessor()
-        self._user_cache = {}  # Кэш пользователей
-        self._cache_ttl = 300  # 5 минут
+        self.user_cache = UserCache()  # LRU-кэш пользователей с TTL
+        self.container_photos = ContainerPhotoMap()  # Фото контейнеров в памяти
+        self.related_index = RelatedTestsIndex(self.pool)  # Глобальные "часто смотрят вместе"
+        self.broadcasts = BroadcastStore(self.pool)  # Рассылки и прогресс по получателям
+        self._low_ratings_synced_id = None  # Последняя учтенная плохая оценка (многопроцессный режим)
+
+    async def connect(self):
+        """Открывает соединения с БД (иначе откроются при первом запросе)"""
+        await self.pool.open()
+
+    async def close(self):
+        """Закрывает соединения с БД"""
+        await self.pool.close()
+
+    def _register_telemetry_counters(self):
+        """Схлопываемые UPSERT-счетчики для TelemetryWriter"""
+        self.telemetry.register_counter(
+            'user_activity',
+            '''
+                INSERT INTO user_activity
+                (user_id, activity_date, request_count, last_activity)
+                VALUES (?, ?, ?, ?)
+                ON CONFLICT(user_id, activity_date) DO UPDATE SET
+                    request_count = request_count + excluded.request_count,
+                    last_activity = excluded.last_activity
+            ''',
+            lambda key, count, last_activity: (key[0], key[1], count, last_activity)
+        )
+        self.telemetry.register_counter(
+            'user_frequent_tests',
+            '''
+                INSERT INTO user_frequent_tests (user_id, test_code, test_name, frequency, last_accessed)
+                VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT(user_id, test_code) DO UPDATE SET
+                    frequency = frequency + excluded.frequency,
+                    test_name = excluded.test_name,
+                    last_accessed = excluded.last_accessed
+            ''',
+            lambda key, count, payload: (key[0], key[1], payload[0], count, payload[1])
+        )
+        self.telemetry.register_counter(
+            'session_activity',
+            '''
+                UPDATE user_sessions
+                SET request_count = request_count + ?,
+                    last_activity = ?
+                WHERE id = ?
+            ''',
+            lambda key, count, last_activity: (count, last_activity, key[0])
+        )
         
     async def get_unique_container_types(self) -> list[str]:
-        """Получает уникальные типы контейнеров из базы тестов (из обоих полей)"""
+        """Получает уникальные типы контейнеров из индекса каталога (из обоих полей)"""
         try:
-            if not self.test_processor.vector_store:
-                self.test_processor.load_vector_store()
-            
-            all_tests = self.test_processor.search_test(query="", top_k=2000)
-            
-            container_types = set()
-            
-            for doc, _ in all_tests:
-                # Получаем типы контейнеров из ОБОИХ полей
-                container_fields = [
-                    doc.metadata.get('primary_container_type', '').strip(),  # ПРИОРИТЕТ
-                    doc.metadata.get('container_type', '').strip()
-                ]
-                
-                for container_type_raw in container_fields:
-                    if not container_type_raw or container_type_raw.lower() in ['не указан', 'нет', '-', '', 'none', 'null']:
-                        continue
-                    
-                    # Убираем переносы строк, лишние пробелы и кавычки
-                    container_type_raw = container_type_raw.replace('"', '').replace('\n', ' ')
-                    container_type_raw = ' '.join(container_type_raw.split())
-                    
-                    # Разбиваем по *I* если есть несколько контейнеров
-                    if '*I*' in container_type_raw:
-                        parts = container_type_raw.split('*I*')
-                    else:
-                        parts = [container_type_raw]
-                    
-                    for part in parts:
-                        container_type = part.strip()
-                        if container_type:
-                            # ВАЖНО: Нормализуем - первая буква каждого слова заглавная
-                            normalized = ' '.join(word.capitalize() for word in container_type.split())
-                            container_types.add(normalized)
-            
-            # Возвращаем отсортированный список уникальных типов
-            return sorted(list(container_types))
-            
+            return self.test_processor.catalog_index.container_types()
         except Exception as e:
             print(f"[ERROR] Failed to get container types: {e}")
             return []
@@ -87,32 +115,29 @@ class Database:
             if len(bot_response) > 5000:
                 bot_response = bot_response[:4997] + "..."
             
-            async with aiosqlite.connect(self.db_path) as db:
-                await db.execute('''
-                    INSERT INTO chat_history 
-                    (user_id, user_name, question, bot_response, request_type, 
-                    search_success, found_test_code, timestamp)
-                    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-                ''', (
-                    user_id, 
-                    user_name, 
-                    question, 
-                    bot_response, 
-                    request_type,
-                    search_success,
-                    found_test_code,
-                    datetime.now()
-                ))
-                
-                await db.commit()
-                return True
+            await self.telemetry.insert('''
+                INSERT INTO chat_history
+                (user_id, user_name, question, bot_response, request_type,
+                search_success, found_test_code, timestamp)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            ''', (
+                user_id,
+                user_name,
+                question,
+                bot_response,
+                request_type,
+                search_success,
+                found_test_code,
+                datetime.now()
+            ))
+            return True
         except Exception as e:
             print(f"[ERROR] Failed to log chat interaction: {e}")
             return False
         
     async def update_poll_media(self, poll_id, media_file_id, media_type):
         """Добавление благодарственного медиа к опросу"""
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self.pool.write() as db:
             # Проверяем, существует ли колонка, если нет - создаем
             cursor = await db.execute("PRAGMA table_info(polls)")
             columns = await cursor.fetchall()
@@ -131,7 +156,7 @@ class Database:
 
     async def get_poll_info(self, poll_id):
         """Получение информации об опросе"""
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self.pool.read() as db:
             db.row_factory = aiosqlite.Row
             cursor = await db.execute(
                 "SELECT * FROM polls WHERE id = ?",
@@ -148,7 +173,7 @@ class Database:
         
     async def update_poll_video(self, poll_id, video_file_id):
         """Добавление благодарственного видео к опросу"""
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self.pool.write() as db:
             # Добавляем колонку если её нет
             await db.execute('''
                 ALTER TABLE polls ADD COLUMN thank_you_video TEXT
@@ -162,7 +187,7 @@ class Database:
         
     async def create_poll(self, title, description, questions, created_by):
         """Создание нового опроса"""
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self.pool.write() as db:
 
             
             # Создаем таблицы для опросов если их нет
@@ -222,9 +247,9 @@ class Database:
 
     async def check_user_poll_participation(self, user_id, poll_id):
         """Проверка участия пользователя в опросе"""
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self.pool.read() as db:
             cursor = await db.execute(
-                "SELECT COUNT(*) FROM poll_responses WHERE user_id = ? AND poll_id = ?",
+                queries.CHECK_USER_POLL_PARTICIPATION,
                 (user_id, poll_id)
             )
             count = await cursor.fetchone()
@@ -232,13 +257,8 @@ class Database:
 
     async def get_poll_questions(self, poll_id):
         """Получение вопросов опроса"""
-        async with aiosqlite.connect(self.db_path) as db:
-            cursor = await db.execute('''
-                SELECT id, question_text, question_type, options
-                FROM poll_questions
-                WHERE poll_id = ?
-                ORDER BY question_order
-            ''', (poll_id,))
+        async with self.pool.read() as db:
+            cursor = await db.execute(queries.GET_POLL_QUESTIONS, (poll_id,))
             
             rows = await cursor.fetchall()
             questions = []
@@ -251,57 +271,9 @@ class Database:
                 })
             return questions
         
-    async def get_container_photo(self, container_type: str):
-        """Получает фото контейнера по типу"""
-        try:
-            await self.ensure_container_photos_table()
-            # Нормализуем тип контейнера при поиске
-            normalized_type = ' '.join(word.capitalize() for word in container_type.split())
-            
-            async with aiosqlite.connect(self.db_path) as db:
-                cursor = await db.execute(
-                    'SELECT file_id, description FROM container_photos WHERE container_type = ?',
-                    (normalized_type,)
-                )
-                row = await cursor.fetchone()
-                
-                # Если не нашли точное совпадение, пробуем без учета регистра
-                if not row:
-                    cursor = await db.execute(
-                        'SELECT file_id, description FROM container_photos WHERE LOWER(container_type) = LOWER(?)',
-                        (container_type.strip(),)
-                    )
-                    row = await cursor.fetchone()
-                
-                if row:
-                    return {'file_id': row[0], 'description': row[1]}
-                
-                # Для отладки
-                print(f"[DEBUG] No photo found for container type: '{normalized_type}'")
-                return None
-        except Exception as e:
-            print(f"[ERROR] Failed to get container photo: {e}")
-            return None
-
-    async def delete_container_photo(self, container_type: str):
-        """Удаляет фото контейнера по типу"""
-        try:
-            await self.ensure_container_photos_table()
-            async with aiosqlite.connect(self.db_path) as db:
-                cursor = await db.execute(
-                    'DELETE FROM container_photos WHERE container_type = ?', 
-                    (container_type,)
-                )
-                deleted = cursor.rowcount > 0
-                await db.commit()
-                return deleted
-        except Exception as e:
-            print(f"[ERROR] Failed to delete container photo: {e}")
-            return False
-
     async def save_poll_response(self, poll_id, question_id, user_id, answer):
         """Сохранение ответа пользователя на вопрос опроса"""
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self.pool.write() as db:
             await db.execute(
                 "INSERT INTO poll_responses (poll_id, question_id, user_id, answer) VALUES (?, ?, ?, ?)",
                 (poll_id, question_id, user_id, answer)
@@ -310,7 +282,7 @@ class Database:
 
     async def get_active_polls(self):
         """Получение активных опросов"""
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self.pool.read() as db:
             cursor = await db.execute('''
                 SELECT 
                     p.id,
@@ -342,7 +314,7 @@ class Database:
 
     async def get_polls_with_results(self):
         """Получение опросов с результатами"""
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self.pool.read() as db:
             # Получаем все опросы
             cursor = await db.execute('''
                 SELECT 
@@ -363,12 +335,7 @@ class Database:
                 poll_id = poll_row[0]
                 
                 # Получаем вопросы для каждого опроса
-                q_cursor = await db.execute('''
-                    SELECT id, question_text, question_type, options
-                    FROM poll_questions
-                    WHERE poll_id = ?
-                    ORDER BY question_order
-                ''', (poll_id,))
+                q_cursor = await db.execute(queries.GET_POLL_QUESTIONS, (poll_id,))
                 
                 questions_data = await q_cursor.fetchall()
                 questions = []
@@ -392,14 +359,7 @@ class Database:
                         
                     elif q_row[2] in ['single', 'multiple']:
                         # Для вариантов считаем самый популярный
-                        top_cursor = await db.execute('''
-                            SELECT answer, COUNT(*) as cnt
-                            FROM poll_responses
-                            WHERE question_id = ?
-                            GROUP BY answer
-                            ORDER BY cnt DESC
-                            LIMIT 1
-                        ''', (question_id,))
+                        top_cursor = await db.execute(queries.GET_POLL_TOP_ANSWER, (question_id,))
                         top_row = await top_cursor.fetchone()
                         question['top_answer'] = top_row[0] if top_row else 'Нет ответов'
                         
@@ -425,7 +385,7 @@ class Database:
 
     async def get_full_poll_results(self):
         """Получение полных результатов опросов для выгрузки"""
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self.pool.read() as db:
             # Получаем все опросы
             cursor = await db.execute('''
                 SELECT 
@@ -448,12 +408,7 @@ class Database:
                 poll_id = poll_row[0]
                 
                 # Получаем вопросы
-                q_cursor = await db.execute('''
-                    SELECT id, question_text, question_type, options
-                    FROM poll_questions
-                    WHERE poll_id = ?
-                    ORDER BY question_order
-                ''', (poll_id,))
+                q_cursor = await db.execute(queries.GET_POLL_QUESTIONS, (poll_id,))
                 
                 questions_data = await q_cursor.fetchall()
                 questions = []
@@ -591,53 +546,33 @@ class Database:
                            found_test_code: str = None, search_type: str = 'text', 
                            success: bool = True):
         """Добавляет запись в историю поиска"""
-        async with aiosqlite.connect(self.db_path) as db:
-            await db.execute('''
-                INSERT INTO search_history (user_id, search_query, found_test_code, 
-                                        search_type, success, created_at)
-                VALUES (?, ?, ?, ?, ?, ?)
-            ''', (user_id, search_query, found_test_code, search_type, success, datetime.now()))
-            await db.commit()
+        await self.telemetry.insert('''
+            INSERT INTO search_history (user_id, search_query, found_test_code,
+                                    search_type, success, created_at)
+            VALUES (?, ?, ?, ?, ?, ?)
+        ''', (user_id, search_query, found_test_code, search_type, success, datetime.now()))
 
     async def update_user_frequent_test(self, user_id: int, test_code: str, test_name: str):
         """Обновляет частоту использования теста пользователем"""
-        async with aiosqlite.connect(self.db_path) as db:
-            await db.execute('''
-                INSERT INTO user_frequent_tests (user_id, test_code, test_name, frequency, last_accessed)
-                VALUES (?, ?, ?, 1, ?)
-                ON CONFLICT(user_id, test_code) DO UPDATE SET
-                    frequency = frequency + 1,
-                    test_name = excluded.test_name,
-                    last_accessed = excluded.last_accessed
-            ''', (user_id, test_code, test_name, datetime.now()))
-            await db.commit()
+        # Повторные просмотры до сброса схлопываются в один UPSERT
+        await self.telemetry.increment(
+            'user_frequent_tests', (user_id, test_code), (test_name, datetime.now())
+        )
 
     async def get_user_frequent_tests(self, user_id: int, limit: int = 10) -> list:
         """Получает частые тесты пользователя"""
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self.pool.read() as db:
             db.row_factory = aiosqlite.Row
-            cursor = await db.execute('''
-                SELECT test_code, test_name, frequency, last_accessed
-                FROM user_frequent_tests
-                WHERE user_id = ?
-                ORDER BY frequency DESC, last_accessed DESC
-                LIMIT ?
-            ''', (user_id, limit))
+            cursor = await db.execute(queries.GET_USER_FREQUENT_TESTS, (user_id, limit))
             
             rows = await cursor.fetchall()
             return [dict(row) for row in rows]
 
     async def get_recent_searches(self, user_id: int, limit: int = 10) -> list:
         """Получает последние поиски пользователя"""
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self.pool.read() as db:
             db.row_factory = aiosqlite.Row
-            cursor = await db.execute('''
-                SELECT search_query, found_test_code, search_type, success, created_at
-                FROM search_history
-                WHERE user_id = ? AND success = TRUE
-                ORDER BY created_at DESC
-                LIMIT ?
-            ''', (user_id, limit))
+            cursor = await db.execute(queries.GET_RECENT_SEARCHES, (user_id, limit))
             
             rows = await cursor.fetchall()
             return [dict(row) for row in rows]
@@ -648,7 +583,7 @@ class Database:
         if test_code_1 > test_code_2:
             test_code_1, test_code_2 = test_code_2, test_code_1
         
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self.pool.write() as db:
             await db.execute('''
                 INSERT INTO related_tests (user_id, test_code_1, test_code_2, 
                                         correlation_count, last_correlation)
@@ -661,44 +596,124 @@ class Database:
 
     async def get_user_related_tests(self, user_id: int, test_code: str, limit: int = 5) -> list:
         """Получает тесты, которые пользователь часто ищет вместе с данным"""
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self.pool.read() as db:
             db.row_factory = aiosqlite.Row
-            cursor = await db.execute('''
-                SELECT 
-                    CASE 
-                        WHEN test_code_1 = ? THEN test_code_2 
-                        ELSE test_code_1 
-                    END as related_code,
-                    correlation_count
-                FROM related_tests
-                WHERE user_id = ? AND (test_code_1 = ? OR test_code_2 = ?)
-                ORDER BY correlation_count DESC, last_correlation DESC
-                LIMIT ?
-            ''', (test_code, user_id, test_code, test_code, limit))
+            cursor = await db.execute(
+                queries.GET_USER_RELATED_TESTS, (test_code, user_id, test_code, test_code, limit)
+            )
             
             rows = await cursor.fetchall()
             related_codes = [dict(row) for row in rows]
             
-            # Получаем полную информацию о связанных тестах
+        # Полная информация о связанных тестах - одним пакетом
+        tests = await self.get_tests_by_codes([item['related_code'] for item in related_codes])
+        result = []
+        for item in related_codes:
+            test_info = tests.get(str(item['related_code']).upper())
+            if test_info:
+                test_info['correlation_count'] = item['correlation_count']
+                result.append(test_info)
+        
+        return result
+
+    async def get_related_tests(self, test_code: str, limit: int = 3) -> list:
+        """Тесты, которые все пользователи часто смотрят вместе с данным (из памяти)"""
+        try:
+            related = self.related_index.get_related(test_code, limit)
+            if not related:
+                return []
+            tests = await self.get_tests_by_codes([code for code, _ in related])
             result = []
-            for item in related_codes:
-                test_info = await self.get_test_by_code(item['related_code'])
+            for code, score in related:
+                test_info = tests.get(code)
                 if test_info:
-                    test_info['correlation_count'] = item['correlation_count']
+                    test_info['score'] = score
                     result.append(test_info)
-            
             return result
+        except Exception as e:
+            print(f"[ERROR] Failed to get related tests: {e}")
+            return []
+
+    async def rebuild_related_tests(self) -> int:
+        """Пересчитывает глобальные рекомендации по совместным просмотрам"""
+        try:
+            # search_history пишется через телеметрию - сначала дописываем буфер
+            await self.telemetry.flush()
+            return await self.related_index.rebuild(self.test_processor.catalog_index)
+        except Exception as e:
+            print(f"[ERROR] Failed to rebuild related tests: {e}")
+            return 0
 
     async def get_search_suggestions(self, user_id: int, query: str = "") -> list:
-        """Получает персонализированные подсказки для поиска"""
+        """
+        Получает персонализированные подсказки для поиска.
+        Частые тесты и недавние поиски - одним SQL-запросом, карточки
+        тестов - пакетно из индекса каталога в памяти.
+        """
+        async with self.pool.read() as db:
+            db.row_factory = aiosqlite.Row
+            cursor = await db.execute('''
+                SELECT
+                    test_code,
+                    MAX(test_name) as test_name,
+                    MAX(frequency) as frequency,
+                    MAX(last_used) as last_used,
+                    MAX(search_query) as original_query,
+                    MAX(recent_at) as recent_at
+                FROM (
+                    SELECT * FROM (
+                        SELECT test_code, test_name, frequency, last_accessed as last_used,
+                               NULL as search_query, NULL as recent_at
+                        FROM user_frequent_tests
+                        WHERE user_id = ?
+                        ORDER BY frequency DESC, last_accessed DESC
+                        LIMIT 20
+                    )
+                    UNION ALL
+                    SELECT * FROM (
+                        -- Последний успешный поиск по каждому коду (bare column при MAX)
+                        SELECT UPPER(found_test_code) as test_code, NULL as test_name, 0 as frequency,
+                               NULL as last_used, search_query, MAX(created_at) as recent_at
+                        FROM search_history
+                        WHERE user_id = ? AND success = TRUE AND found_test_code IS NOT NULL
+                        GROUP BY UPPER(found_test_code)
+                        ORDER BY recent_at DESC
+                        LIMIT 10
+                    )
+                )
+                GROUP BY test_code
+                ORDER BY frequency DESC, last_used DESC
+            ''', (user_id, user_id))
+            rows = [dict(row) for row in await cursor.fetchall()]
+
+        frequent_tests = [row for row in rows if row['frequency']]
+        recent_searches = sorted(
+            (row for row in rows if row['original_query']),
+            key=lambda row: str(row['recent_at']), reverse=True
+        )
+        catalog = await self.get_tests_by_codes([row['test_code'] for row in recent_searches])
+
+        def frequent_item(test):
+            return {
+                'type': 'frequent',
+                'code': test['test_code'],
+                'name': test['test_name'],
+                'frequency': test['frequency']
+            }
+
+        def recent_item(search):
+            test_info = catalog.get(str(search['test_code']).upper())
+            if not test_info:
+                return None
+            return {
+                'type': 'recent',
+                'code': test_info['test_code'],
+                'name': test_info['test_name'],
+                'original_query': search['original_query']
+            }
+
         suggestions = []
         
-        # 1. Частые тесты пользователя
-        frequent_tests = await self.get_user_frequent_tests(user_id, limit=20)
-        
-        # 2. Недавние успешные поиски
-        recent_searches = await self.get_recent_searches(user_id, limit=10)
-        
         # Фильтруем по запросу если он есть
         if query:
             query_upper = query.upper()
@@ -707,77 +722,42 @@ class Database:
             # Фильтруем частые тесты
             for test in frequent_tests:
                 if (query_upper in test['test_code'] or 
-                    query_lower in test['test_name'].lower()):
-                    suggestions.append({
-                        'type': 'frequent',
-                        'code': test['test_code'],
-                        'name': test['test_name'],
-                        'frequency': test['frequency']
-                    })
+                    query_lower in (test['test_name'] or '').lower()):
+                    suggestions.append(frequent_item(test))
             
             # Фильтруем недавние поиски
             seen_codes = {s['code'] for s in suggestions}
             for search in recent_searches:
-                if search['found_test_code'] and search['found_test_code'] not in seen_codes:
-                    if query_lower in search['search_query'].lower():
-                        # Получаем информацию о тесте
-                        test_info = await self.get_test_by_code(search['found_test_code'])
-                        if test_info:
-                            suggestions.append({
-                                'type': 'recent',
-                                'code': test_info['test_code'],
-                                'name': test_info['test_name'],
-                                'original_query': search['search_query']
-                            })
+                if search['test_code'] not in seen_codes and query_lower in search['original_query'].lower():
+                    item = recent_item(search)
+                    if item:
+                        suggestions.append(item)
         else:
             # Без запроса показываем топ частых
             for test in frequent_tests[:3]:
-                suggestions.append({
-                    'type': 'frequent',
-                    'code': test['test_code'],
-                    'name': test['test_name'],
-                    'frequency': test['frequency']
-                })
+                suggestions.append(frequent_item(test))
             
             # Добавляем недавние поиски
             seen_codes = {s['code'] for s in suggestions}
             for search in recent_searches[:2]:
-                if search['found_test_code'] and search['found_test_code'] not in seen_codes:
-                    # Получаем информацию о тесте
-                    test_info = await self.get_test_by_code(search['found_test_code'])
-                    if test_info:
-                        suggestions.append({
-                            'type': 'recent',
-                            'code': test_info['test_code'],
-                            'name': test_info['test_name'],
-                            'original_query': search['search_query']
-                        })
-                        seen_codes.add(test_info['test_code'])
+                if search['test_code'] not in seen_codes:
+                    item = recent_item(search)
+                    if item:
+                        suggestions.append(item)
+                        seen_codes.add(item['code'])
         
         return suggestions[:10]  # Максимум 10 подсказок
 
     async def get_user_search_stats(self, user_id: int) -> dict:
         """Получает статистику поисков пользователя"""
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self.pool.read() as db:
             # Общее количество поисков
-            cursor = await db.execute('''
-                SELECT COUNT(*) as total,
-                    SUM(CASE WHEN success = TRUE THEN 1 ELSE 0 END) as successful,
-                    COUNT(DISTINCT found_test_code) as unique_tests
-                FROM search_history
-                WHERE user_id = ?
-            ''', (user_id,))
+            cursor = await db.execute(queries.GET_USER_SEARCH_TOTALS, (user_id,))
             
             stats = await cursor.fetchone()
             
             # Самый частый тест
-            cursor = await db.execute('''
-                SELECT test_code, test_name, frequency
-                FROM user_frequent_tests
-                WHERE user_id = ?
-                ORDER BY frequency DESC
-                LIMIT 1
-            ''', (user_id,))
+            cursor = await db.execute(queries.GET_USER_MOST_FREQUENT_TEST, (user_id,))
             
             most_frequent = await cursor.fetchone()
             
@@ -791,13 +771,10 @@ class Database:
 
     async def cleanup_old_search_history(self, days: int = 90):
         """Удаляет старую историю поисков"""
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self.pool.write() as db:
             cutoff_date = datetime.now() - timedelta(days=days)
             
-            cursor = await db.execute('''
-                DELETE FROM search_history
-                WHERE created_at < ?
-            ''', (cutoff_date,))
+            cursor = await db.execute(queries.CLEANUP_OLD_SEARCH_HISTORY, (cutoff_date,))
             
             deleted = cursor.rowcount
             await db.commit()
@@ -806,7 +783,7 @@ class Database:
         
     async def ensure_container_photos_table(self):
         """Создает таблицу container_photos если её нет"""
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self.pool.write() as db:
             await db.execute('''
                 CREATE TABLE IF NOT EXISTS container_photos (
                     container_type TEXT PRIMARY KEY,
@@ -818,15 +795,24 @@ class Database:
                 )
             ''')
             await db.commit()
+
+    async def _ensure_container_photos_loaded(self):
+        """Загружает container_photos в память один раз (дальше - write-through)"""
+        if self.container_photos.loaded:
+            return
+        # Ошибка БД пробрасывается: карта остается незагруженной, следующий вызов повторит
+        rows = await self._fetch_container_photos()
+        self.container_photos.load(rows)
+        print(f"[INFO] Loaded {len(self.container_photos)} container photos into memory")
             
     async def add_container_photo(self, container_type: str, file_id: str, uploaded_by: int, description: str = None):
         """Добавляет или обновляет фото для типа контейнера"""
         try:
-            await self.ensure_container_photos_table()
+            await self._ensure_container_photos_loaded()
             # Нормализуем тип контейнера при сохранении (каждое слово с заглавной буквы)
-            normalized_type = ' '.join(word.capitalize() for word in container_type.split())
+            normalized_type = display_container_name(container_type)
             
-            async with aiosqlite.connect(self.db_path) as db:
+            async with self.pool.write() as db:
                 await db.execute('''
                     INSERT OR REPLACE INTO container_photos 
                     (container_type, file_id, uploaded_by, description, upload_date)
@@ -834,40 +820,26 @@ class Database:
                 ''', (normalized_type, file_id, uploaded_by, description, datetime.now()))
                 
                 await db.commit()
-                print(f"[INFO] Saved photo for container: '{normalized_type}'")
-                return True
+
+            self.container_photos.set(normalized_type, file_id, description)
+            print(f"[INFO] Saved photo for container: '{normalized_type}'")
+            return True
         except Exception as e:
             print(f"[ERROR] Failed to add container photo: {e}")
             return False
 
     async def get_container_photo(self, container_type: str):
-        """Получает фото контейнера по типу"""
+        """
+        Получает фото контейнера по типу - из карты в памяти, без запросов к БД.
+        Варианты написания (регистр, количество, "/" и "+", пробирка/пробирки)
+        сворачиваются ключом нормализации.
+        """
         try:
-            await self.ensure_container_photos_table()
-            # Нормализуем тип контейнера при поиске
-            normalized_type = ' '.join(word.capitalize() for word in container_type.split())
-            
-            async with aiosqlite.connect(self.db_path) as db:
-                cursor = await db.execute(
-                    'SELECT file_id, description FROM container_photos WHERE container_type = ?',
-                    (normalized_type,)
-                )
-                row = await cursor.fetchone()
-                
-                # Если не нашли точное совпадение, пробуем без учета регистра
-                if not row:
-                    cursor = await db.execute(
-                        'SELECT file_id, description FROM container_photos WHERE LOWER(container_type) = LOWER(?)',
-                        (container_type.strip(),)
-                    )
-                    row = await cursor.fetchone()
-                
-                if row:
-                    return {'file_id': row[0], 'description': row[1]}
-                
-                # Для отладки
-                print(f"[DEBUG] No photo found for container type: '{normalized_type}'")
-                return None
+            await self._ensure_container_photos_loaded()
+            photo = self.container_photos.resolve(container_type)
+            if photo is None:
+                print(f"[DEBUG] No photo found for container type: '{display_container_name(container_type)}'")
+            return photo
         except Exception as e:
             print(f"[ERROR] Failed to get container photo: {e}")
             return None
@@ -875,61 +847,44 @@ class Database:
     async def delete_container_photo(self, container_type: str):
         """Удаляет фото контейнера по типу"""
         try:
-            await self.ensure_container_photos_table()
-            async with aiosqlite.connect(self.db_path) as db:
+            await self._ensure_container_photos_loaded()
+            async with self.pool.write() as db:
                 cursor = await db.execute(
                     'DELETE FROM container_photos WHERE container_type = ?', 
                     (container_type,)
                 )
                 deleted = cursor.rowcount > 0
                 await db.commit()
-                return deleted
+            if deleted:
+                self.container_photos.remove(container_type)
+            return deleted
         except Exception as e:
             print(f"[ERROR] Failed to delete container photo: {e}")
             return False
 
-    async def get_test_by_code(self, code: str) -> Optional[dict]:
-        """
-        Find test by exact code match using ChromaDB.
-        """
-        try:
-            # Search in ChromaDB with test code filter
-            results = self.test_processor.search_test(
-                query="",
-                filter_dict={"test_code": code.upper()},
-                top_k=1
-            )
-            
-            if not results:
-                return None
-                
-            doc = results[0][0] if isinstance(results[0], tuple) else results[0]
-            return {
-                'test_code': doc.metadata['test_code'],
-                'test_name': doc.metadata['test_name'],
-                'container_type': doc.metadata.get('container_type', ''),
-                'primary_container_type': doc.metadata.get('primary_container_type', ''),  # ВАЖНО!
-                'preanalytics': doc.metadata.get('preanalytics', ''),
-                'storage_temp': doc.metadata.get('storage_temp', ''),
-                'department': doc.metadata.get('department', '')
-            }
-        except Exception as e:
-            print(f"[ERROR] Failed to search test by code: {e}")
-            return None 
-        
+    async def _fetch_container_photos(self):
+        """Все фото контейнеров из БД (ошибки не перехватываются)"""
+        await self.ensure_container_photos_table()
+        async with self.pool.read() as db:
+            db.row_factory = aiosqlite.Row
+            cursor = await db.execute('''
+                SELECT container_type, file_id, upload_date, description, uploaded_by
+                FROM container_photos 
+                ORDER BY container_type
+            ''')
+            rows = await cursor.fetchall()
+            return [dict(row) for row in rows]
+
+    async def reload_container_photos(self) -> int:
+        """Перечитывает фото контейнеров из БД (изменения, сделанные в другом воркере)"""
+        rows = await self._fetch_container_photos()
+        self.container_photos.load(rows)
+        return len(rows)
+
     async def get_all_container_photos(self):
         """Получает все фото контейнеров"""
         try:
-            await self.ensure_container_photos_table()
-            async with aiosqlite.connect(self.db_path) as db:
-                db.row_factory = aiosqlite.Row
-                cursor = await db.execute('''
-                    SELECT container_type, file_id, upload_date, description, uploaded_by
-                    FROM container_photos 
-                    ORDER BY container_type
-                ''')
-                rows = await cursor.fetchall()
-                return [dict(row) for row in rows]
+            return await self._fetch_container_photos()
         except Exception as e:
             print(f"[ERROR] Failed to get all container photos: {e}")
             return []
@@ -940,7 +895,7 @@ class Database:
         self.test_processor.load_vector_store()
     
     async def create_tables(self):
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self.pool.write() as db:
             await db.execute('''
                 CREATE TABLE IF NOT EXISTS blank_files (
                     file_name TEXT PRIMARY KEY,
@@ -1163,9 +1118,22 @@ class Database:
                     session_end TIMESTAMP,
                     request_count INTEGER DEFAULT 0,
                     is_active BOOLEAN DEFAULT TRUE,
+                    last_activity TIMESTAMP,
                     FOREIGN KEY (user_id) REFERENCES users(telegram_id)
                 )
             ''')
+
+            # Для существующих БД: колонка last_activity (время последнего события сессии)
+            cursor = await db.execute("PRAGMA table_info(user_sessions)")
+            session_columns = [column[1] for column in await cursor.fetchall()]
+            if 'last_activity' not in session_columns:
+                await db.execute('ALTER TABLE user_sessions ADD COLUMN last_activity TIMESTAMP')
+                await db.execute('''
+                    UPDATE user_sessions
+                    SET last_activity = COALESCE(session_end, session_start)
+                    WHERE last_activity IS NULL
+                ''')
+                print("[INFO] Added last_activity column to user_sessions")
             
             # Таблица для системных метрик
             await db.execute('''
@@ -1240,6 +1208,9 @@ class Database:
                 CREATE INDEX IF NOT EXISTS idx_response_ratings_user_time 
                 ON response_ratings(user_id, timestamp DESC)
             ''')
+
+            # Инкрементальные агрегаты для дашбордов (src/database/rollups.py)
+            await self.rollups.create_tables(db)
             
             # ============================================================
             # КОНЕЦ ДОБАВЛЕНИЯ
@@ -1267,6 +1238,12 @@ class Database:
                 CREATE INDEX IF NOT EXISTS idx_sessions_active
                 ON user_sessions(is_active, user_id) WHERE is_active = TRUE
             ''')
+
+            # Индекс для фонового закрытия неактивных сессий
+            await db.execute('''
+                CREATE INDEX IF NOT EXISTS idx_sessions_active_last_activity
+                ON user_sessions(last_activity) WHERE is_active = TRUE
+            ''')
             
             # Индекс для поиска по user_id и role (составной)
             await db.execute('''
@@ -1284,11 +1261,15 @@ class Database:
             
             # Теперь коммитим все изменения
             await db.commit()
+
+            # Версионированные миграции поверх базовой схемы
+            schema_version = await apply_migrations(db)
+            print(f"[INFO] Database schema version: {schema_version}")
     
     async def add_client(self, telegram_id: int, name: str, client_code: str,
                         specialization: str, country: str = 'RU'):
         """Добавление клиента (ветеринарной клиники)"""
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self.pool.write() as db:
             try:
                 await db.execute('''
                     INSERT INTO users (telegram_id, user_type, name, client_code,
@@ -1308,7 +1289,7 @@ class Database:
     
     async def add_employee(self, telegram_id: int, name: str, region: str, department_function: str, country: str = 'RU'):
         """Добавление сотрудника только с именем (без фамилии)"""
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self.pool.write() as db:
             try:
                 await db.execute('''
                     INSERT INTO users (telegram_id, user_type, name, first_name,
@@ -1327,41 +1308,30 @@ class Database:
                 return False
     
     async def get_user(self, telegram_id: int):
-        """Получает пользователя с кэшированием"""
-        # Проверяем кэш
-        cache_key = f"user_{telegram_id}"
-        if cache_key in self._user_cache:
-            cached_data, cached_time = self._user_cache[cache_key]
-            if time.time() - cached_time < self._cache_ttl:
-                return cached_data
+        """Получает пользователя с кэшированием (включая отсутствующих)"""
+        user_data = self.user_cache.get(telegram_id)
+        if user_data is not MISSING:
+            return user_data
         
         # Загружаем из БД
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self.pool.read() as db:
             db.row_factory = aiosqlite.Row
-            cursor = await db.execute(
-                'SELECT * FROM users WHERE telegram_id = ?', 
-                (telegram_id,)
-            )
+            cursor = await db.execute(queries.GET_USER, (telegram_id,))
             row = await cursor.fetchone()
             user_data = dict(row) if row else None
             
-            # Сохраняем в кэш
-            self._user_cache[cache_key] = (user_data, time.time())
-            
-            return user_data
+        # Сохраняем в кэш (None - тоже результат)
+        self.user_cache.put(telegram_id, user_data)
+        return user_data
         
     def clear_user_cache(self, telegram_id: int = None):
-        """Очищает кэш пользователей"""
-        if telegram_id:
-            cache_key = f"user_{telegram_id}"
-            self._user_cache.pop(cache_key, None)
-        else:
-            self._user_cache.clear()
+        """Очищает кэш пользователей (одного или весь)"""
+        self.user_cache.invalidate(telegram_id)
             
     async def get_dau_metrics_optimized(self, days: int = 30):
         """Оптимизированная версия получения DAU метрик"""
         try:
-            async with aiosqlite.connect(self.db_path) as db:
+            async with self.pool.read() as db:
                 db.row_factory = aiosqlite.Row
                 
                 start_date = datetime.now() - timedelta(days=days)
@@ -1392,16 +1362,17 @@ class Database:
     
     async def update_user_role(self, telegram_id: int, role: str):
         """Обновление роли пользователя (только для админа)"""
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self.pool.write() as db:
             await db.execute(
                 'UPDATE users SET role = ? WHERE telegram_id = ?',
                 (role, telegram_id)
             )
             await db.commit()
+        self.clear_user_cache(telegram_id)
     
     async def check_activation_code(self, code: str):
         """Проверка кода активации администратора"""
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self.pool.read() as db:
             db.row_factory = aiosqlite.Row
             cursor = await db.execute('''
                 SELECT * FROM activation_codes 
@@ -1425,7 +1396,7 @@ class Database:
     
     async def use_activation_code(self, code: str, user_id: int):
         """Использование кода активации"""
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self.pool.write() as db:
             await db.execute('''
                 UPDATE activation_codes 
                 SET is_used = TRUE, used_by = ?, used_at = ?
@@ -1435,7 +1406,7 @@ class Database:
     
     async def create_admin_code(self, code: str):
         """Создание одноразового кода активации администратора"""
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self.pool.write() as db:
             try:
                 await db.execute('''
                     INSERT INTO activation_codes (code, role, created_at)
@@ -1461,17 +1432,15 @@ class Database:
                 print(f"Ошибка сохранения истории FAQ: {e}")
 
     async def add_request_stat(self, user_id: int, request_type: str, request_text: str):
-        async with aiosqlite.connect(self.db_path) as db:
-            await db.execute('''
-                INSERT INTO request_statistics (user_id, request_type, 
-                                              request_text, timestamp)
-                VALUES (?, ?, ?, ?)
-            ''', (user_id, request_type, request_text, datetime.now()))
-            await db.commit()
+        await self.telemetry.insert('''
+            INSERT INTO request_statistics (user_id, request_type,
+                                          request_text, timestamp)
+            VALUES (?, ?, ?, ?)
+        ''', (user_id, request_type, request_text, datetime.now()))
     
     async def add_feedback(self, user_id: int, feedback_type: str, message: str, 
                           media_type: str = None, media_file_id: str = None):
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self.pool.write() as db:
             await db.execute('''
                 INSERT INTO feedback (user_id, feedback_type, message, 
                                     media_type, media_file_id, timestamp)
@@ -1482,7 +1451,7 @@ class Database:
 
     async def get_statistics(self):
         """Получение статистики для администратора"""
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self.pool.read() as db:
             # Статистика пользователей (ИСКЛЮЧАЯ админов)
             cursor = await db.execute("""
                 SELECT user_type, COUNT(*) 
@@ -1548,7 +1517,7 @@ class Database:
         
     async def add_memory(self, user_id: int, type: str, content: str):
         """Сохранение памяти разговора"""
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self.pool.write() as db:
             await db.execute('''
                 INSERT INTO conversation_memory (user_id, type, content)
                 VALUES (?, ?, ?)
@@ -1557,18 +1526,14 @@ class Database:
 
     async def get_buffer(self, user_id: int) -> list[str]:
         """Получение буфера сообщений"""
-        async with aiosqlite.connect(self.db_path) as db:
-            cursor = await db.execute('''
-                SELECT content FROM conversation_memory
-                WHERE user_id = ? AND type = 'buffer'
-                ORDER BY timestamp
-            ''', (user_id,))
+        async with self.pool.read() as db:
+            cursor = await db.execute(queries.GET_BUFFER, (user_id,))
             rows = await cursor.fetchall()
             return [r[0] for r in rows]
 
     async def clear_buffer(self, user_id: int):
         """Очистка буфера сообщений"""
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self.pool.write() as db:
             await db.execute('''
                 DELETE FROM conversation_memory
                 WHERE user_id = ? AND type = 'buffer'
@@ -1577,20 +1542,15 @@ class Database:
 
     async def get_latest_summary(self, user_id: int) -> str | None:
         """Получение последней сводки разговора"""
-        async with aiosqlite.connect(self.db_path) as db:
-            cursor = await db.execute('''
-                SELECT content FROM conversation_memory
-                WHERE user_id = ? AND type = 'summary'
-                ORDER BY timestamp DESC
-                LIMIT 1
-            ''', (user_id,))
+        async with self.pool.read() as db:
+            cursor = await db.execute(queries.GET_LATEST_SUMMARY, (user_id,))
             row = await cursor.fetchone()
             return row[0] if row else None
 
     # Новые методы для администраторов
     async def get_broadcast_recipients(self, broadcast_type: str) -> list:
         """Получить список ID получателей для рассылки"""
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self.pool.read() as db:
             if broadcast_type == 'all':
                 query = "SELECT telegram_id FROM users WHERE is_active = TRUE"
             elif broadcast_type == 'clients':
@@ -1606,7 +1566,7 @@ class Database:
 
     async def get_recent_users(self, limit: int = 10) -> list:
         """Получить последних зарегистрированных пользователей"""
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self.pool.read() as db:
             db.row_factory = aiosqlite.Row
             cursor = await db.execute('''
                 SELECT * FROM users 
@@ -1618,7 +1578,7 @@ class Database:
 
     async def get_recent_feedback(self, limit: int = 5) -> list:
         """Получить последние обращения"""
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self.pool.read() as db:
             db.row_factory = aiosqlite.Row
             cursor = await db.execute('''
                 SELECT f.*, u.name as user_name 
@@ -1632,7 +1592,7 @@ class Database:
 
     async def clear_old_logs(self, days: int = 30) -> int:
         """Очистить старые записи логов"""
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self.pool.write() as db:
             cutoff_date = datetime.now() - timedelta(days=days)
             
             cursor = await db.execute('''
@@ -1654,7 +1614,7 @@ class Database:
 
     async def get_uptime(self) -> str:
         """Получить время работы системы"""
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self.pool.read() as db:
             cursor = await db.execute('''
                 SELECT MIN(registration_date) FROM users
             ''')
@@ -1674,7 +1634,7 @@ class Database:
         
     async def get_test_by_code(self, code: str) -> Optional[dict]:
         """
-        Find test by exact code match using ChromaDB.
+        Find test by exact code match using the in-memory catalog index.
         
         Args:
             code: Test code to search for (case insensitive)
@@ -1683,29 +1643,22 @@ class Database:
             Dictionary with test data or None if not found
         """
         try:
-            # Search in ChromaDB with test code filter
-            results = self.test_processor.search_test(
-                query="",
-                filter_dict={"test_code": code.upper()},
-                top_k=1
-            )
-            
-            if not results:
-                return None
-                
-            doc = results[0][0]
-            return {
-                'test_code': doc.metadata['test_code'],
-                'test_name': doc.metadata['test_name'],
-                'container_type': doc.metadata['container_type'],
-                'primary_container_type': doc.metadata.get('primary_container_type', ''),
-                'preanalytics': doc.metadata['preanalytics'],
-                'storage_temp': doc.metadata['storage_temp'],
-                'department': doc.metadata['department']
-            }
+            return self.test_processor.catalog_index.get_tests_by_codes([code]).get(code.upper())
         except Exception as e:
             print(f"[ERROR] Failed to search test by code: {e}")
             return None
+
+    async def get_tests_by_codes(self, codes: list) -> dict:
+        """
+        Пакетный поиск тестов по кодам: {КОД: карточка теста}.
+        Отсутствующие в каталоге коды в результат не попадают.
+        """
+        try:
+            return self.test_processor.catalog_index.get_tests_by_codes(codes)
+        except Exception as e:
+            print(f"[ERROR] Failed to search tests by codes: {e}")
+            return {}
+
     # ============================================================
     # МЕТОДЫ ДЛЯ РАБОТЫ С МЕТРИКАМИ
     # ============================================================
@@ -1746,23 +1699,18 @@ class Database:
                 if user and user.get('role') == 'admin':
                     return
             
-            # Используем timeout для предотвращения блокировки
-            async with aiosqlite.connect(self.db_path, timeout=10.0) as db:
-                # Явно устанавливаем WAL mode для лучшей concurrent работы
-                await db.execute('PRAGMA journal_mode=WAL')
-                
-                await db.execute('''
-                    INSERT INTO request_metrics
-                    (user_id, request_type, query_text, response_time, success,
-                    relevance_score, has_answer, error_message, timestamp)
-                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-                ''', (
-                    user_id, request_type, query_text[:500], response_time, success,
-                    relevance_score, has_answer, error_message, datetime.now()
-                ))
-                await db.commit()
-                
-                print(f"[METRICS] ✓ Logged request: type={request_type}, user={user_id}, success={success}, has_answer={has_answer}")
+            # Запись уходит в пакетный writer, а не в транзакцию на пути ответа
+            await self.telemetry.insert('''
+                INSERT INTO request_metrics
+                (user_id, request_type, query_text, response_time, success,
+                relevance_score, has_answer, error_message, timestamp)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ''', (
+                user_id, request_type, query_text[:500], response_time, success,
+                relevance_score, has_answer, error_message, datetime.now()
+            ))
+
+            print(f"[METRICS] ✓ Queued request: type={request_type}, user={user_id}, success={success}, has_answer={has_answer}")
         except aiosqlite.OperationalError as db_error:
             # Ошибка БД (блокировка, timeout и т.д.)
             print(f"[ERROR] Database operational error in log_request_metric: {db_error}")
@@ -1775,29 +1723,40 @@ class Database:
             traceback.print_exc()
 
     
+    async def refresh_rollups(self):
+        """Дописывает телеметрию и обрабатывает новые строки в агрегаты"""
+        try:
+            await self.telemetry.flush()
+            return await self.rollups.refresh()
+        except Exception as e:
+            print(f"[ERROR] Failed to refresh rollups: {e}")
+            return 0
+
     async def update_daily_metrics(self):
-        """Обновляет ежедневные метрики"""
+        """Обновляет ежедневные метрики (из инкрементальных агрегатов)"""
         try:
+            await self.refresh_rollups()
+
             today = datetime.now().date()
             
-            async with aiosqlite.connect(self.db_path) as db:
-                # Получаем статистику за сегодня
+            async with self.pool.write() as db:
+                # Статистика за сегодня - строки rollup_daily_type по типам
                 cursor = await db.execute('''
                     SELECT 
-                        COUNT(*) as total,
-                        SUM(CASE WHEN success = 1 THEN 1 ELSE 0 END) as successful,
-                        SUM(CASE WHEN success = 0 THEN 1 ELSE 0 END) as failed,
-                        AVG(response_time) as avg_time,
-                        MAX(response_time) as max_time,
-                        MIN(response_time) as min_time,
-                        COUNT(DISTINCT user_id) as unique_users
-                    FROM request_metrics
-                    WHERE DATE(timestamp) = ?
-                ''', (today,))
+                        SUM(t.total) as total,
+                        SUM(t.successful) as successful,
+                        SUM(t.failed) as failed,
+                        SUM(t.sum_response_time) / SUM(t.total) as avg_time,
+                        MAX(t.max_response_time) as max_time,
+                        MIN(t.min_response_time) as min_time,
+                        (SELECT unique_users FROM rollup_daily WHERE metric_date = ?) as unique_users
+                    FROM rollup_daily_type t
+                    WHERE t.metric_date = ?
+                ''', (str(today), str(today)))
                 
                 stats = await cursor.fetchone()
                 
-                if stats and stats[0] > 0:
+                if stats and stats[0]:
                     await db.execute('''
                         INSERT OR REPLACE INTO bot_metrics
                         (metric_date, total_requests, successful_requests, failed_requests,
@@ -1811,75 +1770,71 @@ class Database:
             print(f"[ERROR] Failed to update daily metrics: {e}")
     
     async def get_metrics_summary(self, days: int = 7):
-        """Получает сводку метрик за период"""
+        """Получает сводку метрик за период (из агрегатов, ИСКЛЮЧАЯ админов)"""
         try:
-            async with aiosqlite.connect(self.db_path) as db:
+            await self.refresh_rollups()
+
+            async with self.pool.read() as db:
                 db.row_factory = aiosqlite.Row
                 
-                start_date = datetime.now() - timedelta(days=days)
+                start_date = str((datetime.now() - timedelta(days=days)).date())
                 
-                # Общая статистика НАПРЯМУЮ из request_metrics (ИСКЛЮЧАЯ админов)
+                # Общая статистика
                 cursor = await db.execute('''
                     SELECT
-                        COUNT(*) as total_requests,
-                        SUM(CASE WHEN rm.success = 1 THEN 1 ELSE 0 END) as successful_requests,
-                        SUM(CASE WHEN rm.success = 0 THEN 1 ELSE 0 END) as failed_requests,
-                        COALESCE(AVG(rm.response_time), 0) as avg_response_time,
-                        COALESCE(MAX(rm.response_time), 0) as max_response_time,
-                        COUNT(DISTINCT rm.user_id) as total_unique_users
-                    FROM request_metrics rm
-                    JOIN users u ON rm.user_id = u.telegram_id
-                    WHERE rm.timestamp >= ? AND u.role != 'admin'
+                        COALESCE(SUM(total), 0) as total_requests,
+                        COALESCE(SUM(successful), 0) as successful_requests,
+                        COALESCE(SUM(failed), 0) as failed_requests,
+                        COALESCE(SUM(sum_response_time) / SUM(total), 0) as avg_response_time,
+                        COALESCE(MAX(max_response_time), 0) as max_response_time
+                    FROM rollup_daily_type
+                    WHERE metric_date >= ?
                 ''', (start_date,))
                 
-                overall = await cursor.fetchone()
-                
-                # Средняя активность в день (уникальных пользователей) - ИСКЛЮЧАЯ админов
-                cursor_daily = await db.execute('''
-                    SELECT COUNT(DISTINCT rm.user_id) as daily_users, DATE(rm.timestamp) as metric_date
-                    FROM request_metrics rm
-                    JOIN users u ON rm.user_id = u.telegram_id
-                    WHERE rm.timestamp >= ? AND u.role != 'admin'
-                    GROUP BY DATE(rm.timestamp)
+                overall_dict = dict(await cursor.fetchone())
+
+                cursor = await db.execute('''
+                    SELECT COUNT(DISTINCT user_id) FROM rollup_daily_users
+                    WHERE metric_date >= ?
                 ''', (start_date,))
+                overall_dict['total_unique_users'] = (await cursor.fetchone())[0]
                 
-                daily_users = await cursor_daily.fetchall()
-                avg_daily_users = sum(row[0] for row in daily_users) / len(daily_users) if daily_users else 0
-                
-                # Добавляем avg_daily_users к overall
-                overall_dict = dict(overall) if overall else {}
-                overall_dict['avg_daily_users'] = avg_daily_users
+                # Средняя активность в день (уникальных пользователей)
+                cursor = await db.execute('''
+                    SELECT COALESCE(AVG(unique_users), 0) FROM rollup_daily
+                    WHERE metric_date >= ?
+                ''', (start_date,))
+                overall_dict['avg_daily_users'] = (await cursor.fetchone())[0]
                 
-                # Статистика по типам запросов (ИСКЛЮЧАЯ админов)
+                # Статистика по типам запросов
                 cursor = await db.execute('''
                     SELECT
-                        rm.request_type,
-                        COUNT(*) as count,
-                        COALESCE(AVG(rm.response_time), 0) as avg_time,
-                        SUM(CASE WHEN rm.success = 1 THEN 1 ELSE 0 END) as successful,
-                        SUM(CASE WHEN rm.has_answer = 0 THEN 1 ELSE 0 END) as no_answer,
-                        COALESCE(AVG(CASE WHEN rm.relevance_score IS NOT NULL THEN rm.relevance_score ELSE 0 END), 0) as avg_relevance
-                    FROM request_metrics rm
-                    JOIN users u ON rm.user_id = u.telegram_id
-                    WHERE DATE(rm.timestamp) >= ? AND u.role != 'admin'
-                    GROUP BY rm.request_type
+                        request_type,
+                        SUM(total) as count,
+                        COALESCE(SUM(sum_response_time) / SUM(total), 0) as avg_time,
+                        SUM(successful) as successful,
+                        SUM(no_answer) as no_answer,
+                        COALESCE(SUM(sum_relevance) / SUM(total), 0) as avg_relevance
+                    FROM rollup_daily_type
+                    WHERE metric_date >= ?
+                    GROUP BY request_type
                 ''', (start_date,))
                 
                 by_type = await cursor.fetchall()
                 
-                # Топ пользователей (ИСКЛЮЧАЯ администраторов)
+                # Топ пользователей
                 cursor = await db.execute('''
                     SELECT
                         u.name,
                         u.user_type,
                         u.client_code,
-                        COUNT(rm.id) as request_count,
-                        COALESCE(AVG(rm.response_time), 0) as avg_time,
-                        SUM(CASE WHEN rm.success = 1 THEN 1 ELSE 0 END) as successful
-                    FROM request_metrics rm
-                    JOIN users u ON rm.user_id = u.telegram_id
-                    WHERE DATE(rm.timestamp) >= ? AND u.role != 'admin'
-                    GROUP BY rm.user_id
+                        SUM(du.request_count) as request_count,
+                        COALESCE(SUM(du.sum_response_time) / SUM(du.request_count), 0) as avg_time,
+                        SUM(du.successful) as successful
+                    FROM rollup_daily_users du
+                    JOIN users u ON du.user_id = u.telegram_id
+                    WHERE du.metric_date >= ? AND u.role != 'admin'
+                    GROUP BY du.user_id
                     ORDER BY request_count DESC
                     LIMIT 10
                 ''', (start_date,))
@@ -1904,7 +1859,7 @@ class Database:
             if not end_date:
                 end_date = datetime.now()
             
-            async with aiosqlite.connect(self.db_path) as db:
+            async with self.pool.read() as db:
                 db.row_factory = aiosqlite.Row
                 
                 # Детальная информация по запросам (ИСКЛЮЧАЯ администраторов)
@@ -1945,21 +1900,12 @@ class Database:
     async def get_user_metrics(self, user_id: int, days: int = 30):
         """Получает метрики конкретного пользователя"""
         try:
-            async with aiosqlite.connect(self.db_path) as db:
+            async with self.pool.read() as db:
                 db.row_factory = aiosqlite.Row
                 
                 start_date = datetime.now() - timedelta(days=days)
                 
-                cursor = await db.execute('''
-                    SELECT 
-                        COUNT(*) as total_requests,
-                        SUM(CASE WHEN success = 1 THEN 1 ELSE 0 END) as successful_requests,
-                        AVG(response_time) as avg_response_time,
-                        SUM(CASE WHEN has_answer = 0 THEN 1 ELSE 0 END) as no_answer_count,
-                        AVG(CASE WHEN relevance_score IS NOT NULL THEN relevance_score ELSE 0 END) as avg_relevance
-                    FROM request_metrics
-                    WHERE user_id = ? AND timestamp >= ?
-                ''', (user_id, start_date))
+                cursor = await db.execute(queries.GET_USER_REQUEST_STATS, (user_id, start_date))
                 
                 stats = await cursor.fetchone()
                 
@@ -1992,10 +1938,13 @@ class Database:
     # МЕТОДЫ ДЛЯ РАСШИРЕННЫХ МЕТРИК
     # ============================================================
     
-    async def track_user_activity(self, user_id: int):
+    async def track_user_activity(self, user_id: int, count: int = 1, activity_time: datetime = None):
         """
         Отслеживает активность пользователя за день (ИСКЛЮЧАЯ админов).
         ИСПРАВЛЕНО: НЕ трекает незарегистрированных пользователей
+
+        count/activity_time - для агрегатора активности, который сбрасывает
+        несколько событий пользователя одним вызовом.
         """
         try:
             # КРИТИЧНО: Проверяем, зарегистрирован ли пользователь
@@ -2017,24 +1966,11 @@ class Database:
                 if user.get('role') == 'admin':
                     return
             
-            today = datetime.now().date()
-            current_time = datetime.now()
+            current_time = activity_time or datetime.now()
+            today = current_time.date()
             
-            # Используем timeout для предотвращения блокировки
-            async with aiosqlite.connect(self.db_path, timeout=10.0) as db:
-                await db.execute('PRAGMA journal_mode=WAL')
-                
-                await db.execute('''
-                    INSERT INTO user_activity
-                    (user_id, activity_date, request_count, last_activity)
-                    VALUES (?, ?, 1, ?)
-                    ON CONFLICT(user_id, activity_date) DO UPDATE SET
-                        request_count = request_count + 1,
-                        last_activity = excluded.last_activity
-                ''', (user_id, today, current_time))
-                
-                await db.commit()
-                print(f"[ACTIVITY] ✓ Tracked activity for user {user_id}")
+            # Счетчик за день схлопывается в памяти до пакетного сброса
+            await self.telemetry.increment('user_activity', (user_id, today), current_time, count)
         except aiosqlite.OperationalError as db_error:
             print(f"[ERROR] Database error in track_user_activity: {db_error}")
         except Exception as e:
@@ -2045,15 +1981,17 @@ class Database:
     async def start_user_session(self, user_id: int) -> int:
         """Начинает новую сессию пользователя"""
         try:
-            async with aiosqlite.connect(self.db_path) as db:
+            current_time = datetime.now()
+            async with self.pool.write() as db:
                 cursor = await db.execute('''
                     INSERT INTO user_sessions 
-                    (user_id, session_start, is_active)
-                    VALUES (?, ?, TRUE)
-                ''', (user_id, datetime.now()))
+                    (user_id, session_start, last_activity, is_active)
+                    VALUES (?, ?, ?, TRUE)
+                ''', (user_id, current_time, current_time))
                 
                 session_id = cursor.lastrowid
                 await db.commit()
+                self._active_sessions[user_id] = [session_id, current_time]
                 return session_id
         except Exception as e:
             print(f"[ERROR] Failed to start session: {e}")
@@ -2062,7 +2000,7 @@ class Database:
     async def end_user_session(self, session_id: int):
         """Завершает сессию пользователя"""
         try:
-            async with aiosqlite.connect(self.db_path) as db:
+            async with self.pool.write() as db:
                 await db.execute('''
                     UPDATE user_sessions
                     SET session_end = ?, is_active = FALSE
@@ -2070,53 +2008,58 @@ class Database:
                 ''', (datetime.now(), session_id))
                 
                 await db.commit()
+
+            for user_id, (active_id, _) in list(self._active_sessions.items()):
+                if active_id == session_id:
+                    del self._active_sessions[user_id]
         except Exception as e:
             print(f"[ERROR] Failed to end session: {e}")
     
-    async def close_inactive_sessions(self, inactivity_minutes: int = 3):
+    async def close_inactive_sessions(self, inactivity_minutes: int = SESSION_TIMEOUT_MINUTES,
+                                      owned_only: bool = False):
         """
         Закрывает сессии с неактивностью более указанного времени.
         
         ВАЖНО:
-        - Проверяет последнюю активность в request_metrics ИЛИ session_start если запросов нет
+        - Последняя активность хранится в user_sessions.last_activity
+          (один проход по частичному индексу, без подзапросов к request_metrics)
         - session_end = последняя_активность + inactivity_minutes (время на чтение)
+        - owned_only - многопроцессный режим: только сессии из памяти этого
+          воркера. Пользователь закреплен за воркером (bot/sharding.py), и
+          свежая last_activity есть только в его очереди телеметрии - чужие
+          сессии по устаревшей last_activity закрывать нельзя
         """
         try:
-            async with aiosqlite.connect(self.db_path) as db:
-                cutoff_time = datetime.now() - timedelta(minutes=inactivity_minutes)
+            # last_activity обновляется через пакетный writer - дописываем очередь
+            await self.telemetry.flush()
+
+            cutoff_time = datetime.now() - timedelta(minutes=inactivity_minutes)
+
+            async with self.pool.write() as db:
+                if owned_only:
+                    expired = [
+                        (f'+{inactivity_minutes} minutes', session_id, cutoff_time)
+                        for session_id, last_activity in self._active_sessions.values()
+                        if last_activity < cutoff_time
+                    ]
+                    cursor = await db.executemany(queries.CLOSE_INACTIVE_SESSION_BY_ID, expired)
+                else:
+                    cursor = await db.execute(
+                        queries.CLOSE_INACTIVE_SESSIONS, (f'+{inactivity_minutes} minutes', cutoff_time)
+                    )
                 
-                # Закрываем сессии, где последняя активность (или старт если нет запросов)
-                # была более N минут назад
-                cursor = await db.execute('''
-                    UPDATE user_sessions
-                    SET is_active = FALSE,
-                        session_end = datetime(
-                            COALESCE(
-                                (SELECT MAX(timestamp)
-                                 FROM request_metrics
-                                 WHERE user_id = user_sessions.user_id
-                                 AND timestamp >= user_sessions.session_start),
-                                user_sessions.session_start
-                            ),
-                            '+''' + str(inactivity_minutes) + ''' minutes'
-                        )
-                    WHERE is_active = TRUE
-                    AND COALESCE(
-                        (SELECT MAX(rm.timestamp)
-                         FROM request_metrics rm
-                         WHERE rm.user_id = user_sessions.user_id
-                         AND rm.timestamp >= user_sessions.session_start),
-                        user_sessions.session_start
-                    ) < ?
-                ''', (cutoff_time,))
-                
-                closed_count = cursor.rowcount
+                closed_count = max(cursor.rowcount, 0)
                 await db.commit()
+
+            # Синхронизируем карту активных сессий
+            for user_id, (_, last_activity) in list(self._active_sessions.items()):
+                if last_activity < cutoff_time:
+                    del self._active_sessions[user_id]
                 
-                if closed_count > 0:
-                    print(f"[SESSIONS] Closed {closed_count} inactive sessions (added {inactivity_minutes} min for reading)")
-                
-                return closed_count
+            if closed_count > 0:
+                print(f"[SESSIONS] Closed {closed_count} inactive sessions (added {inactivity_minutes} min for reading)")
+            
+            return closed_count
         except Exception as e:
             print(f"[ERROR] Failed to close inactive sessions: {e}")
             return 0
@@ -2127,60 +2070,68 @@ class Database:
         Используется после успешной обработки валидного запроса.
         """
         try:
-            async with aiosqlite.connect(self.db_path, timeout=10.0) as db:
-                await db.execute('PRAGMA journal_mode=WAL')
-                
-                current_time = datetime.now()
-                
-                # Находим активную сессию пользователя
-                cursor = await db.execute('''
-                    SELECT us.id, us.session_start,
-                           (SELECT MAX(rm.timestamp)
-                            FROM request_metrics rm
-                            WHERE rm.user_id = us.user_id
-                            AND rm.timestamp >= us.session_start) as last_request
-                    FROM user_sessions us
-                    WHERE us.user_id = ? AND us.is_active = TRUE
-                    ORDER BY us.session_start DESC
-                    LIMIT 1
-                ''', (user_id,))
-                
-                session = await cursor.fetchone()
-                
-                if session:
-                    session_id = session[0]
-                    last_request = session[2]
-                    
-                    # Закрываем сессию, устанавливая session_end = последний запрос + 3 минуты на чтение
-                    if last_request:
-                        session_end = datetime.fromisoformat(last_request) + timedelta(minutes=3)
-                    else:
-                        session_end = current_time
-                    
+            session = await self._get_active_session(user_id)
+
+            if session:
+                session_id, last_activity = session
+
+                # session_end = последняя активность + время на чтение
+                session_end = last_activity + timedelta(minutes=SESSION_TIMEOUT_MINUTES)
+
+                await self.telemetry.flush()
+                async with self.pool.write() as db:
                     await db.execute('''
                         UPDATE user_sessions
                         SET is_active = FALSE,
                             session_end = ?
                         WHERE id = ?
                     ''', (session_end, session_id))
-                    
                     await db.commit()
-                    print(f"[SESSION] ✓ Closed session {session_id} for user {user_id} (ended at {session_end})")
-                    return True
-                else:
-                    print(f"[SESSION] No active session found for user {user_id}")
-                    return False
+
+                self._active_sessions.pop(user_id, None)
+                print(f"[SESSION] ✓ Closed session {session_id} for user {user_id} (ended at {session_end})")
+                return True
+            else:
+                print(f"[SESSION] No active session found for user {user_id}")
+                return False
                     
         except Exception as e:
             print(f"[ERROR] Failed to close user session: {e}")
             import traceback
             traceback.print_exc()
             return False
+
+    async def _get_active_session(self, user_id: int):
+        """
+        Активная сессия пользователя [session_id, last_activity]: из памяти,
+        а при промахе (рестарт, закрытие фоновым проходом) - одним запросом по индексу.
+        """
+        session = self._active_sessions.get(user_id)
+        if session is not None:
+            return session
+
+        async with self.pool.read() as db:
+            cursor = await db.execute(queries.GET_ACTIVE_SESSION, (user_id,))
+            row = await cursor.fetchone()
+
+        if row is None:
+            return None
+
+        last_activity = row[1]
+        if isinstance(last_activity, str):
+            last_activity = datetime.fromisoformat(last_activity)
+        session = [row[0], last_activity]
+        self._active_sessions[user_id] = session
+        return session
     
-    async def update_session_activity(self, user_id: int):
+    async def update_session_activity(self, user_id: int, count: int = 1, activity_time: datetime = None):
         """
         Обновляет активность в текущей сессии или создает новую.
         ИСПРАВЛЕНО: НЕ создает сессии для незарегистрированных пользователей
+
+        Стоимость не зависит от объема истории: продление сессии - счетчик в
+        памяти (UPDATE по первичному ключу при пакетном сбросе), новая сессия -
+        один INSERT. Просроченные сессии закрывает фоновый проход в main.py.
         """
         try:
             # КРИТИЧНО: Проверяем, зарегистрирован ли пользователь
@@ -2193,58 +2144,35 @@ class Database:
             # Не трекаем админов
             if user.get('role') == 'admin':
                 return
-            
-            # Сначала закрываем все неактивные сессии (но не ждем долго)
-            try:
-                await asyncio.wait_for(
-                    self.close_inactive_sessions(inactivity_minutes=3),
-                    timeout=5.0
-                )
-            except asyncio.TimeoutError:
-                print(f"[SESSION] Timeout closing inactive sessions, proceeding anyway")
-            except Exception as e:
-                print(f"[SESSION] Error closing inactive sessions: {e}")
-            
-            # Используем timeout для предотвращения блокировки
-            async with aiosqlite.connect(self.db_path, timeout=10.0) as db:
-                await db.execute('PRAGMA journal_mode=WAL')
-                
-                current_time = datetime.now()
-                three_minutes_ago = current_time - timedelta(minutes=3)
-                
-                # Проверяем, есть ли активная сессия с последней активностью менее 3 минут назад
-                cursor = await db.execute('''
-                    SELECT us.id, us.session_start, MAX(rm.timestamp) as last_activity
-                    FROM user_sessions us
-                    LEFT JOIN request_metrics rm ON rm.user_id = us.user_id
-                        AND rm.timestamp >= us.session_start
-                    WHERE us.user_id = ? AND us.is_active = TRUE
-                    GROUP BY us.id
-                    HAVING last_activity >= ? OR last_activity IS NULL
-                    ORDER BY us.session_start DESC
-                    LIMIT 1
-                ''', (user_id, three_minutes_ago))
-                
-                session = await cursor.fetchone()
-                
+
+            current_time = activity_time or datetime.now()
+            session = await self._get_active_session(user_id)
+
+            if session and current_time - session[1] < timedelta(minutes=SESSION_TIMEOUT_MINUTES):
+                # Продлеваем текущую сессию
+                session[1] = current_time
+                await self.telemetry.increment('session_activity', (session[0],), current_time, count)
+                return
+
+            async with self.pool.write() as db:
                 if session:
-                    # Обновляем существующую сессию
+                    # Сессия просрочена, но фоновый проход ее еще не закрыл
                     await db.execute('''
                         UPDATE user_sessions
-                        SET request_count = request_count + 1
-                        WHERE id = ?
-                    ''', (session[0],))
-                    print(f"[SESSION] ✓ Updated session {session[0]} for user {user_id}")
-                else:
-                    # Создаем новую сессию (старые уже закрыты выше)
-                    await db.execute('''
-                        INSERT INTO user_sessions
-                        (user_id, session_start, request_count, is_active)
-                        VALUES (?, ?, 1, TRUE)
-                    ''', (user_id, current_time))
-                    print(f"[SESSION] ✓ Created new session for user {user_id}")
-                
+                        SET is_active = FALSE,
+                            session_end = ?
+                        WHERE id = ? AND is_active = TRUE
+                    ''', (session[1] + timedelta(minutes=SESSION_TIMEOUT_MINUTES), session[0]))
+
+                cursor = await db.execute('''
+                    INSERT INTO user_sessions
+                    (user_id, session_start, last_activity, request_count, is_active)
+                    VALUES (?, ?, ?, ?, TRUE)
+                ''', (user_id, current_time, current_time, count))
                 await db.commit()
+
+                self._active_sessions[user_id] = [cursor.lastrowid, current_time]
+                print(f"[SESSION] ✓ Created new session {cursor.lastrowid} for user {user_id}")
         except aiosqlite.OperationalError as db_error:
             print(f"[ERROR] Database error in update_session_activity: {db_error}")
             import traceback
@@ -2255,25 +2183,24 @@ class Database:
             traceback.print_exc()
     
     async def get_dau_metrics(self, days: int = 30):
-        """Получает метрики Daily Active Users - ИСКЛЮЧАЯ администраторов"""
+        """Получает метрики Daily Active Users - ИСКЛЮЧАЯ администраторов (из агрегатов)"""
         try:
-            async with aiosqlite.connect(self.db_path) as db:
+            await self.refresh_rollups()
+
+            async with self.pool.read() as db:
                 db.row_factory = aiosqlite.Row
                 
-                start_date = datetime.now() - timedelta(days=days)
+                start_date = str((datetime.now() - timedelta(days=days)).date())
                 
-                # Считаем запросы ТОЛЬКО от не-админов
                 cursor = await db.execute('''
                     SELECT
-                        DATE(rm.timestamp) as activity_date,
-                        COUNT(DISTINCT rm.user_id) as dau,
-                        COUNT(*) as total_requests,
-                        CAST(COUNT(*) AS REAL) / COUNT(DISTINCT rm.user_id) as avg_requests_per_user
-                    FROM request_metrics rm
-                    JOIN users u ON rm.user_id = u.telegram_id
-                    WHERE rm.timestamp >= ? AND u.role != 'admin'
-                    GROUP BY DATE(rm.timestamp)
-                    ORDER BY activity_date DESC
+                        metric_date as activity_date,
+                        unique_users as dau,
+                        total_requests,
+                        CAST(total_requests AS REAL) / unique_users as avg_requests_per_user
+                    FROM rollup_daily
+                    WHERE metric_date >= ? AND unique_users > 0
+                    ORDER BY metric_date DESC
                 ''', (start_date,))
                 
                 return [dict(row) for row in await cursor.fetchall()]
@@ -2282,74 +2209,30 @@ class Database:
             return []
     
     async def get_retention_metrics(self):
-        """Получает метрики возвратности пользователей (ИСКЛЮЧАЯ администраторов)"""
+        """Получает метрики возвратности пользователей (ИСКЛЮЧАЯ администраторов, из агрегатов)"""
         try:
-            async with aiosqlite.connect(self.db_path) as db:
+            await self.refresh_rollups()
+
+            async with self.pool.read() as db:
                 db.row_factory = aiosqlite.Row
                 
                 today = datetime.now().date()
-                
-                # Пользователи активные сегодня (ИСКЛЮЧАЯ админов)
-                cursor = await db.execute('''
-                    SELECT COUNT(DISTINCT ua.user_id) as today_users
-                    FROM user_activity ua
-                    JOIN users u ON ua.user_id = u.telegram_id
-                    WHERE ua.activity_date = ? AND u.role != 'admin'
-                ''', (today,))
-                today_users = (await cursor.fetchone())['today_users']
-                
-                # Возвратность за 1 день
                 yesterday = today - timedelta(days=1)
+
                 cursor = await db.execute('''
-                    SELECT COUNT(DISTINCT ua1.user_id) as returned
-                    FROM user_activity ua1
-                    JOIN users u ON ua1.user_id = u.telegram_id
-                    WHERE ua1.activity_date = ? AND u.role != 'admin'
-                    AND EXISTS (
-                        SELECT 1 FROM user_activity ua2
-                        WHERE ua2.user_id = ua1.user_id
-                        AND ua2.activity_date = ?
-                    )
-                ''', (today, yesterday))
-                returned_1d = (await cursor.fetchone())['returned']
-                
-                # Возвратность за 7 дней
-                week_ago = today - timedelta(days=7)
-                cursor = await db.execute('''
-                    SELECT COUNT(DISTINCT ua1.user_id) as returned
-                    FROM user_activity ua1
-                    JOIN users u ON ua1.user_id = u.telegram_id
-                    WHERE ua1.activity_date = ? AND u.role != 'admin'
-                    AND EXISTS (
-                        SELECT 1 FROM user_activity ua2
-                        WHERE ua2.user_id = ua1.user_id
-                        AND ua2.activity_date BETWEEN ? AND ?
-                    )
-                ''', (today, week_ago, yesterday))
-                returned_7d = (await cursor.fetchone())['returned']
-                
-                # Возвратность за 30 дней
-                month_ago = today - timedelta(days=30)
-                cursor = await db.execute('''
-                    SELECT COUNT(DISTINCT ua1.user_id) as returned
-                    FROM user_activity ua1
-                    JOIN users u ON ua1.user_id = u.telegram_id
-                    WHERE ua1.activity_date = ? AND u.role != 'admin'
-                    AND EXISTS (
-                        SELECT 1 FROM user_activity ua2
-                        WHERE ua2.user_id = ua1.user_id
-                        AND ua2.activity_date BETWEEN ? AND ?
-                    )
-                ''', (today, month_ago, yesterday))
-                returned_30d = (await cursor.fetchone())['returned']
-                
-                cursor = await db.execute('''
-                    SELECT COUNT(DISTINCT ua.user_id) as yesterday_users
-                    FROM user_activity ua
-                    JOIN users u ON ua.user_id = u.telegram_id
-                    WHERE ua.activity_date = ? AND u.role != 'admin'
-                ''', (yesterday,))
-                yesterday_users = (await cursor.fetchone())['yesterday_users']
+                    SELECT metric_date, active_users, returned_1d, returned_7d, returned_30d
+                    FROM rollup_retention
+                    WHERE metric_date IN (?, ?)
+                ''', (str(today), str(yesterday)))
+                rows = {str(row['metric_date']): dict(row) for row in await cursor.fetchall()}
+
+                empty = {'active_users': 0, 'returned_1d': 0, 'returned_7d': 0, 'returned_30d': 0}
+                today_row = rows.get(str(today), empty)
+                today_users = today_row['active_users']
+                yesterday_users = rows.get(str(yesterday), empty)['active_users']
+                returned_1d = today_row['returned_1d']
+                returned_7d = today_row['returned_7d']
+                returned_30d = today_row['returned_30d']
                 
                 return {
                     'today_users': today_users,
@@ -2370,7 +2253,7 @@ class Database:
         ИСПРАВЛЕНО: считает общую длительность от session_start до session_end (включает время на чтение).
         """
         try:
-            async with aiosqlite.connect(self.db_path) as db:
+            async with self.pool.read() as db:
                 db.row_factory = aiosqlite.Row
                 
                 start_date = datetime.now() - timedelta(days=days)
@@ -2415,18 +2298,18 @@ class Database:
             disk = psutil.disk_usage('/').percent
             
             # Подсчитываем активные сессии
-            async with aiosqlite.connect(self.db_path) as db:
+            async with self.pool.write() as db:
                 cursor = await db.execute('''
                     SELECT COUNT(*) FROM user_sessions
                     WHERE is_active = TRUE
                 ''')
                 active_sessions = (await cursor.fetchone())[0]
                 
-                # Подсчитываем ошибки за сегодня
+                # Подсчитываем ошибки за сегодня (из агрегатов)
                 cursor = await db.execute('''
-                    SELECT COUNT(*) FROM request_metrics
-                    WHERE DATE(timestamp) = ? AND success = FALSE
-                ''', (today,))
+                    SELECT COALESCE(SUM(failed), 0) FROM rollup_daily_type
+                    WHERE metric_date = ?
+                ''', (str(today),))
                 error_count = (await cursor.fetchone())[0]
                 
                 # Сохраняем метрики
@@ -2442,29 +2325,31 @@ class Database:
             print(f"[ERROR] Failed to update system metrics: {e}")
     
     async def update_quality_metrics(self):
-        """Обновляет метрики качества работы бота"""
+        """Обновляет метрики качества работы бота (из инкрементальных агрегатов)"""
         try:
+            await self.refresh_rollups()
+
             today = datetime.now().date()
             
-            async with aiosqlite.connect(self.db_path) as db:
-                # Подсчитываем метрики за сегодня ТОЛЬКО для валидных типов запросов
+            async with self.pool.write() as db:
+                # Метрики за сегодня ТОЛЬКО для валидных типов запросов
                 cursor = await db.execute('''
                     SELECT
-                        COUNT(*) as total,
-                        SUM(CASE WHEN success = TRUE AND has_answer = TRUE THEN 1 ELSE 0 END) as correct,
-                        SUM(CASE WHEN success = FALSE THEN 1 ELSE 0 END) as incorrect,
-                        SUM(CASE WHEN has_answer = FALSE THEN 1 ELSE 0 END) as no_answer,
-                        SUM(CASE WHEN request_type = 'code_search' THEN 1 ELSE 0 END) as code_search,
-                        SUM(CASE WHEN request_type = 'name_search' THEN 1 ELSE 0 END) as name_search,
-                        SUM(CASE WHEN request_type = 'general' THEN 1 ELSE 0 END) as general_question
-                    FROM request_metrics
-                    WHERE DATE(timestamp) = ?
+                        SUM(total) as total,
+                        SUM(correct) as correct,
+                        SUM(failed) as incorrect,
+                        SUM(no_answer) as no_answer,
+                        SUM(CASE WHEN request_type = 'code_search' THEN total ELSE 0 END) as code_search,
+                        SUM(CASE WHEN request_type = 'name_search' THEN total ELSE 0 END) as name_search,
+                        SUM(CASE WHEN request_type = 'general' THEN total ELSE 0 END) as general_question
+                    FROM rollup_daily_type
+                    WHERE metric_date = ?
                     AND request_type IN ('general', 'code_search', 'name_search')
-                ''', (today,))
+                ''', (str(today),))
                 
                 stats = await cursor.fetchone()
                 
-                if stats and stats[0] > 0:
+                if stats and stats[0]:
                     await db.execute('''
                         INSERT OR REPLACE INTO quality_metrics
                         (metric_date, total_queries, correct_answers, incorrect_answers,
@@ -2481,27 +2366,27 @@ class Database:
     async def get_quality_metrics_summary(self, days: int = 7):
         """Получает сводку по метрикам качества - ТОЛЬКО валидные типы запросов"""
         try:
-            async with aiosqlite.connect(self.db_path) as db:
+            await self.refresh_rollups()
+
+            async with self.pool.read() as db:
                 db.row_factory = aiosqlite.Row
                 
                 start_date = datetime.now().date() - timedelta(days=days)
                 
-                # Считаем напрямую из request_metrics с фильтрацией типов (ИСКЛЮЧАЯ админов)
+                # Считаем по агрегатам с фильтрацией типов (админы отсечены при агрегации)
                 cursor = await db.execute('''
                     SELECT
-                        COUNT(*) as total,
-                        SUM(CASE WHEN rm.success = TRUE AND rm.has_answer = TRUE THEN 1 ELSE 0 END) as correct,
-                        SUM(CASE WHEN rm.success = FALSE THEN 1 ELSE 0 END) as incorrect,
-                        SUM(CASE WHEN rm.has_answer = FALSE THEN 1 ELSE 0 END) as no_answer,
-                        SUM(CASE WHEN rm.request_type = 'code_search' THEN 1 ELSE 0 END) as code_searches,
-                        SUM(CASE WHEN rm.request_type = 'name_search' THEN 1 ELSE 0 END) as name_searches,
-                        SUM(CASE WHEN rm.request_type = 'general' THEN 1 ELSE 0 END) as general_questions
-                    FROM request_metrics rm
-                    JOIN users u ON rm.user_id = u.telegram_id
-                    WHERE DATE(rm.timestamp) >= ?
-                    AND rm.request_type IN ('general', 'code_search', 'name_search')
-                    AND u.role != 'admin'
-                ''', (start_date,))
+                        COALESCE(SUM(total), 0) as total,
+                        COALESCE(SUM(correct), 0) as correct,
+                        COALESCE(SUM(failed), 0) as incorrect,
+                        COALESCE(SUM(no_answer), 0) as no_answer,
+                        COALESCE(SUM(CASE WHEN request_type = 'code_search' THEN total ELSE 0 END), 0) as code_searches,
+                        COALESCE(SUM(CASE WHEN request_type = 'name_search' THEN total ELSE 0 END), 0) as name_searches,
+                        COALESCE(SUM(CASE WHEN request_type = 'general' THEN total ELSE 0 END), 0) as general_questions
+                    FROM rollup_daily_type
+                    WHERE metric_date >= ?
+                    AND request_type IN ('general', 'code_search', 'name_search')
+                ''', (str(start_date),))
                 
                 result = dict(await cursor.fetchone())
                 
@@ -2539,7 +2424,7 @@ class Database:
     async def _get_latest_system_metrics(self):
         """Получает последние системные метрики"""
         try:
-            async with aiosqlite.connect(self.db_path) as db:
+            async with self.pool.read() as db:
                 db.row_factory = aiosqlite.Row
                 
                 cursor = await db.execute('''
@@ -2560,36 +2445,55 @@ class Database:
             if timestamp is None:
                 timestamp = datetime.now()
                 
-            async with aiosqlite.connect(self.db_path) as db:
+            async with self.pool.write() as db:
                 await db.execute('''
                     INSERT INTO response_ratings 
                     (user_id, chat_history_id, rating, question, response, timestamp)
                     VALUES (?, ?, ?, ?, ?, ?)
                 ''', (user_id, chat_history_id, rating, question[:500], response[:1000], timestamp))
                 await db.commit()
-                return True
+
+            # Плохо оцененный ответ больше не отдаем из семантического кэша
+            if rating <= LOW_RATING_THRESHOLD:
+                answer_cache.invalidate_rated(question, response)
+            return True
         except Exception as e:
             print(f"[ERROR] Failed to save rating: {e}")
             return False
 
+    async def sync_low_ratings(self) -> int:
+        """
+        Убирает из семантического кэша ответы, плохо оцененные в других
+        воркерах (многопроцессный режим); возвращает число новых оценок.
+        """
+        async with self.pool.read() as db:
+            if self._low_ratings_synced_id is None:
+                # Кэш процесса пуст при старте - учитываем только новые оценки
+                cursor = await db.execute('SELECT COALESCE(MAX(id), 0) FROM response_ratings')
+                self._low_ratings_synced_id = (await cursor.fetchone())[0]
+                return 0
+            cursor = await db.execute('''
+                SELECT id, question, response FROM response_ratings
+                WHERE id > ? AND rating <= ?
+                ORDER BY id
+            ''', (self._low_ratings_synced_id, LOW_RATING_THRESHOLD))
+            rows = await cursor.fetchall()
+
+        for rating_id, question, response in rows:
+            answer_cache.invalidate_rated(question, response)
+            self._low_ratings_synced_id = rating_id
+        return len(rows)
+
     async def get_rating_stats(self, days: int = 30):
         """Получает статистику оценок"""
         try:
-            async with aiosqlite.connect(self.db_path) as db:
+            async with self.pool.read() as db:
                 db.row_factory = aiosqlite.Row
                 
                 start_date = datetime.now() - timedelta(days=days)
                 
                 # Общая статистика
-                cursor = await db.execute('''
-                    SELECT
-                        COUNT(*) as total_ratings,
-                        AVG(rating) as avg_rating,
-                        COUNT(CASE WHEN rating <= 3 THEN 1 END) as low_ratings,
-                        COUNT(CASE WHEN rating >= 4 THEN 1 END) as high_ratings
-                    FROM response_ratings
-                    WHERE timestamp >= ?
-                ''', (start_date,))
+                cursor = await db.execute(queries.GET_RATING_STATS, (start_date,))
                 
                 stats = await cursor.fetchone()
                 return dict(stats) if stats else None
@@ -2600,7 +2504,7 @@ class Database:
     async def get_average_user_rating(self, days: int = 30):
         """Получает средний рейтинг от пользователей за период"""
         try:
-            async with aiosqlite.connect(self.db_path) as db:
+            async with self.pool.read() as db:
                 start_date = datetime.now() - timedelta(days=days)
                 
                 cursor = await db.execute('''
@@ -2625,7 +2529,7 @@ class Database:
         активное время - только между валидными запросами.
         """
         try:
-            async with aiosqlite.connect(self.db_path) as db:
+            async with self.pool.read() as db:
                 db.row_factory = aiosqlite.Row
                 
                 start_date = datetime.now() - timedelta(days=days)
@@ -2792,7 +2696,7 @@ class Database:
     
     async def ensure_gallery_table(self):
         """Создает таблицу галереи если её нет"""
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self.pool.write() as db:
             await db.execute('''
                 CREATE TABLE IF NOT EXISTS gallery_items (
                     id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -2811,7 +2715,7 @@ class Database:
         """Добавляет элемент в галерею"""
         try:
             await self.ensure_gallery_table()
-            async with aiosqlite.connect(self.db_path) as db:
+            async with self.pool.write() as db:
                 cursor = await db.execute('''
                     INSERT INTO gallery_items (title, file_id, description, added_by)
                     VALUES (?, ?, ?, ?)
@@ -2826,7 +2730,7 @@ class Database:
         """Получает все активные элементы галереи"""
         try:
             await self.ensure_gallery_table()
-            async with aiosqlite.connect(self.db_path) as db:
+            async with self.pool.read() as db:
                 db.row_factory = aiosqlite.Row
                 cursor = await db.execute('''
                     SELECT * FROM gallery_items 
@@ -2843,7 +2747,7 @@ class Database:
         """Получает конкретный элемент галереи"""
         try:
             await self.ensure_gallery_table()
-            async with aiosqlite.connect(self.db_path) as db:
+            async with self.pool.read() as db:
                 db.row_factory = aiosqlite.Row
                 cursor = await db.execute(
                     'SELECT * FROM gallery_items WHERE id = ? AND is_active = TRUE',
@@ -2859,7 +2763,7 @@ class Database:
         """Деактивирует элемент галереи"""
         try:
             await self.ensure_gallery_table()
-            async with aiosqlite.connect(self.db_path) as db:
+            async with self.pool.write() as db:
                 await db.execute(
                     'UPDATE gallery_items SET is_active = FALSE WHERE id = ?',
                     (item_id,)
@@ -2876,7 +2780,7 @@ class Database:
     
     async def ensure_blanks_table(self):
         """Создает таблицу бланков если её нет"""
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self.pool.write() as db:
             await db.execute('''
                 CREATE TABLE IF NOT EXISTS blank_documents (
                     id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -2895,7 +2799,7 @@ class Database:
         """Добавляет документ бланка"""
         try:
             await self.ensure_blanks_table()
-            async with aiosqlite.connect(self.db_path) as db:
+            async with self.pool.write() as db:
                 cursor = await db.execute('''
                     INSERT INTO blank_documents (title, file_id, description, added_by)
                     VALUES (?, ?, ?, ?)
@@ -2910,7 +2814,7 @@ class Database:
         """Получает все активные документы бланков"""
         try:
             await self.ensure_blanks_table()
-            async with aiosqlite.connect(self.db_path) as db:
+            async with self.pool.read() as db:
                 db.row_factory = aiosqlite.Row
                 cursor = await db.execute('''
                     SELECT * FROM blank_documents
@@ -2927,7 +2831,7 @@ class Database:
         """Деактивирует документ бланка"""
         try:
             await self.ensure_blanks_table()
-            async with aiosqlite.connect(self.db_path) as db:
+            async with self.pool.write() as db:
                 await db.execute(
                     'UPDATE blank_documents SET is_active = FALSE WHERE id = ?',
                     (blank_id,)
@@ -2942,7 +2846,7 @@ class Database:
         """Получает конкретный документ бланка"""
         try:
             await self.ensure_blanks_table()
-            async with aiosqlite.connect(self.db_path) as db:
+            async with self.pool.read() as db:
                 db.row_factory = aiosqlite.Row
                 cursor = await db.execute(
                     'SELECT * FROM blank_documents WHERE id = ? AND is_active = TRUE',
@@ -2959,7 +2863,7 @@ class Database:
     async def get_blank_file_id(self, file_name: str):
         """Получает file_id бланка из базы данных"""
         try:
-            async with aiosqlite.connect(self.db_path) as db:
+            async with self.pool.read() as db:
                 cursor = await db.execute(
                     "SELECT file_id FROM blank_files WHERE file_name = ?",
                     (file_name,)
@@ -2970,14 +2874,27 @@ class Database:
             print(f"[ERROR] Failed to get blank file_id: {e}")
             return None
 
-    async def save_blank_file_id(self, file_name: str, file_id: str):
-        """Сохраняет file_id бланка в базу данных"""
+    async def get_blank_file_ids(self) -> list:
+        """Все сохраненные file_id бланков (для кэша доставки файлов)"""
+        try:
+            async with self.pool.read() as db:
+                db.row_factory = aiosqlite.Row
+                cursor = await db.execute(
+                    "SELECT file_name, file_id, content_hash FROM blank_files"
+                )
+                return [dict(row) for row in await cursor.fetchall()]
+        except Exception as e:
+            print(f"[ERROR] Failed to get blank file_ids: {e}")
+            return []
+
+    async def save_blank_file_id(self, file_name: str, file_id: str, content_hash: str = None):
+        """Сохраняет file_id бланка (и хэш содержимого файла) в базу данных"""
         try:
-            async with aiosqlite.connect(self.db_path) as db:
+            async with self.pool.write() as db:
                 await db.execute('''
-                    INSERT OR REPLACE INTO blank_files (file_name, file_id, created_at)
-                    VALUES (?, ?, ?)
-                ''', (file_name, file_id, datetime.now()))
+                    INSERT OR REPLACE INTO blank_files (file_name, file_id, content_hash, created_at)
+                    VALUES (?, ?, ?, ?)
+                ''', (file_name, file_id, content_hash, datetime.now()))
                 await db.commit()
                 return True
         except Exception as e:
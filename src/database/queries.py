@@ -0,0 +1,183 @@
+"""
+SQL горячих запросов.
+
+Один и тот же текст выполняет код (models.py, rollups.py, broadcasts.py,
+fsm_storage.py) и проверяет check_query_plans.py через
+migrations.HOT_QUERIES - проверяемый план не расходится с настоящим.
+Меняя запрос, меняйте его здесь; новый горячий запрос - сюда же и в
+HOT_QUERIES.
+"""
+
+# ============================================================
+# ПОЛЬЗОВАТЕЛИ И ПОИСК
+# ============================================================
+
+GET_USER = 'SELECT * FROM users WHERE telegram_id = ?'
+
+GET_RECENT_SEARCHES = '''
+    SELECT search_query, found_test_code, search_type, success, created_at
+    FROM search_history
+    WHERE user_id = ? AND success = TRUE
+    ORDER BY created_at DESC
+    LIMIT ?
+'''
+
+GET_USER_SEARCH_TOTALS = '''
+    SELECT COUNT(*) as total,
+        SUM(CASE WHEN success = TRUE THEN 1 ELSE 0 END) as successful,
+        COUNT(DISTINCT found_test_code) as unique_tests
+    FROM search_history
+    WHERE user_id = ?
+'''
+
+GET_USER_MOST_FREQUENT_TEST = '''
+    SELECT test_code, test_name, frequency
+    FROM user_frequent_tests
+    WHERE user_id = ?
+    ORDER BY frequency DESC
+    LIMIT 1
+'''
+
+CLEANUP_OLD_SEARCH_HISTORY = '''
+    DELETE FROM search_history
+    WHERE created_at < ?
+'''
+
+GET_USER_FREQUENT_TESTS = '''
+    SELECT test_code, test_name, frequency, last_accessed
+    FROM user_frequent_tests
+    WHERE user_id = ?
+    ORDER BY frequency DESC, last_accessed DESC
+    LIMIT ?
+'''
+
+GET_USER_RELATED_TESTS = '''
+    SELECT
+        CASE
+            WHEN test_code_1 = ? THEN test_code_2
+            ELSE test_code_1
+        END as related_code,
+        correlation_count
+    FROM related_tests
+    WHERE user_id = ? AND (test_code_1 = ? OR test_code_2 = ?)
+    ORDER BY correlation_count DESC, last_correlation DESC
+    LIMIT ?
+'''
+
+# ============================================================
+# ОПРОСЫ
+# ============================================================
+
+CHECK_USER_POLL_PARTICIPATION = "SELECT COUNT(*) FROM poll_responses WHERE user_id = ? AND poll_id = ?"
+
+GET_POLL_QUESTIONS = '''
+    SELECT id, question_text, question_type, options
+    FROM poll_questions
+    WHERE poll_id = ?
+    ORDER BY question_order
+'''
+
+GET_POLL_TOP_ANSWER = '''
+    SELECT answer, COUNT(*) as cnt
+    FROM poll_responses
+    WHERE question_id = ?
+    GROUP BY answer
+    ORDER BY cnt DESC
+    LIMIT 1
+'''
+
+# ============================================================
+# ПАМЯТЬ ДИАЛОГА
+# ============================================================
+
+GET_BUFFER = '''
+    SELECT content FROM conversation_memory
+    WHERE user_id = ? AND type = 'buffer'
+    ORDER BY timestamp
+'''
+
+GET_LATEST_SUMMARY = '''
+    SELECT content FROM conversation_memory
+    WHERE user_id = ? AND type = 'summary'
+    ORDER BY timestamp DESC
+    LIMIT 1
+'''
+
+# ============================================================
+# СЕССИИ И МЕТРИКИ
+# ============================================================
+
+GET_ACTIVE_SESSION = '''
+    SELECT id, COALESCE(last_activity, session_start)
+    FROM user_sessions
+    WHERE user_id = ? AND is_active = TRUE
+    ORDER BY session_start DESC
+    LIMIT 1
+'''
+
+CLOSE_INACTIVE_SESSIONS = '''
+    UPDATE user_sessions
+    SET is_active = FALSE,
+        session_end = datetime(last_activity, ?)
+    WHERE is_active = TRUE
+    AND last_activity < ?
+'''
+
+CLOSE_INACTIVE_SESSION_BY_ID = '''
+    UPDATE user_sessions
+    SET is_active = FALSE,
+        session_end = datetime(last_activity, ?)
+    WHERE id = ? AND is_active = TRUE
+    AND last_activity < ?
+'''
+
+GET_USER_REQUEST_STATS = '''
+    SELECT
+        COUNT(*) as total_requests,
+        SUM(CASE WHEN success = 1 THEN 1 ELSE 0 END) as successful_requests,
+        AVG(response_time) as avg_response_time,
+        SUM(CASE WHEN has_answer = 0 THEN 1 ELSE 0 END) as no_answer_count,
+        AVG(CASE WHEN relevance_score IS NOT NULL THEN relevance_score ELSE 0 END) as avg_relevance
+    FROM request_metrics
+    WHERE user_id = ? AND timestamp >= ?
+'''
+
+GET_RATING_STATS = '''
+    SELECT
+        COUNT(*) as total_ratings,
+        AVG(rating) as avg_rating,
+        COUNT(CASE WHEN rating <= 3 THEN 1 END) as low_ratings,
+        COUNT(CASE WHEN rating >= 4 THEN 1 END) as high_ratings
+    FROM response_ratings
+    WHERE timestamp >= ?
+'''
+
+ROLLUP_REQUEST_METRICS_BATCH = '''
+    SELECT rm.id, rm.user_id, rm.request_type, rm.response_time, rm.success,
+           rm.has_answer, rm.relevance_score, rm.timestamp, u.role
+    FROM request_metrics rm
+    LEFT JOIN users u ON u.telegram_id = rm.user_id
+    WHERE rm.id > ?
+    ORDER BY rm.id
+    LIMIT ?
+'''
+
+ROLLUP_USER_ACTIVITY_BATCH = '''
+    SELECT ua.id, ua.user_id, ua.activity_date, u.role
+    FROM user_activity ua
+    LEFT JOIN users u ON u.telegram_id = ua.user_id
+    WHERE ua.id > ?
+    ORDER BY ua.id
+    LIMIT ?
+'''
+
+# ============================================================
+# РАССЫЛКИ И FSM
+# ============================================================
+
+GET_BROADCAST_PENDING_RECIPIENTS = '''
+    SELECT user_id FROM broadcast_recipients
+    WHERE broadcast_id = ? AND status = 'pending'
+'''
+
+DELETE_EXPIRED_FSM_STATES = 'DELETE FROM fsm_storage WHERE updated_at < ?'
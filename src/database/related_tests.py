@@ -0,0 +1,274 @@
+"""
+Глобальные рекомендации "часто смотрят вместе" для тестов.
+
+Фоновая задача (rebuild) собирает разреженную матрицу совместных
+просмотров из related_tests (пары от всех пользователей) и
+search_history (последовательные найденные тесты одного пользователя
+в пределах окна), нормирует веса и сохраняет top-N соседей каждого
+теста в test_recommendations. Опционально к ним подмешиваются ближайшие
+соседи по эмбеддингам каталога (RELATED_TESTS_KNN_WEIGHT > 0).
+
+Чтение после показа теста - обращение к словарю в памяти,
+без запросов к БД.
+"""
+import asyncio
+import logging
+import math
+import os
+import time
+from collections import defaultdict
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+RELATED_TESTS_TOP_N = 5
+HISTORY_WINDOW_DAYS = 180  # Глубина search_history для матрицы
+HISTORY_PAIR_MINUTES = 30  # Соседние находки дальше этого - разные задачи
+HISTORY_WEIGHT = 0.5  # Вес пары из search_history относительно related_tests
+KNN_NEIGHBORS = 10
+KNN_WEIGHT = float(os.getenv('RELATED_TESTS_KNN_WEIGHT', 0))  # 0 - без эмбеддингов
+
+
+class RelatedTestsIndex:
+    def __init__(self, pool, top_n: int = RELATED_TESTS_TOP_N):
+        self.pool = pool
+        self.top_n = top_n
+        self._related: Dict[str, List[Tuple[str, float]]] = {}  # КОД -> [(КОД, score)]
+        self._rebuild_lock = asyncio.Lock()
+        self.loaded = False
+        self.rebuilds = 0
+        self.pairs = 0
+        self.last_rebuild_ms = 0.0
+        self.last_rebuild_at: Optional[datetime] = None
+
+    # ============================================================
+    # ЧТЕНИЕ
+    # ============================================================
+
+    def get_related(self, code: str, limit: Optional[int] = None) -> List[Tuple[str, float]]:
+        """Соседи теста [(КОД, score)] по убыванию score"""
+        related = self._related.get(str(code).upper(), [])
+        return related[:limit] if limit else list(related)
+
+    async def load(self):
+        """Загружает сохраненные рекомендации (до первой пересборки)"""
+        async with self.pool.read() as db:
+            cursor = await db.execute('''
+                SELECT test_code, related_code, score
+                FROM test_recommendations
+                ORDER BY test_code, rank
+            ''')
+            rows = await cursor.fetchall()
+
+        related = defaultdict(list)
+        for test_code, related_code, score in rows:
+            related[test_code].append((related_code, score))
+        self._related = dict(related)
+        self.loaded = True
+        return len(self._related)
+
+    # ============================================================
+    # ПЕРЕСБОРКА
+    # ============================================================
+
+    async def rebuild(self, catalog_index=None) -> int:
+        """Пересчитывает матрицу и top-N; возвращает число тестов с рекомендациями"""
+        async with self._rebuild_lock:
+            started = time.monotonic()
+            related_rows, history_rows = await self._read_sources()
+
+            embeddings = None
+            if KNN_WEIGHT > 0 and catalog_index is not None:
+                try:
+                    embeddings = await asyncio.to_thread(self._load_embeddings, catalog_index)
+                except Exception as e:
+                    logger.error(f"[RELATED] Embeddings unavailable, co-occurrence only: {e}")
+
+            catalog_codes = None
+            if catalog_index is not None:
+                try:
+                    catalog_codes = await asyncio.to_thread(catalog_index.codes)
+                except Exception as e:
+                    logger.error(f"[RELATED] Catalog unavailable, codes not filtered: {e}")
+
+            related, pairs = await asyncio.to_thread(
+                self._compute, related_rows, history_rows, embeddings, catalog_codes
+            )
+            await self._store(related)
+
+            self._related = related
+            self.loaded = True
+            self.pairs = pairs
+            self.rebuilds += 1
+            self.last_rebuild_at = datetime.now()
+            self.last_rebuild_ms = (time.monotonic() - started) * 1000
+            logger.info(
+                f"[RELATED] Rebuilt: {len(related)} tests, {pairs} pairs "
+                f"in {self.last_rebuild_ms:.0f} ms"
+            )
+            return len(related)
+
+    async def _read_sources(self):
+        since = datetime.now() - timedelta(days=HISTORY_WINDOW_DAYS)
+        async with self.pool.read() as db:
+            # Пара засчитывается один раз на пользователя (без накрутки одним человеком)
+            cursor = await db.execute('''
+                SELECT UPPER(test_code_1), UPPER(test_code_2), COUNT(DISTINCT user_id)
+                FROM related_tests
+                WHERE test_code_1 != test_code_2
+                GROUP BY UPPER(test_code_1), UPPER(test_code_2)
+            ''')
+            related_rows = await cursor.fetchall()
+
+            cursor = await db.execute('''
+                SELECT user_id, UPPER(found_test_code), created_at
+                FROM search_history
+                WHERE created_at >= ?
+                  AND success = TRUE
+                  AND found_test_code IS NOT NULL AND found_test_code != ''
+                ORDER BY user_id, created_at
+            ''', (since,))
+            history_rows = await cursor.fetchall()
+        return related_rows, history_rows
+
+    @staticmethod
+    def _load_embeddings(catalog_index):
+        """(коды, матрица эмбеддингов) - первый документ каждого теста"""
+        import numpy as np
+
+        store = catalog_index.processor.get_vector_store()
+        data = store.get(include=["metadatas", "embeddings"])
+        codes = []
+        vectors = []
+        seen = set()
+        for metadata, vector in zip(data.get('metadatas') or [], data.get('embeddings') or []):
+            code = str((metadata or {}).get('test_code', '')).upper()
+            if not code or code in seen or vector is None:
+                continue
+            seen.add(code)
+            codes.append(code)
+            vectors.append(vector)
+        if not codes:
+            return None
+        matrix = np.asarray(vectors, dtype=np.float32)
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        return codes, matrix / norms
+
+    @staticmethod
+    def _knn(embeddings, k: int, block: int = 512) -> Dict[str, List[Tuple[str, float]]]:
+        """k ближайших соседей по косинусной близости (блоками строк)"""
+        import numpy as np
+
+        codes, matrix = embeddings
+        k = min(k, len(codes) - 1)
+        if k <= 0:
+            return {}
+        neighbours = {}
+        for start in range(0, len(codes), block):
+            sims = matrix[start:start + block] @ matrix.T
+            for row, sim in enumerate(sims):
+                sim[start + row] = -1.0  # сам тест не сосед
+                top = np.argpartition(-sim, k)[:k]
+                neighbours[codes[start + row]] = [(codes[i], float(sim[i])) for i in top]
+        return neighbours
+
+    def _compute(self, related_rows, history_rows, embeddings=None, catalog_codes=None):
+        weights = defaultdict(lambda: defaultdict(float))
+
+        def add(code_1, code_2, weight):
+            weights[code_1][code_2] += weight
+            weights[code_2][code_1] += weight
+
+        for code_1, code_2, users in related_rows:
+            if code_1 != code_2:
+                add(code_1, code_2, float(users))
+
+        # Соседние находки одного пользователя; пара - один раз на пользователя
+        pair_gap = timedelta(minutes=HISTORY_PAIR_MINUTES)
+        user_pairs = set()
+        previous_user, previous_code, previous_time = None, None, None
+        for user_id, code, created_at in history_rows:
+            current_time = _parse_time(created_at)
+            if user_id != previous_user:
+                for code_1, code_2 in user_pairs:
+                    add(code_1, code_2, HISTORY_WEIGHT)
+                user_pairs = set()
+            elif (code != previous_code and current_time and previous_time
+                    and current_time - previous_time <= pair_gap):
+                user_pairs.add(tuple(sorted((previous_code, code))))
+            previous_user, previous_code, previous_time = user_id, code, current_time
+        for code_1, code_2 in user_pairs:
+            add(code_1, code_2, HISTORY_WEIGHT)
+
+        pairs = sum(len(row) for row in weights.values()) // 2
+
+        # Косинусная нормировка: популярные тесты не забивают всех соседей
+        totals = {code: sum(row.values()) for code, row in weights.items()}
+        scores = {
+            code: {
+                other: weight / math.sqrt(totals[code] * totals[other])
+                for other, weight in row.items()
+            }
+            for code, row in weights.items()
+        }
+
+        if embeddings is not None:
+            for code, neighbours in self._knn(embeddings, KNN_NEIGHBORS).items():
+                row = scores.setdefault(code, {})
+                for other, similarity in neighbours:
+                    if similarity > 0:
+                        row[other] = row.get(other, 0.0) + KNN_WEIGHT * similarity
+
+        related = {}
+        for code, row in scores.items():
+            if catalog_codes is not None and code not in catalog_codes:
+                continue
+            ranked = sorted(
+                ((other, score) for other, score in row.items()
+                 if catalog_codes is None or other in catalog_codes),
+                key=lambda item: (-item[1], item[0])
+            )[:self.top_n]
+            if ranked:
+                related[code] = [(other, round(score, 4)) for other, score in ranked]
+        return related, pairs
+
+    async def _store(self, related: Dict[str, List[Tuple[str, float]]]):
+        now = datetime.now()
+        rows = [
+            (code, rank, other, score, now)
+            for code, neighbours in related.items()
+            for rank, (other, score) in enumerate(neighbours)
+        ]
+        async with self.pool.write() as db:
+            try:
+                await db.execute('DELETE FROM test_recommendations')
+                await db.executemany('''
+                    INSERT INTO test_recommendations
+                    (test_code, rank, related_code, score, updated_at)
+                    VALUES (?, ?, ?, ?, ?)
+                ''', rows)
+                await db.commit()
+            except Exception:
+                await db.rollback()
+                raise
+
+    def get_stats(self) -> Dict:
+        return {
+            "tests": len(self._related),
+            "pairs": self.pairs,
+            "rebuilds": self.rebuilds,
+            "last_rebuild_ms": self.last_rebuild_ms,
+            "last_rebuild_at": self.last_rebuild_at,
+            "knn_weight": KNN_WEIGHT,
+        }
+
+
+def _parse_time(value) -> Optional[datetime]:
+    if isinstance(value, datetime):
+        return value
+    try:
+        return datetime.fromisoformat(str(value))
+    except (TypeError, ValueError):
+        return None
@@ -0,0 +1,335 @@
+"""
+Инкрементальные агрегаты (rollups) для метрик и дашбордов.
+
+Вместо пересчета request_metrics / user_activity за весь день (или
+период) каждые 5 минут новые строки обрабатываются один раз: от
+последнего обработанного id (rollup_state) до текущего максимума.
+Дашборды и экспорт читают готовые строки по дням.
+
+Таблицы:
+- rollup_daily_type   - день x тип запроса (счетчики, суммы, min/max времени)
+- rollup_daily_users  - день x пользователь (для уникальных и топа)
+- rollup_daily        - день: всего запросов и уникальных пользователей
+- rollup_hourly       - час: нагрузка и ошибки
+- user_cohorts        - первая и последняя дата активности пользователя
+- rollup_retention    - день: активные, новые и вернувшиеся (1/7/30 дней)
+
+Админы отсекаются при обработке строки (по роли на этот момент).
+"""
+import logging
+import time
+from datetime import date
+from typing import Dict, List
+
+from src.database import queries
+
+logger = logging.getLogger(__name__)
+
+ROLLUP_BATCH_SIZE = 5000
+
+
+class MetricsRollups:
+    def __init__(self, pool, batch_size: int = ROLLUP_BATCH_SIZE):
+        self.pool = pool
+        self.batch_size = batch_size
+        self.last_refresh_ms = 0.0
+        self.rows_processed = 0
+
+    # ============================================================
+    # СХЕМА
+    # ============================================================
+
+    @staticmethod
+    async def create_tables(db):
+        await db.execute('''
+            CREATE TABLE IF NOT EXISTS rollup_state (
+                name TEXT PRIMARY KEY,
+                last_id INTEGER NOT NULL DEFAULT 0,
+                updated_at TIMESTAMP
+            )
+        ''')
+
+        await db.execute('''
+            CREATE TABLE IF NOT EXISTS rollup_daily_type (
+                metric_date DATE NOT NULL,
+                request_type TEXT NOT NULL,
+                total INTEGER DEFAULT 0,
+                successful INTEGER DEFAULT 0,
+                failed INTEGER DEFAULT 0,
+                no_answer INTEGER DEFAULT 0,
+                correct INTEGER DEFAULT 0,
+                sum_response_time REAL DEFAULT 0,
+                max_response_time REAL DEFAULT 0,
+                min_response_time REAL,
+                sum_relevance REAL DEFAULT 0,
+                PRIMARY KEY (metric_date, request_type)
+            ) WITHOUT ROWID
+        ''')
+
+        await db.execute('''
+            CREATE TABLE IF NOT EXISTS rollup_daily_users (
+                metric_date DATE NOT NULL,
+                user_id INTEGER NOT NULL,
+                request_count INTEGER DEFAULT 0,
+                successful INTEGER DEFAULT 0,
+                sum_response_time REAL DEFAULT 0,
+                PRIMARY KEY (metric_date, user_id)
+            ) WITHOUT ROWID
+        ''')
+
+        await db.execute('''
+            CREATE TABLE IF NOT EXISTS rollup_daily (
+                metric_date DATE PRIMARY KEY,
+                total_requests INTEGER DEFAULT 0,
+                unique_users INTEGER DEFAULT 0
+            )
+        ''')
+
+        await db.execute('''
+            CREATE TABLE IF NOT EXISTS rollup_hourly (
+                metric_hour TEXT PRIMARY KEY,
+                total INTEGER DEFAULT 0,
+                failed INTEGER DEFAULT 0,
+                sum_response_time REAL DEFAULT 0,
+                max_response_time REAL DEFAULT 0
+            )
+        ''')
+
+        await db.execute('''
+            CREATE TABLE IF NOT EXISTS user_cohorts (
+                user_id INTEGER PRIMARY KEY,
+                first_active_date DATE NOT NULL,
+                last_active_date DATE NOT NULL
+            )
+        ''')
+
+        await db.execute('''
+            CREATE TABLE IF NOT EXISTS rollup_retention (
+                metric_date DATE PRIMARY KEY,
+                active_users INTEGER DEFAULT 0,
+                new_users INTEGER DEFAULT 0,
+                returned_1d INTEGER DEFAULT 0,
+                returned_7d INTEGER DEFAULT 0,
+                returned_30d INTEGER DEFAULT 0
+            )
+        ''')
+
+        await db.execute('''
+            CREATE INDEX IF NOT EXISTS idx_user_cohorts_first
+            ON user_cohorts(first_active_date)
+        ''')
+
+    # ============================================================
+    # ОБНОВЛЕНИЕ
+    # ============================================================
+
+    @staticmethod
+    async def _get_last_id(db, name: str) -> int:
+        cursor = await db.execute('SELECT last_id FROM rollup_state WHERE name = ?', (name,))
+        row = await cursor.fetchone()
+        return row[0] if row else 0
+
+    @staticmethod
+    async def _set_last_id(db, name: str, last_id: int):
+        await db.execute('''
+            INSERT INTO rollup_state (name, last_id, updated_at)
+            VALUES (?, ?, CURRENT_TIMESTAMP)
+            ON CONFLICT(name) DO UPDATE SET
+                last_id = excluded.last_id,
+                updated_at = excluded.updated_at
+        ''', (name, last_id))
+
+    async def refresh(self) -> int:
+        """Обрабатывает новые строки request_metrics и user_activity; возвращает их число"""
+        started = time.monotonic()
+        processed = 0
+        while True:
+            # Блокировка записи - на один пакет: первый догоняющий проход по
+            # всей истории не должен держать остальных писателей.
+            # pool.write() исключает только писателей своего процесса; в
+            # режиме воркеров last_id читается уже под BEGIN IMMEDIATE, иначе
+            # два процесса прочтут один last_id и посчитают пакет дважды
+            async with self.pool.write() as db:
+                await db.execute('BEGIN IMMEDIATE')
+                batch = await self._refresh_requests(db)
+                batch += await self._refresh_activity(db)
+                await db.commit()
+            processed += batch
+            if batch == 0:
+                break
+
+        self.rows_processed += processed
+        self.last_refresh_ms = (time.monotonic() - started) * 1000
+        if processed:
+            logger.info(f"[ROLLUP] Processed {processed} new rows in {self.last_refresh_ms:.0f} ms")
+        return processed
+
+    async def _refresh_requests(self, db) -> int:
+        last_id = await self._get_last_id(db, 'request_metrics')
+        cursor = await db.execute(queries.ROLLUP_REQUEST_METRICS_BATCH, (last_id, self.batch_size))
+        rows = await cursor.fetchall()
+        if not rows:
+            return 0
+
+        by_type: Dict[tuple, List] = {}
+        by_user: Dict[tuple, List] = {}
+        by_hour: Dict[str, List] = {}
+
+        for _, user_id, request_type, response_time, success, has_answer, relevance, timestamp, role in rows:
+            if role is None or role == 'admin' or not timestamp:
+                continue
+            timestamp = str(timestamp)
+            metric_date, metric_hour = timestamp[:10], timestamp[:13]
+            response_time = response_time or 0
+            success = 1 if success else 0
+
+            entry = by_type.setdefault((metric_date, request_type), [0, 0, 0, 0, 0, 0.0, 0.0, None, 0.0])
+            entry[0] += 1
+            entry[1] += success
+            entry[2] += 1 - success
+            entry[3] += 0 if has_answer else 1
+            entry[4] += 1 if success and has_answer else 0
+            entry[5] += response_time
+            entry[6] = max(entry[6], response_time)
+            entry[7] = response_time if entry[7] is None else min(entry[7], response_time)
+            entry[8] += relevance or 0
+
+            entry = by_user.setdefault((metric_date, user_id), [0, 0, 0.0])
+            entry[0] += 1
+            entry[1] += success
+            entry[2] += response_time
+
+            entry = by_hour.setdefault(metric_hour, [0, 0, 0.0, 0.0])
+            entry[0] += 1
+            entry[1] += 1 - success
+            entry[2] += response_time
+            entry[3] = max(entry[3], response_time)
+
+        if by_type:
+            await db.executemany('''
+                INSERT INTO rollup_daily_type
+                (metric_date, request_type, total, successful, failed, no_answer, correct,
+                 sum_response_time, max_response_time, min_response_time, sum_relevance)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT(metric_date, request_type) DO UPDATE SET
+                    total = total + excluded.total,
+                    successful = successful + excluded.successful,
+                    failed = failed + excluded.failed,
+                    no_answer = no_answer + excluded.no_answer,
+                    correct = correct + excluded.correct,
+                    sum_response_time = sum_response_time + excluded.sum_response_time,
+                    max_response_time = MAX(max_response_time, excluded.max_response_time),
+                    min_response_time = MIN(COALESCE(min_response_time, excluded.min_response_time),
+                                            excluded.min_response_time),
+                    sum_relevance = sum_relevance + excluded.sum_relevance
+            ''', [key + tuple(values) for key, values in by_type.items()])
+
+            await db.executemany('''
+                INSERT INTO rollup_daily_users
+                (metric_date, user_id, request_count, successful, sum_response_time)
+                VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT(metric_date, user_id) DO UPDATE SET
+                    request_count = request_count + excluded.request_count,
+                    successful = successful + excluded.successful,
+                    sum_response_time = sum_response_time + excluded.sum_response_time
+            ''', [key + tuple(values) for key, values in by_user.items()])
+
+            await db.executemany('''
+                INSERT INTO rollup_hourly (metric_hour, total, failed, sum_response_time, max_response_time)
+                VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT(metric_hour) DO UPDATE SET
+                    total = total + excluded.total,
+                    failed = failed + excluded.failed,
+                    sum_response_time = sum_response_time + excluded.sum_response_time,
+                    max_response_time = MAX(max_response_time, excluded.max_response_time)
+            ''', [(hour,) + tuple(values) for hour, values in by_hour.items()])
+
+            # Итоги по затронутым дням - по первичному ключу rollup_daily_users
+            touched_dates = sorted({metric_date for metric_date, _ in by_user})
+            await db.executemany('''
+                INSERT OR REPLACE INTO rollup_daily (metric_date, total_requests, unique_users)
+                SELECT ?, COALESCE(SUM(request_count), 0), COUNT(*)
+                FROM rollup_daily_users
+                WHERE metric_date = ?
+            ''', [(metric_date, metric_date) for metric_date in touched_dates])
+
+        await self._set_last_id(db, 'request_metrics', rows[-1][0])
+        return len(rows)
+
+    async def _refresh_activity(self, db) -> int:
+        """Когорты и возвратность: новые пары (пользователь, день) из user_activity"""
+        last_id = await self._get_last_id(db, 'user_activity')
+        cursor = await db.execute(queries.ROLLUP_USER_ACTIVITY_BATCH, (last_id, self.batch_size))
+        rows = await cursor.fetchall()
+        if not rows:
+            return 0
+
+        pairs = sorted(
+            (str(activity_date)[:10], user_id)
+            for _, user_id, activity_date, role in rows
+            if role is not None and role != 'admin' and activity_date
+        )
+
+        # Текущее состояние когорт для пользователей пакета
+        cohorts: Dict[int, List[str]] = {}
+        user_ids = list({user_id for _, user_id in pairs})
+        for i in range(0, len(user_ids), 500):
+            chunk = user_ids[i:i + 500]
+            placeholders = ','.join('?' * len(chunk))
+            cursor = await db.execute(f'''
+                SELECT user_id, first_active_date, last_active_date
+                FROM user_cohorts
+                WHERE user_id IN ({placeholders})
+            ''', chunk)
+            for user_id, first_date, last_date in await cursor.fetchall():
+                cohorts[user_id] = [str(first_date), str(last_date)]
+
+        retention: Dict[str, List[int]] = {}
+        for metric_date, user_id in pairs:
+            entry = retention.setdefault(metric_date, [0, 0, 0, 0, 0])
+            entry[0] += 1
+
+            cohort = cohorts.get(user_id)
+            if cohort is None:
+                cohorts[user_id] = [metric_date, metric_date]
+                entry[1] += 1
+                continue
+
+            if metric_date > cohort[1]:
+                # Вернулся: разрыв с предыдущим днем активности
+                gap = (date.fromisoformat(metric_date) - date.fromisoformat(cohort[1])).days
+                entry[2] += 1 if gap <= 1 else 0
+                entry[3] += 1 if gap <= 7 else 0
+                entry[4] += 1 if gap <= 30 else 0
+                cohort[1] = metric_date
+            elif metric_date < cohort[0]:
+                cohort[0] = metric_date
+
+        await db.executemany('''
+            INSERT INTO user_cohorts (user_id, first_active_date, last_active_date)
+            VALUES (?, ?, ?)
+            ON CONFLICT(user_id) DO UPDATE SET
+                first_active_date = MIN(first_active_date, excluded.first_active_date),
+                last_active_date = MAX(last_active_date, excluded.last_active_date)
+        ''', [(user_id, first_date, last_date) for user_id, (first_date, last_date) in cohorts.items()])
+
+        await db.executemany('''
+            INSERT INTO rollup_retention
+            (metric_date, active_users, new_users, returned_1d, returned_7d, returned_30d)
+            VALUES (?, ?, ?, ?, ?, ?)
+            ON CONFLICT(metric_date) DO UPDATE SET
+                active_users = active_users + excluded.active_users,
+                new_users = new_users + excluded.new_users,
+                returned_1d = returned_1d + excluded.returned_1d,
+                returned_7d = returned_7d + excluded.returned_7d,
+                returned_30d = returned_30d + excluded.returned_30d
+        ''', [(metric_date,) + tuple(values) for metric_date, values in retention.items()])
+
+        await self._set_last_id(db, 'user_activity', rows[-1][0])
+        return len(rows)
+
+    def get_stats(self) -> Dict:
+        return {
+            "rows_processed": self.rows_processed,
+            "last_refresh_ms": self.last_refresh_ms,
+        }
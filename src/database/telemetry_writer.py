@@ -0,0 +1,288 @@
+"""
+Отложенная пакетная запись телеметрии (метрики, история, счетчики).
+
+Записи копятся в памяти и сбрасываются одной транзакцией на writer-
+соединении пула каждые FLUSH_INTERVAL_SECONDS или при накоплении
+MAX_BATCH_SIZE записей. Счетчики (UPSERT с +1) схлопываются по ключу:
+десять запросов пользователя за день дают один UPSERT с +10.
+Пакет, который не удалось записать из-за занятой БД ("database is
+locked"/"busy"), возвращается в очередь и пишется следующим сбросом;
+отбрасывается только после MAX_FLUSH_RETRIES неудачных попыток подряд.
+При любой другой ошибке пакет пишется по группам SQL, а неудавшаяся
+группа - по строкам (каждая под SAVEPOINT): отбрасываются только
+строки, которые записать нельзя, остальная телеметрия сохраняется.
+"""
+import asyncio
+import logging
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import aiosqlite
+
+from utils.latency_stats import LatencyHistogram
+
+logger = logging.getLogger(__name__)
+
+FLUSH_INTERVAL_SECONDS = 0.5
+MAX_BATCH_SIZE = 200
+MAX_PENDING = 10000   # Верхняя граница записей в памяти; дальше - backpressure
+MAX_FLUSH_RETRIES = 5  # Попыток записать неудавшийся пакет (БД занята) до отбрасывания
+
+
+def _is_busy(error: BaseException) -> bool:
+    """БД занята другим писателем - пакет стоит повторить целиком"""
+    if not isinstance(error, aiosqlite.OperationalError):
+        return False
+    message = str(error).lower()
+    return 'locked' in message or 'busy' in message
+
+
+class _Counter:
+    """Схлопываемый UPSERT: sql + построитель параметров (key, count, payload)"""
+    __slots__ = ("sql", "build_params", "pending")
+
+    def __init__(self, sql: str, build_params: Callable[[Tuple, int, Any], Tuple]):
+        self.sql = sql
+        self.build_params = build_params
+        self.pending: Dict[Tuple, List] = {}  # key -> [count, last_payload]
+
+
+class TelemetryWriter:
+    def __init__(self, pool, flush_interval: float = FLUSH_INTERVAL_SECONDS,
+                 max_batch: int = MAX_BATCH_SIZE, max_pending: int = MAX_PENDING):
+        self.pool = pool
+        self.flush_interval = flush_interval
+        self.max_batch = max_batch
+        self.max_pending = max_pending
+
+        self._inserts: List[Tuple[str, Tuple]] = []
+        self._counters: Dict[str, _Counter] = {}
+        self._pending = 0
+        self._retry: List[Tuple[str, Tuple]] = []  # Неудавшийся пакет для повторной записи
+        self._retry_attempts = 0
+
+        self._wakeup = asyncio.Event()
+        self._space = asyncio.Condition()
+        self._flush_lock = asyncio.Lock()
+        self._task = None
+        self._running = False
+
+        self.flush_latency = LatencyHistogram()
+        self.flushed_records = 0
+        self.flushed_batches = 0
+        self.coalesced = 0
+        self.dropped = 0
+        self.retried_batches = 0
+        self.backpressure_waits = 0
+        self.max_batch_seen = 0
+
+    # ------------------------------------------------------------------
+    # Регистрация и прием записей
+    # ------------------------------------------------------------------
+
+    def register_counter(self, name: str, sql: str, build_params: Callable[[Tuple, int, Any], Tuple]):
+        self._counters[name] = _Counter(sql, build_params)
+
+    async def insert(self, sql: str, params: Tuple):
+        """Добавляет INSERT в очередь"""
+        await self._reserve()
+        self._inserts.append((sql, params))
+        await self._after_submit()
+
+    async def increment(self, name: str, key: Tuple, payload: Any = None, count: int = 1):
+        """Увеличивает схлопываемый счетчик (payload - последнее значение, напр. время)"""
+        counter = self._counters[name]
+        entry = counter.pending.get(key)
+        if entry is not None:
+            entry[0] += count
+            entry[1] = payload
+            self.coalesced += 1
+            return
+        await self._reserve()
+        counter.pending[key] = [count, payload]
+        await self._after_submit()
+
+    async def _reserve(self):
+        """Backpressure: ждем, пока в буфере не освободится место"""
+        if not self._running:
+            return
+        if self._pending >= self.max_pending:
+            self.backpressure_waits += 1
+            self._wakeup.set()
+            async with self._space:
+                await self._space.wait_for(lambda: self._pending < self.max_pending or not self._running)
+
+    async def _after_submit(self):
+        self._pending += 1
+        if not self._running:
+            # Фоновый писатель не запущен (скрипты, экспорт) - пишем сразу
+            await self.flush()
+        elif self._pending >= self.max_batch:
+            self._wakeup.set()
+
+    # ------------------------------------------------------------------
+    # Сброс в БД
+    # ------------------------------------------------------------------
+
+    def _take_batch(self) -> List[Tuple[str, Tuple]]:
+        batch = self._retry + self._inserts
+        self._retry = []
+        self._inserts = []
+        for counter in self._counters.values():
+            for key, (count, payload) in counter.pending.items():
+                batch.append((counter.sql, counter.build_params(key, count, payload)))
+            counter.pending = {}
+        self._pending = 0
+        return batch
+
+    async def _write(self, grouped: Dict[str, List[Tuple]]):
+        """Весь пакет одной транзакцией"""
+        async with self.pool.write() as db:
+            for sql, params_list in grouped.items():
+                await db.executemany(sql, params_list)
+            await db.commit()
+
+    async def _write_isolated(self, grouped: Dict[str, List[Tuple]]) -> int:
+        """
+        Пакет по группам SQL, неудавшаяся группа - по строкам; возвращает
+        число отброшенных строк. Занятая БД пробрасывается наверх.
+        """
+        dropped = 0
+        async with self.pool.write() as db:
+            await db.execute('BEGIN')
+            for sql, params_list in grouped.items():
+                if await self._try_write(db, sql, params_list) is None:
+                    continue
+                failed = 0
+                error = None
+                for params in params_list:
+                    row_error = await self._try_write(db, sql, [params])
+                    if row_error is not None:
+                        failed += 1
+                        error = row_error
+                if failed:
+                    dropped += failed
+                    logger.error(
+                        f"[TELEMETRY] Dropped {failed} of {len(params_list)} records "
+                        f"for '{' '.join(sql.split())[:80]}': {error}"
+                    )
+            await db.commit()
+        return dropped
+
+    @staticmethod
+    async def _try_write(db, sql: str, params_list: List[Tuple]) -> Optional[Exception]:
+        """executemany под SAVEPOINT; ошибка откатывает только эти строки"""
+        await db.execute('SAVEPOINT telemetry_write')
+        try:
+            await db.executemany(sql, params_list)
+        except Exception as e:
+            await db.execute('ROLLBACK TO telemetry_write')
+            await db.execute('RELEASE telemetry_write')
+            if _is_busy(e):
+                raise
+            return e
+        await db.execute('RELEASE telemetry_write')
+        return None
+
+    async def flush(self) -> int:
+        """Сбрасывает все накопленное одной транзакцией"""
+        async with self._flush_lock:
+            batch = self._take_batch()
+            if batch:
+                started = time.monotonic()
+                # Группируем по SQL, чтобы использовать executemany
+                grouped: Dict[str, List[Tuple]] = {}
+                for sql, params in batch:
+                    grouped.setdefault(sql, []).append(params)
+                try:
+                    try:
+                        await self._write(grouped)
+                        dropped = 0
+                    except Exception as e:
+                        if _is_busy(e):
+                            raise
+                        # Битая запись не должна утянуть за собой весь пакет
+                        logger.warning(f"[TELEMETRY] Batch of {len(batch)} records failed, isolating bad rows: {e}")
+                        dropped = await self._write_isolated(grouped)
+
+                    self.dropped += dropped
+                    self.flushed_records += len(batch) - dropped
+                    self.flushed_batches += 1
+                    self.max_batch_seen = max(self.max_batch_seen, len(batch))
+                    self._retry_attempts = 0
+                except Exception as e:
+                    self._retry_attempts += 1
+                    if not _is_busy(e):
+                        # Не занятость БД и не отдельные строки - повтор не поможет
+                        self.dropped += len(batch)
+                        self._retry_attempts = 0
+                        logger.error(f"[TELEMETRY] Dropped {len(batch)} records: {e}")
+                    elif self._retry_attempts > MAX_FLUSH_RETRIES:
+                        self.dropped += len(batch)
+                        self._retry_attempts = 0
+                        logger.error(f"[TELEMETRY] Dropped {len(batch)} records after {MAX_FLUSH_RETRIES} retries: {e}")
+                    else:
+                        # Вернем в очередь - запишется следующим сбросом
+                        self._retry = batch
+                        self._pending += len(batch)
+                        self.retried_batches += 1
+                        logger.warning(
+                            f"[TELEMETRY] Failed to flush {len(batch)} records "
+                            f"(attempt {self._retry_attempts}/{MAX_FLUSH_RETRIES}), will retry: {e}"
+                        )
+                finally:
+                    self.flush_latency.observe(time.monotonic() - started)
+
+            async with self._space:
+                self._space.notify_all()
+            return len(batch)
+
+    async def _run(self):
+        while self._running:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"[TELEMETRY] Flush loop error: {e}")
+
+    async def start(self):
+        if self._running:
+            return
+        self._running = True
+        self._task = asyncio.create_task(self._run())
+        logger.info(f"[TELEMETRY] Writer started (every {self.flush_interval * 1000:.0f} ms or {self.max_batch} records)")
+
+    async def stop(self):
+        """Останавливает фоновый сброс и дописывает остаток"""
+        if not self._running:
+            return
+        self._running = False
+        self._wakeup.set()
+        if self._task:
+            await self._task
+            self._task = None
+        flushed = await self.flush()
+        # Пакет вернулся в очередь - дописываем, пока не кончатся попытки
+        while self._retry:
+            await asyncio.sleep(self.flush_interval)
+            flushed = await self.flush()
+        logger.info(f"[TELEMETRY] Writer stopped, final flush: {flushed} records")
+
+    def get_stats(self) -> Dict:
+        return {
+            "running": self._running,
+            "queue_depth": self._pending,
+            "flushed_records": self.flushed_records,
+            "flushed_batches": self.flushed_batches,
+            "coalesced": self.coalesced,
+            "dropped": self.dropped,
+            "retried_batches": self.retried_batches,
+            "retry_pending": len(self._retry),
+            "backpressure_waits": self.backpressure_waits,
+            "max_batch": self.max_batch_seen,
+            "flush_latency": self.flush_latency.snapshot(),
+        }
@@ -0,0 +1,123 @@
+"""
+Кэш пользователей для Database.get_user.
+
+- ограниченный LRU (OrderedDict) с TTL на каждую запись;
+- отрицательное кэширование: неизвестные telegram_id тоже кэшируются
+  (с меньшим TTL), чтобы сообщения незарегистрированных не шли в SQLite;
+- точечная инвалидация при записи в users;
+- мемоизация в рамках одного апдейта Telegram (contextvar, выставляется
+  в MetricsMiddleware): повторные get_user внутри обработчика бесплатны.
+"""
+import contextvars
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Dict, Optional, Tuple
+
+USER_CACHE_MAX_SIZE = 5000
+USER_CACHE_TTL_SECONDS = 300          # 5 минут
+USER_CACHE_NEGATIVE_TTL_SECONDS = 60  # Неизвестные пользователи
+
+MISSING = object()
+
+# Мемо текущего апдейта: telegram_id -> данные пользователя (или None)
+_request_memo: contextvars.ContextVar = contextvars.ContextVar("user_request_memo", default=None)
+
+
+@contextmanager
+def request_scope():
+    """Область одного апдейта: get_user внутри нее обращается к кэшу один раз"""
+    token = _request_memo.set({})
+    try:
+        yield
+    finally:
+        _request_memo.reset(token)
+
+
+class UserCache:
+    def __init__(self, max_size: int = USER_CACHE_MAX_SIZE, ttl: float = USER_CACHE_TTL_SECONDS,
+                 negative_ttl: float = USER_CACHE_NEGATIVE_TTL_SECONDS):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self._entries: "OrderedDict[int, Tuple[Optional[dict], float]]" = OrderedDict()  # id -> (данные, истекает)
+
+        self.hits = 0
+        self.negative_hits = 0
+        self.request_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, telegram_id: int):
+        """Данные пользователя, None для известного отсутствия или MISSING (нет в кэше)"""
+        memo = _request_memo.get()
+        if memo is not None and telegram_id in memo:
+            self.request_hits += 1
+            return memo[telegram_id]
+
+        entry = self._entries.get(telegram_id)
+        if entry is None or entry[1] <= time.monotonic():
+            if entry is not None:
+                del self._entries[telegram_id]
+            self.misses += 1
+            return MISSING
+
+        self._entries.move_to_end(telegram_id)
+        if entry[0] is None:
+            self.negative_hits += 1
+        else:
+            self.hits += 1
+        if memo is not None:
+            memo[telegram_id] = entry[0]
+        return entry[0]
+
+    def put(self, telegram_id: int, user_data: Optional[dict]):
+        ttl = self.ttl if user_data is not None else self.negative_ttl
+        self._entries[telegram_id] = (user_data, time.monotonic() + ttl)
+        self._entries.move_to_end(telegram_id)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+        memo = _request_memo.get()
+        if memo is not None:
+            memo[telegram_id] = user_data
+
+    def invalidate(self, telegram_id: Optional[int] = None):
+        """Удаляет запись пользователя (или весь кэш, если id не указан)"""
+        memo = _request_memo.get()
+        if telegram_id is None:
+            self._entries.clear()
+            if memo is not None:
+                memo.clear()
+        else:
+            self._entries.pop(telegram_id, None)
+            if memo is not None:
+                memo.pop(telegram_id, None)
+        self.invalidations += 1
+
+    def evict_expired(self) -> int:
+        """Удаляет только просроченные записи"""
+        now = time.monotonic()
+        expired = [key for key, (_, expires) in self._entries.items() if expires <= now]
+        for key in expired:
+            del self._entries[key]
+        return len(expired)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get_stats(self) -> Dict:
+        lookups = self.hits + self.negative_hits + self.request_hits + self.misses
+        return {
+            "size": len(self._entries),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "negative_hits": self.negative_hits,
+            "request_hits": self.request_hits,
+            "misses": self.misses,
+            "hit_rate": (lookups - self.misses) / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+        }
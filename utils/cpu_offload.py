@@ -0,0 +1,108 @@
+"""
+Вынос синхронной обработки запросов из event loop.
+
+Этапы конвейера (расширение аббревиатур, фильтр по животным, векторный
+и fuzzy-поиск, выгрузка Excel) выполняются в пуле потоков
+CPU_OFFLOAD_WORKERS. Сетевые вызовы эмбеддингов, Chroma (SQLite) и
+numpy/torch отпускают GIL и идут параллельно с loop; чистый Python GIL
+держит, но интерпретатор переключается каждые sys.getswitchinterval(),
+поэтому долгий запрос одного пользователя больше не останавливает
+апдейты остальных. Масштабирование по ядрам - многопроцессный режим
+(bot/sharding.py): пул процессов здесь заново импортировал бы пакет
+bot.handlers (Bot, БД, все роутеры) в каждом дочернем процессе.
+
+Маленькие входы (size <= CPU_OFFLOAD_INLINE_MAX_CHARS) выполняются
+сразу: передача в поток дороже самой работы.
+"""
+import asyncio
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Optional
+
+from config import CPU_OFFLOAD_INLINE_MAX_CHARS, CPU_OFFLOAD_WORKERS
+from utils.latency_stats import LatencyHistogram
+
+
+class _StageStats:
+    __slots__ = ('inline', 'offloaded', 'errors', 'duration', 'queue_wait')
+
+    def __init__(self):
+        self.inline = 0
+        self.offloaded = 0
+        self.errors = 0
+        self.duration = LatencyHistogram()
+        self.queue_wait = LatencyHistogram()
+
+
+class CpuOffload:
+    def __init__(self, max_workers: int = CPU_OFFLOAD_WORKERS,
+                 inline_max_chars: int = CPU_OFFLOAD_INLINE_MAX_CHARS):
+        self.max_workers = max_workers
+        self.inline_max_chars = inline_max_chars
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._stages: Dict[str, _StageStats] = defaultdict(_StageStats)
+
+    def _get_executor(self) -> ThreadPoolExecutor:
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(
+                max_workers=self.max_workers, thread_name_prefix="cpu-offload"
+            )
+        return self._executor
+
+    async def run(self, func: Callable, *args, stage: str, size: Optional[int] = None, **kwargs):
+        """
+        Выполняет func(*args, **kwargs) вне event loop.
+        size - размер входа (например, длина запроса): маленькие входы - сразу.
+        """
+        stats = self._stages[stage]
+        if size is not None and size <= self.inline_max_chars:
+            stats.inline += 1
+            started = time.monotonic()
+            try:
+                return func(*args, **kwargs)
+            except Exception:
+                stats.errors += 1
+                raise
+            finally:
+                stats.duration.observe(time.monotonic() - started)
+
+        stats.offloaded += 1
+        queued_at = time.monotonic()
+
+        def call():
+            started = time.monotonic()
+            stats.queue_wait.observe(started - queued_at)
+            try:
+                return func(*args, **kwargs)
+            except Exception:
+                stats.errors += 1
+                raise
+            finally:
+                stats.duration.observe(time.monotonic() - started)
+
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._get_executor(), call)
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    def get_stats(self) -> Dict:
+        return {
+            "workers": self.max_workers,
+            "stages": {
+                stage: {
+                    "inline": stats.inline,
+                    "offloaded": stats.offloaded,
+                    "errors": stats.errors,
+                    "duration": stats.duration.snapshot(),
+                    "queue_wait": stats.queue_wait.snapshot(),
+                }
+                for stage, stats in self._stages.items()
+            },
+        }
+
+
+cpu_offload = CpuOffload()
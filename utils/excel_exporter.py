@@ -2,9 +2,11 @@ import pandas as pd
 from datetime import datetime
 from pathlib import Path
 import aiosqlite
-from typing import Optional
+from typing import Optional, Tuple
 import io
 
+from utils.cpu_offload import cpu_offload
+
 class ExcelExporter:
     def __init__(self, db_path: str):
         self.db_path = db_path
@@ -13,78 +15,103 @@ class ExcelExporter:
         """Экспорт всех данных в Excel (БЕЗ администраторов)"""
         async with aiosqlite.connect(self.db_path) as db:
             db.row_factory = aiosqlite.Row
+            users = await self._fetch_users(db)
+            questions = await self._fetch_questions(db)
+            callbacks = await self._fetch_callbacks(db)
+            feedback = await self._fetch_feedback(db)
+
+        # DataFrame и книга строятся синхронно и долго на больших таблицах: вне event loop
+        return await cpu_offload.run(
+            self._build_all_data, users, questions, callbacks, feedback, stage="excel_export"
+        )
+
+    def _build_all_data(self, users, questions, callbacks, feedback) -> bytes:
+        output = io.BytesIO()
+        
+        with pd.ExcelWriter(output, engine='xlsxwriter') as writer:
+            # Экспорт пользователей
+            users_df = self._frame(users)
+            users_df.to_excel(writer, sheet_name='Пользователи', index=False)
             
-            output = io.BytesIO()
+            # Экспорт вопросов
+            questions_df = self._questions_dataframe(questions)
+            questions_df.to_excel(writer, sheet_name='Вопросы', index=False)
             
-            with pd.ExcelWriter(output, engine='xlsxwriter') as writer:
-                # Экспорт пользователей
-                users_df = await self._get_users_dataframe(db)
-                users_df.to_excel(writer, sheet_name='Пользователи', index=False)
-                
-                # Экспорт вопросов
-                questions_df = await self._get_questions_dataframe(db)
-                questions_df.to_excel(writer, sheet_name='Вопросы', index=False)
-                
-                # Экспорт запросов на звонок
-                callbacks_df = await self._get_callbacks_dataframe(db)
-                callbacks_df.to_excel(writer, sheet_name='Звонки', index=False)
-                
-                # Экспорт обратной связи
-                feedback_df = await self._get_feedback_dataframe(db)
-                feedback_df.to_excel(writer, sheet_name='Обратная связь', index=False)
-                
-                # Форматирование
-                workbook = writer.book
-                for worksheet in workbook.worksheets():
-                    worksheet.set_column('A:Z', 20)
+            # Экспорт запросов на звонок
+            callbacks_df = self._callbacks_dataframe(callbacks)
+            callbacks_df.to_excel(writer, sheet_name='Звонки', index=False)
             
-            output.seek(0)
-            return output.read()
+            # Экспорт обратной связи
+            feedback_df = self._feedback_dataframe(feedback)
+            feedback_df.to_excel(writer, sheet_name='Обратная связь', index=False)
+            
+            # Форматирование
+            workbook = writer.book
+            for worksheet in workbook.worksheets():
+                worksheet.set_column('A:Z', 20)
+        
+        output.seek(0)
+        return output.read()
         
     async def export_chat_history(self) -> bytes:
         """Экспорт истории общения с ботом (БЕЗ администраторов)"""
         async with aiosqlite.connect(self.db_path) as db:
             db.row_factory = aiosqlite.Row
+            chat = await self._fetch_chat_history(db)
+
+        return await cpu_offload.run(self._build_chat_history, chat, stage="excel_export")
+
+    def _build_chat_history(self, chat) -> bytes:
+        output = io.BytesIO()
+        chat_df = self._frame(chat)
+        
+        with pd.ExcelWriter(output, engine='xlsxwriter') as writer:
+            chat_df.to_excel(writer, sheet_name='История общения', index=False)
             
-            output = io.BytesIO()
-            chat_df = await self._get_chat_history_dataframe(db)
+            # Добавляем статистику
+            stats_df = self._calculate_chat_stats(chat_df)
+            stats_df.to_excel(writer, sheet_name='Статистика', index=False)
             
-            with pd.ExcelWriter(output, engine='xlsxwriter') as writer:
-                chat_df.to_excel(writer, sheet_name='История общения', index=False)
-                
-                # Добавляем статистику
-                stats_df = self._calculate_chat_stats(chat_df)
-                stats_df.to_excel(writer, sheet_name='Статистика', index=False)
-                
-                # Форматирование
-                workbook = writer.book
-                worksheet = writer.sheets['История общения']
-                
-                # Устанавливаем ширину колонок
-                worksheet.set_column('A:A', 12)  # ID
-                worksheet.set_column('B:B', 20)  # Пользователь
-                worksheet.set_column('C:C', 15)  # Тип
-                worksheet.set_column('D:D', 15)  # Код клиента
-                worksheet.set_column('E:E', 50)  # Вопрос
-                worksheet.set_column('F:F', 60)  # Ответ
-                worksheet.set_column('G:G', 15)  # Тип запроса
-                worksheet.set_column('H:H', 12)  # Успех
-                worksheet.set_column('I:I', 15)  # Код теста
-                worksheet.set_column('J:J', 20)  # Дата
-                
-                # Добавляем перенос текста для вопросов и ответов
-                wrap_format = workbook.add_format({'text_wrap': True, 'valign': 'top'})
-                worksheet.set_column('E:F', None, wrap_format)
-                
-                # Статистика
-                stats_worksheet = writer.sheets['Статистика']
-                stats_worksheet.set_column('A:B', 30)
+            # Форматирование
+            workbook = writer.book
+            worksheet = writer.sheets['История общения']
+            
+            # Устанавливаем ширину колонок
+            worksheet.set_column('A:A', 12)  # ID
+            worksheet.set_column('B:B', 20)  # Пользователь
+            worksheet.set_column('C:C', 15)  # Тип
+            worksheet.set_column('D:D', 15)  # Код клиента
+            worksheet.set_column('E:E', 50)  # Вопрос
+            worksheet.set_column('F:F', 60)  # Ответ
+            worksheet.set_column('G:G', 15)  # Тип запроса
+            worksheet.set_column('H:H', 12)  # Успех
+            worksheet.set_column('I:I', 15)  # Код теста
+            worksheet.set_column('J:J', 20)  # Дата
             
-            output.seek(0)
-            return output.read()
+            # Добавляем перенос текста для вопросов и ответов
+            wrap_format = workbook.add_format({'text_wrap': True, 'valign': 'top'})
+            worksheet.set_column('E:F', None, wrap_format)
+            
+            # Статистика
+            stats_worksheet = writer.sheets['Статистика']
+            stats_worksheet.set_column('A:B', 30)
+        
+        output.seek(0)
+        return output.read()
+
+    @staticmethod
+    async def _rows(cursor) -> Tuple[list, list]:
+        """Строки и имена колонок запроса (DataFrame строится вне event loop)"""
+        rows = await cursor.fetchall()
+        return [tuple(row) for row in rows], [desc[0] for desc in cursor.description]
 
-    async def _get_chat_history_dataframe(self, db) -> pd.DataFrame:
-        """Получить DataFrame с историей общения (БЕЗ администраторов)"""
+    @staticmethod
+    def _frame(data: Tuple[list, list]) -> pd.DataFrame:
+        rows, columns = data
+        return pd.DataFrame(rows, columns=columns)
+
+    async def _fetch_chat_history(self, db) -> Tuple[list, list]:
+        """Строки истории общения (БЕЗ администраторов)"""
         cursor = await db.execute('''
             SELECT 
                 ch.id as "ID",
@@ -119,8 +146,7 @@ class ExcelExporter:
             ORDER BY ch.timestamp DESC
         ''')
         
-        rows = await cursor.fetchall()
-        return pd.DataFrame(rows, columns=[desc[0] for desc in cursor.description])
+        return await self._rows(cursor)
 
     def _calculate_chat_stats(self, chat_df: pd.DataFrame) -> pd.DataFrame:
         """Рассчитать статистику по истории общения"""
@@ -262,87 +288,92 @@ class ExcelExporter:
         """Экспорт только пользователей (БЕЗ администраторов)"""
         async with aiosqlite.connect(self.db_path) as db:
             db.row_factory = aiosqlite.Row
+            users = await self._fetch_users(db)
+
+        return await cpu_offload.run(self._build_users, users, stage="excel_export")
+
+    def _build_users(self, users) -> bytes:
+        output = io.BytesIO()
+        users_df = self._frame(users)
+        
+        with pd.ExcelWriter(output, engine='xlsxwriter') as writer:
+            users_df.to_excel(writer, sheet_name='Пользователи', index=False)
             
-            output = io.BytesIO()
-            users_df = await self._get_users_dataframe(db)
-            
-            with pd.ExcelWriter(output, engine='xlsxwriter') as writer:
-                users_df.to_excel(writer, sheet_name='Пользователи', index=False)
-                
-                # Добавляем статистику
-                stats_df = self._calculate_user_stats(users_df)
-                stats_df.to_excel(writer, sheet_name='Статистика', index=False)
-                
-                # Форматирование
-                workbook = writer.book
-                for worksheet in workbook.worksheets():
-                    worksheet.set_column('A:Z', 20)
+            # Добавляем статистику
+            stats_df = self._calculate_user_stats(users_df)
+            stats_df.to_excel(writer, sheet_name='Статистика', index=False)
             
-            output.seek(0)
-            return output.read()
+            # Форматирование
+            workbook = writer.book
+            for worksheet in workbook.worksheets():
+                worksheet.set_column('A:Z', 20)
+        
+        output.seek(0)
+        return output.read()
     
     async def export_questions(self) -> bytes:
         """Экспорт только вопросов (БЕЗ вопросов от администраторов)"""
         async with aiosqlite.connect(self.db_path) as db:
             db.row_factory = aiosqlite.Row
+            questions = await self._fetch_questions(db)
+
+        return await cpu_offload.run(self._build_questions, questions, stage="excel_export")
+
+    def _build_questions(self, questions) -> bytes:
+        output = io.BytesIO()
+        questions_df = self._questions_dataframe(questions)
+        
+        with pd.ExcelWriter(output, engine='xlsxwriter') as writer:
+            questions_df.to_excel(writer, sheet_name='Вопросы', index=False)
             
-            output = io.BytesIO()
-            questions_df = await self._get_questions_dataframe(db)
-            
-            with pd.ExcelWriter(output, engine='xlsxwriter') as writer:
-                questions_df.to_excel(writer, sheet_name='Вопросы', index=False)
-                
-                # Форматирование
-                workbook = writer.book
-                worksheet = writer.sheets['Вопросы']
-                worksheet.set_column('A:A', 15)  # ID
-                worksheet.set_column('B:B', 20)  # Пользователь
-                worksheet.set_column('C:C', 50)  # Вопрос
-                worksheet.set_column('D:D', 20)  # Дата
-            
-            output.seek(0)
-            return output.read()
+            # Форматирование
+            workbook = writer.book
+            worksheet = writer.sheets['Вопросы']
+            worksheet.set_column('A:A', 15)  # ID
+            worksheet.set_column('B:B', 20)  # Пользователь
+            worksheet.set_column('C:C', 50)  # Вопрос
+            worksheet.set_column('D:D', 20)  # Дата
+        
+        output.seek(0)
+        return output.read()
     
     async def export_callbacks(self) -> bytes:
         """Экспорт только запросов на звонок (БЕЗ запросов от администраторов)"""
         async with aiosqlite.connect(self.db_path) as db:
             db.row_factory = aiosqlite.Row
-            
-            output = io.BytesIO()
-            callbacks_df = await self._get_callbacks_dataframe(db)
-            
-            with pd.ExcelWriter(output, engine='xlsxwriter') as writer:
-                callbacks_df.to_excel(writer, sheet_name='Звонки', index=False)
-                
-                # Форматирование
-                workbook = writer.book
-                worksheet = writer.sheets['Звонки']
-                worksheet.set_column('A:Z', 20)
-            
-            output.seek(0)
-            return output.read()
+            callbacks = await self._fetch_callbacks(db)
+
+        return await cpu_offload.run(
+            self._build_sheet, self._callbacks_dataframe, callbacks, 'Звонки', stage="excel_export"
+        )
     
     async def export_feedback(self) -> bytes:
         """Экспорт только обратной связи (БЕЗ обращений от администраторов)"""
         async with aiosqlite.connect(self.db_path) as db:
             db.row_factory = aiosqlite.Row
+            feedback = await self._fetch_feedback(db)
+
+        return await cpu_offload.run(
+            self._build_sheet, self._feedback_dataframe, feedback, 'Обратная связь', stage="excel_export"
+        )
+
+    def _build_sheet(self, to_dataframe, data, sheet_name: str) -> bytes:
+        """Книга из одного листа с шириной колонок 20"""
+        output = io.BytesIO()
+        df = to_dataframe(data)
+        
+        with pd.ExcelWriter(output, engine='xlsxwriter') as writer:
+            df.to_excel(writer, sheet_name=sheet_name, index=False)
             
-            output = io.BytesIO()
-            feedback_df = await self._get_feedback_dataframe(db)
-            
-            with pd.ExcelWriter(output, engine='xlsxwriter') as writer:
-                feedback_df.to_excel(writer, sheet_name='Обратная связь', index=False)
-                
-                # Форматирование
-                workbook = writer.book
-                worksheet = writer.sheets['Обратная связь']
-                worksheet.set_column('A:Z', 20)
-            
-            output.seek(0)
-            return output.read()
+            # Форматирование
+            worksheet = writer.sheets[sheet_name]
+            worksheet.set_column('A:Z', 20)
+        
+        output.seek(0)
+        return output.read()
     
-    async def _get_users_dataframe(self, db) -> pd.DataFrame:
-        """Получить DataFrame с пользователями (БЕЗ администраторов)"""
+    async def _fetch_users(self, db) -> Tuple[list, list]:
+        """Строки пользователей (БЕЗ администраторов)"""
         cursor = await db.execute('''
             SELECT 
                 telegram_id as "Telegram ID",
@@ -383,11 +414,10 @@ class ExcelExporter:
             ORDER BY registration_date DESC
         ''')
         
-        rows = await cursor.fetchall()
-        return pd.DataFrame(rows, columns=[desc[0] for desc in cursor.description])
+        return await self._rows(cursor)
     
-    async def _get_questions_dataframe(self, db) -> pd.DataFrame:
-        """Получить DataFrame с вопросами (БЕЗ вопросов от администраторов)"""
+    async def _fetch_questions(self, db) -> Tuple[list, list]:
+        """Строки вопросов (БЕЗ вопросов от администраторов)"""
         cursor = await db.execute('''
             SELECT 
                 rs.id as "ID",
@@ -403,8 +433,11 @@ class ExcelExporter:
             ORDER BY rs.timestamp DESC
         ''')
         
-        rows = await cursor.fetchall()
-        df = pd.DataFrame(rows, columns=[desc[0] for desc in cursor.description])
+        return await self._rows(cursor)
+
+    def _questions_dataframe(self, data: Tuple[list, list]) -> pd.DataFrame:
+        """DataFrame с вопросами (БЕЗ вопросов от администраторов)"""
+        df = self._frame(data)
         
         # Добавляем колонку типа пользователя
         if not df.empty:
@@ -415,8 +448,8 @@ class ExcelExporter:
         
         return df
     
-    async def _get_callbacks_dataframe(self, db) -> pd.DataFrame:
-        """Получить DataFrame с запросами на звонок (БЕЗ запросов от администраторов)"""
+    async def _fetch_callbacks(self, db) -> Tuple[list, list]:
+        """Строки запросов на звонок (БЕЗ запросов от администраторов)"""
         cursor = await db.execute('''
             SELECT 
                 rs.id as "ID",
@@ -433,8 +466,11 @@ class ExcelExporter:
             ORDER BY rs.timestamp DESC
         ''')
         
-        rows = await cursor.fetchall()
-        df = pd.DataFrame(rows, columns=[desc[0] for desc in cursor.description])
+        return await self._rows(cursor)
+
+    def _callbacks_dataframe(self, data: Tuple[list, list]) -> pd.DataFrame:
+        """DataFrame с запросами на звонок (БЕЗ запросов от администраторов)"""
+        df = self._frame(data)
         
         # Извлекаем телефон из текста запроса и добавляем тип пользователя
         if not df.empty:
@@ -447,8 +483,8 @@ class ExcelExporter:
         
         return df
     
-    async def _get_feedback_dataframe(self, db) -> pd.DataFrame:
-        """Получить DataFrame с обратной связью (БЕЗ обращений от администраторов)"""
+    async def _fetch_feedback(self, db) -> Tuple[list, list]:
+        """Строки обратной связи (БЕЗ обращений от администраторов)"""
         cursor = await db.execute('''
             SELECT 
                 f.id as "ID",
@@ -473,8 +509,11 @@ class ExcelExporter:
             ORDER BY f.timestamp DESC
         ''')
         
-        rows = await cursor.fetchall()
-        df = pd.DataFrame(rows, columns=[desc[0] for desc in cursor.description])
+        return await self._rows(cursor)
+
+    def _feedback_dataframe(self, data: Tuple[list, list]) -> pd.DataFrame:
+        """DataFrame с обратной связью (БЕЗ обращений от администраторов)"""
+        df = self._frame(data)
         
         # Добавляем тип пользователя
         if not df.empty:
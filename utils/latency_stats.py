@@ -0,0 +1,56 @@
+"""
+Легковесные гистограммы задержек для внутренних метрик
+(LLM, БД, очереди). Хранятся в памяти процесса.
+"""
+from bisect import bisect_left
+from collections import deque
+from typing import Dict, List, Optional
+
+# Границы корзин в миллисекундах
+DEFAULT_BUCKETS_MS = [5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000]
+
+
+class LatencyHistogram:
+    def __init__(self, buckets_ms: Optional[List[float]] = None, window: int = 500):
+        self.buckets_ms = buckets_ms or DEFAULT_BUCKETS_MS
+        self.counts = [0] * (len(self.buckets_ms) + 1)  # Последняя корзина - "больше максимума"
+        self.total = 0
+        self.sum_ms = 0.0
+        self.max_ms = 0.0
+        # Последние значения для точных перцентилей
+        self._recent = deque(maxlen=window)
+
+    def observe(self, seconds: float):
+        ms = seconds * 1000
+        self.counts[bisect_left(self.buckets_ms, ms)] += 1
+        self.total += 1
+        self.sum_ms += ms
+        self.max_ms = max(self.max_ms, ms)
+        self._recent.append(ms)
+
+    def percentile(self, p: float) -> Optional[float]:
+        """Перцентиль (в мс) по последним наблюдениям"""
+        if not self._recent:
+            return None
+        values = sorted(self._recent)
+        index = min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))
+        return values[index]
+
+    @property
+    def sample_count(self) -> int:
+        return len(self._recent)
+
+    def snapshot(self) -> Dict:
+        buckets = {}
+        for i, bound in enumerate(self.buckets_ms):
+            buckets[f"le_{bound:g}ms"] = self.counts[i]
+        buckets["inf"] = self.counts[-1]
+
+        return {
+            "count": self.total,
+            "avg_ms": self.sum_ms / self.total if self.total else 0.0,
+            "p50_ms": self.percentile(50) or 0.0,
+            "p95_ms": self.percentile(95) or 0.0,
+            "max_ms": self.max_ms,
+            "buckets": buckets,
+        }
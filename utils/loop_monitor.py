@@ -0,0 +1,63 @@
+"""
+Замер задержки event loop (loop lag).
+
+Фоновая задача засыпает на интервал и меряет, насколько позже она
+проснулась. Запаздывание - время, на которое синхронный код занял loop:
+столько же ждали все остальные апдейты. Долгие остановки логируются.
+"""
+import asyncio
+import logging
+import time
+from typing import Dict, Optional
+
+from utils.latency_stats import LatencyHistogram
+
+logger = logging.getLogger(__name__)
+
+SAMPLE_INTERVAL_SECONDS = 0.25
+STALL_THRESHOLD_SECONDS = 0.1
+STALL_LOG_THRESHOLD_SECONDS = 1.0
+
+
+class LoopLagMonitor:
+    def __init__(self, interval: float = SAMPLE_INTERVAL_SECONDS):
+        self.interval = interval
+        self.lag = LatencyHistogram()
+        self.stalls = 0
+        self.stalled_seconds = 0.0
+        self.last_lag_ms = 0.0
+        self._task: Optional[asyncio.Task] = None
+
+    async def _run(self):
+        while True:
+            expected = time.monotonic() + self.interval
+            await asyncio.sleep(self.interval)
+            lag = max(time.monotonic() - expected, 0.0)
+            self.lag.observe(lag)
+            self.last_lag_ms = lag * 1000
+            if lag >= STALL_THRESHOLD_SECONDS:
+                self.stalls += 1
+                self.stalled_seconds += lag
+                if lag >= STALL_LOG_THRESHOLD_SECONDS:
+                    logger.warning(f"[LOOP] Event loop blocked for {lag:.2f}s")
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    def get_stats(self) -> Dict:
+        return {
+            "lag": self.lag.snapshot(),
+            "last_lag_ms": self.last_lag_ms,
+            "stalls": self.stalls,
+            "stalled_seconds": self.stalled_seconds,
+        }
+
+
+loop_monitor = LoopLagMonitor()
@@ -6,6 +6,8 @@ from datetime import datetime, timedelta
 from typing import Optional
 import xlsxwriter
 
+from utils.cpu_offload import cpu_offload
+
 
 class MetricsExporter:
     """Экспортер метрик в Excel"""
@@ -239,6 +241,19 @@ class MetricsExporter:
     
     async def export_comprehensive_metrics(self, days: int = 30) -> bytes:
         """Экспортирует полные метрики в Excel"""
+        data = {
+            'metrics': await self.db.get_comprehensive_metrics(days),
+            'avg_rating': await self.db.get_average_user_rating(days),
+            'dau': await self.db.get_dau_metrics(days),
+            'performance': await self.db.get_metrics_summary(days),
+            'system': await self.db._get_latest_system_metrics(),
+            'quality': await self.db.get_quality_metrics_summary(days),
+            'interactions': await self._get_detailed_interactions(days),
+        }
+        # Сборка книги синхронная и долгая на больших периодах: вне event loop
+        return await cpu_offload.run(self._build_comprehensive_metrics, data, days, stage="excel_export")
+
+    def _build_comprehensive_metrics(self, data: dict, days: int) -> bytes:
         output = io.BytesIO()
         workbook = xlsxwriter.Workbook(output, {'in_memory': True})
         
@@ -246,25 +261,25 @@ class MetricsExporter:
         formats = self._create_formats(workbook)
         
         # 1. Сводный лист (Executive Dashboard)
-        await self._create_summary_sheet(workbook, formats, days)
+        self._create_summary_sheet(workbook, formats, days, data)
         
         # 2. Клиентские метрики
-        await self._create_client_metrics_sheet(workbook, formats, days)
+        self._create_client_metrics_sheet(workbook, formats, days, data)
         
         # 3. Технические метрики
-        await self._create_technical_metrics_sheet(workbook, formats, days)
+        self._create_technical_metrics_sheet(workbook, formats, days, data)
         
         # 4. Метрики качества
-        await self._create_quality_metrics_sheet(workbook, formats, days)
+        self._create_quality_metrics_sheet(workbook, formats, days, data)
         
         # 5. Детальные данные
-        await self._create_detailed_data_sheet(workbook, formats, days)
+        self._create_detailed_data_sheet(workbook, formats, days, data)
         
         workbook.close()
         output.seek(0)
         return output.read()
     
-    async def _create_summary_sheet(self, workbook, formats, days):
+    def _create_summary_sheet(self, workbook, formats, days, data):
         """Создает сводный лист - Executive Dashboard"""
         worksheet = workbook.add_worksheet('📊 Сводная панель')
         
@@ -289,8 +304,8 @@ class MetricsExporter:
         row += 2
         
         # Получаем данные
-        metrics = await self.db.get_comprehensive_metrics(days)
-        avg_rating = await self.db.get_average_user_rating(days)
+        metrics = data['metrics']
+        avg_rating = data['avg_rating']
         
         if not metrics:
             worksheet.write(row, 0, 'Нет данных за указанный период', formats['metric_label'])
@@ -511,7 +526,7 @@ class MetricsExporter:
         else:
             return '🔴 Требует внимания'
     
-    async def _create_client_metrics_sheet(self, workbook, formats, days):
+    def _create_client_metrics_sheet(self, workbook, formats, days, data):
         """Создает лист с клиентскими метриками"""
         worksheet = workbook.add_worksheet('👥 Клиенты')
         
@@ -522,7 +537,7 @@ class MetricsExporter:
         worksheet.set_row(0, 30)
         
         # DAU по дням
-        dau_data = await self.db.get_dau_metrics(days)
+        dau_data = data['dau']
         
         if dau_data:
             row = 2
@@ -568,7 +583,7 @@ class MetricsExporter:
                 chart.set_legend({'position': 'bottom'})
                 worksheet.insert_chart(row + 2, 0, chart)
     
-    async def _create_technical_metrics_sheet(self, workbook, formats, days):
+    def _create_technical_metrics_sheet(self, workbook, formats, days, data):
         """Создает лист с техническими метриками"""
         worksheet = workbook.add_worksheet('⚙️ Технические')
         
@@ -579,7 +594,7 @@ class MetricsExporter:
         worksheet.set_row(0, 30)
         
         # Метрики производительности
-        perf_data = await self.db.get_metrics_summary(days)
+        perf_data = data['performance']
         
         row = 2
         worksheet.merge_range(row, 0, row, 4,
@@ -612,7 +627,7 @@ class MetricsExporter:
                             formats['section_header'])
         row += 1
         
-        sys_metrics = await self.db._get_latest_system_metrics()
+        sys_metrics = data['system']
         
         if sys_metrics:
             headers = ['Дата', 'CPU %', 'Память %', 'Диск %', 'Активных сессий', 'Ошибок']
@@ -633,7 +648,7 @@ class MetricsExporter:
                 worksheet.write(row, 5, metric.get('error_count') or 0, formats['cell_number'])
                 row += 1
     
-    async def _create_quality_metrics_sheet(self, workbook, formats, days):
+    def _create_quality_metrics_sheet(self, workbook, formats, days, data):
         """Создает лист с метриками качества"""
         worksheet = workbook.add_worksheet('🎯 Качество')
         
@@ -643,7 +658,7 @@ class MetricsExporter:
                             formats['main_title'])
         worksheet.set_row(0, 30)
         
-        quality = await self.db.get_quality_metrics_summary(days)
+        quality = data['quality']
         
         row = 2
         worksheet.merge_range(row, 0, row, 2,
@@ -726,16 +741,8 @@ class MetricsExporter:
                 chart.set_size({'width': 500, 'height': 400})
                 worksheet.insert_chart(row + 2, 0, chart)
     
-    async def _create_detailed_data_sheet(self, workbook, formats, days):
-        """Создает лист с детальными данными - ТОЛЬКО валидные запросы (общие вопросы, поиск по коду/названию)"""
-        worksheet = workbook.add_worksheet('📋 Детали')
-        
-        # Заголовок
-        worksheet.merge_range(0, 0, 0, 5,
-                            f'ДЕТАЛЬНЫЕ ДАННЫЕ ЗА {days} ДНЕЙ',
-                            formats['main_title'])
-        worksheet.set_row(0, 30)
-        
+    async def _get_detailed_interactions(self, days):
+        """Валидные запросы за период (общие вопросы, поиск по коду/названию), до 1000"""
         start_date = datetime.now() - timedelta(days=days)
         
         # Получаем ТОЛЬКО валидные запросы (общие вопросы, поиск по коду, поиск по названию)
@@ -762,7 +769,19 @@ class MetricsExporter:
                 LIMIT 1000
             ''', (start_date,))
             
-            interactions = await cursor.fetchall()
+            return await cursor.fetchall()
+    
+    def _create_detailed_data_sheet(self, workbook, formats, days, data):
+        """Создает лист с детальными данными - ТОЛЬКО валидные запросы (общие вопросы, поиск по коду/названию)"""
+        worksheet = workbook.add_worksheet('📋 Детали')
+        
+        # Заголовок
+        worksheet.merge_range(0, 0, 0, 5,
+                            f'ДЕТАЛЬНЫЕ ДАННЫЕ ЗА {days} ДНЕЙ',
+                            formats['main_title'])
+        worksheet.set_row(0, 30)
+        
+        interactions = data['interactions']
         
         if not interactions:
             worksheet.write(2, 0, 'Нет данных за указанный период', formats['metric_label'])
@@ -838,6 +857,10 @@ class MetricsExporter:
     
     async def export_dau_report(self, days: int = 30) -> bytes:
         """Экспортирует отчет по DAU с улучшенным дизайном"""
+        dau_data = await self.db.get_dau_metrics(days)
+        return await cpu_offload.run(self._build_dau_report, dau_data, days, stage="excel_export")
+
+    def _build_dau_report(self, dau_data, days: int) -> bytes:
         output = io.BytesIO()
         workbook = xlsxwriter.Workbook(output, {'in_memory': True})
         
@@ -860,8 +883,6 @@ class MetricsExporter:
         worksheet.set_column('A:D', 22)
         
         # Данные
-        dau_data = await self.db.get_dau_metrics(days)
-        
         row += 1
         for data in dau_data:
             worksheet.write(row, 0, str(data.get('activity_date', '')), formats['cell_data'])
@@ -902,6 +923,13 @@ class MetricsExporter:
         Создает детальный отчет по времени активности пользователей.
         Анализирует причины запредельного времени сессий.
         """
+        data = {
+            'sessions': await self.db.get_detailed_session_report(days),
+            'session_metrics': await self.db.get_session_metrics(days),
+        }
+        return await cpu_offload.run(self._build_session_activity_report, data, days, stage="excel_export")
+
+    def _build_session_activity_report(self, data: dict, days: int) -> bytes:
         output = io.BytesIO()
         workbook = xlsxwriter.Workbook(output, {'in_memory': True})
         
@@ -909,25 +937,25 @@ class MetricsExporter:
         
         # === ЛИСТ 1: СВОДКА ===
         summary_sheet = workbook.add_worksheet('📊 Сводка')
-        await self._create_session_summary_sheet(summary_sheet, formats, days)
+        self._create_session_summary_sheet(summary_sheet, formats, days, data)
         
         # === ЛИСТ 2: ДЕТАЛЬНЫЕ СЕССИИ ===
         detail_sheet = workbook.add_worksheet('🔍 Детали сессий')
-        await self._create_session_detail_sheet(detail_sheet, formats, days)
+        self._create_session_detail_sheet(detail_sheet, formats, days, data)
         
         # === ЛИСТ 3: АНАЛИЗ ПРОБЛЕМ ===
         analysis_sheet = workbook.add_worksheet('⚠️ Анализ проблем')
-        await self._create_session_analysis_sheet(analysis_sheet, formats, days)
+        self._create_session_analysis_sheet(analysis_sheet, formats, days, data)
         
         # === ЛИСТ 4: РЕКОМЕНДАЦИИ ===
         recommendations_sheet = workbook.add_worksheet('💡 Рекомендации')
-        await self._create_recommendations_sheet(recommendations_sheet, formats, days)
+        self._create_recommendations_sheet(recommendations_sheet, formats, days, data)
         
         workbook.close()
         output.seek(0)
         return output.read()
     
-    async def _create_session_summary_sheet(self, worksheet, formats, days):
+    def _create_session_summary_sheet(self, worksheet, formats, days, data):
         """Создает сводный лист с общей статистикой по сессиям"""
         # Настройка колонок
         worksheet.set_column('A:A', 40)
@@ -950,8 +978,8 @@ class MetricsExporter:
         row += 2
         
         # Получаем данные
-        sessions_data = await self.db.get_detailed_session_report(days)
-        session_metrics = await self.db.get_session_metrics(days)
+        sessions_data = data['sessions']
+        session_metrics = data['session_metrics']
         
         if not sessions_data:
             worksheet.write(row, 0, 'Нет данных о сессиях за указанный период', formats['metric_label'])
@@ -1078,7 +1106,7 @@ class MetricsExporter:
         else:
             worksheet.write(row, 0, 'Нет длинных сессий для анализа', formats['metric_label'])
     
-    async def _create_session_detail_sheet(self, worksheet, formats, days):
+    def _create_session_detail_sheet(self, worksheet, formats, days, data):
         """Создает детальный лист с информацией по каждой сессии"""
         # Настройка колонок
         worksheet.set_column('A:A', 18)  # Дата/время
@@ -1106,7 +1134,7 @@ class MetricsExporter:
         row += 1
         
         # Получаем данные
-        sessions_data = await self.db.get_detailed_session_report(days)
+        sessions_data = data['sessions']
         
         if not sessions_data:
             worksheet.write(row, 0, 'Нет данных о сессиях', formats['metric_label'])
@@ -1186,7 +1214,7 @@ class MetricsExporter:
             
             row += 1
     
-    async def _create_session_analysis_sheet(self, worksheet, formats, days):
+    def _create_session_analysis_sheet(self, worksheet, formats, days, data):
         """Создает лист с анализом проблемных сессий"""
         # Настройка колонок
         worksheet.set_column('A:A', 25)
@@ -1206,7 +1234,7 @@ class MetricsExporter:
         row += 2
         
         # Получаем данные
-        sessions_data = await self.db.get_detailed_session_report(days)
+        sessions_data = data['sessions']
         
         # Фильтруем только длинные сессии (> 30 минут)
         long_sessions = [s for s in sessions_data if s.get('duration_minutes', 0) > 30]
@@ -1324,7 +1352,7 @@ class MetricsExporter:
             worksheet.write(row, 5, '\n'.join(actions), formats['cell_data'])
             row += 1
     
-    async def _create_recommendations_sheet(self, worksheet, formats, days):
+    def _create_recommendations_sheet(self, worksheet, formats, days, data):
         """Создает лист с рекомендациями"""
         # Настройка колонок
         worksheet.set_column('A:A', 60)
@@ -1340,7 +1368,7 @@ class MetricsExporter:
         row += 2
         
         # Получаем данные
-        sessions_data = await self.db.get_detailed_session_report(days)
+        sessions_data = data['sessions']
         
         # Анализируем данные для рекомендаций
         long_sessions = [s for s in sessions_data if s.get('duration_minutes', 0) > 30]
@@ -4,6 +4,11 @@ from datetime import datetime
 
 class PollExporter:
     async def export_polls_to_excel(self, polls_data):
+        # Сборка книги - синхронная и долгая на больших опросах: вне event loop
+        from utils.cpu_offload import cpu_offload
+        return await cpu_offload.run(self._build_workbook, polls_data, stage="excel_export")
+
+    def _build_workbook(self, polls_data) -> bytes:
         output = io.BytesIO()
         workbook = xlsxwriter.Workbook(output)
         
@@ -0,0 +1,68 @@
+"""
+Ограничители частоты для исходящих запросов к Telegram.
+
+TokenBucket - глобальный лимит (сообщений в секунду с запасом на всплеск),
+ChatRateLimiter - минимальный интервал между сообщениями в один чат.
+Оба поддерживают паузу по retry_after из ответа Telegram.
+"""
+import asyncio
+import time
+from typing import Dict
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float = None):
+        self.rate = rate  # токенов в секунду
+        self.capacity = capacity if capacity is not None else rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._blocked_until = 0.0
+        self._lock = asyncio.Lock()
+        self.waited_seconds = 0.0
+
+    def _refill(self, now: float):
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    async def acquire(self):
+        """Ждет свободный токен (ожидающие обслуживаются по очереди)"""
+        started = time.monotonic()
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._blocked_until:
+                    await asyncio.sleep(self._blocked_until - now)
+                    continue
+                self._refill(now)
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    break
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+        self.waited_seconds += time.monotonic() - started
+
+    def pause(self, seconds: float):
+        """Не выдавать токены seconds секунд (retry_after / flood wait)"""
+        self._blocked_until = max(self._blocked_until, time.monotonic() + seconds)
+        self._tokens = 0
+
+
+class ChatRateLimiter:
+    """Минимальный интервал между отправками в один чат"""
+
+    def __init__(self, min_interval: float = 1.0):
+        self.min_interval = min_interval
+        self._next_allowed: Dict[int, float] = {}
+
+    async def wait(self, chat_id: int):
+        now = time.monotonic()
+        allowed = self._next_allowed.get(chat_id, 0.0)
+        # Резервируем слот до сна: параллельные отправки в тот же чат встают в очередь
+        slot = max(now, allowed)
+        self._next_allowed[chat_id] = slot + self.min_interval
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+    def pause(self, chat_id: int, seconds: float):
+        self._next_allowed[chat_id] = max(
+            self._next_allowed.get(chat_id, 0.0), time.monotonic() + seconds
+        )
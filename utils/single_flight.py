@@ -0,0 +1,95 @@
+"""
+Single-flight: одно вычисление на одинаковые одновременные запросы.
+
+Пока вычисление по ключу идет, повторные вызовы с тем же ключом не
+запускают его заново, а ждут общий результат (или общую ошибку).
+Ключ включает нормализованный запрос и версию каталога; после
+завершения ключ удаляется - это не кэш, устаревших результатов нет.
+
+Вычисление выполняется отдельной задачей: отмена одного из ждущих
+(например, пользователь отправил новый запрос) не отменяет его для
+остальных. Если ушли все ждущие, вычисление отменяется.
+
+Результат общий для всех ждущих: изменяемые результаты (списки)
+вызывающий код копирует перед изменением.
+"""
+import asyncio
+import re
+from collections import defaultdict
+from typing import Callable, Dict, Hashable
+
+_SPACES = re.compile(r'\s+')
+
+
+def query_key(text: str) -> str:
+    """Нормализованный текст запроса для ключа (регистр, пробелы, ё)"""
+    return _SPACES.sub(' ', (text or '').lower().replace('ё', 'е')).strip()
+
+
+class _Flight:
+    __slots__ = ('task', 'waiters')
+
+    def __init__(self, task: asyncio.Task):
+        self.task = task
+        self.waiters = 0
+
+
+class SingleFlight:
+    def __init__(self):
+        self._flights: Dict[Hashable, _Flight] = {}
+        self.leaders = defaultdict(int)  # Запущено вычислений по стадиям
+        self.coalesced = defaultdict(int)  # Присоединились к идущему вычислению
+        self.errors = defaultdict(int)
+
+    async def do(self, key: Hashable, func: Callable, *args, **kwargs):
+        """
+        Результат await func(*args, **kwargs), общий для одновременных
+        вызовов с одинаковым key. Первый элемент key - имя стадии (для статистики).
+        """
+        stage = key[0] if isinstance(key, tuple) else str(key)
+        flight = self._flights.get(key)
+        if flight is None:
+            flight = _Flight(asyncio.create_task(func(*args, **kwargs)))
+            self._flights[key] = flight
+            flight.task.add_done_callback(lambda task: self._finish(key, flight, stage))
+            self.leaders[stage] += 1
+        else:
+            self.coalesced[stage] += 1
+
+        flight.waiters += 1
+        try:
+            return await asyncio.shield(flight.task)
+        except asyncio.CancelledError:
+            if not flight.task.done() and flight.waiters == 1:
+                # Последний ждущий ушел - результат больше никому не нужен. Ключ
+                # убираем сразу: запрос, пришедший до завершения отмены, начнет
+                # новое вычисление, а не получит чужой CancelledError
+                if self._flights.get(key) is flight:
+                    del self._flights[key]
+                flight.task.cancel()
+            raise
+        finally:
+            flight.waiters -= 1
+
+    def _finish(self, key: Hashable, flight: _Flight, stage: str):
+        if self._flights.get(key) is flight:
+            del self._flights[key]
+        if not flight.task.cancelled() and flight.task.exception() is not None:
+            self.errors[stage] += 1
+
+    def get_stats(self) -> Dict:
+        leaders = sum(self.leaders.values())
+        coalesced = sum(self.coalesced.values())
+        total = leaders + coalesced
+        return {
+            "in_flight": len(self._flights),
+            "leaders": dict(self.leaders),
+            "coalesced": dict(self.coalesced),
+            "errors": dict(self.errors),
+            "total_leaders": leaders,
+            "total_coalesced": coalesced,
+            "coalesce_rate": coalesced / total if total else 0.0,
+        }
+
+
+single_flight = SingleFlight()
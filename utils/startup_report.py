@@ -0,0 +1,90 @@
+"""
+Отчет о времени импорта и памяти при запуске бота.
+
+Запуск отдельно: python -m utils.startup_report
+"""
+import importlib
+import sys
+import time
+from typing import Dict, List, Optional
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+# Тяжелые зависимости, которые не должны грузиться без необходимости
+HEAVY_MODULES = [
+    "torch",
+    "transformers",
+    "langchain_community",
+    "chromadb",
+    "openai",
+    "pandas",
+    "pymorphy3",
+]
+
+# Модули проекта в порядке, в котором их импортирует main.py
+PROJECT_MODULES = [
+    "models.models_init",
+    "models.vector_models_init",
+    "src.database.db_init",
+    "bot.handlers",
+]
+
+
+def get_peak_rss_mb() -> Optional[float]:
+    """Пиковый resident memory процесса в МБ (None, если модуля resource нет)"""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux отдает КБ, macOS - байты
+    if sys.platform == "darwin":
+        return peak / (1024 * 1024)
+    return peak / 1024
+
+
+def loaded_heavy_modules() -> List[str]:
+    return [name for name in HEAVY_MODULES if name in sys.modules]
+
+
+def build_startup_report(import_seconds: float) -> List[str]:
+    """Собирает строки отчета о холодном старте"""
+    peak_rss = get_peak_rss_mb()
+    lines = [
+        f"Import time: {import_seconds:.2f}s",
+        f"Peak RSS: {peak_rss:.1f} MB" if peak_rss is not None else "Peak RSS: unavailable",
+        f"Heavy modules loaded: {', '.join(loaded_heavy_modules()) or 'none'}",
+    ]
+
+    models_init = sys.modules.get("models.models_init")
+    if models_init is not None:
+        clients = models_init.loaded_chat_models()
+        lines.append(
+            f"Chat clients created: {len(clients)}/{len(models_init.CHAT_MODELS)}"
+            f" ({', '.join(clients) or 'none'})"
+        )
+
+    vector_models = sys.modules.get("models.vector_models_init")
+    if vector_models is not None:
+        lines.append(f"Embedding models created: {len(vector_models._models) > 0}")
+
+    return lines
+
+
+def measure_project_imports() -> Dict[str, float]:
+    """Последовательно импортирует модули проекта и замеряет время каждого"""
+    timings = {}
+    for module_name in PROJECT_MODULES:
+        started = time.perf_counter()
+        importlib.import_module(module_name)
+        timings[module_name] = time.perf_counter() - started
+    return timings
+
+
+if __name__ == "__main__":
+    timings = measure_project_imports()
+    for module_name, seconds in timings.items():
+        print(f"[IMPORT] {module_name}: {seconds:.2f}s")
+    for line in build_startup_report(sum(timings.values())):
+        print(f"[IMPORT] {line}")